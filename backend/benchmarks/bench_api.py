@@ -0,0 +1,311 @@
+"""
+Latency and throughput benchmark for every route in app.py.
+
+Seeds a synthetic population, then drives each route with concurrent clients and prints one JSON
+document with throughput, p50/p95/p99 latency, queries per request and peak RSS per route.
+
+    python benchmarks/bench_api.py --sessions 100000 --threads 8 --seconds 3 --save run.json
+    python benchmarks/bench_api.py --sessions 100000 --compare run.json --tolerance 20
+    python benchmarks/bench_api.py --http ...        # through a real HTTP server in this process
+    python benchmarks/bench_api.py --url http://host:3000 --no-seed ...  # against a running server
+
+Point DATABASE_URL at the database to use; without it a throwaway SQLite file is created.
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from urllib.parse import urlencode, urlsplit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+os.environ.setdefault('DATABASE_URL', f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}")
+from sqlalchemy import event, func, insert, literal, select  # noqa: E402
+from app import app, db  # noqa: E402
+from hashing import hasher  # noqa: E402
+from leaderboard import board  # noqa: E402
+from models import User, Profile, GameStats, GameSession  # noqa: E402
+
+PASSWORD = 'benchmark'
+SEED_CHUNK = 20000
+
+
+def seed(sessions, sessions_per_user=20):
+    """Creates users, profiles, sessions and matching GameStats with bulk inserts."""
+    users = max(sessions // sessions_per_user, 1)
+    password = hasher.hash(PASSWORD)
+    now = datetime.utcnow()
+    rng = random.Random(42)
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        for start in range(1, users + 1, SEED_CHUNK):
+            ids = range(start, min(start + SEED_CHUNK, users + 1))
+            db.session.execute(insert(User), [
+                {'id': i, 'email': f'user{i}@bench.test', 'password': password, 'is_active': True} for i in ids
+            ])
+            db.session.execute(insert(Profile), [
+                {'id': i, 'display_name': f'Player {i}', 'created_at': now, 'updated_at': now} for i in ids
+            ])
+        for start in range(0, sessions, SEED_CHUNK):
+            db.session.execute(insert(GameSession), [
+                {
+                    'user_id': rng.randint(1, users),
+                    'score': rng.randint(0, 5000),
+                    'level_reached': rng.randint(1, 5),
+                    'zombies_defeated': rng.randint(0, 200),
+                    'duration_seconds': rng.randint(30, 900),
+                    'completed_at': now - timedelta(seconds=rng.randint(0, 90 * 86400)),
+                }
+                for _ in range(start, min(start + SEED_CHUNK, sessions))
+            ])
+        db.session.commit()
+        db.session.execute(insert(GameStats.__table__).from_select(
+            ['user_id', 'total_games', 'high_score', 'total_score', 'levels_completed', 'zombies_defeated',
+             'created_at', 'updated_at'],
+            select(User.id, func.count(GameSession.id), func.coalesce(func.max(GameSession.score), 0),
+                   func.coalesce(func.sum(GameSession.score), 0),
+                   func.coalesce(func.max(GameSession.level_reached), 0),
+                   func.coalesce(func.sum(GameSession.zombies_defeated), 0),
+                   literal(now), literal(now))
+            .outerjoin(GameSession, GameSession.user_id == User.id)
+            .group_by(User.id)
+        ))
+        db.session.commit()
+    return users
+
+
+def population():
+    with app.app_context():
+        users = db.session.scalar(select(func.count(User.id)))
+        max_session = db.session.scalar(select(func.max(GameSession.id))) or 1
+    return users, max_session
+
+
+def scenarios(users, max_session, token_for):
+    """(name, method, path, body, headers) factories, one per route."""
+    def user():
+        return random.randint(1, users)
+
+    def session():
+        return random.randint(1, max_session)
+
+    def auth(uid):
+        return {'Authorization': f'Bearer {token_for(uid)}'}
+
+    counter = iter(range(10 ** 9))
+    return {
+        'GET /': lambda: ('GET', '/', None, {}),
+        'GET /user': lambda: ('GET', '/user', None, {}),
+        'POST /api/auth/register': lambda: ('POST', '/api/auth/register', {
+            'email': f'new{os.getpid()}-{next(counter)}-{random.random()}@bench.test',
+            'name': 'New player', 'password': PASSWORD}, {}),
+        'POST /api/auth/login': lambda: ('POST', '/api/auth/login', {
+            'email': f'user{user()}@bench.test', 'password': PASSWORD}, {}),
+        'GET /api/auth/me': lambda: (lambda uid: ('GET', '/api/auth/me', None, auth(uid)))(user()),
+        'GET /api/players/<id>': lambda: ('GET', f'/api/players/{user()}', None, {}),
+        'PUT /profiles/<id>': lambda: (lambda uid: ('PUT', f'/profiles/{uid}', {
+            'display_name': f'Player {uid}'}, auth(uid)))(user()),
+        'GET /leaderboard': lambda: ('GET', '/leaderboard?' + urlencode({'offset': random.randint(0, 200)}), None, {}),
+        'GET /leaderboard/<id>': lambda: ('GET', f'/leaderboard/{user()}', None, {}),
+        'POST /sessions': lambda: ('POST', '/sessions', {
+            'user_id': user(), 'score': random.randint(0, 5000), 'level_reached': random.randint(1, 5),
+            'zombies_defeated': random.randint(0, 200), 'duration_seconds': 120}, {}),
+        'POST /sessions/batch': lambda: ('POST', '/sessions/batch', [
+            {'user_id': user(), 'score': random.randint(0, 5000)} for _ in range(50)], {}),
+        'GET /sessions': lambda: ('GET', '/sessions?' + urlencode({'limit': 100, 'cursor': session()}), None, {}),
+        'GET /sessions?user_id': lambda: ('GET', '/sessions?' + urlencode({'user_id': user()}), None, {}),
+        'GET /sessions/<id>': lambda: ('GET', f'/sessions/{session()}', None, {}),
+        'PUT /sessions/<id>': lambda: ('PUT', f'/sessions/{session()}', {'duration_seconds': 60}, {}),
+        'DELETE /sessions/<id>': lambda: ('DELETE', f'/sessions/{session()}', None, {}),
+        'GET /stats/<id>': lambda: ('GET', f'/stats/{user()}', None, {}),
+        'GET /stats/lag': lambda: ('GET', '/stats/lag', None, {}),
+    }
+
+
+class InProcessClient:
+    def __init__(self):
+        self.client = app.test_client()
+
+    def request(self, method, path, body, headers):
+        return self.client.open(path, method=method, json=body, headers=headers).status_code
+
+
+class HTTPClient:
+    def __init__(self, base_url):
+        parts = urlsplit(base_url)
+        self.conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=30)
+        self.prefix = parts.path.rstrip('/')
+
+    def request(self, method, path, body, headers):
+        payload = None
+        if body is not None:
+            payload = json.dumps(body)
+            headers = dict(headers, **{'Content-Type': 'application/json'})
+        self.conn.request(method, self.prefix + path, body=payload, headers=headers)
+        response = self.conn.getresponse()
+        response.read()
+        return response.status
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * pct / 100))]
+
+
+def drive(name, make_request, make_client, threads, seconds):
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+    stop = threading.Event()
+
+    def worker():
+        client = make_client()
+        local, local_statuses = [], {}
+        while not stop.is_set():
+            method, path, body, headers = make_request()
+            started = time.perf_counter()
+            status = client.request(method, path, body, headers)
+            local.append(time.perf_counter() - started)
+            local_statuses[status] = local_statuses.get(status, 0) + 1
+        with lock:
+            latencies.extend(local)
+            for status, count in local_statuses.items():
+                statuses[status] = statuses.get(status, 0) + count
+
+    queries = [0]
+
+    def count(*args):
+        queries[0] += 1
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', count)
+    pool = [threading.Thread(target=worker) for _ in range(threads)]
+    started = time.perf_counter()
+    for t in pool:
+        t.start()
+    time.sleep(seconds)
+    stop.set()
+    for t in pool:
+        t.join()
+    elapsed = time.perf_counter() - started
+    event.remove(engine, 'before_cursor_execute', count)
+
+    latencies.sort()
+    ms = lambda v: round(v * 1000, 3) if v is not None else None  # noqa: E731
+    return {
+        'route': name,
+        'requests': len(latencies),
+        'throughput_rps': round(len(latencies) / elapsed, 1),
+        'p50_ms': ms(percentile(latencies, 50)),
+        'p95_ms': ms(percentile(latencies, 95)),
+        'p99_ms': ms(percentile(latencies, 99)),
+        'queries_per_request': round(queries[0] / len(latencies), 2) if latencies else None,
+        'statuses': {str(k): v for k, v in sorted(statuses.items())},
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def serve_in_background():
+    from werkzeug.serving import make_server
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_port}'
+
+
+def compare(results, baseline, tolerance):
+    """Lists routes whose p95 rose or throughput fell by more than `tolerance` percent."""
+    before = {r['route']: r for r in baseline['routes']}
+    regressions = []
+    for current in results['routes']:
+        old = before.get(current['route'])
+        if not old or not old['requests'] or not current['requests']:
+            continue
+        if current['p95_ms'] > old['p95_ms'] * (1 + tolerance / 100):
+            regressions.append({'route': current['route'], 'metric': 'p95_ms',
+                                'baseline': old['p95_ms'], 'current': current['p95_ms']})
+        if current['throughput_rps'] < old['throughput_rps'] * (1 - tolerance / 100):
+            regressions.append({'route': current['route'], 'metric': 'throughput_rps',
+                                'baseline': old['throughput_rps'], 'current': current['throughput_rps']})
+    return regressions
+
+
+def run(args):
+    if args.seed:
+        seed(args.sessions, args.sessions_per_user)
+    users, max_session = population()
+    board.reset()
+
+    tokens = {}
+
+    def token_for(uid):
+        if uid not in tokens:
+            with app.app_context():
+                from flask_jwt_extended import create_access_token
+                tokens[uid] = create_access_token(identity=str(uid))
+        return tokens[uid]
+
+    server = None
+    if args.url:
+        make_client = lambda: HTTPClient(args.url)  # noqa: E731
+    elif args.http:
+        server, url = serve_in_background()
+        make_client = lambda: HTTPClient(url)  # noqa: E731
+    else:
+        make_client = InProcessClient
+
+    routes = scenarios(users, max_session, token_for)
+    selected = [r for r in routes if not args.routes or any(p in r for p in args.routes)]
+    results = {
+        'mode': 'external' if args.url else 'http' if args.http else 'in-process',
+        'database': app.config['SQLALCHEMY_DATABASE_URI'].split('@')[-1],
+        'users': users,
+        'sessions': max_session,
+        'threads': args.threads,
+        'seconds_per_route': args.seconds,
+        'routes': [drive(name, routes[name], make_client, args.threads, args.seconds) for name in selected],
+    }
+    if server is not None:
+        server.shutdown()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sessions', type=int, default=10000, help='sessions to seed (10k to 10M)')
+    parser.add_argument('--sessions-per-user', type=int, default=20)
+    parser.add_argument('--no-seed', dest='seed', action='store_false', help='reuse the existing data')
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=3)
+    parser.add_argument('--routes', nargs='*', help='only routes containing one of these strings')
+    parser.add_argument('--http', action='store_true', help='go through a local HTTP server')
+    parser.add_argument('--url', help='benchmark an already running server')
+    parser.add_argument('--save', help='write the results to this file')
+    parser.add_argument('--compare', help='baseline results to compare against')
+    parser.add_argument('--tolerance', type=float, default=20, help='allowed regression in percent')
+    args = parser.parse_args(argv)
+
+    results = run(args)
+    status = 0
+    if args.compare:
+        with open(args.compare) as f:
+            results['regressions'] = compare(results, json.load(f), args.tolerance)
+        status = 1 if results['regressions'] else 0
+    output = json.dumps(results, indent=2)
+    if args.save:
+        with open(args.save, 'w') as f:
+            f.write(output)
+    print(output)
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,116 @@
+"""
+Fan-out cost of GET /leaderboard/stream on the ASGI app's feed.
+
+Connects --subscribers clients to one process's feed, then plays --rounds bursts of --writes score
+changes each. Reports the memory held per connected client, how many frames and database reads
+each burst cost, and how long the slowest client waited for the diff after the burst.
+
+    python benchmarks/bench_feed.py --subscribers 5000 --rounds 5
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+os.environ.setdefault('DATABASE_URL', f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}")
+from sqlalchemy import event, insert, update  # noqa: E402
+from sqlalchemy.engine import Engine  # noqa: E402
+from app import app, db  # noqa: E402
+from models import User, Profile, GameStats  # noqa: E402
+from cache import stats_changed  # noqa: E402
+import asgi  # noqa: E402
+
+
+def seed(players):
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        db.session.execute(insert(User), [{'id': n, 'email': f'u{n}@example.com', 'password': 'x', 'is_active': True}
+                                          for n in range(1, players + 1)])
+        db.session.execute(insert(Profile), [{'id': n, 'display_name': f'Player {n}'} for n in range(1, players + 1)])
+        db.session.execute(insert(GameStats), [{'user_id': n, 'high_score': n} for n in range(1, players + 1)])
+        db.session.commit()
+
+
+def burst(players, writes):
+    with app.app_context():
+        for _ in range(writes):
+            user_id = random.randint(1, players)
+            db.session.execute(update(GameStats).where(GameStats.user_id == user_id)
+                               .values(high_score=GameStats.high_score + random.randint(1, players)))
+            db.session.commit()
+            stats_changed([user_id])
+
+
+async def run(args):
+    config = asgi.load_config()
+    config['LEADERBOARD_FEED_INTERVAL'] = args.interval
+    fastapi_app = asgi.create_app(config)
+    feed = fastapi_app.state.leaderboard_feed
+    received = [0] * args.subscribers
+    arrived = asyncio.Condition()
+
+    async def client(i):
+        async for chunk in feed.subscribe():
+            received[i] += chunk.count(b'\nevent: ')
+            async with arrived:
+                arrived.notify_all()
+
+    # The first subscriber makes the initial read; measure the ones after it
+    tasks = [asyncio.create_task(client(0))]
+    while not received[0]:
+        await asyncio.sleep(0.01)
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    tasks += [asyncio.create_task(client(i)) for i in range(1, args.subscribers)]
+    while not all(received):
+        await asyncio.sleep(0.01)
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f'{args.subscribers:,} subscribers: {(after - before) / (args.subscribers - 1):,.0f} bytes each, '
+          f'stream generator and client task included')
+
+    reads = []
+    listener = lambda conn, cursor, statement, *rest: reads.append(statement)  # noqa: E731
+    event.listen(Engine, 'before_cursor_execute', listener)
+    try:
+        for round_ in range(args.rounds):
+            seen = sum(received)
+            reads.clear()
+            await asyncio.to_thread(burst, args.players, args.writes)
+            start = time.perf_counter()
+            async with arrived:
+                await arrived.wait_for(lambda: sum(received) >= seen + args.subscribers)
+            waited = time.perf_counter() - start
+            await asyncio.sleep(args.interval * 2)
+            frames = (sum(received) - seen) / args.subscribers
+            print(f'round {round_ + 1}: {args.writes} writes -> {frames:.0f} frame(s), '
+                  f'{sum(1 for s in reads if s.lstrip().upper().startswith("SELECT"))} feed read(s), '
+                  f'last client {waited * 1000:.0f} ms after the burst')
+    finally:
+        event.remove(Engine, 'before_cursor_execute', listener)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await feed.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--subscribers', type=int, default=2000, help='Clients connected to the feed.')
+    parser.add_argument('--players', type=int, default=1000, help='Players seeded.')
+    parser.add_argument('--writes', type=int, default=50, help='Score changes per burst.')
+    parser.add_argument('--rounds', type=int, default=3, help='Bursts played.')
+    parser.add_argument('--interval', type=float, default=0.5, help='LEADERBOARD_FEED_INTERVAL in seconds.')
+    args = parser.parse_args()
+    seed(args.players)
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
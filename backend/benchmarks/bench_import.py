@@ -0,0 +1,78 @@
+"""
+`flask data import` throughput on a fresh SQLite database, with and without --defer-indexes.
+
+A CSV of --sessions random sessions for --players players is written once; each mode then loads
+it in a fresh interpreter on a fresh database. Sessions per second over the whole load (parsing,
+inserting, rollups, index and stats rebuilds) are printed as JSON.
+
+    python benchmarks/bench_import.py --sessions 1000000 --players 10000 --workers 3
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+import numpy as np
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+MODES = {'indexed': [], 'deferred': ['--defer-indexes']}
+
+PROBE = '''
+import json, sys, time
+from app import app, db
+from bulk import import_sessions, seed_players
+path, players, chunk = sys.argv[1], int(sys.argv[2]), int(sys.argv[3])
+workers = None if sys.argv[4] == '' else int(sys.argv[4])
+with app.app_context():
+    db.create_all()
+    seed_players(players, 'x')
+    loaded, began = 0, time.perf_counter()
+    for progress in import_sessions(path, 'csv', app.config, chunk=chunk, workers=workers,
+                                    defer_indexes=sys.argv[5] == '1'):
+        loaded = progress.get('loaded', loaded)
+    elapsed = time.perf_counter() - began
+print(json.dumps({'sessions_per_s': round(loaded / elapsed), 'loaded': loaded, 'seconds': round(elapsed, 2)}))
+'''
+
+
+def write_csv(path, sessions, players):
+    rng = np.random.default_rng(0)
+    completed = np.datetime64('2026-01-01T00:00:00') - rng.integers(0, 90 * 86400, sessions).astype('timedelta64[s]')
+    columns = [rng.integers(1, players + 1, sessions), rng.integers(0, 50000, sessions),
+               rng.integers(1, 10, sessions), rng.integers(0, 500, sessions), rng.integers(30, 1800, sessions)]
+    with open(path, 'w') as out:
+        out.write('user_id,score,level_reached,zombies_defeated,duration_seconds,completed_at\n')
+        for start in range(0, sessions, 100000):
+            rows = zip(*(column[start:start + 100000].astype(str) for column in columns),
+                       np.datetime_as_string(completed[start:start + 100000]))
+            out.writelines(','.join(row) + '\n' for row in rows)
+
+
+def measure(mode, path, args):
+    db_path = os.path.join(tempfile.mkdtemp(), f'{mode}.db')
+    env = dict(os.environ, DATABASE_URL=f'sqlite:///{db_path}', CACHE_BACKEND='none', METRICS_ENABLED='0',
+               HASH_METHOD='pbkdf2:sha256:1')
+    env.pop('FLASK_RUN_FROM_CLI', None)
+    workers = '' if args.workers is None else str(args.workers)
+    out = subprocess.run([sys.executable, '-c', PROBE, path, str(args.players), str(args.chunk), workers,
+                          '1' if MODES[mode] else '0'], cwd=SRC, env=env, check=True, capture_output=True, text=True)
+    return dict(json.loads(out.stdout.splitlines()[-1]), mode=mode)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sessions', type=int, default=500000, help='Sessions in the generated CSV.')
+    parser.add_argument('--players', type=int, default=5000, help='Players the sessions belong to.')
+    parser.add_argument('--chunk', type=int, default=50000, help='Lines per chunk and transaction.')
+    parser.add_argument('--workers', type=int, help='Parsing processes [default: CPUs - 1].')
+    args = parser.parse_args()
+    path = os.path.join(tempfile.mkdtemp(), 'sessions.csv')
+    write_csv(path, args.sessions, args.players)
+    results = [measure(mode, path, args) for mode in MODES]
+    print(json.dumps({'sessions': args.sessions, 'players': args.players, 'modes': results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
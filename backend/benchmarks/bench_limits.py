@@ -0,0 +1,79 @@
+"""
+Overhead of limits.py per request: the rate limit check (shared-memory token bucket, caller by
+address or by a JWT verified earlier) and an admission slot taken and returned.
+
+Each measurement runs --calls checks in each of --workers forked processes at once, all against
+one bucket file. Address checks alternate between a bucket every process shares and one of their
+own; JWT checks all share one identity's bucket.
+CPU and wall-clock microseconds per call are printed as JSON; with more workers than cores, the
+wall-clock figure also counts the time the others hold the CPU.
+
+    python benchmarks/bench_limits.py --workers 4 --calls 200000
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import jwt  # noqa: E402
+from limits import RateLimiter, AdmissionControl  # noqa: E402
+
+SECRET = 'bench-secret-of-at-least-32-bytes'
+
+
+def measure(name, args, path):
+    token = 'Bearer ' + jwt.encode({'sub': '7', 'exp': time.time() + 3600}, SECRET, algorithm='HS256')
+
+    def run(worker, start, out):
+        limiter = RateLimiter()
+        limiter.configure({'RATE_LIMITS': 'login_user=1e9/1', 'RATE_LIMIT_PATH': path, 'JWT_SECRET_KEY': SECRET})
+        control = AdmissionControl()
+        control.configure({'ADMISSION_LIMITS': 'login_user=64'})
+        address = f'10.0.0.{worker}'
+        if name == 'ip':
+            def call(n):
+                limiter.check('login_user', limiter.caller(None, address if n % 2 else '10.0.0.255'))
+        elif name == 'jwt':
+            def call(n):
+                limiter.check('login_user', limiter.caller(token, address))
+        else:
+            def call(n):
+                rule = control.rule('login_user')
+                control.enter(rule)
+                control.leave(rule)
+        call(0)
+        start.wait()
+        began, cpu = time.perf_counter(), time.process_time()
+        for n in range(args.calls):
+            call(n)
+        out.put((time.perf_counter() - began, time.process_time() - cpu))
+
+    ctx = multiprocessing.get_context('fork')
+    start, out = ctx.Event(), ctx.Queue()
+    procs = [ctx.Process(target=run, args=(w, start, out)) for w in range(args.workers)]
+    for p in procs:
+        p.start()
+    start.set()
+    seconds = [out.get() for _ in procs]
+    for p in procs:
+        p.join()
+    return {'check': name, 'cpu_us_per_call': round(sum(cpu for _, cpu in seconds) / len(seconds) / args.calls * 1e6, 2),
+            'wall_us_per_call': round(max(wall for wall, _ in seconds) / args.calls * 1e6, 2)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=4, help='Forked processes checking at once.')
+    parser.add_argument('--calls', type=int, default=200000, help='Checks per process.')
+    args = parser.parse_args()
+    path = os.path.join(tempfile.mkdtemp(), 'buckets')
+    results = [measure(name, args, path) for name in ('ip', 'jwt', 'admission')]
+    print(json.dumps({'workers': args.workers, 'cpus': os.cpu_count(), 'results': results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""
+Login throughput under concurrency, with hashing inline versus on the process pool.
+
+While `--threads` clients log in as fast as they can, one more thread keeps calling
+GET /leaderboard, so the output also shows how much the hashing starves other endpoints.
+
+    python benchmarks/bench_login.py --threads 16 --seconds 5 --workers 0 4
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+os.environ.setdefault('DATABASE_URL', f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}")
+from app import app, db  # noqa: E402
+from hashing import hasher  # noqa: E402
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def run(workers, threads, seconds, users):
+    app.config['HASH_WORKERS'] = workers
+    app.config['HASH_QUEUE_DEPTH'] = max(workers * 4, 1)
+    hasher.init_app(app)
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+    client = app.test_client()
+    for n in range(users):
+        client.post('/api/auth/register', json={'email': f'u{n}@example.com', 'name': f'u{n}', 'password': 'pw'})
+
+    stop = threading.Event()
+    logins, rejected, other = [], [], []
+
+    def login(n):
+        c = app.test_client()
+        while not stop.is_set():
+            started = time.perf_counter()
+            rv = c.post('/api/auth/login', json={'email': f'u{n % users}@example.com', 'password': 'pw'})
+            (rejected if rv.status_code == 503 else logins).append(time.perf_counter() - started)
+
+    def browse():
+        c = app.test_client()
+        while not stop.is_set():
+            started = time.perf_counter()
+            c.get('/leaderboard')
+            other.append(time.perf_counter() - started)
+
+    pool = [threading.Thread(target=login, args=(n,)) for n in range(threads)]
+    pool.append(threading.Thread(target=browse))
+    for t in pool:
+        t.start()
+    time.sleep(seconds)
+    stop.set()
+    for t in pool:
+        t.join()
+    hasher.shutdown()
+    return {
+        'hash_workers': workers,
+        'threads': threads,
+        'logins_per_sec': round(len(logins) / seconds, 1),
+        'login_p50_ms': round(percentile(logins, 50) * 1000, 2) if logins else None,
+        'login_p99_ms': round(percentile(logins, 99) * 1000, 2) if logins else None,
+        'rejected_503': len(rejected),
+        'leaderboard_p50_ms': round(statistics.median(other) * 1000, 2) if other else None,
+        'leaderboard_p99_ms': round(percentile(other, 99) * 1000, 2) if other else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, os.cpu_count() or 1])
+    args = parser.parse_args()
+    results = [run(w, args.threads, args.seconds, args.users) for w in args.workers]
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
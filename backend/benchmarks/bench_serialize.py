@@ -0,0 +1,128 @@
+"""
+Rows per second for the session listing and leaderboard serialization paths.
+
+Each path is timed end to end (fetch, build the response dicts, encode the JSON body), comparing
+the ORM serialize() path the endpoints used to take with the column-tuple encoders, once with
+orjson and once with the standard library fallback.
+
+    python benchmarks/bench_serialize.py --rows 100000 --repeat 5
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+os.environ.setdefault('DATABASE_URL', f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}")
+from sqlalchemy import insert, select  # noqa: E402
+from app import app, db  # noqa: E402
+from models import User, GameSession  # noqa: E402
+from leaderboard import BoardRow, BOARD_FIELDS  # noqa: E402
+from listing import SessionListing  # noqa: E402
+import serializers  # noqa: E402
+
+
+def seed(rows):
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        db.session.execute(insert(User), [{'email': f'u{n}@example.com', 'password': 'x', 'is_active': True}
+                                               for n in range(100)])
+        now = datetime.utcnow()
+        for start in range(0, rows, 10000):
+            db.session.execute(insert(GameSession), [
+                {'user_id': n % 100 + 1, 'score': n, 'level_reached': n % 5 + 1, 'zombies_defeated': n % 40,
+                 'duration_seconds': n % 600, 'completed_at': now}
+                for n in range(start, min(start + 10000, rows))
+            ])
+        db.session.commit()
+
+
+def orm_sessions():
+    sessions = db.session.scalars(select(GameSession).order_by(GameSession.id)).all()
+    body = json.dumps([s.serialize() for s in sessions])
+    db.session.expunge_all()
+    return len(sessions), body
+
+
+def tuple_sessions():
+    listing = SessionListing({})
+    rows = db.session.execute(listing.statement(None, None)).all()
+    return len(rows), serializers.dumps_bytes([listing.encode(row) for row in rows])
+
+
+def board_data(players):
+    values = [(f'Player {n}', n * 7 % 100000, n % 50, n % 5) for n in range(players)]
+    return [dict(zip(BOARD_FIELDS, v)) for v in values], [BoardRow(*v) for v in values]
+
+
+def dict_board(rows):
+    return len(rows), json.dumps([dict(row, rank=i + 1, user_id=i) for i, row in enumerate(rows)])
+
+
+def record_board(rows):
+    entries = []
+    for i, row in enumerate(rows):
+        entry = row.as_dict()
+        entry['rank'] = i + 1
+        entry['user_id'] = i
+        entries.append(entry)
+    return len(entries), serializers.dumps_bytes(entries)
+
+
+def measure(fn, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        count, _ = fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return count / best
+
+
+def memory(build):
+    tracemalloc.start()
+    kept = build()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del kept
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=50000, help='Sessions seeded and listed per run.')
+    parser.add_argument('--players', type=int, default=100000, help='Leaderboard rows encoded per run.')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per path; the fastest is reported.')
+    args = parser.parse_args()
+
+    seed(args.rows)
+    dicts, records = board_data(args.players)
+    fast = serializers.orjson
+    results = {}
+    with app.app_context():
+        results['sessions: orm serialize() + json'] = measure(orm_sessions, args.repeat)
+        if fast is not None:
+            results['sessions: tuples + encoder + orjson'] = measure(tuple_sessions, args.repeat)
+        serializers.orjson = None
+        results['sessions: tuples + encoder + stdlib'] = measure(tuple_sessions, args.repeat)
+        serializers.orjson = fast
+    results['leaderboard: dict rows + json'] = measure(lambda: dict_board(dicts), args.repeat)
+    if fast is not None:
+        results['leaderboard: records + orjson'] = measure(lambda: record_board(records), args.repeat)
+
+    baseline = {'sessions': results['sessions: orm serialize() + json'],
+                'leaderboard': results['leaderboard: dict rows + json']}
+    for name, rate in results.items():
+        print(f"{name:<40} {rate:>12,.0f} rows/s  {rate / baseline[name.split(':')[0]]:>5.2f}x")
+    values = [(f'Player {n}', n, n, n) for n in range(args.players)]
+    print(f"leaderboard rows in memory: dicts {memory(lambda: [dict(zip(BOARD_FIELDS, v)) for v in values]) / 2**20:.1f} MiB, "
+          f"records {memory(lambda: [BoardRow(*v) for v in values]) / 2**20:.1f} MiB")
+
+
+if __name__ == '__main__':
+    main()
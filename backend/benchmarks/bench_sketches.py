@@ -0,0 +1,71 @@
+"""
+Percentile of a score among --sessions games: an exact COUNT(*) over game_session against the
+score sketches of sketches.py, with the worst relative error of the sketch's quantiles.
+
+Scores are drawn log-normally over --levels levels into a SQLite file; the count runs with and
+without an index on score. Microseconds per lookup and per sketch update are printed as JSON.
+
+    python benchmarks/bench_sketches.py --sessions 1000000 --queries 200
+"""
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from collections import Counter
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from sketches import ScoreSketches  # noqa: E402
+
+
+def per_call(fn, args):
+    began = time.perf_counter()
+    for arg in args:
+        fn(arg)
+    return round((time.perf_counter() - began) / len(args) * 1e6, 2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sessions', type=int, default=1000000, help='Games in the table and the sketch.')
+    parser.add_argument('--levels', type=int, default=20, help='Levels the games are spread over.')
+    parser.add_argument('--queries', type=int, default=200, help='Percentile lookups timed per method.')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(1)
+    scores = rng.lognormal(7, 1.5, args.sessions).astype(np.int64)
+    levels = rng.integers(1, args.levels + 1, args.sessions)
+    probes = rng.choice(scores, args.queries).tolist()
+
+    conn = sqlite3.connect(os.path.join(tempfile.mkdtemp(), 'sessions.db'))
+    conn.execute('CREATE TABLE game_session (id INTEGER PRIMARY KEY, level_reached INTEGER, score INTEGER)')
+    conn.executemany('INSERT INTO game_session (level_reached, score) VALUES (?, ?)',
+                     zip(levels.tolist(), scores.tolist()))
+    conn.commit()
+
+    def count(score):
+        return conn.execute('SELECT count(*) FROM game_session WHERE score < ?', (score,)).fetchone()[0]
+
+    results = {'sessions': args.sessions, 'count_scan_us': per_call(count, probes)}
+    conn.execute('CREATE INDEX ix_game_session_score ON game_session (score)')
+    results['count_indexed_us'] = per_call(count, probes)
+
+    sketch = ScoreSketches()
+    sketch.apply(Counter(zip(levels.tolist(), sketch.buckets(scores).tolist())))
+    results['sketch_percentile_us'] = per_call(sketch.percentile, probes)
+    results['sketch_level_percentile_us'] = per_call(lambda score: sketch.percentile(score, level=1), probes)
+    qs = np.linspace(0, 1, 101)
+    results['sketch_quantiles_us'] = per_call(lambda _: sketch.quantiles(qs), range(args.queries))
+    results['sketch_update_us'] = per_call(lambda score: sketch.apply({(1, sketch.bucket(score)): 1}), probes)
+    _, estimates = sketch.quantiles(qs)
+    exact = np.quantile(scores, qs, method='lower')
+    results['max_relative_error'] = round(float(np.max(np.abs(np.array(estimates) - exact) / np.maximum(exact, 1))), 5)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
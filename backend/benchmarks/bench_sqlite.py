@@ -0,0 +1,92 @@
+"""
+Concurrent POST /sessions throughput on a SQLite file, with and without SQLITE_PRODUCTION.
+
+Each mode runs in a fresh interpreter on a fresh database: the app is imported once, then forked
+into --workers processes (as gunicorn --preload does) that each post --sessions games from
+--threads threads. Sessions per second, failed requests and the commits taken are printed as JSON.
+
+    python benchmarks/bench_sqlite.py --workers 4 --threads 8 --sessions 50
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+MODES = {'default': '0', 'production': '1'}
+
+PROBE = '''
+import json, multiprocessing, sys, threading, time
+from sqlalchemy import event
+from app import app, db
+workers, threads, sessions = map(int, sys.argv[1:4])
+with app.app_context():
+    db.create_all()
+client = app.test_client()
+uids = [client.post('/api/auth/register', json={'email': f'p{n}@example.com', 'name': f'P{n}', 'password': 'x'})
+        .get_json()['user']['id'] for n in range(50)]
+with app.app_context():
+    db.engine.dispose()
+
+def play(worker, statuses):
+    c = app.test_client()
+    for n in range(sessions):
+        try:
+            statuses.append(c.post('/sessions', json={'user_id': uids[(worker + n) % 50], 'score': n}).status_code)
+        except Exception:
+            statuses.append(500)
+
+def process(worker, start, out):
+    commits = []
+    with app.app_context():
+        event.listen(db.engine, 'commit', lambda conn: commits.append(1))
+    statuses = []
+    pool = [threading.Thread(target=play, args=(worker * threads + t, statuses)) for t in range(threads)]
+    start.wait()
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    out.put((sum(1 for s in statuses if s == 201), len(statuses), len(commits)))
+
+ctx = multiprocessing.get_context('fork')
+start, out = ctx.Event(), ctx.Queue()
+procs = [ctx.Process(target=process, args=(w, start, out)) for w in range(workers)]
+for p in procs:
+    p.start()
+began = time.perf_counter()
+start.set()
+done = [out.get() for _ in procs]
+elapsed = time.perf_counter() - began
+for p in procs:
+    p.join()
+ok = sum(d[0] for d in done)
+print(json.dumps({'sessions_per_s': round(ok / elapsed), 'ok': ok, 'failed': sum(d[1] for d in done) - ok,
+                  'commits': sum(d[2] for d in done), 'seconds': round(elapsed, 2)}))
+'''
+
+
+def measure(mode, args):
+    path = os.path.join(tempfile.mkdtemp(), f'{mode}.db')
+    env = dict(os.environ, DATABASE_URL=f'sqlite:///{path}', SQLITE_PRODUCTION=MODES[mode], CACHE_BACKEND='none',
+               METRICS_ENABLED='0', HASH_METHOD='pbkdf2:sha256:1')
+    env.pop('FLASK_RUN_FROM_CLI', None)
+    out = subprocess.run([sys.executable, '-c', PROBE, str(args.workers), str(args.threads), str(args.sessions)],
+                         cwd=SRC, env=env, check=True, capture_output=True, text=True)
+    return dict(json.loads(out.stdout.splitlines()[-1]), mode=mode)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=4, help='Forked worker processes.')
+    parser.add_argument('--threads', type=int, default=8, help='Posting threads per worker.')
+    parser.add_argument('--sessions', type=int, default=50, help='Sessions posted per thread.')
+    args = parser.parse_args()
+    results = [measure(mode, args) for mode in MODES]
+    print(json.dumps({'workers': args.workers, 'threads': args.threads, 'modes': results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""
+Cold start benchmark: time to import app.py and latency of the first requests to a fresh process.
+
+Every run happens in a new interpreter, once with the optional subsystems left lazy and once
+with EAGER_SUBSYSTEMS=admin,migrate,swagger, and the medians are printed as one JSON document.
+
+    python benchmarks/bench_startup.py --runs 7 --save startup.json
+    python benchmarks/bench_startup.py --compare startup.json --tolerance 25
+
+Point DATABASE_URL at the database to use; without it a throwaway SQLite file is created.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+MODES = {'lazy': '', 'eager': 'admin,migrate,swagger'}
+ROUTES = ('/user', '/leaderboard', '/sessions', '/admin/', '/swagger.json')
+
+PROBE = '''
+import json, sys, time
+start = time.perf_counter()
+from app import app
+imported = time.perf_counter()
+client = app.test_client()
+first, second = {}, {}
+for path in sys.argv[1:]:
+    for timings in (first, second):
+        t = time.perf_counter()
+        status = client.get(path).status_code
+        timings[path] = round((time.perf_counter() - t) * 1000, 2)
+        assert status < 500, (path, status)
+print(json.dumps({'import_ms': round((imported - start) * 1000, 2), 'first_ms': first, 'second_ms': second,
+                  'modules': len(sys.modules)}))
+'''
+
+SETUP = '''
+from app import app, db
+with app.app_context():
+    db.create_all()
+'''
+
+
+def python(code, env, args=()):
+    out = subprocess.run([sys.executable, '-c', code, *args], cwd=SRC, env=env, check=True,
+                         capture_output=True, text=True)
+    return out.stdout
+
+
+def measure(mode, runs, env):
+    env = dict(env, EAGER_SUBSYSTEMS=MODES[mode])
+    samples = [json.loads(python(PROBE, env, ROUTES)) for _ in range(runs)]
+    median = lambda values: round(statistics.median(values), 2)  # noqa: E731
+    return {
+        'mode': mode,
+        'import_ms': median(s['import_ms'] for s in samples),
+        'modules': samples[-1]['modules'],
+        'first_request_ms': {path: median(s['first_ms'][path] for s in samples) for path in ROUTES},
+        'warm_request_ms': {path: median(s['second_ms'][path] for s in samples) for path in ROUTES},
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Lists import and first-request timings that grew by more than `tolerance` percent."""
+    before = {m['mode']: m for m in baseline['modes']}
+    regressions = []
+    for current in results['modes']:
+        old = before.get(current['mode'])
+        if not old:
+            continue
+        pairs = [('import_ms', old['import_ms'], current['import_ms'])]
+        pairs += [(f'first_request_ms {path}', old['first_request_ms'].get(path), ms)
+                  for path, ms in current['first_request_ms'].items()]
+        for metric, was, now in pairs:
+            if was and now > was * (1 + tolerance / 100):
+                regressions.append({'mode': current['mode'], 'metric': metric, 'baseline': was, 'current': now})
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5, help='fresh processes per mode')
+    parser.add_argument('--modes', nargs='*', default=list(MODES), choices=list(MODES))
+    parser.add_argument('--save', help='write the results to this file')
+    parser.add_argument('--compare', help='baseline results to compare against')
+    parser.add_argument('--tolerance', type=float, default=25, help='allowed regression in percent')
+    args = parser.parse_args(argv)
+
+    env = dict(os.environ)
+    env.setdefault('DATABASE_URL', f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}")
+    python(SETUP, env)
+    results = {'runs': args.runs, 'modes': [measure(mode, args.runs, env) for mode in args.modes]}
+    status = 0
+    if args.compare:
+        with open(args.compare) as f:
+            results['regressions'] = compare(results, json.load(f), args.tolerance)
+        status = 1 if results['regressions'] else 0
+    output = json.dumps(results, indent=2)
+    if args.save:
+        with open(args.save, 'w') as f:
+            f.write(output)
+    print(output)
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
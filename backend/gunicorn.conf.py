@@ -0,0 +1,41 @@
+"""
+gunicorn settings, picked up from the working directory by the Procfile's `gunicorn wsgi`.
+
+With preload_app the master imports the app once and forks it into the workers, so modules,
+compiled encoders and anything listed in EAGER_SUBSYSTEMS are built once and shared
+copy-on-write. The collector stays off while preloading and what survived is frozen before
+each fork, so collections in the workers do not write to (and thereby copy) the shared pages.
+Set GUNICORN_PRELOAD=0 to import the app in each worker instead.
+
+Workers are threaded, so a long-lived request such as GET /leaderboard/stream holds one of a
+worker's GUNICORN_THREADS threads rather than the whole worker. Past LEADERBOARD_FEED_MAX_STREAMS
+(half the threads by default) the stream is refused and the frontend polls; serve large audiences
+from asgi.py instead.
+"""
+import gc
+import os
+
+preload_app = os.getenv('GUNICORN_PRELOAD', '1') == '1'
+# config.py reads the same variable to pick the response cache shared by the workers
+workers = max(int(os.getenv('WEB_CONCURRENCY', 1)), 1)
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.getenv('GUNICORN_THREADS', 8))
+
+if preload_app:
+    gc.disable()
+
+
+def pre_fork(server, worker):
+    if not preload_app:
+        return
+    from app import app
+    from models import db
+    # Connections opened while preloading would otherwise be shared by every worker
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose()
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    gc.enable()
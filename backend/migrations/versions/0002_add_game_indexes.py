@@ -0,0 +1,27 @@
+"""index game tables for the API's query shapes
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18 00:00:00
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '0002'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_game_session_user_id_completed_at', 'game_session', ['user_id', 'completed_at'])
+    op.create_index('ix_game_session_user_id_score', 'game_session', ['user_id', sa.text('score DESC')])
+    op.create_index('ix_game_stats_high_score', 'game_stats', [sa.text('high_score DESC'), 'user_id'])
+
+
+def downgrade():
+    op.drop_index('ix_game_stats_high_score', table_name='game_stats')
+    op.drop_index('ix_game_session_user_id_score', table_name='game_session')
+    op.drop_index('ix_game_session_user_id_completed_at', table_name='game_session')
@@ -0,0 +1,49 @@
+"""add hourly, daily and per-level rollups of game_session
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18 00:00:00
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+
+def counters():
+    return [
+        sa.Column('games', sa.BigInteger(), nullable=False, server_default='0'),
+        sa.Column('total_score', sa.BigInteger(), nullable=False, server_default='0'),
+        sa.Column('zombies_defeated', sa.BigInteger(), nullable=False, server_default='0'),
+        sa.Column('total_duration', sa.BigInteger(), nullable=False, server_default='0'),
+    ]
+
+
+def upgrade():
+    op.create_table(
+        'rollup_hourly',
+        sa.Column('bucket', sa.DateTime(), primary_key=True),
+        *counters()
+    )
+    op.create_table(
+        'rollup_daily',
+        sa.Column('bucket', sa.DateTime(), primary_key=True),
+        *counters()
+    )
+    op.create_table(
+        'rollup_level',
+        sa.Column('bucket', sa.DateTime(), primary_key=True),
+        sa.Column('level', sa.Integer(), primary_key=True),
+        *counters()
+    )
+
+
+def downgrade():
+    op.drop_table('rollup_level')
+    op.drop_table('rollup_daily')
+    op.drop_table('rollup_hourly')
@@ -0,0 +1,23 @@
+"""index game_session by (user_id, level_reached DESC) for levels_completed recovery
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18 00:00:00
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '0004'
+down_revision = '0003'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_game_session_user_id_level_reached', 'game_session', ['user_id', sa.text('level_reached DESC')])
+
+
+def downgrade():
+    op.drop_index('ix_game_session_user_id_level_reached', table_name='game_session')
@@ -0,0 +1,22 @@
+"""index game_session by completed_at for date-range filters
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-18 00:00:00
+"""
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '0005'
+down_revision = '0004'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_game_session_completed_at', 'game_session', ['completed_at'])
+
+
+def downgrade():
+    op.drop_index('ix_game_session_completed_at', table_name='game_session')
@@ -0,0 +1,32 @@
+"""add archived_stats, each player's share of the archived sessions
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-18 00:00:00
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '0006'
+down_revision = '0005'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'archived_stats',
+        sa.Column('user_id', sa.Integer(), sa.ForeignKey('user.id'), primary_key=True),
+        sa.Column('total_games', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('high_score', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('total_score', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('levels_completed', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('zombies_defeated', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('updated_at', sa.DateTime(), nullable=False),
+    )
+
+
+def downgrade():
+    op.drop_table('archived_stats')
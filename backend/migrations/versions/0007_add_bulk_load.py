@@ -0,0 +1,33 @@
+"""add bulk_load, the checkpoints of `flask data import`
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2026-10-18 00:00:00
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '0007'
+down_revision = '0006'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'bulk_load',
+        sa.Column('name', sa.String(500), primary_key=True),
+        sa.Column('bytes_read', sa.BigInteger(), nullable=False, server_default='0'),
+        sa.Column('lines_read', sa.BigInteger(), nullable=False, server_default='0'),
+        sa.Column('loaded', sa.BigInteger(), nullable=False, server_default='0'),
+        sa.Column('rejected', sa.BigInteger(), nullable=False, server_default='0'),
+        sa.Column('first_session_id', sa.BigInteger(), nullable=False, server_default='0'),
+        sa.Column('finished_at', sa.DateTime(), nullable=True),
+        sa.Column('updated_at', sa.DateTime(), nullable=False),
+    )
+
+
+def downgrade():
+    op.drop_table('bulk_load')
@@ -0,0 +1,33 @@
+"""add session_key, the Idempotency-Keys of POST /sessions
+
+Revision ID: 0008
+Revises: 0007
+Create Date: 2026-10-18 00:00:00
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '0008'
+down_revision = '0007'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'session_key',
+        sa.Column('user_id', sa.Integer(), sa.ForeignKey('user.id'), primary_key=True),
+        sa.Column('key', sa.String(255), primary_key=True),
+        sa.Column('session_id', sa.Integer(), nullable=False),
+        sa.Column('request_hash', sa.String(64), nullable=False),
+        sa.Column('response', sa.Text(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+    )
+    op.create_index('ix_session_key_created_at', 'session_key', ['created_at'])
+
+
+def downgrade():
+    op.drop_index('ix_session_key_created_at', table_name='session_key')
+    op.drop_table('session_key')
@@ -1,19 +1,60 @@
 import os
-from flask_admin import Admin
+import threading
+from flask import Flask
 from models import db, User, Profile, GameStats, GameSession
-from flask_admin.contrib.sqla import ModelView
+from sqlite_mode import sqlite_mode
+
+
+class LazyApp:
+    """WSGI app built by `factory` on its first request (or an explicit `load()`)."""
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.app = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        if self.app is None:
+            with self._lock:
+                if self.app is None:
+                    self.app = self.factory()
+        return self.app
+
+    def __call__(self, environ, start_response):
+        return self.load()(environ, start_response)
+
+
+def build_admin_app(app):
+    """
+    Flask-Admin on its own Flask app, mounted under /admin by app.py. Blueprints cannot be added
+    to `app` once it has served requests, so a separate app is what lets the admin load late.
+    It shares `app`'s config and database, through a pool of its own.
+    """
+    admin_app = Flask(__name__)
+    admin_app.config.update(app.config)
+    db.init_app(admin_app)
+    if sqlite_mode.enabled:
+        sqlite_mode.tune(admin_app)
+    setup_admin(admin_app, url='/')
+    return admin_app
+
+
+def setup_admin(app, url='/admin'):
+    from flask_admin import Admin
+    from admin_views import UserView, ProfileView, StatsView, SessionView, JobsView
 
-def setup_admin(app):
     app.secret_key = os.environ.get('FLASK_APP_KEY', 'sample key')
     app.config['FLASK_ADMIN_SWATCH'] = 'cerulean'
-    admin = Admin(app, name='4Geeks Admin', template_mode='bootstrap3')
+    admin = Admin(app, name='4Geeks Admin', url=url, template_mode='bootstrap3')
+
 
-    
-    # Add your models here, for example this is how we add a the User model to the admin
-    admin.add_view(ModelView(User, db.session))
-    admin.add_view(ModelView(Profile, db.session))
-    admin.add_view(ModelView(GameStats, db.session))
-    admin.add_view(ModelView(GameSession, db.session))
+    # Add your models here, for example this is how we add a the User model to the admin.
+    # The game tables grow large, so they use the keyset-paginated views of admin_views.py
+    admin.add_view(UserView(User, db.session))
+    admin.add_view(ProfileView(Profile, db.session))
+    admin.add_view(StatsView(GameStats, db.session))
+    admin.add_view(SessionView(GameSession, db.session))
+    admin.add_view(JobsView(name='Jobs', endpoint='jobs'))
 
     # You can duplicate that line to add mew models
-    # admin.add_view(ModelView(YourModelName, db.session))
\ No newline at end of file
+    # admin.add_view(ModelView(YourModelName, db.session))
@@ -0,0 +1,148 @@
+"""
+Flask-Admin views that stay fast on tables with millions of rows.
+
+Lists are read newest first with keyset pagination on the primary key (`?after=<id>`), so a page
+never scans the rows before it, and the exact COUNT(*) is replaced by the planner's estimate.
+Filters are limited to indexed columns, and related users are picked through AJAX lookups
+instead of a select holding every user. Long-running bulk changes are handed to `jobs`.
+
+Sessions are read-only here: a row changed behind the API's back would leave the stats, rollups,
+sketches, leaderboard and caches that the session endpoints keep in step with it out of date.
+Old sessions are deleted by the jobs page, which keeps them exact.
+"""
+from datetime import datetime
+from flask import flash, redirect, request, url_for
+from flask_admin import BaseView, expose
+from flask_admin.actions import action
+from flask_admin.contrib.sqla import ModelView
+from flask_admin.contrib.sqla.filters import (FilterEqual, IntEqualFilter, IntGreaterFilter, IntSmallerFilter,
+                                              DateTimeBetweenFilter)
+from sqlalchemy import select, func, text
+from models import db, User, Profile, GameStats, GameSession
+from jobs import jobs
+
+USER_LOOKUP = {'user': {'fields': ('email',), 'page_size': 10}}
+
+
+def estimated_rows(model):
+    """Approximate row count: pg_class statistics on PostgreSQL, the key range elsewhere."""
+    table = model.__table__
+    if db.session.get_bind().dialect.name == 'postgresql':
+        estimate = db.session.execute(text('SELECT reltuples::bigint FROM pg_class WHERE oid = CAST(:name AS regclass)'),
+                                      {'name': table.name}).scalar()
+        if estimate is not None and estimate >= 0:
+            return estimate
+    key = list(table.primary_key.columns)[0]
+    lo, hi = db.session.execute(select(func.min(key), func.max(key))).one()
+    return hi - lo + 1 if hi is not None else 0
+
+
+class KeysetModelView(ModelView):
+    list_template = 'admin/keyset_list.html'
+    page_size = 50
+    can_set_page_size = False
+    simple_list_pager = True
+    column_display_pk = True
+    column_sortable_list = ()
+    column_default_sort = None
+
+    def _key(self):
+        return list(self.model.__table__.primary_key.columns)[0]
+
+    def _after(self):
+        if request.endpoint and request.endpoint.endswith('.index_view'):
+            return request.args.get('after', type=int)
+        return None
+
+    def get_query(self):
+        key = self._key()
+        query = super().get_query()
+        after = self._after()
+        if after is not None:
+            query = query.filter(key < after)
+        return query.order_by(key.desc())
+
+    def get_list(self, page, sort_column, sort_desc, search, filters, execute=True, page_size=None):
+        # Pages are addressed by `after`, never by offset
+        return super().get_list(0, None, False, search, filters, execute, page_size)
+
+    def next_page_url(self, data):
+        args = request.args.to_dict()
+        args.pop('page', None)
+        args['after'] = getattr(data[-1], self._key().key)
+        return url_for('.index_view', **args)
+
+    def first_page_url(self):
+        args = request.args.to_dict()
+        args.pop('after', None)
+        args.pop('page', None)
+        return url_for('.index_view', **args)
+
+    def estimated_count(self):
+        return estimated_rows(self.model)
+
+
+class UserView(KeysetModelView):
+    column_list = ('id', 'email', 'is_active')
+    column_filters = (FilterEqual(User.email, 'Email'), IntEqualFilter(User.id, 'User id'))
+    form_excluded_columns = ('sessions', 'profile', 'stats')
+
+
+class ProfileView(KeysetModelView):
+    column_list = ('id', 'display_name', 'avatar_url', 'created_at', 'updated_at')
+    column_filters = (IntEqualFilter(Profile.id, 'User id'),)
+    form_ajax_refs = USER_LOOKUP
+
+
+class StatsView(KeysetModelView):
+    column_list = ('id', 'user_id', 'total_games', 'high_score', 'total_score', 'levels_completed',
+                   'zombies_defeated', 'updated_at')
+    column_filters = (IntEqualFilter(GameStats.user_id, 'User id'),
+                      IntGreaterFilter(GameStats.high_score, 'High score'))
+    form_ajax_refs = USER_LOOKUP
+
+    @action('recompute', 'Recompute from sessions', 'Recompute the selected stats rows from their sessions?')
+    def action_recompute(self, ids):
+        user_ids = db.session.scalars(select(GameStats.user_id).where(GameStats.id.in_([int(i) for i in ids]))).all()
+        job_id, _ = jobs.submit('recompute_stats', user_ids=sorted(user_ids))
+        flash(f'Recomputing {len(user_ids)} stats rows in background job {job_id}.')
+
+
+class SessionView(KeysetModelView):
+    can_create = False
+    can_edit = False
+    can_delete = False
+    column_list = ('id', 'user_id', 'score', 'level_reached', 'zombies_defeated', 'duration_seconds', 'completed_at')
+    column_filters = (
+        IntEqualFilter(GameSession.user_id, 'User id'),
+        DateTimeBetweenFilter(GameSession.completed_at, 'Completed'),
+        IntGreaterFilter(GameSession.score, 'Score'),
+        IntSmallerFilter(GameSession.score, 'Score'),
+    )
+
+
+class JobsView(BaseView):
+    """Starts the bulk jobs and lists recent ones with their progress."""
+
+    @expose('/')
+    def index(self):
+        recent = jobs.recent()
+        for job in recent:
+            job['updated'] = datetime.fromtimestamp(job['updated']).strftime('%Y-%m-%d %H:%M:%S')
+        return self.render('admin/jobs.html', jobs=recent)
+
+    @expose('/recompute-stats', methods=['POST'])
+    def recompute_stats(self):
+        job_id, _ = jobs.submit('recompute_stats')
+        flash(f'Recomputing every stats row in background job {job_id}.')
+        return redirect(url_for('.index'))
+
+    @expose('/delete-sessions', methods=['POST'])
+    def delete_sessions(self):
+        days = request.form.get('days', type=int)
+        if days is None or days < 1:
+            flash('Enter a number of days of at least 1.', 'error')
+            return redirect(url_for('.index'))
+        job_id, _ = jobs.submit('delete_sessions', days=days)
+        flash(f'Deleting sessions older than {days} days in background job {job_id}.')
+        return redirect(url_for('.index'))
@@ -1,213 +1,396 @@
 """
 This module takes care of starting the API Server, Loading the DB and Adding the endpoints
+
+`create_app` builds the Flask app; the module-level `app` is the one wsgi.py and the `flask`
+command use. Flask-Admin, Flask-Migrate and flask_swagger are only imported when first needed
+(their routes, or a `flask` command) unless EAGER_SUBSYSTEMS names them.
 """
 import os
-from flask import Flask, request, jsonify, url_for
-from flask_migrate import Migrate
-from flask_swagger import swagger
+from contextlib import nullcontext
+from flask import Flask, Response, request, jsonify, url_for, stream_with_context
+from werkzeug.middleware.dispatcher import DispatcherMiddleware
+from werkzeug.middleware.proxy_fix import ProxyFix
 from flask_cors import CORS
 from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity
-from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime
 from utils import APIException, generate_sitemap
-from admin import setup_admin
-from models import db, User, Profile, GameStats, GameSession
+from config import load_config
+from admin import LazyApp, build_admin_app
+from commands import setup_commands
+from models import db, User, Profile, GameStats
+from ingest import ingest_sessions, iter_ndjson, chunked
+from listing import SessionListing, MAX_LIMIT, EXPORT_FORMATS, export_body, stream_json_array, stream_ndjson
+from leaderboard import ensure_loaded, sync_stats
+from writebehind import write_behind
+from rollups import GlobalStats
+from cache import leaderboard_version, response_cache, stats_changed, profile_changed
+from hashing import HashingBusy, hasher
+from metrics import metrics
+from jobs import jobs
+from replicas import replicas, primary, read_from_primary
+from sqlite_mode import sqlite_mode
+import services
+from feed import SSE_HEADERS, leaderboard_feed
+from archive import archiver
+from limits import rate_limiter, admission
+from idempotency import session_keys
+from sketches import score_sketches, parse_quantiles
+from queries import (profile_statement, serialize_profile, player_statement, serialize_player,
+                     session_statement, stats_statement, high_score_statement, encode_session, encode_stats)
+from serializers import JSONProvider, dumps
+from simulator import session_validator
 #from models import Person
 
-app = Flask(__name__)
-app.url_map.strict_slashes = False
-
-db_url = os.getenv("DATABASE_URL")
-if db_url is not None:
-    app.config['SQLALCHEMY_DATABASE_URI'] = db_url.replace("postgres://", "postgresql://")
-else:
-    app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite:////tmp/test.db"
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['JWT_SECRET_KEY'] = os.getenv('JWT_SECRET_KEY', 'change-me')
-
-MIGRATE = Migrate(app, db)
-db.init_app(app)
-CORS(app)
-jwt = JWTManager(app)
-setup_admin(app)
-
-# Handle/serialize errors like a JSON object
-@app.errorhandler(APIException)
-def handle_invalid_usage(error):
-    return jsonify(error.to_dict()), error.status_code
-
-# generate sitemap with all your endpoints
-@app.route('/')
-def sitemap():
-    return generate_sitemap(app)
-
-@app.route('/user', methods=['GET'])
-def handle_hello():
-
-    response_body = {
-        "msg": "Hello, this is your GET /user response "
-    }
-
-    return jsonify(response_body), 200
-
-
-@app.post('/api/auth/register')
-def register_user():
-    data = request.get_json() or {}
-    email = data.get('email')
-    password = data.get('password')
-    name = data.get('name') or data.get('display_name')
-    if not email or not password or not name:
-        return jsonify({'msg': 'Missing fields'}), 400
-    if User.query.filter_by(email=email).first():
-        return jsonify({'msg': 'User already exists'}), 400
-    user = User(email=email, password=generate_password_hash(password), is_active=True)
-    db.session.add(user)
-    db.session.commit()
-    profile = Profile(id=user.id, display_name=name)
-    stats = GameStats(user_id=user.id)
-    db.session.add(profile)
-    db.session.add(stats)
-    db.session.commit()
-    token = create_access_token(identity=user.id)
-    return jsonify(token=token, user=user.serialize()), 201
-
-
-@app.post('/api/auth/login')
-def login_user():
-    data = request.get_json() or {}
-    email = data.get('email')
-    password = data.get('password')
-    user = User.query.filter_by(email=email).first()
-    if not user or not check_password_hash(user.password, password):
-        return jsonify({'msg': 'Invalid credentials'}), 401
-    token = create_access_token(identity=user.id)
-    return jsonify(token=token, user=user.serialize()), 200
-
-
-@app.get('/api/auth/me')
-@jwt_required()
-def get_profile():
-    user_id = get_jwt_identity()
-    user = User.query.get(user_id)
-    profile = Profile.query.filter_by(id=user_id).first()
-    if not user:
-        return jsonify({'msg': 'User not found'}), 404
-    data = user.serialize()
-    if profile:
-        data['display_name'] = profile.display_name
-    return jsonify(data)
-
-
-@app.put('/profiles/<int:user_id>')
-@jwt_required()
-def update_profile_api(user_id):
-    identity = get_jwt_identity()
-    if identity != user_id:
-        return jsonify({'msg': 'Unauthorized'}), 403
-    profile = Profile.query.filter_by(id=user_id).first()
-    if not profile:
-        return jsonify({'msg': 'Profile not found'}), 404
-    data = request.get_json() or {}
-    profile.display_name = data.get('display_name', profile.display_name)
-    profile.updated_at = datetime.utcnow()
-    db.session.commit()
-    return jsonify(profile.serialize())
-
-
-@app.get('/leaderboard')
-def leaderboard():
-    rows = (
-        db.session.query(Profile.display_name, GameStats.high_score,
-                        GameStats.total_games, GameStats.levels_completed)
-        .join(GameStats, GameStats.user_id == Profile.id)
-        .order_by(GameStats.high_score.desc())
-        .limit(20)
-        .all()
-    )
-    result = [
-        {
-            'display_name': r.display_name,
-            'high_score': r.high_score,
-            'total_games': r.total_games,
-            'levels_completed': r.levels_completed,
+def setup_migrate(app):
+    from flask_migrate import Migrate
+    Migrate(app, db)
+
+
+def create_app(config=None):
+    """Builds the app from the environment's settings, with `config` overriding them."""
+    app = Flask(__name__)
+    app.url_map.strict_slashes = False
+    app.json = JSONProvider(app)
+
+    app.config.update(load_config())
+    app.config.update(config or {})
+    eager = set(app.config['EAGER_SUBSYSTEMS'])
+
+    db.init_app(app)
+    replicas.init_app(app, db)
+    sqlite_mode.init_app(app)
+    # Migrations are only run through `flask db ...`
+    if 'migrate' in eager or os.environ.get('FLASK_RUN_FROM_CLI') == 'true':
+        setup_migrate(app)
+    CORS(app, expose_headers=['X-Next-Cursor', 'X-Read-Replica'])
+    jwt = JWTManager(app)
+    # Before any other hook, so a shed request costs as little as possible
+    rate_limiter.init_app(app)
+    admission.init_app(app)
+    admin = LazyApp(lambda: build_admin_app(app))
+    app.wsgi_app = DispatcherMiddleware(app.wsgi_app, {'/admin': admin})
+    if 'admin' in eager:
+        admin.load()
+    hops = app.config['PROXY_FIX_HOPS']
+    if hops:
+        # Outermost, so the rate limits and /admin see the client's address rather than the proxy's
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=hops, x_proto=hops, x_host=hops)
+    setup_commands(app)
+    write_behind.init_app(app)
+    response_cache.init_app(app)
+    hasher.init_app(app)
+    session_validator.init_app(app)
+    metrics.init_app(app, db)
+    jobs.init_app(app)
+    leaderboard_feed.init_app(app)
+    archiver.init_app(app)
+    session_keys.init_app(app)
+    score_sketches.init_app(app)
+
+    # Handle/serialize errors like a JSON object
+    @app.errorhandler(APIException)
+    def handle_invalid_usage(error):
+        return jsonify(error.to_dict()), error.status_code
+
+    @app.errorhandler(HashingBusy)
+    def handle_hashing_busy(error):
+        return jsonify({'msg': 'Server busy, retry shortly'}), 503, {'Retry-After': str(error.retry_after)}
+
+    # generate sitemap with all your endpoints
+    @app.route('/')
+    def sitemap():
+        return generate_sitemap(app)
+
+    spec = {}
+
+    def load_spec():
+        if not spec:
+            from flask_swagger import swagger
+            spec.update(swagger(app))
+        return spec
+
+    @app.get('/swagger.json')
+    def swagger_spec():
+        return jsonify(load_spec())
+
+    @app.route('/user', methods=['GET'])
+    def handle_hello():
+
+        response_body = {
+            "msg": "Hello, this is your GET /user response "
         }
-        for r in rows
-    ]
-    return jsonify(result)
-
-
-@app.post('/sessions')
-def create_session():
-    data = request.get_json() or {}
-    session = GameSession(
-        user_id=data['user_id'],
-        score=data.get('score', 0),
-        level_reached=data.get('level_reached', 1),
-        zombies_defeated=data.get('zombies_defeated', 0),
-        duration_seconds=data.get('duration_seconds', 0)
-    )
-    db.session.add(session)
-    stats = GameStats.query.filter_by(user_id=data['user_id']).first()
-    if stats:
-        stats.total_games += 1
-        stats.total_score += session.score
-        stats.high_score = max(stats.high_score, session.score)
-        stats.levels_completed = max(stats.levels_completed, session.level_reached)
-        stats.zombies_defeated += session.zombies_defeated
-        stats.updated_at = datetime.utcnow()
-    db.session.commit()
-    return jsonify(session.serialize()), 201
-
-
-@app.get('/sessions')
-def list_sessions():
-    user_id = request.args.get('user_id')
-    query = GameSession.query
-    if user_id:
-        query = query.filter_by(user_id=user_id)
-    sessions = query.all()
-    return jsonify([s.serialize() for s in sessions])
-
-
-@app.get('/sessions/<int:session_id>')
-def get_session(session_id):
-    session = GameSession.query.get(session_id)
-    if not session:
-        return jsonify({'msg': 'Not found'}), 404
-    return jsonify(session.serialize())
-
-
-@app.put('/sessions/<int:session_id>')
-def update_session(session_id):
-    session = GameSession.query.get(session_id)
-    if not session:
-        return jsonify({'msg': 'Not found'}), 404
-    data = request.get_json() or {}
-    session.score = data.get('score', session.score)
-    session.level_reached = data.get('level_reached', session.level_reached)
-    session.zombies_defeated = data.get('zombies_defeated', session.zombies_defeated)
-    session.duration_seconds = data.get('duration_seconds', session.duration_seconds)
-    db.session.commit()
-    return jsonify(session.serialize())
-
-
-@app.delete('/sessions/<int:session_id>')
-def delete_session(session_id):
-    session = GameSession.query.get(session_id)
-    if not session:
-        return jsonify({'msg': 'Not found'}), 404
-    db.session.delete(session)
-    db.session.commit()
-    return jsonify({'detail': 'Session deleted'})
-
-
-@app.get('/stats/<int:user_id>')
-def stats(user_id):
-    stats = GameStats.query.filter_by(user_id=user_id).first()
-    if not stats:
-        return jsonify({'msg': 'Not found'}), 404
-    return jsonify(stats.serialize())
+
+        return jsonify(response_body), 200
+
+
+    @app.post('/api/auth/register')
+    def register_user():
+        data = request.get_json() or {}
+        email = data.get('email')
+        password = data.get('password')
+        name = data.get('name') or data.get('display_name')
+        if not email or not password or not name:
+            return jsonify({'msg': 'Missing fields'}), 400
+        if User.query.filter_by(email=email).first():
+            return jsonify({'msg': 'User already exists'}), 400
+        user = User(email=email, password=hasher.hash(password), is_active=True)
+        db.session.add(user)
+        db.session.commit()
+        profile = Profile(id=user.id, display_name=name)
+        stats = GameStats(user_id=user.id)
+        db.session.add(profile)
+        db.session.add(stats)
+        db.session.commit()
+        sync_stats(stats, display_name=profile.display_name)
+        stats_changed([user.id])
+        token = create_access_token(identity=str(user.id))
+        return jsonify(token=token, user=user.serialize()), 201
+
+
+    @app.post('/api/auth/login')
+    def login_user():
+        data = request.get_json() or {}
+        email = data.get('email')
+        password = data.get('password')
+        user = User.query.filter_by(email=email).first()
+        if not user or not hasher.verify(user.password, password):
+            return jsonify({'msg': 'Invalid credentials'}), 401
+        if hasher.needs_rehash(user.password):
+            user.password = hasher.hash(password)
+            db.session.commit()
+        token = create_access_token(identity=str(user.id))
+        return jsonify(token=token, user=user.serialize()), 200
+
+
+    @app.get('/api/auth/me')
+    @jwt_required()
+    @primary
+    @response_cache.cached(lambda: [f'user:{get_jwt_identity()}'])
+    def get_profile():
+        row = db.session.execute(profile_statement(int(get_jwt_identity()))).first()
+        if not row:
+            return jsonify({'msg': 'User not found'}), 404
+        return jsonify(serialize_profile(row))
+
+
+    @app.get('/api/players/<int:user_id>')
+    @response_cache.cached(lambda user_id: [f'user:{user_id}', f'stats:{user_id}'])
+    def get_player(user_id):
+        limit = min(max(request.args.get('sessions', 5, type=int), 0), 50)
+        rows = db.session.execute(player_statement(user_id, limit)).all()
+        if not rows:
+            return jsonify({'msg': 'User not found'}), 404
+        return jsonify(serialize_player(rows))
+
+
+    @app.put('/profiles/<int:user_id>')
+    @jwt_required()
+    def update_profile_api(user_id):
+        identity = int(get_jwt_identity())
+        if identity != user_id:
+            return jsonify({'msg': 'Unauthorized'}), 403
+        profile = Profile.query.filter_by(id=user_id).first()
+        if not profile:
+            return jsonify({'msg': 'Profile not found'}), 404
+        data = request.get_json() or {}
+        profile.display_name = data.get('display_name', profile.display_name)
+        profile.updated_at = datetime.utcnow()
+        db.session.commit()
+        stats = GameStats.query.filter_by(user_id=user_id).first()
+        if stats:
+            sync_stats(stats, display_name=profile.display_name)
+        profile_changed(user_id)
+        return jsonify(profile.serialize())
+
+
+    def current_board():
+        board = ensure_loaded()
+        # Another worker wrote since: such a page must not outlive the tag version it would be stored under
+        if board.version != leaderboard_version.value():
+            response_cache.skip()
+        return board
+
+
+    @app.get('/leaderboard')
+    @response_cache.cached(lambda: ['leaderboard'])
+    def leaderboard():
+        limit = min(request.args.get('limit', 20, type=int), 100)
+        offset = max(request.args.get('offset', 0, type=int), 0)
+        return jsonify(current_board().page(offset, limit))
+
+
+    @app.get('/leaderboard/stream')
+    def leaderboard_stream():
+        if leaderboard_feed.full():
+            return jsonify({'msg': 'Too many streams, poll /leaderboard'}), 503, {'Retry-After': '60'}
+        return Response(leaderboard_feed.subscribe(request.headers.get('Last-Event-ID')),
+                        mimetype='text/event-stream', headers=SSE_HEADERS)
+
+
+    @app.get('/leaderboard/<int:user_id>')
+    @response_cache.cached(lambda user_id: ['leaderboard'])
+    def leaderboard_rank(user_id):
+        radius = min(max(request.args.get('radius', 5, type=int), 0), 50)
+        board = current_board()
+        rank, entries = board.around(user_id, radius)
+        if rank is None:
+            return jsonify({'msg': 'Not ranked'}), 404
+        return jsonify({'rank': rank, 'total': len(board), 'entries': entries})
+
+
+    def submit_session(data, record=None):
+        """(response body, status) for a POST /sessions body; `record` is called with a 201's body before the commit."""
+        if sqlite_mode.enabled:
+            return sqlite_mode.write(data, record)
+        return services.create_session(db.session, data, record)
+
+    @app.post('/sessions')
+    def create_session():
+        data = request.get_json() or {}
+        if 'user_id' not in data:
+            return jsonify({'msg': 'Missing user_id'}), 400
+        key = request.headers.get('Idempotency-Key')
+        try:
+            if key is None:
+                body, status = submit_session(data)
+                return jsonify(body), status
+            body, status, headers = session_keys.submit(data, key, lambda record: submit_session(data, record),
+                                                        timeout=app.config['IDEMPOTENCY_WAIT'])
+        except TimeoutError:
+            return jsonify({'msg': 'Server busy, retry shortly'}), 503
+        return jsonify(body), status, headers
+
+
+    @app.post('/sessions/batch')
+    def create_sessions_batch():
+        if request.mimetype == 'application/x-ndjson':
+            return create_sessions_stream()
+        data = request.get_json(silent=True)
+        items = data.get('sessions') if isinstance(data, dict) else data
+        if not isinstance(items, list):
+            return jsonify({'msg': 'Expected a list of sessions'}), 400
+        if len(items) > app.config['SESSION_BATCH_LIMIT']:
+            return jsonify({'msg': 'Too many sessions'}), 413
+        results = ingest_sessions(items)
+        created = sum(1 for r in results if r['status'] == 201)
+        status = 201 if created == len(results) else 207
+        return jsonify(created=created, failed=len(results) - created, results=results), status
+
+
+    def create_sessions_stream():
+        # One transaction per chunk so arbitrarily long uploads never sit in memory at once
+        size = app.config['SESSION_BATCH_CHUNK']
+
+        def generate():
+            start = 0
+            for chunk in chunked(iter_ndjson(request.stream), size):
+                for result in ingest_sessions(chunk, start):
+                    yield dumps(result) + '\n'
+                start += len(chunk)
+
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+    @app.get('/sessions')
+    def list_sessions():
+        listing = SessionListing(request.args)
+        stream = request.args.get('stream')
+        if stream in ('json', 'ndjson'):
+            if stream == 'ndjson':
+                body, mimetype = stream_ndjson(listing.scan()), 'application/x-ndjson'
+            else:
+                body, mimetype = stream_json_array(listing.scan()), 'application/json'
+            return Response(stream_with_context(body), mimetype=mimetype)
+        rows, next_cursor = listing.page()
+        response = jsonify(rows)
+        if next_cursor is not None:
+            response.headers['X-Next-Cursor'] = str(next_cursor)
+        return response
+
+
+    @app.get('/sessions/export')
+    def export_sessions():
+        fmt = request.args.get('format', 'ndjson')
+        if fmt not in EXPORT_FORMATS:
+            return jsonify({'msg': f"Invalid format, expected one of: {', '.join(EXPORT_FORMATS)}"}), 400
+        listing = SessionListing(dict(request.args.to_dict(), limit=MAX_LIMIT))
+        body = export_body(fmt, listing.fields, listing.export(archiver.archive))
+        return Response(stream_with_context(body), mimetype=EXPORT_FORMATS[fmt],
+                        headers={'Content-Disposition': f'attachment; filename=sessions.{fmt}'})
+
+
+    @app.get('/sessions/<int:session_id>')
+    def get_session(session_id):
+        row = db.session.execute(session_statement(session_id)).first()
+        if not row:
+            return jsonify({'msg': 'Not found'}), 404
+        return jsonify(encode_session(row))
+
+
+    @app.put('/sessions/<int:session_id>')
+    def update_session(session_id):
+        body, status = services.update_session(db.session, session_id, request.get_json() or {})
+        return jsonify(body), status
+
+
+    @app.delete('/sessions/<int:session_id>')
+    def delete_session(session_id):
+        body, status = services.delete_session(db.session, session_id)
+        return jsonify(body), status
+
+
+    @app.get('/stats/global')
+    def global_stats():
+        query = GlobalStats(request.args)
+        return jsonify(query.serialize(db.session.execute(query.statement()).all()))
+
+
+    @app.get('/stats/distribution')
+    def score_distribution():
+        try:
+            qs = parse_quantiles(request.args.get('q'))
+        except ValueError:
+            return jsonify({'msg': 'Invalid q'}), 400
+        score_sketches.ensure_loaded()
+        return jsonify(score_sketches.distribution(qs, request.args.get('level', type=int)))
+
+
+    @app.get('/stats/<int:user_id>/percentile')
+    def score_percentile(user_id):
+        high_score = db.session.scalar(high_score_statement(user_id))
+        if high_score is None:
+            return jsonify({'msg': 'Not found'}), 404
+        score_sketches.ensure_loaded()
+        return jsonify(dict(score_sketches.standing(high_score), user_id=user_id))
+
+
+    @app.get('/stats/<int:user_id>')
+    @response_cache.cached(lambda user_id: None if request.args.get('fresh') else [f'stats:{user_id}'])
+    def stats(user_id):
+        fresh = request.args.get('fresh', type=int)
+        stmt = stats_statement(user_id)
+        if fresh and write_behind.enabled:
+            stmt = stmt.add_columns(write_behind.applied_column())
+        with read_from_primary() if fresh else nullcontext():
+            row = db.session.execute(stmt).first()
+            if not row:
+                return jsonify({'msg': 'Not found'}), 404
+            data = encode_stats(row)
+            if fresh and write_behind.enabled:
+                data = write_behind.fold_pending(data, row[-1])
+        return jsonify(data)
+
+
+    @app.get('/stats/lag')
+    def stats_lag():
+        return jsonify(write_behind.lag())
+
+    if 'swagger' in eager:
+        load_spec()
+    return app
+
+
+app = create_app()
 
 # this only runs if `$ python src/app.py` is executed
 if __name__ == '__main__':
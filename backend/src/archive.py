@@ -0,0 +1,364 @@
+"""
+Cold storage for game_session: sessions completed more than ARCHIVE_AFTER_DAYS ago are moved out
+of the table into compressed columnar segments under ARCHIVE_PATH, partitioned by month.
+
+A segment holds one chunk of moved rows of one month (`2025-03/<first id>-<last id>.npz`) as a
+deflated int64 array per column, completed_at in microseconds since the epoch, so a reader only
+decompresses the columns it asks for. `manifest.json` lists the segments with the min and max of
+every column, and a scan skips the segments its predicates rule out before opening them.
+
+Moved sessions keep counting in GameStats and the rollups; archived_stats holds each player's
+share of them so the stats checks and the maxima lookups still add up. Archived sessions are
+read-only. GET /sessions/export and `flask export-sessions` read both tiers.
+"""
+import json
+import operator
+import os
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import numpy as np
+from sqlalchemy import select, delete
+from models import db, GameSession, ArchivedStats
+from cache import response_cache
+from writebehind import write_behind
+
+try:
+    import fcntl
+except ImportError:  # not on Windows; run one archiver per host there
+    fcntl = None
+
+COLUMNS = tuple(column.key for column in GameSession.__table__.columns)
+OPS = {'==': operator.eq, '<': operator.lt, '<=': operator.le, '>': operator.gt, '>=': operator.ge}
+MANIFEST = 'manifest.json'
+# Ids per DELETE, below SQLite's bound-parameter limit
+DELETE_BATCH = 10000
+
+
+def to_storage(column, value):
+    if column == 'completed_at':
+        return int(np.datetime64(value, 'us').astype(np.int64))
+    return int(value)
+
+
+def to_python(column, values):
+    if column == 'completed_at':
+        return values.astype('datetime64[us]').tolist()
+    return values.tolist()
+
+
+def columnar(rows):
+    """{column: int64 array} from game_session rows selected in COLUMNS order."""
+    arrays = {}
+    for i, column in enumerate(COLUMNS):
+        values = [row[i] for row in rows]
+        if column == 'completed_at':
+            arrays[column] = np.array(values, dtype='datetime64[us]').astype(np.int64)
+        else:
+            arrays[column] = np.array([value or 0 for value in values], dtype=np.int64)
+    return arrays
+
+
+def predicates(where):
+    """Checks (column, op, value) predicates and converts their values to stored ones."""
+    unknown = [column for column, _, _ in where if column not in COLUMNS]
+    if unknown:
+        raise ValueError(f"Unknown columns: {', '.join(unknown)}")
+    if any(op not in OPS for _, op, _ in where):
+        raise ValueError(f"Unknown operator, expected one of: {', '.join(OPS)}")
+    return [(column, op, to_storage(column, value)) for column, op, value in where]
+
+
+def may_match(segment, where):
+    """False when the segment's min/max rule out one of the (column, op, value) predicates."""
+    for column, op, value in where:
+        low, high = segment['min'][column], segment['max'][column]
+        if op == '==' and not low <= value <= high:
+            return False
+        if (op == '<' and low >= value) or (op == '<=' and low > value):
+            return False
+        if (op == '>' and high <= value) or (op == '>=' and high < value):
+            return False
+    return True
+
+
+class Archive:
+    """The segments under one directory: written by the archiver, scanned by readers."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def manifest(self):
+        try:
+            with open(os.path.join(self.path, MANIFEST)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {'segments': []}
+
+    def segments(self, where=()):
+        """The manifest entries of the segments that may hold rows matching `where`."""
+        where = predicates(where)
+        return [segment for segment in self.manifest()['segments'] if may_match(segment, where)]
+
+    def scan(self, columns=None, where=()):
+        """
+        Yields {column: array} per segment for the rows matching every (column, op, value) in
+        `where`, reading only `columns` (default all) and the predicates' columns.
+        """
+        columns = list(columns or COLUMNS)
+        unknown = [column for column in columns if column not in COLUMNS]
+        if unknown:
+            raise ValueError(f"Unknown columns: {', '.join(unknown)}")
+        segments = self.segments(where)
+        where = predicates(where)
+        for segment in segments:
+            with np.load(os.path.join(self.path, segment['file'])) as data:
+                loaded = {}
+                mask = None
+                for column, op, value in where:
+                    if column not in loaded:
+                        loaded[column] = data[column]
+                    matches = OPS[op](loaded[column], value)
+                    mask = matches if mask is None else mask & matches
+                if mask is not None and not mask.any():
+                    continue
+                batch = {}
+                for column in columns:
+                    values = loaded[column] if column in loaded else data[column]
+                    batch[column] = values if mask is None else values[mask]
+                yield batch
+
+    def batches(self, columns=None, where=()):
+        """Like `scan`, as a list of row tuples of Python values (datetimes for completed_at) per segment."""
+        columns = list(columns or COLUMNS)
+        for batch in self.scan(columns, where):
+            yield list(zip(*(to_python(column, batch[column]) for column in columns)))
+
+    def rows(self, columns=None, where=()):
+        for batch in self.batches(columns, where):
+            yield from batch
+
+    def write(self, arrays):
+        """Writes one segment per month of `arrays`; returns their manifest entries, not yet committed."""
+        months = arrays['completed_at'].astype('datetime64[us]').astype('datetime64[M]')
+        entries = []
+        for month in np.unique(months):
+            mask = months == month
+            part = {column: values[mask] for column, values in arrays.items()}
+            ids = part['id']
+            name = f'{month}/{int(ids.min()):012d}-{int(ids.max()):012d}.npz'
+            path = os.path.join(self.path, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + '.tmp', 'wb') as f:
+                np.savez_compressed(f, **part)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(path + '.tmp', path)
+            entries.append(self._entry(name, part))
+        return entries
+
+    def _entry(self, name, part):
+        return {'file': name, 'rows': int(len(part['id'])),
+                'min': {column: int(values.min()) for column, values in part.items()},
+                'max': {column: int(values.max()) for column, values in part.items()}}
+
+    def commit(self, entries):
+        manifest = self.manifest()
+        files = {entry['file'] for entry in entries}
+        segments = [s for s in manifest['segments'] if s['file'] not in files] + entries
+        manifest['segments'] = sorted(segments, key=lambda s: s['file'])
+        path = os.path.join(self.path, MANIFEST)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(manifest, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+
+    def recover(self):
+        """
+        Settles the segments a crashed run left out of the manifest: adopted when their rows are
+        gone from game_session (the move committed), removed when they are still there.
+        """
+        listed = {segment['file'] for segment in self.manifest()['segments']}
+        adopted = []
+        for month in sorted(os.listdir(self.path)):
+            directory = os.path.join(self.path, month)
+            if not os.path.isdir(directory):
+                continue
+            for file in sorted(os.listdir(directory)):
+                name = f'{month}/{file}'
+                path = os.path.join(directory, file)
+                if file.endswith('.tmp'):
+                    os.remove(path)
+                    continue
+                if name in listed:
+                    continue
+                with np.load(path) as data:
+                    part = {column: data[column] for column in COLUMNS}
+                moved = db.session.scalar(select(GameSession.id).where(GameSession.id == int(part['id'][0]))) is None
+                if moved:
+                    adopted.append(self._entry(name, part))
+                else:
+                    os.remove(path)
+        if adopted:
+            self.commit(adopted)
+        return len(adopted)
+
+
+def summarize(arrays):
+    """Per-player ArchivedStats deltas of `arrays`, as {user_id: {field: value}}."""
+    users, inverse = np.unique(arrays['user_id'], return_inverse=True)
+    high = np.zeros(len(users), dtype=np.int64)
+    levels = np.zeros(len(users), dtype=np.int64)
+    np.maximum.at(high, inverse, arrays['score'])
+    np.maximum.at(levels, inverse, arrays['level_reached'])
+    games = np.bincount(inverse, minlength=len(users))
+    total = np.bincount(inverse, weights=arrays['score'], minlength=len(users))
+    zombies = np.bincount(inverse, weights=arrays['zombies_defeated'], minlength=len(users))
+    return {int(user): {'total_games': int(games[i]), 'total_score': int(total[i]), 'high_score': int(high[i]),
+                        'levels_completed': int(levels[i]), 'zombies_defeated': int(zombies[i])}
+            for i, user in enumerate(users)}
+
+
+def add_archived_stats(deltas):
+    now = datetime.utcnow()
+    users = list(deltas)
+    for start in range(0, len(users), DELETE_BATCH):
+        batch = users[start:start + DELETE_BATCH]
+        stmt = select(ArchivedStats).where(ArchivedStats.user_id.in_(batch)).with_for_update()
+        existing = {row.user_id: row for row in db.session.scalars(stmt)}
+        for user_id in batch:
+            delta = deltas[user_id]
+            row = existing.get(user_id)
+            if row is None:
+                db.session.add(ArchivedStats(user_id=user_id, updated_at=now, **delta))
+                continue
+            row.total_games += delta['total_games']
+            row.total_score += delta['total_score']
+            row.zombies_defeated += delta['zombies_defeated']
+            row.high_score = max(row.high_score, delta['high_score'])
+            row.levels_completed = max(row.levels_completed, delta['levels_completed'])
+            row.updated_at = now
+
+
+def move_sessions(archive, days, chunk):
+    """
+    Moves the sessions completed more than `days` days ago into `archive`, oldest ids first,
+    yielding the running count. Each chunk's segments are written before the transaction that
+    deletes its rows and adds them to archived_stats, and listed in the manifest after it commits.
+    """
+    write_behind.flush()
+    archive.recover()
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    columns = [GameSession.__table__.c[column] for column in COLUMNS]
+    done = 0
+    while True:
+        stmt = select(*columns).where(GameSession.completed_at < cutoff).order_by(GameSession.id).limit(chunk)
+        rows = db.session.execute(stmt).all()
+        if not rows:
+            return
+        arrays = columnar(rows)
+        entries = archive.write(arrays)
+        deltas = summarize(arrays)
+        add_archived_stats(deltas)
+        ids = arrays['id'].tolist()
+        for start in range(0, len(ids), DELETE_BATCH):
+            db.session.execute(delete(GameSession).where(GameSession.id.in_(ids[start:start + DELETE_BATCH])))
+        db.session.commit()
+        archive.commit(entries)
+        # Stats are unchanged, but a player's recent sessions may not be
+        response_cache.invalidate(*(f'stats:{user_id}' for user_id in deltas))
+        done += len(rows)
+        yield done
+
+
+class SessionArchiver:
+    """The configured archive, and the thread per process that fills it every ARCHIVE_INTERVAL seconds."""
+
+    def __init__(self, app=None):
+        self.app = None
+        self.archive = None
+        self.after_days = 365
+        self.chunk = 50000
+        self.interval = 0.0
+        self._thread = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._lock_file = None
+        self._lock_pid = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        path = app.config.get('ARCHIVE_PATH')
+        self.archive = Archive(path) if path else None
+        self.after_days = app.config.get('ARCHIVE_AFTER_DAYS', 365)
+        self.chunk = app.config.get('ARCHIVE_CHUNK', 50000)
+        self.interval = app.config.get('ARCHIVE_INTERVAL', 0.0)
+        self._pid = None
+        self._lock_pid = None
+        if self.archive is not None:
+            os.makedirs(path, exist_ok=True)
+            if self.interval > 0:
+                app.before_request(self._ensure_started)
+
+    def run(self, days=None, chunk=None, wait=True):
+        """Moves old sessions into the archive, yielding the running count; nothing if another run holds the host lock."""
+        if self.archive is None:
+            raise RuntimeError('ARCHIVE_PATH is not set')
+        with self._host_lock(wait) as held:
+            if held:
+                yield from move_sessions(self.archive, days or self.after_days, chunk or self.chunk)
+
+    def _ensure_started(self):
+        # Started lazily and per pid so a preloaded app forks cleanly into its workers
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='session-archiver', daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            with self.app.app_context():
+                try:
+                    for _ in self.run(wait=False):
+                        pass
+                except Exception:
+                    db.session.rollback()
+                    self.app.logger.exception('archiving sessions failed')
+                finally:
+                    db.session.remove()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join()
+
+    @contextmanager
+    def _host_lock(self, wait):
+        # One run per archive directory at a time, across the worker processes of the host
+        if fcntl is None:
+            yield True
+            return
+        if self._lock_pid != os.getpid():
+            self._lock_file = open(os.path.join(self.archive.path, '.lock'), 'a')
+            self._lock_pid = os.getpid()
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | (0 if wait else fcntl.LOCK_NB))
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+
+archiver = SessionArchiver()
@@ -0,0 +1,497 @@
+"""
+ASGI entry point: the endpoints of app.py on FastAPI, backed by SQLAlchemy's async engine.
+
+Run it instead of wsgi.py when a deployment wants many concurrent requests per core:
+
+    uvicorn asgi:app --app-dir src --workers 4
+
+It shares models.py, the statement builders, the in-process leaderboard and the session writes of
+services.py and ingest.py with the Flask app, and reads the same environment. Only the Flask app
+serves:
+
+- SQLITE_PRODUCTION's group-committed POST /sessions
+- STATS_WRITE_BEHIND (sessions posted here always update GameStats in their own transaction)
+- the response cache (writes made here still bump its tags, so a shared cache stays correct)
+- read-replica routing (every query goes to SQLALCHEMY_DATABASE_URI)
+- /metrics
+- moving sessions to the archive (exports still read archived segments)
+"""
+import asyncio
+import json
+import math
+import uuid
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+import jwt
+from fastapi import Depends, FastAPI, Request
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import HTMLResponse, StreamingResponse
+from fastapi.responses import JSONResponse as BaseJSONResponse
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from starlette.exceptions import HTTPException
+from archive import Archive
+from cache import leaderboard_version, response_cache, stats_changed, profile_changed
+from config import load_config
+from feed import SSE_HEADERS, AsyncLeaderboardFeed
+from hashing import HashingBusy, hasher
+from idempotency import session_keys
+import ingest
+import leaderboard
+from leaderboard import ALL, board, board_rows, refresh_chunks
+from limits import rate_limiter, admission, forwarded_address
+from listing import SessionListing, MAX_LIMIT, EXPORT_FORMATS, csv_line
+from models import User, Profile, GameStats
+from rollups import GlobalStats
+from queries import (profile_statement, serialize_profile, player_statement, serialize_player,
+                     session_statement, stats_statement, high_score_statement, encode_session, encode_stats)
+from serializers import dumps, dumps_bytes
+import services
+from simulator import session_validator
+from sketches import score_sketches, parse_quantiles
+from utils import APIException
+from writebehind import write_behind
+
+ASYNC_DRIVERS = {
+    'postgresql': 'postgresql+asyncpg',
+    'sqlite': 'sqlite+aiosqlite',
+    'mysql': 'mysql+aiomysql',
+}
+
+
+def async_database_url(url):
+    scheme, sep, rest = url.partition('://')
+    return ASYNC_DRIVERS.get(scheme, scheme) + sep + rest
+
+
+def create_engine(config):
+    url = async_database_url(config['SQLALCHEMY_DATABASE_URI'])
+    options = {'pool_pre_ping': True}
+    if ':memory:' not in url:
+        options.update(
+            pool_size=config['ASYNC_POOL_SIZE'],
+            max_overflow=config['ASYNC_MAX_OVERFLOW'],
+            pool_timeout=config['ASYNC_POOL_TIMEOUT'],
+            pool_recycle=config['ASYNC_POOL_RECYCLE'],
+        )
+    return create_async_engine(url, **options)
+
+
+class JSONResponse(BaseJSONResponse):
+    """Renders through serializers.dumps_bytes, so bodies may hold raw datetimes."""
+
+    def render(self, content):
+        return dumps_bytes(content)
+
+
+def msg(text, status_code=200, headers=None):
+    return JSONResponse({'msg': text}, status_code=status_code, headers=headers)
+
+
+async def json_body(request):
+    try:
+        return await request.json()
+    except ValueError:
+        return None
+
+
+async def get_db(request: Request):
+    async with request.app.state.sessionmaker() as session:
+        yield session
+
+
+def create_access_token(identity, secret, expires=timedelta(minutes=15)):
+    # Same claims as flask_jwt_extended, so tokens work against either entry point
+    now = datetime.now(timezone.utc)
+    claims = {'fresh': False, 'iat': now, 'jti': str(uuid.uuid4()), 'type': 'access',
+              'sub': identity, 'nbf': now, 'exp': now + expires}
+    return jwt.encode(claims, secret, algorithm='HS256')
+
+
+def jwt_identity(request: Request):
+    header = request.headers.get('Authorization', '')
+    if not header.startswith('Bearer '):
+        raise HTTPException(401, 'Missing Authorization Header')
+    try:
+        claims = jwt.decode(header[len('Bearer '):], request.app.state.config['JWT_SECRET_KEY'],
+                            algorithms=['HS256'])
+    except jwt.ExpiredSignatureError:
+        raise HTTPException(401, 'Token has expired')
+    except jwt.InvalidTokenError as error:
+        raise HTTPException(422, str(error))
+    return int(claims['sub'])
+
+
+async def limit_request(request: Request):
+    """limits.py's rate limits and admission control, keyed by the view's name like Flask's endpoints."""
+    endpoint = request.scope['endpoint'].__name__
+    client = forwarded_address(request.headers.get('X-Forwarded-For'), request.client.host if request.client else None,
+                               request.app.state.config['PROXY_FIX_HOPS'])
+    wait = rate_limiter.check(endpoint, rate_limiter.caller(request.headers.get('Authorization'), client))
+    if wait:
+        raise HTTPException(429, 'Too many requests', headers={'Retry-After': str(math.ceil(wait))})
+    name = admission.rule(endpoint) if admission.limits else None
+    if name is None:
+        yield
+        return
+    if not await admission.aenter(name):
+        raise HTTPException(503, 'Server busy, retry shortly', headers={'Retry-After': '1'})
+    try:
+        yield
+    finally:
+        admission.aleave(name)
+
+
+_board_lock = asyncio.Lock()
+
+
+async def loaded_board(db):
+    version = leaderboard_version.value()
+    if board.changes(version) is not None:
+        async with _board_lock:
+            version = leaderboard_version.value()
+            user_ids = board.changes(version)
+            if user_ids is ALL:
+                rows = (await db.execute(board_rows())).all()
+            elif user_ids is not None:
+                rows = []
+                for chunk in refresh_chunks(user_ids):
+                    rows.extend((await db.execute(board_rows(chunk))).all())
+            if user_ids is not None:
+                # Re-sorting every player is CPU-bound, so it stays off the event loop
+                await asyncio.to_thread(board.catch_up, version, user_ids, rows)
+    return board
+
+
+async def sync_users(db, user_ids):
+    await db.run_sync(lambda session: leaderboard.sync_users(user_ids, session))
+
+
+async def ingest_sessions(db, items, start=0):
+    return await db.run_sync(lambda session: ingest.ingest_sessions(items, start, session))
+
+
+async def aiter_ndjson(request):
+    buffer = b''
+    async for chunk in request.stream():
+        buffer += chunk
+        *lines, buffer = buffer.split(b'\n')
+        for line in lines:
+            if line.strip():
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    yield None
+    if buffer.strip():
+        try:
+            yield json.loads(buffer)
+        except ValueError:
+            yield None
+
+
+async def achunked(items, size):
+    chunk = []
+    async for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def create_app(config=None):
+    config = config or load_config()
+    engine = create_engine(config)
+    hasher.configure(config)
+    response_cache.configure(config)
+    session_validator.configure(config)
+    rate_limiter.configure(config)
+    admission.configure(config)
+    session_keys.configure(config)
+    score_sketches.configure(config)
+
+    @asynccontextmanager
+    async def lifespan(app):
+        stop_flushing = asyncio.Event()
+        flusher = asyncio.create_task(score_sketches.arun(app.state.sessionmaker, stop_flushing))
+        yield
+        stop_flushing.set()
+        await flusher
+        await app.state.leaderboard_feed.stop()
+        await engine.dispose()
+        hasher.shutdown()
+
+    app = FastAPI(title='Bootstrap vs Zombies API', lifespan=lifespan, default_response_class=JSONResponse,
+                  dependencies=[Depends(limit_request)])
+    app.state.config = config
+    app.state.engine = engine
+    app.state.sessionmaker = async_sessionmaker(engine, expire_on_commit=False)
+    app.state.leaderboard_feed = AsyncLeaderboardFeed(config, app.state.sessionmaker)
+    app.state.archive = Archive(config['ARCHIVE_PATH']) if config['ARCHIVE_PATH'] else None
+    app.add_middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*'],
+                       expose_headers=['X-Next-Cursor'])
+
+    @app.exception_handler(HTTPException)
+    async def handle_http_error(request, error):
+        return msg(error.detail, error.status_code, getattr(error, 'headers', None))
+
+    @app.exception_handler(APIException)
+    async def handle_invalid_usage(request, error):
+        return JSONResponse(error.to_dict(), status_code=error.status_code)
+
+    @app.exception_handler(HashingBusy)
+    async def handle_hashing_busy(request, error):
+        return msg('Server busy, retry shortly', 503, {'Retry-After': str(error.retry_after)})
+
+    @app.get('/', response_class=HTMLResponse)
+    async def sitemap():
+        links = sorted(route.path for route in app.routes
+                       if 'GET' in getattr(route, 'methods', ()) and '{' not in route.path)
+        items = ''.join(f"<li><a href='{link}'>{link}</a></li>" for link in links)
+        return f'<h1>Bootstrap vs Zombies API</h1><ul>{items}</ul>'
+
+    @app.get('/user')
+    async def handle_hello():
+        return {'msg': 'Hello, this is your GET /user response '}
+
+    @app.post('/api/auth/register')
+    async def register_user(request: Request, db: AsyncSession = Depends(get_db)):
+        data = await json_body(request) or {}
+        email = data.get('email')
+        password = data.get('password')
+        name = data.get('name') or data.get('display_name')
+        if not email or not password or not name:
+            return msg('Missing fields', 400)
+        if (await db.scalars(select(User.id).where(User.email == email))).first():
+            return msg('User already exists', 400)
+        user = User(email=email, password=await hasher.ahash(password), is_active=True)
+        db.add(user)
+        await db.flush()
+        stats = GameStats(user_id=user.id)
+        db.add_all([Profile(id=user.id, display_name=name), stats])
+        await db.commit()
+        await sync_users(db, [user.id])
+        stats_changed([user.id])
+        token = create_access_token(str(user.id), config['JWT_SECRET_KEY'])
+        return JSONResponse({'token': token, 'user': user.serialize()}, status_code=201)
+
+    @app.post('/api/auth/login')
+    async def login_user(request: Request, db: AsyncSession = Depends(get_db)):
+        data = await json_body(request) or {}
+        password = data.get('password')
+        user = (await db.scalars(select(User).where(User.email == data.get('email')))).first()
+        if not user or not await hasher.averify(user.password, password):
+            return msg('Invalid credentials', 401)
+        if hasher.needs_rehash(user.password):
+            user.password = await hasher.ahash(password)
+            await db.commit()
+        token = create_access_token(str(user.id), config['JWT_SECRET_KEY'])
+        return {'token': token, 'user': user.serialize()}
+
+    @app.get('/api/auth/me')
+    async def get_profile(user_id: int = Depends(jwt_identity), db: AsyncSession = Depends(get_db)):
+        row = (await db.execute(profile_statement(user_id))).first()
+        if not row:
+            return msg('User not found', 404)
+        return serialize_profile(row)
+
+    @app.get('/api/players/{user_id}')
+    async def get_player(user_id: int, sessions: int = 5, db: AsyncSession = Depends(get_db)):
+        rows = (await db.execute(player_statement(user_id, min(max(sessions, 0), 50)))).all()
+        if not rows:
+            return msg('User not found', 404)
+        return serialize_player(rows)
+
+    @app.put('/profiles/{user_id}')
+    async def update_profile_api(user_id: int, request: Request, identity: int = Depends(jwt_identity),
+                                 db: AsyncSession = Depends(get_db)):
+        if identity != user_id:
+            return msg('Unauthorized', 403)
+        profile = await db.get(Profile, user_id)
+        if not profile:
+            return msg('Profile not found', 404)
+        data = await json_body(request) or {}
+        profile.display_name = data.get('display_name', profile.display_name)
+        profile.updated_at = datetime.utcnow()
+        await db.commit()
+        await sync_users(db, [user_id])
+        profile_changed(user_id)
+        return profile.serialize()
+
+    @app.get('/leaderboard')
+    async def leaderboard(limit: int = 20, offset: int = 0, db: AsyncSession = Depends(get_db)):
+        return (await loaded_board(db)).page(max(offset, 0), min(limit, 100))
+
+    # Declared before /leaderboard/{user_id}, which would otherwise claim the path
+    @app.get('/leaderboard/stream')
+    async def leaderboard_stream(request: Request):
+        frames = app.state.leaderboard_feed.subscribe(request.headers.get('Last-Event-ID'))
+        return StreamingResponse(frames, media_type='text/event-stream', headers=SSE_HEADERS)
+
+    @app.get('/leaderboard/{user_id}')
+    async def leaderboard_rank(user_id: int, radius: int = 5, db: AsyncSession = Depends(get_db)):
+        lb = await loaded_board(db)
+        rank, entries = lb.around(user_id, min(max(radius, 0), 50))
+        if rank is None:
+            return msg('Not ranked', 404)
+        return {'rank': rank, 'total': len(lb), 'entries': entries}
+
+    @app.post('/sessions')
+    async def create_session(request: Request, db: AsyncSession = Depends(get_db)):
+        data = await json_body(request) or {}
+        if 'user_id' not in data:
+            return msg('Missing user_id', 400)
+
+        async def submit(record=None):
+            return await db.run_sync(services.create_session, data, record)
+
+        key = request.headers.get('idempotency-key')
+        if key is None:
+            body, status = await submit()
+            return JSONResponse(body, status_code=status)
+        body, status, headers = await session_keys.asubmit(db, data, key, submit, config['IDEMPOTENCY_WAIT'])
+        return JSONResponse(body, status_code=status, headers=headers)
+
+    @app.post('/sessions/batch')
+    async def create_sessions_batch(request: Request, db: AsyncSession = Depends(get_db)):
+        if request.headers.get('content-type', '').startswith('application/x-ndjson'):
+            return create_sessions_stream(request)
+        data = await json_body(request)
+        items = data.get('sessions') if isinstance(data, dict) else data
+        if not isinstance(items, list):
+            return msg('Expected a list of sessions', 400)
+        if len(items) > config['SESSION_BATCH_LIMIT']:
+            return msg('Too many sessions', 413)
+        results = await ingest_sessions(db, items)
+        created = sum(1 for r in results if r['status'] == 201)
+        status = 201 if created == len(results) else 207
+        return JSONResponse({'created': created, 'failed': len(results) - created, 'results': results},
+                            status_code=status)
+
+    def create_sessions_stream(request):
+        async def generate():
+            start = 0
+            async with app.state.sessionmaker() as db:
+                async for chunk in achunked(aiter_ndjson(request), config['SESSION_BATCH_CHUNK']):
+                    for result in await ingest_sessions(db, chunk, start):
+                        yield dumps(result) + '\n'
+                    start += len(chunk)
+
+        return StreamingResponse(generate(), media_type='application/x-ndjson')
+
+    @app.get('/sessions')
+    async def list_sessions(request: Request, db: AsyncSession = Depends(get_db)):
+        listing = SessionListing(request.query_params)
+        stream = request.query_params.get('stream')
+        if stream in ('json', 'ndjson'):
+            if stream == 'ndjson':
+                return StreamingResponse(scan_ndjson(listing), media_type='application/x-ndjson')
+            return StreamingResponse(scan_json_array(listing), media_type='application/json')
+        rows, next_cursor = listing.paginate((await db.execute(listing.page_statement())).all())
+        headers = {'X-Next-Cursor': str(next_cursor)} if next_cursor is not None else None
+        return JSONResponse(rows, headers=headers)
+
+    async def scan(listing):
+        # Streaming bodies outlive the request's dependencies, so they open their own session
+        after = listing.cursor
+        async with app.state.sessionmaker() as db:
+            while True:
+                rows = (await db.execute(listing.statement(after, listing.limit))).all()
+                for row in rows:
+                    yield listing.encode(row)
+                if len(rows) < listing.limit:
+                    return
+                after = rows[-1][0]
+
+    async def scan_ndjson(listing):
+        async for item in scan(listing):
+            yield dumps(item) + '\n'
+
+    async def scan_json_array(listing):
+        yield '['
+        first = True
+        async for item in scan(listing):
+            yield dumps(item) if first else ',' + dumps(item)
+            first = False
+        yield ']'
+
+    @app.get('/sessions/export')
+    async def export_sessions(request: Request):
+        fmt = request.query_params.get('format', 'ndjson')
+        if fmt not in EXPORT_FORMATS:
+            return JSONResponse({'msg': f"Invalid format, expected one of: {', '.join(EXPORT_FORMATS)}"}, status_code=400)
+        listing = SessionListing(dict(request.query_params, limit=MAX_LIMIT))
+        return StreamingResponse(export_body(fmt, listing), media_type=EXPORT_FORMATS[fmt],
+                                 headers={'Content-Disposition': f'attachment; filename=sessions.{fmt}'})
+
+    async def export(listing):
+        archive = app.state.archive
+        if archive is not None:
+            # Segments are read and decompressed off the event loop, one at a time
+            batches = archive.batches(listing.columns, listing.where)
+            while (batch := await asyncio.to_thread(next, batches, None)) is not None:
+                for row in batch:
+                    yield listing.encode(row)
+        async for item in scan(listing):
+            yield item
+
+    async def export_body(fmt, listing):
+        if fmt == 'csv':
+            yield csv_line(listing.fields)
+        async for item in export(listing):
+            yield csv_line(item.values()) if fmt == 'csv' else dumps(item) + '\n'
+
+    @app.get('/sessions/{session_id}')
+    async def get_session(session_id: int, db: AsyncSession = Depends(get_db)):
+        row = (await db.execute(session_statement(session_id))).first()
+        if not row:
+            return msg('Not found', 404)
+        return JSONResponse(encode_session(row))
+
+    @app.put('/sessions/{session_id}')
+    async def update_session(session_id: int, request: Request, db: AsyncSession = Depends(get_db)):
+        data = await json_body(request) or {}
+        body, status = await db.run_sync(services.update_session, session_id, data)
+        return JSONResponse(body, status_code=status)
+
+    @app.delete('/sessions/{session_id}')
+    async def delete_session(session_id: int, db: AsyncSession = Depends(get_db)):
+        body, status = await db.run_sync(services.delete_session, session_id)
+        return JSONResponse(body, status_code=status)
+
+    @app.get('/stats/lag')
+    async def stats_lag():
+        return write_behind.lag()
+
+    @app.get('/stats/global')
+    async def global_stats(request: Request, db: AsyncSession = Depends(get_db)):
+        query = GlobalStats(request.query_params)
+        return query.serialize((await db.execute(query.statement())).all())
+
+    @app.get('/stats/distribution')
+    async def score_distribution(q: str | None = None, level: int | None = None):
+        try:
+            qs = parse_quantiles(q)
+        except ValueError:
+            return msg('Invalid q', 400)
+        return score_sketches.distribution(qs, level)
+
+    @app.get('/stats/{user_id}/percentile')
+    async def score_percentile(user_id: int, db: AsyncSession = Depends(get_db)):
+        high_score = await db.scalar(high_score_statement(user_id))
+        if high_score is None:
+            return msg('Not found', 404)
+        return dict(score_sketches.standing(high_score), user_id=user_id)
+
+    @app.get('/stats/{user_id}')
+    async def stats(user_id: int, db: AsyncSession = Depends(get_db)):
+        row = (await db.execute(stats_statement(user_id))).first()
+        if not row:
+            return msg('Not found', 404)
+        return JSONResponse(encode_stats(row))
+
+    return app
+
+
+app = create_app()
@@ -0,0 +1,509 @@
+"""
+Bulk loading of game sessions, behind `flask data import` and `flask data seed`.
+
+Input is read a chunk of lines at a time. A process pool parses and checks each chunk into int64
+column arrays, with the rules of POST /sessions (and SESSION_VALIDATION). The main process
+inserts the surviving rows with one executemany per chunk, or COPY on PostgreSQL, and adds
+them to the rollups in the same transaction.
+
+A bulk_load row, updated in each chunk's transaction, records how much of the input is in, so a
+rerun of an interrupted import resumes after the last committed chunk. GameStats is not touched
+per row: once the input is in, the stats of every player with new sessions are rebuilt with one
+INSERT .. SELECT .. GROUP BY, which counts their archived share too. Like `flask backfill-rollups`,
+run it while the game is quiet: with STATS_WRITE_BEHIND, a session posted for one of those players
+during the rebuild would be counted by it and again when its queued delta is applied, so the rebuild
+is rolled back instead and a rerun retries it.
+"""
+import csv
+import io
+import json
+import os
+import warnings
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from itertools import islice
+import numpy as np
+from sqlalchemy import select, func, insert, literal, true, delete, DateTime
+from sqlalchemy.dialects import postgresql, sqlite
+from models import (db, User, Profile, GameStats, GameSession, ArchivedStats, BulkLoad,
+                    HourlyRollup, DailyRollup, LevelRollup, ScoreSketch)
+from ingest import UPSERT_DIALECTS, SESSION_FIELDS, parse_session, chunked
+from maintenance import check_users, fix
+from rollups import upsert_rollups
+from sketches import high_scores, score_sketches
+from leaderboard import sync_users
+from cache import stats_changed
+from hashing import hasher
+from simulator import SessionValidator, MESSAGES, CLAMP, OK
+from writebehind import write_behind
+
+COLUMNS = ('user_id', 'score', 'level_reached', 'zombies_defeated', 'duration_seconds', 'completed_at')
+FORMATS = ('csv', 'ndjson')
+# Columns a CSV header may name besides COLUMNS; `flask export-sessions` writes id
+IGNORED = ('id',)
+INT_MAX = 2 ** 31 - 1
+EPOCH = datetime(1970, 1, 1)
+HOUR = 3600 * 10 ** 6
+DAY = 24 * HOUR
+PLACEHOLDERS = {'qmark': '?', 'format': '%s', 'pyformat': '%s'}
+
+_validators = {}
+
+
+def microseconds(value, default):
+    """completed_at as microseconds since the epoch (UTC) from an ISO string, or `default` if empty."""
+    if value is None or value == '':
+        return default
+    if not isinstance(value, str):
+        raise ValueError(value)
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return (parsed - EPOCH) // timedelta(microseconds=1)
+
+
+def read_header(line):
+    header = [name.strip() for name in next(csv.reader([line.decode('utf-8-sig')]), [])]
+    unknown = [name for name in header if name not in COLUMNS and name not in IGNORED]
+    if unknown or 'user_id' not in header:
+        raise ValueError(f"Expected a CSV header with user_id and any of {', '.join(COLUMNS)}")
+    return header
+
+
+def _items(fmt, header, lines):
+    """(line index, item or error message) for every non-blank line."""
+    if fmt == 'ndjson':
+        for i, line in enumerate(lines):
+            if line.strip():
+                try:
+                    yield i, json.loads(line)
+                except ValueError:
+                    yield i, 'Invalid JSON'
+        return
+    ints = [name for name in header if name in SESSION_FIELDS or name == 'user_id']
+    for i, values in enumerate(csv.reader(line.decode('utf-8') for line in lines)):
+        if not values:
+            continue
+        if len(values) != len(header):
+            yield i, f'Expected {len(header)} columns'
+            continue
+        item = dict(zip(header, values))
+        try:
+            for name in ints:
+                if item[name] == '':
+                    del item[name]
+                else:
+                    item[name] = int(item[name])
+        except ValueError:
+            yield i, f'Invalid {name}'
+            continue
+        yield i, item
+
+
+def validator(validation):
+    key = tuple(sorted(validation.items()))
+    if key not in _validators:
+        _validators[key] = SessionValidator()
+        _validators[key].configure(validation)
+    return _validators[key]
+
+
+def parse_chunk(fmt, header, first_line, lines, now, validation):
+    """
+    Parses one chunk of raw input lines into {column: int64 array} (plus `line`, the input line
+    numbers) and a list of (line number, message) for the rejected lines. Runs in the worker
+    pool, so it only works from its arguments.
+    """
+    parsed = _parse_csv(header, first_line, lines, now) if fmt == 'csv' else None
+    arrays, rejects = parsed if parsed is not None else _parse_rows(fmt, header, first_line, lines, now)
+    checker = validator(validation)
+    if checker.enabled and len(arrays['line']):
+        codes = checker.simulator.check(*(np.minimum(arrays[name], CLAMP) for name in (
+            'score', 'level_reached', 'zombies_defeated', 'duration_seconds')), checker.points_per_zombie)
+        rejects += [(number, MESSAGES[int(code)]) for number, code in zip(arrays['line'].tolist(), codes) if code != OK]
+        arrays = take(arrays, codes == OK)
+    return arrays, rejects
+
+
+def _parse_rows(fmt, header, first_line, lines, now):
+    rows, numbers, rejects = [], [], []
+    for i, item in _items(fmt, header, lines):
+        number = first_line + i
+        if isinstance(item, str):
+            rejects.append((number, item))
+            continue
+        row, error = parse_session(item)
+        if error is None and any(value > INT_MAX for value in row.values()):
+            error = 'Value out of range'
+        if error:
+            rejects.append((number, error))
+            continue
+        try:
+            completed_at = microseconds(item.get('completed_at'), now)
+        except ValueError:
+            rejects.append((number, 'Invalid completed_at'))
+            continue
+        rows.append([row[name] for name in COLUMNS[:-1]] + [completed_at])
+        numbers.append(number)
+    columns = np.array(rows, dtype=np.int64).reshape(-1, len(COLUMNS)).T
+    return dict(zip(COLUMNS, columns), line=np.array(numbers, dtype=np.int64)), rejects
+
+
+def _parse_csv(header, first_line, lines, now):
+    """
+    `_parse_rows` for CSV with numpy's C parser. None when a line is blank, quoted, has the wrong
+    number of columns, or holds anything but integers and naive ISO datetimes, so the row-by-row
+    path can name it.
+    """
+    data = b''.join(lines)
+    if b'"' in data or data.count(b',') != len(lines) * (len(header) - 1):
+        return None
+    options = dict(delimiter=',', comments=None, encoding='utf-8', ndmin=2)
+    ints = [i for i, name in enumerate(header) if name != 'completed_at']
+    try:
+        with warnings.catch_warnings():
+            # numpy only warns on timezone offsets
+            warnings.simplefilter('error')
+            values = np.loadtxt(lines, dtype=np.int64, usecols=ints, **options)
+            if 'completed_at' in header:
+                completed = np.loadtxt(lines, dtype='datetime64[us]', usecols=[header.index('completed_at')],
+                                       **options)[:, 0]
+                # Empty fields read as NaT
+                completed = np.where(np.isnat(completed), now, completed.astype(np.int64))
+            else:
+                completed = np.full(len(values), now, dtype=np.int64)
+    except (ValueError, OverflowError, Warning):
+        return None
+    if len(values) != len(lines):
+        return None
+    numbers = np.arange(first_line, first_line + len(lines), dtype=np.int64)
+    columns = dict(zip((header[i] for i in ints), values.T))
+    valid = np.ones(len(numbers), dtype=bool)
+    rejects = []
+    arrays = {}
+    for name in COLUMNS[:-1]:
+        arrays[name] = columns[name] if name in columns else np.full(len(numbers), SESSION_FIELDS[name], dtype=np.int64)
+    checks = [(arrays[name] < 0, f'Invalid {name}') for name in COLUMNS[:-1]]
+    checks += [(arrays[name] > INT_MAX, 'Value out of range') for name in COLUMNS[:-1]]
+    for broken, msg in checks:
+        rejects.extend((number, msg) for number in numbers[broken & valid].tolist())
+        valid &= ~broken
+    arrays['completed_at'] = completed
+    arrays['line'] = numbers
+    return take(arrays, valid), sorted(rejects)
+
+
+def take(arrays, mask):
+    return {name: values[mask] for name, values in arrays.items()}
+
+
+def read_chunks(stream, size, first_line):
+    """Yields (first line number, lines, end offset) for `size` lines at a time from a binary stream."""
+    offset = stream.tell()
+    while True:
+        lines = list(islice(stream, size))
+        if not lines:
+            return
+        offset += sum(map(len, lines))
+        yield first_line, lines, offset
+        first_line += len(lines)
+
+
+@contextmanager
+def worker_pool(workers):
+    if not workers:
+        yield None
+        return
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        yield pool
+
+
+def parsed(pool, fmt, header, chunks, now, validation, depth):
+    """parse_chunk over `chunks` in input order, at most `depth` chunks in flight on `pool`."""
+    if pool is None:
+        for first_line, lines, offset in chunks:
+            yield parse_chunk(fmt, header, first_line, lines, now, validation), len(lines), offset
+        return
+    pending = deque()
+    for first_line, lines, offset in chunks:
+        pending.append((pool.submit(parse_chunk, fmt, header, first_line, lines, now, validation), len(lines), offset))
+        if len(pending) >= depth:
+            future, count, end = pending.popleft()
+            yield future.result(), count, end
+    while pending:
+        future, count, end = pending.popleft()
+        yield future.result(), count, end
+
+
+def insert_sessions(arrays):
+    """Inserts the rows of `arrays` in the current transaction, skipping the ORM and SQLAlchemy's type processing."""
+    count = len(arrays['user_id'])
+    if not count:
+        return
+    connection = db.session.connection()
+    dialect = connection.dialect
+    completed = arrays['completed_at'].astype('datetime64[us]')
+    table = GameSession.__table__.name
+    names = ', '.join(COLUMNS)
+    if dialect.name == 'postgresql':
+        raw = connection.connection.driver_connection
+        if hasattr(raw, 'cursor') and hasattr(raw.cursor(), 'copy_expert'):
+            text = '\n'.join(','.join(row) for row in zip(
+                *(arrays[name].astype(str) for name in COLUMNS[:-1]), np.datetime_as_string(completed, unit='us')))
+            with raw.cursor() as cursor:
+                cursor.copy_expert(f'COPY {table} ({names}) FROM STDIN WITH (FORMAT csv)', io.StringIO(text))
+            return
+    if dialect.name == 'sqlite':
+        # The text layout SQLAlchemy's SQLite DateTime reads and writes
+        completed = np.char.replace(np.datetime_as_string(completed, unit='us'), 'T', ' ').tolist()
+    else:
+        completed = completed.tolist()
+    params = list(zip(*(arrays[name].tolist() for name in COLUMNS[:-1]), completed))
+    placeholder = PLACEHOLDERS.get(dialect.paramstyle)
+    if placeholder is None:
+        db.session.execute(insert(GameSession), [dict(zip(COLUMNS, row)) for row in params])
+        return
+    marks = ', '.join([placeholder] * len(COLUMNS))
+    connection.exec_driver_sql(f'INSERT INTO {table} ({names}) VALUES ({marks})', params)
+
+
+def fold_columns(arrays):
+    """rollups.fold_rollups for column arrays, grouped with numpy instead of row by row."""
+    completed = arrays['completed_at']
+    hours, days = completed // HOUR, completed // DAY
+    counters = [np.ones_like(completed), arrays['score'], arrays['zombies_defeated'], arrays['duration_seconds']]
+    deltas = {}
+    # Each bucket as one int64: the level goes in the low 32 bits of the per-level key
+    for model, keys, bucket in ((HourlyRollup, hours, lambda k: (EPOCH + timedelta(microseconds=k * HOUR),)),
+                                (DailyRollup, days, lambda k: (EPOCH + timedelta(microseconds=k * DAY),)),
+                                (LevelRollup, days << 32 | arrays['level_reached'],
+                                 lambda k: (EPOCH + timedelta(microseconds=(k >> 32) * DAY), k & 0xffffffff))):
+        unique, inverse = np.unique(keys, return_inverse=True)
+        sums = np.stack([np.bincount(inverse, weights=c, minlength=len(unique)) for c in counters], axis=1)
+        deltas[model] = {bucket(key): values for key, values in zip(unique.tolist(), sums.astype(np.int64).tolist())}
+    keys = arrays['level_reached'] << 32 | score_sketches.buckets(arrays['score'])
+    unique, counts = np.unique(keys, return_counts=True)
+    deltas[ScoreSketch] = {(key >> 32, key & 0xffffffff): n for key, n in zip(unique.tolist(), counts.tolist())}
+    return deltas
+
+
+@contextmanager
+def deferred_indexes(defer):
+    """
+    With `defer`, drops game_session's secondary indexes for the load, which then appends to the
+    bare table. They are built again when it ends, or on the next load after a crash.
+    """
+    indexes = sorted(GameSession.__table__.indexes, key=lambda index: index.name)
+    if defer:
+        for index in indexes:
+            index.drop(db.session.connection(), checkfirst=True)
+        db.session.commit()
+    try:
+        yield
+    finally:
+        db.session.rollback()
+        for index in indexes:
+            index.create(db.session.connection(), checkfirst=True)
+        db.session.commit()
+
+
+def store(arrays):
+    insert_sessions(arrays)
+    upsert_rollups(fold_columns(arrays))
+
+
+def rebuild_stats(first_session_id):
+    """
+    Rewrites GameStats from game_session and archived_stats for every player with a session
+    above `first_session_id`. Returns their ids. Raises ValueError, rolled back, when write-behind
+    deltas are queued for them meanwhile (see WriteBehind.ensure_unqueued).
+    """
+    try:
+        return _rebuild_stats(first_session_id)
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+def _rebuild_stats(first_session_id):
+    write_behind.hold()
+    changed = select(GameSession.user_id).where(GameSession.id > first_session_id).distinct()
+    user_ids = db.session.scalars(changed).all()
+    dialect = db.session.get_bind().dialect.name
+    if dialect not in UPSERT_DIALECTS:
+        for batch in chunked(user_ids, 1000):
+            _, mismatches = check_users(batch)
+            write_behind.ensure_unqueued(batch)
+            fix(mismatches)
+            write_behind.hold()
+        return user_ids
+    hot = (select(GameSession.user_id,
+                  func.count(GameSession.id).label('total_games'),
+                  func.sum(GameSession.score).label('total_score'),
+                  func.max(GameSession.score).label('high_score'),
+                  func.max(GameSession.level_reached).label('levels_completed'),
+                  func.sum(GameSession.zombies_defeated).label('zombies_defeated'))
+           .where(GameSession.user_id.in_(changed)).group_by(GameSession.user_id).subquery())
+    greatest = func.max if dialect == 'sqlite' else func.greatest
+    archived = {name: func.coalesce(getattr(ArchivedStats, name), 0) for name in hot.c.keys() if name != 'user_id'}
+    now = datetime.utcnow()
+    rows = (select(hot.c.user_id,
+                   hot.c.total_games + archived['total_games'],
+                   hot.c.total_score + archived['total_score'],
+                   greatest(hot.c.high_score, archived['high_score']),
+                   greatest(hot.c.levels_completed, archived['levels_completed']),
+                   hot.c.zombies_defeated + archived['zombies_defeated'],
+                   literal(now, DateTime()), literal(now, DateTime()))
+            .select_from(hot.outerjoin(ArchivedStats, ArchivedStats.user_id == hot.c.user_id))
+            # SQLite needs a WHERE to tell the join's ON from the upsert's ON CONFLICT
+            .where(true()))
+    names = ['user_id', 'total_games', 'total_score', 'high_score', 'levels_completed', 'zombies_defeated',
+             'created_at', 'updated_at']
+    stmt = (sqlite if dialect == 'sqlite' else postgresql).insert(GameStats).from_select(names, rows)
+    stmt = stmt.on_conflict_do_update(index_elements=[GameStats.user_id],
+                                      set_={name: stmt.excluded[name] for name in names[1:] if name != 'created_at'})
+    old = {}
+    for batch in chunked(user_ids, 10000):
+        old.update(db.session.execute(high_scores(batch)).all())
+    db.session.execute(stmt)
+    for batch in chunked(user_ids, 10000):
+        new = db.session.execute(high_scores(batch)).all()
+        score_sketches.stage(db.session, score_sketches.players((old.get(user_id), score) for user_id, score in new))
+    write_behind.ensure_unqueued(user_ids)
+    return user_ids
+
+
+def finish(user_ids):
+    for batch in chunked(user_ids, 1000):
+        sync_users(batch)
+        stats_changed(batch)
+
+
+def validation_settings(config):
+    return {name: config.get(name) for name in ('SESSION_VALIDATION', 'SESSION_POINTS_PER_ZOMBIE', 'GAME_LEVELS_PATH')}
+
+
+def import_sessions(path, fmt, config, name=None, chunk=50000, workers=None, restart=False, defer_indexes=False):
+    """
+    Loads the sessions of a CSV or NDJSON file, yielding after each committed chunk
+    {'lines', 'loaded', 'rejected', 'rejects': [(line number, message)]}, then
+    {'players': count} once their stats are rebuilt. Resumes the checkpoint called `name`
+    (the file's absolute path by default) unless `restart`. See `deferred_indexes` for
+    `defer_indexes`.
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown format, expected one of: {', '.join(FORMATS)}")
+    write_behind.flush()
+    name = name or os.path.abspath(path)
+    checkpoint = db.session.get(BulkLoad, name)
+    if checkpoint is not None and restart:
+        db.session.execute(delete(BulkLoad).where(BulkLoad.name == name))
+        checkpoint = None
+    if checkpoint is None:
+        checkpoint = BulkLoad(name=name, bytes_read=0, lines_read=0, loaded=0, rejected=0,
+                              first_session_id=db.session.scalar(select(func.max(GameSession.id))) or 0,
+                              updated_at=datetime.utcnow())
+        db.session.add(checkpoint)
+        db.session.commit()
+    elif checkpoint.finished_at is not None:
+        raise ValueError(f'{name} was loaded on {checkpoint.finished_at:%Y-%m-%d %H:%M}; restart to load it again')
+    known = np.fromiter(db.session.scalars(select(User.id)), dtype=np.int64)
+    now = (datetime.utcnow() - EPOCH) // timedelta(microseconds=1)
+    # The main process inserts while the workers parse
+    workers = max((os.cpu_count() or 1) - 1, 0) if workers is None else workers
+    with open(path, 'rb') as stream, deferred_indexes(defer_indexes):
+        header = None
+        if fmt == 'csv':
+            line = stream.readline()
+            header = read_header(line)
+            if checkpoint.bytes_read == 0:
+                checkpoint.bytes_read, checkpoint.lines_read = len(line), 1
+        stream.seek(checkpoint.bytes_read)
+        chunks = read_chunks(stream, chunk, checkpoint.lines_read + 1)
+        with worker_pool(workers) as pool:
+            for (arrays, rejects), count, offset in parsed(pool, fmt, header, chunks, now,
+                                                           validation_settings(config), 2 * max(workers, 1)):
+                found = np.isin(arrays['user_id'], known)
+                rejects += [(number, 'User not found') for number in arrays['line'][~found].tolist()]
+                arrays = take(arrays, found)
+                store(arrays)
+                checkpoint.bytes_read = offset
+                checkpoint.lines_read += count
+                checkpoint.loaded += len(arrays['user_id'])
+                checkpoint.rejected += len(rejects)
+                checkpoint.updated_at = datetime.utcnow()
+                db.session.commit()
+                yield {'lines': checkpoint.lines_read, 'loaded': checkpoint.loaded,
+                       'rejected': checkpoint.rejected, 'rejects': sorted(rejects)}
+    user_ids = rebuild_stats(checkpoint.first_session_id)
+    checkpoint.finished_at = datetime.utcnow()
+    db.session.commit()
+    finish(user_ids)
+    yield {'players': len(user_ids)}
+
+
+def seed_players(count, password):
+    """Ids of the players player<n>@seed.example for n < `count`, registering the missing ones."""
+    emails = [f'player{n}@seed.example' for n in range(count)]
+    existing = set(db.session.scalars(select(User.email).where(User.email.like('%@seed.example'))))
+    missing = [email for email in emails if email not in existing]
+    seeded = select(User.email, User.id).where(User.email.like('%@seed.example'))
+    if missing:
+        hashed = hasher.hash(password)
+        for batch in chunked(missing, 10000):
+            db.session.execute(insert(User), [{'email': email, 'password': hashed, 'is_active': True} for email in batch])
+        ids = dict(db.session.execute(seeded).all())
+        now = datetime.utcnow()
+        for batch in chunked(missing, 10000):
+            db.session.execute(insert(Profile), [{'id': ids[email], 'display_name': email.split('@')[0].title(),
+                                                  'created_at': now, 'updated_at': now} for email in batch])
+            db.session.execute(insert(GameStats), [{'user_id': ids[email], 'created_at': now, 'updated_at': now}
+                                                   for email in batch])
+            score_sketches.stage(db.session, score_sketches.players((None, 0) for _ in batch))
+        db.session.commit()
+    ids = dict(db.session.execute(seeded).all())
+    return np.array([ids[email] for email in emails], dtype=np.int64)
+
+
+def synthetic(rng, user_ids, count, days, now, checker):
+    """`count` plausible sessions of random players over the last `days` days, as column arrays."""
+    levels = rng.integers(1, len(checker.simulator.levels) + 1, count)
+    durations = rng.integers(30, 1800, count)
+    bound = checker.simulator.max_kills(levels, durations)
+    kills = (bound * rng.random(count)).astype(np.int64)
+    scores = (kills * checker.points_per_zombie * rng.uniform(0.5, 1.0, count)).astype(np.int64)
+    return {
+        'user_id': rng.choice(user_ids, count),
+        'score': scores,
+        'level_reached': levels.astype(np.int64),
+        'zombies_defeated': kills,
+        'duration_seconds': durations.astype(np.int64),
+        'completed_at': now - rng.integers(0, days * DAY, count),
+    }
+
+
+def seed_sessions(players, sessions, days, config, chunk=50000, seed=0, password='seed', defer_indexes=False):
+    """
+    Registers `players` seed players (if missing) and loads `sessions` random, plausible sessions
+    for them, yielding {'loaded': count} after each chunk and {'players': count} at the end.
+    """
+    write_behind.flush()
+    user_ids = seed_players(players, password)
+    first_session_id = db.session.scalar(select(func.max(GameSession.id))) or 0
+    checker = validator(validation_settings(config))
+    rng = np.random.default_rng(seed)
+    now = (datetime.utcnow() - EPOCH) // timedelta(microseconds=1)
+    loaded = 0
+    with deferred_indexes(defer_indexes):
+        while loaded < sessions:
+            count = min(chunk, sessions - loaded)
+            store(synthetic(rng, user_ids, count, days, now, checker))
+            db.session.commit()
+            loaded += count
+            yield {'loaded': loaded}
+    changed = rebuild_stats(first_session_id)
+    db.session.commit()
+    finish(changed)
+    yield {'players': len(changed)}
@@ -0,0 +1,365 @@
+"""
+Read-through response cache for the hot GET endpoints.
+
+Cached bodies are stored together with the versions of the tags they depend on (for example
+`stats:3` or `leaderboard`). Write paths bump those versions via `invalidate`, so an entry goes
+stale exactly when a row it was built from changes. Every cached response carries an ETag, and
+a matching If-None-Match is answered with a 304 without rebuilding the body.
+
+The 'lru' backend only sees invalidations made by its own process, so CACHE_BACKEND defaults to
+'shared' when WEB_CONCURRENCY runs more than one worker.
+
+Standings changes also bump `leaderboard_version`, a counter in a memory-mapped file (in /dev/shm
+when available) that every worker process on the host reads whatever CACHE_BACKEND is, so the
+leaderboard feed and the in-process boards notice other workers' writes with one memory read. The
+file also logs which players each bump changed, so a board refreshes just those players.
+"""
+import hashlib
+import mmap
+import os
+import stat
+import struct
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import Response, g, request
+
+try:
+    import fcntl
+except ImportError:  # not on Windows; bumps are then only atomic within a process
+    fcntl = None
+
+COUNTER = struct.Struct('<Q')
+# A ChangeLog slot: the version a change was recorded under and the user id it names
+CHANGE = struct.Struct('<Qq')
+EVERYONE = -1
+
+
+class LRUBackend:
+    """Per-process LRU with a TTL; invalidations are only seen by this process."""
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            expires, value = item
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def versions(self, tags):
+        with self._lock:
+            return tuple(self._versions.get(tag, 0) for tag in tags)
+
+    def bump(self, tags):
+        with self._lock:
+            for tag in tags:
+                self._versions[tag] = self._versions.get(tag, 0) + 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._versions.clear()
+
+
+class SharedBackend:
+    """
+    Cache shared by every worker process on the host through a SQLite file, which lives in
+    /dev/shm when available so reads never touch the disk. Entries are plain columns, so reading
+    one never runs code whoever wrote the file.
+    """
+
+    def __init__(self, path, maxsize=10000):
+        self.path = path
+        self.maxsize = maxsize
+        self._writes = 0
+        self._local = threading.local()
+        self._connect().executescript('''
+            DROP TABLE IF EXISTS entries;
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                expires REAL NOT NULL,
+                versions TEXT NOT NULL,
+                etag TEXT NOT NULL,
+                body BLOB NOT NULL,
+                mimetype TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS versions (tag TEXT PRIMARY KEY, version INTEGER NOT NULL);
+        ''')
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        # A connection opened before fork() (e.g. under gunicorn --preload) must not be reused
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, isolation_level=None, timeout=5)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=OFF')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key):
+        row = self._connect().execute(
+            'SELECT versions, etag, body, mimetype FROM responses WHERE key = ? AND expires >= ?', (key, time.time())
+        ).fetchone()
+        if row is None:
+            return None
+        versions, etag, body, mimetype = row
+        return tuple(int(v) for v in versions.split(',') if v), etag, bytes(body), mimetype
+
+    def set(self, key, value, ttl):
+        versions, etag, body, mimetype = value
+        conn = self._connect()
+        conn.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)',
+                     (key, time.time() + ttl, ','.join(map(str, versions)), etag, body, mimetype))
+        self._writes += 1
+        if self._writes % 100 == 0:
+            conn.execute('DELETE FROM responses WHERE expires < ?', (time.time(),))
+            conn.execute('DELETE FROM responses WHERE rowid IN (SELECT rowid FROM responses '
+                         'ORDER BY expires DESC LIMIT -1 OFFSET ?)', (self.maxsize,))
+
+    def versions(self, tags):
+        found = dict(self._connect().execute(
+            f"SELECT tag, version FROM versions WHERE tag IN ({','.join('?' * len(tags))})", tags
+        ).fetchall())
+        return tuple(found.get(tag, 0) for tag in tags)
+
+    def bump(self, tags):
+        self._connect().executemany(
+            'INSERT INTO versions VALUES (?, 1) ON CONFLICT(tag) DO UPDATE SET version = version + 1',
+            [(tag,) for tag in tags],
+        )
+
+    def clear(self):
+        self._connect().executescript('DELETE FROM responses; DELETE FROM versions;')
+
+
+class ChangeLog:
+    """
+    A version counter in a memory-mapped file shared by the processes that open the same path,
+    followed by a ring of the last `slots` (version, user id) changes. Each bump records one
+    version per player it names, so a process that last looked at version v can find out which
+    players changed since, until the ring wraps past v. `slots` only applies to a new file.
+    """
+
+    def __init__(self, path=None, slots=65536):
+        self.path = path
+        self.slots = slots
+        self._fd = None
+        self._map = None
+        self._pid = None
+        self._lock = threading.Lock()
+        # Called with the value before and after each bump made by this process
+        self.on_bump = []
+
+    def configure(self, path, slots=65536):
+        self.path = path
+        self.slots = slots
+        self._pid = None
+
+    def _open(self):
+        # Mapped once per process, after any fork()
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            if self.path is None:
+                # Not configured, as in scripts that skip ResponseCache
+                self.path = shared_file({}, 'LEADERBOARD_VERSION_PATH', 'bvz_leaderboard_version')
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            self._lockf(fd, 'EX')
+            try:
+                size = os.fstat(fd).st_size
+                if size < COUNTER.size + CHANGE.size or (size - COUNTER.size) % CHANGE.size:
+                    os.ftruncate(fd, 0)
+                    os.ftruncate(fd, COUNTER.size + self.slots * CHANGE.size)
+                    size = COUNTER.size + self.slots * CHANGE.size
+            finally:
+                self._lockf(fd, 'UN')
+            self.slots = (size - COUNTER.size) // CHANGE.size
+            self._map = mmap.mmap(fd, size)
+            self._fd = fd
+            self._pid = os.getpid()
+
+    @staticmethod
+    def _lockf(fd, mode):
+        if fcntl is not None:
+            fcntl.lockf(fd, getattr(fcntl, f'LOCK_{mode}'))
+
+    def value(self):
+        self._open()
+        return COUNTER.unpack_from(self._map)[0]
+
+    def bump(self, user_ids=()):
+        """Records a change to `user_ids`, or to anyone when empty; returns the new value."""
+        self._open()
+        user_ids = sorted(set(user_ids)) or [EVERYONE]
+        with self._lock:
+            self._lockf(self._fd, 'EX')
+            try:
+                before = value = COUNTER.unpack_from(self._map)[0]
+                for user_id in user_ids:
+                    value += 1
+                    CHANGE.pack_into(self._map, COUNTER.size + value % self.slots * CHANGE.size, value, user_id)
+                COUNTER.pack_into(self._map, 0, value)
+            finally:
+                self._lockf(self._fd, 'UN')
+        for listener in self.on_bump:
+            listener(before, value)
+        return value
+
+    def changed(self, since, until):
+        """The user ids changed after version `since` up to `until`, or None when they are unknown."""
+        if since is None or since > until or until - since > self.slots:
+            return None
+        self._open()
+        user_ids = set()
+        with self._lock:
+            self._lockf(self._fd, 'SH')
+            try:
+                for version in range(since + 1, until + 1):
+                    recorded, user_id = CHANGE.unpack_from(self._map, COUNTER.size + version % self.slots * CHANGE.size)
+                    # Overwritten by a later lap of the ring, or a bump that named no one
+                    if recorded != version or user_id == EVERYONE:
+                        return None
+                    user_ids.add(user_id)
+            finally:
+                self._lockf(self._fd, 'UN')
+        return user_ids
+
+
+def shared_dir(config):
+    """
+    The directory for the files the workers of this deployment share: in /dev/shm when available,
+    named after the user and the database so two deployments on one host never share files, and
+    only accessible to the user, since other local users could otherwise plant or read them.
+    """
+    base = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    uid = os.getuid() if hasattr(os, 'getuid') else 0
+    digest = hashlib.blake2b(str(config.get('SQLALCHEMY_DATABASE_URI', '')).encode(), digest_size=8).hexdigest()
+    path = os.path.join(base, f'bvz-{uid}-{digest}')
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+    info = os.lstat(path)
+    if (not stat.S_ISDIR(info.st_mode) or info.st_mode & 0o077
+            or (hasattr(os, 'getuid') and info.st_uid != uid)):
+        raise RuntimeError(f'{path} must be a directory that only this user can access')
+    return path
+
+
+def shared_file(config, name, filename):
+    """`config[name]`, or `filename` in this deployment's shared_dir."""
+    return config.get(name) or os.path.join(shared_dir(config), filename)
+
+
+class ResponseCache:
+    def __init__(self, app=None):
+        self.backend = None
+        self.ttl = 30
+        self.replica_ttl = 30
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.configure(app.config)
+
+    def configure(self, config):
+        kind = config.get('CACHE_BACKEND') or ('shared' if config.get('WEB_WORKERS', 1) > 1 else 'lru')
+        maxsize = config.get('CACHE_MAXSIZE', 10000)
+        self.ttl = config.get('CACHE_TTL', 30)
+        # A body read from a replica may predate the version it is stored under
+        self.replica_ttl = min(self.ttl, config.get('REPLICA_MAX_LAG', self.ttl))
+        leaderboard_version.configure(shared_file(config, 'LEADERBOARD_VERSION_PATH', 'bvz_leaderboard_version'),
+                                      config.get('LEADERBOARD_LOG_SLOTS', 65536))
+        if kind == 'shared':
+            self.backend = SharedBackend(shared_file(config, 'CACHE_PATH', 'bvz_response_cache.db'), maxsize)
+        elif kind == 'lru':
+            self.backend = LRUBackend(maxsize)
+        else:
+            self.backend = None
+
+    def cached(self, tags_for):
+        """
+        Caches a view's 200 responses. `tags_for` receives the view arguments and returns the
+        tags the response depends on, or None to bypass the cache. The request path, query
+        string and tags form the key.
+        """
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                if self.backend is None:
+                    return view(*args, **kwargs)
+                tags = tags_for(**kwargs)
+                if tags is None:
+                    return view(*args, **kwargs)
+                tags = list(tags)
+                key = f"{request.full_path}|{','.join(tags)}"
+                versions = self.backend.versions(tags)
+                hit = self.backend.get(key)
+                if hit is not None and hit[0] == versions:
+                    _, etag, body, mimetype = hit
+                    response = Response(body, mimetype=mimetype)
+                    response.set_etag(etag)
+                    response.headers['Cache-Control'] = 'no-cache'
+                    response.headers['X-Cache'] = 'HIT'
+                    return response.make_conditional(request)
+                response = view(*args, **kwargs)
+                if isinstance(response, Response) and response.status_code == 200 and not g.pop('_uncached', False):
+                    response.add_etag()
+                    etag, _ = response.get_etag()
+                    ttl = self.replica_ttl if g.get('read_replica') else self.ttl
+                    self.backend.set(key, (versions, etag, response.get_data(), response.mimetype), ttl)
+                    response.headers['Cache-Control'] = 'no-cache'
+                    response.headers['X-Cache'] = 'MISS'
+                    return response.make_conditional(request)
+                return response
+            return wrapper
+        return decorator
+
+    def skip(self):
+        """Keeps the current request's response out of the cache, e.g. when it was built from stale state."""
+        g._uncached = True
+
+    def invalidate(self, *tags):
+        if self.backend is not None and tags:
+            self.backend.bump(tags)
+
+    def clear(self):
+        if self.backend is not None:
+            self.backend.clear()
+
+
+leaderboard_version = ChangeLog()
+response_cache = ResponseCache()
+
+
+def stats_changed(user_ids):
+    leaderboard_version.bump(user_ids)
+    response_cache.invalidate('leaderboard', *(f'stats:{user_id}' for user_id in set(user_ids)))
+
+
+def profile_changed(user_id):
+    leaderboard_version.bump([user_id])
+    response_cache.invalidate('leaderboard', f'user:{user_id}')
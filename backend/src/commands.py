@@ -0,0 +1,172 @@
+"""
+Maintenance commands, run with `flask <command>` (FLASK_APP=src/app.py).
+"""
+import json
+from concurrent.futures import ThreadPoolExecutor
+import click
+import numpy as np
+from sqlalchemy import select, func
+from models import db, GameSession, GameStats
+from maintenance import check_range, fix
+from writebehind import write_behind
+from simulator import session_validator, MESSAGES
+from rollups import backfill
+from archive import archiver
+from listing import SessionListing, MAX_LIMIT, EXPORT_FORMATS, export_body
+from utils import APIException
+from bulk import FORMATS, import_sessions, seed_sessions
+
+AUDIT_COLUMNS = (
+    GameSession.id,
+    GameSession.user_id,
+    GameSession.score,
+    GameSession.level_reached,
+    GameSession.zombies_defeated,
+    GameSession.duration_seconds,
+)
+
+
+def setup_commands(app):
+
+    @app.cli.command('audit-sessions')
+    @click.option('--chunk', default=10000, show_default=True, help='Sessions checked per query.')
+    def audit_sessions(chunk):
+        """Re-checks every stored session against the game simulator, printing the implausible ones as NDJSON."""
+        after = 0
+        checked = flagged = 0
+        while True:
+            stmt = select(*AUDIT_COLUMNS).where(GameSession.id > after).order_by(GameSession.id).limit(chunk)
+            rows = db.session.execute(stmt).all()
+            if not rows:
+                break
+            codes = session_validator.codes([tuple(value or 0 for value in row[2:]) for row in rows])
+            for i in np.flatnonzero(codes):
+                row = rows[i]
+                click.echo(json.dumps({'id': row[0], 'user_id': row[1], 'msg': MESSAGES[int(codes[i])]}))
+            flagged += int(np.count_nonzero(codes))
+            checked += len(rows)
+            after = rows[-1][0]
+        click.echo(f'{flagged} of {checked} sessions are implausible', err=True)
+
+    @app.cli.command('backfill-rollups')
+    @click.option('--chunk', default=10000, show_default=True, help='Sessions folded per transaction.')
+    def backfill_rollups(chunk):
+        """Rebuilds the hourly, daily and per-level rollups and the score sketches from game_session and the archive."""
+        total = backfill(chunk, log=lambda done: click.echo(f'{done} sessions folded', err=True),
+                         archive=archiver.archive)
+        click.echo(f'Rebuilt rollups from {total} sessions')
+
+    @app.cli.command('archive-sessions')
+    @click.option('--days', type=int, help='Archive sessions older than this [default: ARCHIVE_AFTER_DAYS].')
+    @click.option('--chunk', type=int, help='Sessions moved per transaction [default: ARCHIVE_CHUNK].')
+    def archive_sessions(days, chunk):
+        """Moves old sessions from game_session into the columnar archive at ARCHIVE_PATH."""
+        if archiver.archive is None:
+            raise click.UsageError('Set ARCHIVE_PATH to archive sessions.')
+        moved = 0
+        for moved in archiver.run(days, chunk):
+            click.echo(f'{moved} sessions archived', err=True)
+        click.echo(f'Archived {moved} sessions to {archiver.archive.path}')
+
+    @app.cli.command('export-sessions')
+    @click.option('--format', 'fmt', type=click.Choice(list(EXPORT_FORMATS)), default='ndjson', show_default=True)
+    @click.option('--fields', help='Comma-separated columns [default: all].')
+    @click.option('--user-id', type=int)
+    @click.option('--min-score', type=int)
+    @click.option('--max-score', type=int)
+    @click.option('--from', 'since', help='ISO date or datetime, inclusive.')
+    @click.option('--to', 'until', help='ISO date or datetime, exclusive.')
+    @click.option('--output', type=click.File('w'), default='-', show_default=True)
+    def export_sessions(fmt, fields, user_id, min_score, max_score, since, until, output):
+        """Streams the matching sessions of the archive and game_session, as GET /sessions/export does."""
+        args = {'fields': fields, 'user_id': user_id, 'min_score': min_score, 'max_score': max_score,
+                'from': since, 'to': until, 'limit': MAX_LIMIT}
+        try:
+            listing = SessionListing({k: str(v) for k, v in args.items() if v is not None})
+        except APIException as error:
+            raise click.UsageError(error.message)
+        for chunk in export_body(fmt, listing.fields, listing.export(archiver.archive)):
+            output.write(chunk)
+
+    @app.cli.command('check-stats')
+    @click.option('--chunk', default=5000, show_default=True, help='User ids per chunk.')
+    @click.option('--workers', default=4, show_default=True, help='Chunks checked in parallel.')
+    @click.option('--fix', 'repair', is_flag=True, help='Rewrite mismatching rows with the recomputed values.')
+    def check_stats(chunk, workers, repair):
+        """Verifies every GameStats row against game_session, printing mismatches as NDJSON."""
+        write_behind.flush()
+        last = db.session.scalar(select(func.max(GameStats.user_id))) or 0
+
+        def check(lo):
+            with app.app_context():
+                checked, mismatches = check_range(lo, lo + chunk)
+                if repair and mismatches:
+                    fix(mismatches)
+                return checked, mismatches
+
+        checked = found = 0
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for count, mismatches in pool.map(check, range(0, last + 1, chunk)):
+                checked += count
+                found += len(mismatches)
+                for mismatch in mismatches:
+                    click.echo(json.dumps(mismatch))
+        click.echo(f"{found} of {checked} stats rows differ from game_session{' (fixed)' if repair else ''}", err=True)
+        if found and not repair:
+            raise SystemExit(1)
+
+    @app.cli.group()
+    def data():
+        """Bulk loading of game sessions."""
+
+    @data.command('import')
+    @click.argument('path', type=click.Path(exists=True, dir_okay=False))
+    @click.option('--format', 'fmt', type=click.Choice(FORMATS), help='Input format [default: from the extension].')
+    @click.option('--chunk', default=50000, show_default=True, help='Lines per chunk and transaction.')
+    @click.option('--workers', type=int, help='Parsing processes, 0 to parse inline [default: CPUs - 1].')
+    @click.option('--name', help='Checkpoint name [default: the absolute path].')
+    @click.option('--restart', is_flag=True, help='Ignore the checkpoint and load the whole file again.')
+    @click.option('--defer-indexes', is_flag=True, help='Drop the game_session indexes while loading, build them after.')
+    def data_import(path, fmt, chunk, workers, name, restart, defer_indexes):
+        """
+        Loads the sessions of a CSV or NDJSON file, printing rejected lines as NDJSON. Reruns resume.
+
+        Run it while the game is quiet: with STATS_WRITE_BEHIND, sessions posted for the imported
+        players while their stats are rebuilt make it stop before the rebuild commits; rerun it then.
+        """
+        fmt = fmt or ('csv' if path.lower().endswith('.csv') else 'ndjson')
+        try:
+            for progress in import_sessions(path, fmt, app.config, name, chunk, workers, restart, defer_indexes):
+                if 'players' in progress:
+                    click.echo(f"Rebuilt the stats of {progress['players']} players", err=True)
+                    continue
+                for line, msg in progress['rejects']:
+                    click.echo(json.dumps({'line': line, 'msg': msg}))
+                click.echo(f"{progress['lines']} lines read, {progress['loaded']} sessions loaded, "
+                           f"{progress['rejected']} rejected", err=True)
+        except ValueError as error:
+            raise click.ClickException(str(error))
+
+    @data.command('seed')
+    @click.option('--players', default=1000, show_default=True, help='Players player<n>@seed.example, registered if missing.')
+    @click.option('--sessions', default=100000, show_default=True, help='Random, plausible sessions to add.')
+    @click.option('--days', default=90, show_default=True, help='Spread completed_at over this many days back.')
+    @click.option('--chunk', default=50000, show_default=True, help='Sessions per transaction.')
+    @click.option('--seed', default=0, show_default=True, help='Random seed.')
+    @click.option('--password', default='seed', show_default=True, help='Password of the new players.')
+    @click.option('--defer-indexes', is_flag=True, help='Drop the game_session indexes while loading, build them after.')
+    def data_seed(players, sessions, days, chunk, seed, password, defer_indexes):
+        """
+        Fills the database with seed players and sessions for development and staging.
+
+        Run it while the game is quiet, as `flask data import`. Should it stop before rebuilding the
+        stats, `flask check-stats --fix` rebuilds them.
+        """
+        try:
+            for progress in seed_sessions(players, sessions, days, app.config, chunk, seed, password, defer_indexes):
+                if 'players' in progress:
+                    click.echo(f"Seeded {sessions} sessions for {progress['players']} players")
+                else:
+                    click.echo(f"{progress['loaded']} sessions loaded", err=True)
+        except ValueError as error:
+            raise click.ClickException(str(error))
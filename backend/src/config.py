@@ -0,0 +1,123 @@
+"""
+Settings read from the environment, shared by the WSGI (app.py) and ASGI (asgi.py) entry points.
+"""
+import os
+
+
+def database_url():
+    db_url = os.getenv("DATABASE_URL")
+    if db_url is not None:
+        return db_url.replace("postgres://", "postgresql://")
+    return "sqlite:////tmp/test.db"
+
+
+def engine_options(prefix):
+    """Engine options from the {prefix}_POOL_SIZE, _MAX_OVERFLOW, _POOL_TIMEOUT, _POOL_RECYCLE and _POOL_PRE_PING set."""
+    options = {}
+    for name, cast in (('POOL_SIZE', int), ('MAX_OVERFLOW', int), ('POOL_TIMEOUT', float), ('POOL_RECYCLE', int)):
+        value = os.getenv(f'{prefix}_{name}')
+        if value is not None:
+            options[name.lower()] = cast(value)
+    pre_ping = os.getenv(f'{prefix}_POOL_PRE_PING')
+    if pre_ping is not None:
+        options['pool_pre_ping'] = pre_ping == '1'
+    return options
+
+
+def replica_binds():
+    """
+    One bind per comma-separated DATABASE_REPLICA_URLS entry. Pools take the DATABASE_REPLICA_* settings,
+    overridden per replica by DATABASE_REPLICA_<n>_*.
+    """
+    urls = [url.strip() for url in os.getenv('DATABASE_REPLICA_URLS', '').split(',') if url.strip()]
+    shared = engine_options('DATABASE_REPLICA')
+    return {f'replica_{n}': dict(shared, **engine_options(f'DATABASE_REPLICA_{n}'),
+                                 url=url.replace("postgres://", "postgresql://"))
+            for n, url in enumerate(urls)}
+
+
+def load_config():
+    # Worker processes per host, which gunicorn and uvicorn both take from WEB_CONCURRENCY
+    web_workers = max(int(os.getenv('WEB_CONCURRENCY', 1)), 1)
+    # Password hashing processes per worker, sharing the CPUs between the workers
+    hash_workers = int(os.getenv('HASH_WORKERS', max((os.cpu_count() or 1) // web_workers, 1)))
+    return {
+        'SQLALCHEMY_DATABASE_URI': database_url(),
+        'SQLALCHEMY_TRACK_MODIFICATIONS': False,
+        'SQLALCHEMY_ENGINE_OPTIONS': engine_options('DATABASE'),
+        'SQLALCHEMY_BINDS': replica_binds(),
+        'SQLITE_PRODUCTION': os.getenv('SQLITE_PRODUCTION') == '1',
+        'SQLITE_BUSY_TIMEOUT_MS': int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', 5000)),
+        'SQLITE_SYNCHRONOUS': os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL'),
+        'SQLITE_CACHE_SIZE_KB': int(os.getenv('SQLITE_CACHE_SIZE_KB', 65536)),
+        'SQLITE_MMAP_SIZE': int(os.getenv('SQLITE_MMAP_SIZE', 268435456)),
+        'SQLITE_TEMP_STORE': os.getenv('SQLITE_TEMP_STORE', 'MEMORY'),
+        'SQLITE_WRITER_BATCH': int(os.getenv('SQLITE_WRITER_BATCH', 500)),
+        'SQLITE_WRITER_TIMEOUT': float(os.getenv('SQLITE_WRITER_TIMEOUT', 30)),
+        'REPLICA_MAX_LAG': float(os.getenv('REPLICA_MAX_LAG', 5)),
+        'REPLICA_CHECK_INTERVAL': float(os.getenv('REPLICA_CHECK_INTERVAL', 5)),
+        'JWT_SECRET_KEY': os.getenv('JWT_SECRET_KEY', 'change-me'),
+        'SESSION_BATCH_LIMIT': int(os.getenv('SESSION_BATCH_LIMIT', 10000)),
+        'SESSION_BATCH_CHUNK': int(os.getenv('SESSION_BATCH_CHUNK', 1000)),
+        'STATS_WRITE_BEHIND': os.getenv('STATS_WRITE_BEHIND') == '1',
+        'STATS_FLUSH_INTERVAL_MS': int(os.getenv('STATS_FLUSH_INTERVAL_MS', 200)),
+        'STATS_JOURNAL_PATH': os.getenv('STATS_JOURNAL_PATH', '/tmp/stats_journal.db'),
+        'WEB_WORKERS': web_workers,
+        # A per-process LRU would miss the invalidations of the other workers
+        'CACHE_BACKEND': os.getenv('CACHE_BACKEND', 'shared' if web_workers > 1 else 'lru'),
+        'CACHE_TTL': int(os.getenv('CACHE_TTL', 30)),
+        'CACHE_PATH': os.getenv('CACHE_PATH'),
+        'LEADERBOARD_VERSION_PATH': os.getenv('LEADERBOARD_VERSION_PATH'),
+        'SESSION_VALIDATION': os.getenv('SESSION_VALIDATION', 'off'),
+        'SESSION_POINTS_PER_ZOMBIE': int(os.getenv('SESSION_POINTS_PER_ZOMBIE', 100)),
+        'GAME_LEVELS_PATH': os.getenv('GAME_LEVELS_PATH'),
+        'HASH_METHOD': os.getenv('HASH_METHOD', 'scrypt:32768:8:1'),
+        'HASH_WORKERS': hash_workers,
+        'HASH_QUEUE_DEPTH': int(os.getenv('HASH_QUEUE_DEPTH', hash_workers * 4)),
+        'METRICS_ENABLED': os.getenv('METRICS_ENABLED', '1') == '1',
+        'METRICS_PATH': os.getenv('METRICS_PATH'),
+        'METRICS_FLUSH_INTERVAL': float(os.getenv('METRICS_FLUSH_INTERVAL', 5)),
+        'SLOW_QUERY_MS': float(os.getenv('SLOW_QUERY_MS', 250)),
+        'PROFILE_TOKEN': os.getenv('PROFILE_TOKEN'),
+        'PROFILE_INTERVAL_MS': float(os.getenv('PROFILE_INTERVAL_MS', 5)),
+        'ASYNC_POOL_SIZE': int(os.getenv('ASYNC_POOL_SIZE', 20)),
+        'ASYNC_MAX_OVERFLOW': int(os.getenv('ASYNC_MAX_OVERFLOW', 10)),
+        'ASYNC_POOL_TIMEOUT': int(os.getenv('ASYNC_POOL_TIMEOUT', 10)),
+        'ASYNC_POOL_RECYCLE': int(os.getenv('ASYNC_POOL_RECYCLE', 1800)),
+        'ADMIN_JOB_CHUNK': int(os.getenv('ADMIN_JOB_CHUNK', 1000)),
+        'ADMIN_JOBS_PATH': os.getenv('ADMIN_JOBS_PATH'),
+        # Changed players remembered for other workers' boards; a board further behind rebuilds
+        'LEADERBOARD_LOG_SLOTS': int(os.getenv('LEADERBOARD_LOG_SLOTS', 65536)),
+        'LEADERBOARD_FEED_SIZE': int(os.getenv('LEADERBOARD_FEED_SIZE', 20)),
+        'LEADERBOARD_FEED_INTERVAL': float(os.getenv('LEADERBOARD_FEED_INTERVAL', 1)),
+        'LEADERBOARD_FEED_HISTORY': int(os.getenv('LEADERBOARD_FEED_HISTORY', 64)),
+        'LEADERBOARD_FEED_KEEPALIVE': float(os.getenv('LEADERBOARD_FEED_KEEPALIVE', 15)),
+        # Streams a Flask worker serves at once, leaving it threads for other requests; 0: unlimited
+        'LEADERBOARD_FEED_MAX_STREAMS': int(os.getenv('LEADERBOARD_FEED_MAX_STREAMS',
+                                                      max(int(os.getenv('GUNICORN_THREADS', 8)) // 2, 1))),
+        # Sessions older than ARCHIVE_AFTER_DAYS move to ARCHIVE_PATH every ARCHIVE_INTERVAL seconds (0: only by command)
+        'ARCHIVE_PATH': os.getenv('ARCHIVE_PATH'),
+        'ARCHIVE_AFTER_DAYS': int(os.getenv('ARCHIVE_AFTER_DAYS', 365)),
+        'ARCHIVE_CHUNK': int(os.getenv('ARCHIVE_CHUNK', 50000)),
+        'ARCHIVE_INTERVAL': float(os.getenv('ARCHIVE_INTERVAL', 3600)),
+        # Reverse proxies in front of the app (Render's load balancer is one), whose X-Forwarded-* are trusted
+        'PROXY_FIX_HOPS': int(os.getenv('PROXY_FIX_HOPS', 0)),
+        # `endpoint=requests/seconds[/burst];...` and `endpoint=concurrency;...`, see limits.py
+        'RATE_LIMITS': os.getenv('RATE_LIMITS', ''),
+        'RATE_LIMIT_PATH': os.getenv('RATE_LIMIT_PATH'),
+        'RATE_LIMIT_SLOTS': int(os.getenv('RATE_LIMIT_SLOTS', 65536)),
+        'ADMISSION_LIMITS': os.getenv('ADMISSION_LIMITS', ''),
+        'ADMISSION_QUEUE_MS': float(os.getenv('ADMISSION_QUEUE_MS', 50)),
+        # Idempotency-Key on POST /sessions, see idempotency.py
+        'IDEMPOTENCY_TTL': int(os.getenv('IDEMPOTENCY_TTL', 86400)),
+        'IDEMPOTENCY_WAIT': float(os.getenv('IDEMPOTENCY_WAIT', 30)),
+        'IDEMPOTENCY_CACHE_SIZE': int(os.getenv('IDEMPOTENCY_CACHE_SIZE', 10000)),
+        'IDEMPOTENCY_PRUNE_INTERVAL': float(os.getenv('IDEMPOTENCY_PRUNE_INTERVAL', 3600)),
+        'IDEMPOTENCY_FILTER_PATH': os.getenv('IDEMPOTENCY_FILTER_PATH'),
+        'IDEMPOTENCY_FILTER_BITS': int(os.getenv('IDEMPOTENCY_FILTER_BITS', 1 << 24)),
+        # Score sketches behind /stats/distribution and /stats/<user_id>/percentile, see sketches.py
+        'SKETCH_RELATIVE_ERROR': float(os.getenv('SKETCH_RELATIVE_ERROR', 0.01)),
+        'SKETCH_FLUSH_INTERVAL': float(os.getenv('SKETCH_FLUSH_INTERVAL', 10)),
+        # Any of admin, migrate, swagger: built at startup instead of on first use
+        'EAGER_SUBSYSTEMS': [s.strip() for s in os.getenv('EAGER_SUBSYSTEMS', '').split(',') if s.strip()],
+    }
@@ -0,0 +1,277 @@
+"""
+Leaderboard push: GET /leaderboard/stream sends the top players as Server-Sent Events.
+
+Every standings change bumps cache.leaderboard_version, a counter every worker process on the
+host shares whatever the CACHE_BACKEND. One producer per process checks it every
+LEADERBOARD_FEED_INTERVAL seconds. Only when it moved does it read the top LEADERBOARD_FEED_SIZE players, diff them against
+the previous read and encode a single `diff` frame, so any number of games in between cost one frame.
+Subscribers share the encoded frames: each only remembers the id of the last frame it sent and never
+queries the database. A client further behind than the kept history, or reconnecting with a
+Last-Event-ID issued by another process, is sent a fresh `snapshot` instead.
+
+Each open stream holds a thread of a gthread worker (gunicorn.conf.py) under the Flask app, so a
+worker serves at most LEADERBOARD_FEED_MAX_STREAMS of them and refuses more with a 503, upon which
+Leaderboard.tsx polls GET /leaderboard instead. Serve the stream from asgi.py when thousands of
+clients are expected.
+"""
+import asyncio
+import logging
+import os
+import threading
+import uuid
+from collections import deque
+from cache import leaderboard_version
+from leaderboard import BOARD_FIELDS, board_rows
+from models import db, GameStats
+from serializers import dumps
+
+KEEPALIVE = b': keepalive\n\n'
+# Proxies such as nginx must pass frames on as they come
+SSE_HEADERS = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+
+log = logging.getLogger(__name__)
+
+
+def top_statement(limit):
+    return board_rows().order_by(GameStats.high_score.desc(), GameStats.user_id).limit(limit)
+
+
+def top_entries(rows):
+    """Rows of top_statement as Leaderboard.page entries."""
+    return [dict(zip(BOARD_FIELDS, values), rank=rank, user_id=user_id)
+            for rank, (user_id, *values) in enumerate(rows, 1)]
+
+
+def current_version():
+    return leaderboard_version.value()
+
+
+def frame(event, event_id, data):
+    return f'id: {event_id}\nevent: {event}\ndata: {dumps(data)}\n\n'.encode()
+
+
+class Feed:
+    """The last top-N read and the recent frames describing how it changed; not thread-safe."""
+
+    def __init__(self, size=20, history=64):
+        self.size = size
+        # Event ids only mean something to the process that issued them
+        self.stream = uuid.uuid4().hex[:8]
+        self.seq = 0
+        self.entries = {}
+        self._frames = deque(maxlen=history)
+        self._snapshot = None
+
+    def event_id(self, seq):
+        return f'{self.stream}-{seq}'
+
+    def parse_id(self, last_event_id):
+        stream, _, seq = (last_event_id or '').partition('-')
+        return int(seq) if stream == self.stream and seq.isdigit() else None
+
+    def publish(self, entries):
+        """Records `entries` (in rank order) and encodes their diff; returns False when nothing changed."""
+        current = {entry['user_id']: entry for entry in entries}
+        upsert = [entry for user_id, entry in current.items() if self.entries.get(user_id) != entry]
+        remove = [user_id for user_id in self.entries if user_id not in current]
+        if self.seq and not upsert and not remove:
+            return False
+        self.seq += 1
+        self.entries = current
+        self._snapshot = None
+        self._frames.append((self.seq, frame('diff', self.event_id(self.seq), {'upsert': upsert, 'remove': remove})))
+        return True
+
+    def snapshot(self):
+        if self._snapshot is None:
+            self._snapshot = frame('snapshot', self.event_id(self.seq), list(self.entries.values()))
+        return self._snapshot
+
+    def since(self, seq):
+        """The frames a client that last saw `seq` is missing, and the seq they bring it to."""
+        if seq == self.seq:
+            return seq, []
+        if seq is None or seq > self.seq or not self._frames or seq < self._frames[0][0] - 1:
+            return self.seq, [self.snapshot()]
+        return self.seq, [data for s, data in self._frames if s > seq]
+
+
+class LeaderboardFeed:
+    """Producer thread of the Flask app; its subscribers block on a shared condition."""
+
+    def __init__(self, app=None):
+        self.app = None
+        self.feed = Feed()
+        self.interval = 1.0
+        self.keepalive = 15.0
+        self.max_streams = 0
+        self.subscribers = 0
+        self.version = None
+        self.fresh = False
+        self._cond = threading.Condition()
+        self._poll_lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._stop = threading.Event()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.interval = app.config['LEADERBOARD_FEED_INTERVAL']
+        self.keepalive = app.config['LEADERBOARD_FEED_KEEPALIVE']
+        self.max_streams = app.config['LEADERBOARD_FEED_MAX_STREAMS']
+        self.feed = Feed(app.config['LEADERBOARD_FEED_SIZE'], app.config['LEADERBOARD_FEED_HISTORY'])
+        self.fresh = False
+
+    def poll(self):
+        """Reads the top players if the standings may have moved and publishes the difference."""
+        with self._poll_lock:
+            version = current_version()
+            if self.fresh and version == self.version:
+                return False
+            return self._read(version)
+
+    def _read(self, version):
+        with self.app.app_context():
+            entries = top_entries(db.session.execute(top_statement(self.feed.size)))
+        self.version = version
+        self.fresh = True
+        with self._cond:
+            changed = self.feed.publish(entries)
+            if changed:
+                self._cond.notify_all()
+        return changed
+
+    def full(self):
+        return bool(self.max_streams) and self.subscribers >= self.max_streams
+
+    def subscribe(self, last_event_id=None):
+        """SSE frames for one client: what it missed (or a snapshot), then every diff as it is published."""
+        self._ensure_started()
+        if not self.fresh:
+            with self._poll_lock:
+                if not self.fresh:
+                    self._read(current_version())
+        with self._cond:
+            self.subscribers += 1
+        try:
+            seq = self.feed.parse_id(last_event_id)
+            while True:
+                with self._cond:
+                    if seq == self.feed.seq:
+                        self._cond.wait(self.keepalive)
+                    seq, frames = self.feed.since(seq)
+                yield b''.join(frames) if frames else KEEPALIVE
+        finally:
+            with self._cond:
+                self.subscribers -= 1
+
+    def _ensure_started(self):
+        # Started lazily and per pid so a preloaded app forks cleanly into its workers
+        with self._poll_lock:
+            if self._pid == os.getpid() and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='leaderboard-feed', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            if not self.subscribers:
+                # Nobody hears about changes made meanwhile, so the next subscriber reads afresh
+                self.fresh = False
+                continue
+            try:
+                self.poll()
+            except Exception:
+                self.app.logger.exception('leaderboard feed poll failed')
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join()
+
+
+leaderboard_feed = LeaderboardFeed()
+
+
+class AsyncLeaderboardFeed:
+    """The same producer as a task on the ASGI app's event loop, reading through its async sessions."""
+
+    def __init__(self, config, sessionmaker):
+        self.feed = Feed(config['LEADERBOARD_FEED_SIZE'], config['LEADERBOARD_FEED_HISTORY'])
+        self.interval = config['LEADERBOARD_FEED_INTERVAL']
+        self.keepalive = config['LEADERBOARD_FEED_KEEPALIVE']
+        self.sessionmaker = sessionmaker
+        self.subscribers = 0
+        self.version = None
+        self.fresh = False
+        self._cond = None
+        self._poll_lock = None
+        self._task = None
+
+    async def poll(self):
+        async with self._poll_lock:
+            version = current_version()
+            if self.fresh and version == self.version:
+                return False
+            return await self._read(version)
+
+    async def _read(self, version):
+        async with self.sessionmaker() as db:
+            entries = top_entries((await db.execute(top_statement(self.feed.size))).all())
+        self.version = version
+        self.fresh = True
+        async with self._cond:
+            changed = self.feed.publish(entries)
+            if changed:
+                self._cond.notify_all()
+        return changed
+
+    async def subscribe(self, last_event_id=None):
+        self._ensure_started()
+        if not self.fresh:
+            async with self._poll_lock:
+                if not self.fresh:
+                    await self._read(current_version())
+        self.subscribers += 1
+        try:
+            seq = self.feed.parse_id(last_event_id)
+            while True:
+                async with self._cond:
+                    if seq == self.feed.seq:
+                        try:
+                            await asyncio.wait_for(self._cond.wait(), self.keepalive)
+                        except asyncio.TimeoutError:
+                            pass
+                    seq, frames = self.feed.since(seq)
+                yield b''.join(frames) if frames else KEEPALIVE
+        finally:
+            self.subscribers -= 1
+
+    def _ensure_started(self):
+        if self._task is None or self._task.done():
+            self._cond = asyncio.Condition()
+            self._poll_lock = asyncio.Lock()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            if not self.subscribers:
+                self.fresh = False
+                continue
+            try:
+                await self.poll()
+            except Exception:
+                log.exception('leaderboard feed poll failed')
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
@@ -0,0 +1,130 @@
+"""
+Password hashing off the request thread.
+
+Hashes run on a bounded process pool so a login storm cannot starve the other endpoints of a
+worker. Once `HASH_QUEUE_DEPTH` hashes are in flight, new ones are refused with HashingBusy,
+which the app turns into a 503 with Retry-After; so is a hash still queued after HASH_TIMEOUT
+seconds. Stored hashes made with other parameters than `HASH_METHOD` are upgraded on the next
+successful login.
+"""
+import asyncio
+import os
+import threading
+from concurrent import futures
+from concurrent.futures import ProcessPoolExecutor
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS, generate_password_hash, check_password_hash
+
+DEFAULT_METHOD = 'scrypt:32768:8:1'
+
+
+def normalize_method(method):
+    """`method` with werkzeug's defaults filled in, as it appears at the start of the hashes it makes."""
+    name, *args = method.split(':')
+    if name == 'scrypt' and not args:
+        args = [2 ** 15, 8, 1]
+    elif name == 'pbkdf2':
+        args = (args or ['sha256']) + [DEFAULT_PBKDF2_ITERATIONS] * (len(args) < 2)
+    return ':'.join([name, *map(str, args)])
+
+
+def default_workers(web_workers=1):
+    """The CPUs left to each of `web_workers` worker processes, at least one."""
+    return max((os.cpu_count() or 1) // max(web_workers, 1), 1)
+
+
+class HashingBusy(Exception):
+    def __init__(self, retry_after=1):
+        Exception.__init__(self)
+        self.retry_after = retry_after
+
+
+class PasswordHasher:
+    def __init__(self, app=None):
+        self.method = DEFAULT_METHOD
+        self.workers = 0
+        self.queue_depth = 0
+        self.timeout = 30
+        self._pool = None
+        self._pid = None
+        self._slots = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.configure(app.config)
+
+    def configure(self, config):
+        self.method = normalize_method(config.get('HASH_METHOD', DEFAULT_METHOD))
+        self.workers = config.get('HASH_WORKERS', default_workers(config.get('WEB_WORKERS', 1)))
+        self.queue_depth = config.get('HASH_QUEUE_DEPTH', self.workers * 4)
+        self.timeout = config.get('HASH_TIMEOUT', 30)
+        self._slots = threading.BoundedSemaphore(self.queue_depth) if self.workers else None
+        self._pool = None
+
+    def _executor(self):
+        # One pool per process: a pool inherited over fork() has no live workers
+        if self._pool is None or self._pid != os.getpid():
+            with self._lock:
+                if self._pool is None or self._pid != os.getpid():
+                    self._pool = ProcessPoolExecutor(max_workers=self.workers)
+                    self._pid = os.getpid()
+        return self._pool
+
+    def _submit(self, func, *args):
+        if not self._slots.acquire(blocking=False):
+            raise HashingBusy()
+        try:
+            future = self._executor().submit(func, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        # A hash that timed out still holds its slot until the pool gets to it
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def _run(self, func, *args):
+        if not self.workers:
+            return func(*args)
+        future = self._submit(func, *args)
+        try:
+            return future.result(timeout=self.timeout)
+        except futures.TimeoutError:
+            future.cancel()
+            raise HashingBusy() from None
+
+    async def _arun(self, func, *args):
+        if not self.workers:
+            return await asyncio.to_thread(func, *args)
+        future = self._submit(func, *args)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+        except asyncio.TimeoutError:
+            raise HashingBusy() from None
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method)
+
+    def verify(self, stored, password):
+        if not stored or password is None:
+            return False
+        return self._run(check_password_hash, stored, password)
+
+    async def ahash(self, password):
+        return await self._arun(generate_password_hash, password, self.method)
+
+    async def averify(self, stored, password):
+        if not stored or password is None:
+            return False
+        return await self._arun(check_password_hash, stored, password)
+
+    def needs_rehash(self, stored):
+        return normalize_method(stored.split('$', 1)[0]) != self.method
+
+    def shutdown(self):
+        if self._pool is not None and self._pid == os.getpid():
+            self._pool.shutdown()
+        self._pool = None
+
+
+hasher = PasswordHasher()
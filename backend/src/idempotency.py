@@ -0,0 +1,339 @@
+"""
+Idempotent POST /sessions: a retry that carries the Idempotency-Key of an earlier submission gets
+the original 201 back, marked Idempotent-Replayed, instead of recording the game twice.
+
+The key is stored in session_key with the response, in the transaction that inserts the session,
+under the primary key (user_id, key): of two workers racing with one key only the first commits,
+and the other answers with its response. In front of the table:
+
+- each process keeps the responses of recent keys in an LRU, and makes concurrent requests with one
+  key wait for the first instead of racing it to the database;
+- a Bloom filter in shared memory (in /dev/shm when available) holds the keys every worker has
+  seen, so a new key skips the lookup. It takes no locks: a lost update only costs that lookup.
+
+Keys are kept at least IDEMPOTENCY_TTL seconds. Reusing one with another body is refused with 422.
+"""
+import asyncio
+import hashlib
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from sqlalchemy import delete, select
+from sqlalchemy.exc import IntegrityError
+from models import db, SessionKey
+from serializers import dumps
+from cache import shared_file
+
+try:
+    import fcntl
+except ImportError:  # not on Windows; the filter is then per process
+    fcntl = None
+
+MAX_KEY_LENGTH = 255
+MAGIC = b'BVZKEYS1'
+# Magic, bits per half, then the epoch each half holds
+HEADER = struct.Struct('<8sQqq')
+POSITIONS = struct.Struct('<4I')
+REPLAYED = {'Idempotent-Replayed': 'true'}
+
+
+def request_hash(data):
+    return hashlib.blake2b(dumps(data, sort_keys=True).encode(), digest_size=16).hexdigest()
+
+
+class KeyFilter:
+    """
+    Bloom filter over a memory-mapped file, in two halves that each take the keys of one
+    `ttl`-long epoch. A new epoch clears the half of the one before last, so a key is remembered
+    for `ttl` to 2 * `ttl` seconds. `bits` only applies to a new file.
+    """
+
+    def __init__(self, path, bits, ttl):
+        self.path = path
+        self.bits = bits
+        self.ttl = ttl
+        self._map = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _open(self):
+        if fcntl is None:
+            # No POSIX locks to create the file safely: each process keeps a filter of its own
+            self.bits = self.bits // 8 * 8
+            self._map = mmap.mmap(-1, HEADER.size + self.bits // 4)
+            HEADER.pack_into(self._map, 0, MAGIC, self.bits, -1, -1)
+            self._pid = os.getpid()
+            return
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.lockf(fd, fcntl.LOCK_EX)
+            magic, bits, _, _ = HEADER.unpack(os.pread(fd, HEADER.size, 0).ljust(HEADER.size, b'\0'))
+            if magic != MAGIC or os.fstat(fd).st_size != HEADER.size + bits // 4:
+                bits = self.bits // 8 * 8
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, HEADER.size + bits // 4)
+                os.pwrite(fd, HEADER.pack(MAGIC, bits, -1, -1), 0)
+            self.bits = bits
+            self._map = mmap.mmap(fd, HEADER.size + bits // 4)
+        finally:
+            # The mapping outlives the descriptor; closing it drops the lock
+            os.close(fd)
+        self._pid = os.getpid()
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        return [position % self.bits for position in POSITIONS.unpack(digest)]
+
+    def _halves(self, now):
+        """(offset of the current half, offsets of the halves to look in)."""
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._open()
+        epoch = int(now // self.ttl)
+        _, _, *epochs = HEADER.unpack_from(self._map, 0)
+        current = epoch % 2
+        # Only moves forward, so a worker with a clock behind the others cannot wipe a half
+        if epochs[current] < epoch:
+            start = HEADER.size + current * (self.bits // 8)
+            self._map[start:start + self.bits // 8] = bytes(self.bits // 8)
+            epochs[current] = epoch
+            struct.pack_into('<q', self._map, 16 + 8 * current, epoch)
+        size = self.bits // 8
+        return (HEADER.size + current * size,
+                [HEADER.size + half * size for half in (0, 1) if epochs[half] >= epoch - 1])
+
+    def add(self, key, now=None):
+        offset, _ = self._halves(time.time() if now is None else now)
+        for position in self._positions(key):
+            index = offset + (position >> 3)
+            self._map[index] |= 1 << (position & 7)
+
+    def seen(self, key, now=None):
+        _, offsets = self._halves(time.time() if now is None else now)
+        positions = self._positions(key)
+        return any(all(self._map[offset + (p >> 3)] & (1 << (p & 7)) for p in positions) for offset in offsets)
+
+
+class SessionKeys:
+    def __init__(self, app=None):
+        self.app = None
+        self.ttl = 86400
+        self.cache_size = 10000
+        self.prune_interval = 0.0
+        self.filter = None
+        self._responses = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+        self._stop = threading.Event()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.configure(app.config)
+
+    def configure(self, config):
+        self.ttl = config.get('IDEMPOTENCY_TTL', 86400)
+        self.cache_size = config.get('IDEMPOTENCY_CACHE_SIZE', 10000)
+        self.prune_interval = config.get('IDEMPOTENCY_PRUNE_INTERVAL', 0.0)
+        self.filter = KeyFilter(shared_file(config, 'IDEMPOTENCY_FILTER_PATH', 'bvz_session_keys'),
+                                config.get('IDEMPOTENCY_FILTER_BITS', 1 << 24), self.ttl)
+        self._responses = OrderedDict()
+        self._pid = None
+
+    def scope(self, data, key):
+        """(user_id, key) a submission is deduplicated under; None when its body has no valid user_id."""
+        if not 0 < len(key) <= MAX_KEY_LENGTH:
+            raise ValueError('Invalid Idempotency-Key')
+        user_id = data.get('user_id')
+        if not isinstance(user_id, int) or isinstance(user_id, bool):
+            return None
+        return user_id, key
+
+    def submit(self, data, key, create, timeout=30):
+        """
+        Returns (body, status, headers) for a POST /sessions body sent with `key`. A new key runs
+        `create(record)`, which returns (body, status) and calls `record(body)` in the transaction
+        that inserts the session; `record` is None when the body cannot be deduplicated.
+        """
+        try:
+            scope = self.scope(data, key)
+        except ValueError as error:
+            return {'msg': str(error)}, 400, {}
+        if scope is None:
+            return (*create(None), {})
+        self._ensure_started()
+        digest = request_hash(data)
+        deadline = time.monotonic() + timeout
+        while True:
+            stored, waiter = self._claim(scope, threading.Event)
+            if stored is not None:
+                return self._replay(stored, digest)
+            if waiter is None:
+                break
+            if not waiter.wait(max(deadline - time.monotonic(), 0)):
+                return self._in_progress()
+        try:
+            stored = self._stored(db.session.execute(self._statement(scope)).first()) if self._seen(scope) else None
+            if stored is not None:
+                return self._replay(stored, digest)
+            record, recorded = self._recorder(scope, digest, db.session)
+            try:
+                body, status = create(record)
+            except IntegrityError:
+                db.session.rollback()
+                stored = self._stored(db.session.execute(self._statement(scope)).first())
+                if stored is None:
+                    raise
+                return self._replay(stored, digest)
+            if 'text' in recorded and status == 201:
+                self._remember(scope, (digest, recorded['text']))
+            return body, status, {}
+        finally:
+            self._release(scope)
+
+    async def asubmit(self, session, data, key, create, timeout=30):
+        """`submit` for asgi.py, on the AsyncSession `session`; `create` is a coroutine function."""
+        try:
+            scope = self.scope(data, key)
+        except ValueError as error:
+            return {'msg': str(error)}, 400, {}
+        if scope is None:
+            return (*await create(None), {})
+        digest = request_hash(data)
+        while True:
+            stored, waiter = self._claim(scope, asyncio.Event)
+            if stored is not None:
+                return self._replay(stored, digest)
+            if waiter is None:
+                break
+            try:
+                await asyncio.wait_for(waiter.wait(), timeout)
+            except asyncio.TimeoutError:
+                return self._in_progress()
+        try:
+            stored = self._stored((await session.execute(self._statement(scope))).first()) if self._seen(scope) else None
+            if stored is not None:
+                return self._replay(stored, digest)
+            record, recorded = self._recorder(scope, digest, session)
+            try:
+                body, status = await create(record)
+            except IntegrityError:
+                await session.rollback()
+                stored = self._stored((await session.execute(self._statement(scope))).first())
+                if stored is None:
+                    raise
+                return self._replay(stored, digest)
+            if 'text' in recorded and status == 201:
+                self._remember(scope, (digest, recorded['text']))
+            return body, status, {}
+        finally:
+            self._release(scope)
+
+    def _claim(self, scope, event):
+        """(stored response, None) for a cached key, (None, event to wait on) while another request
+        has it, or (None, None) once this request has it."""
+        with self._lock:
+            stored = self._responses.get(scope)
+            if stored is not None:
+                self._responses.move_to_end(scope)
+                return stored, None
+            waiter = self._pending.get(scope)
+            if waiter is not None:
+                return None, waiter
+            self._pending[scope] = event()
+            return None, None
+
+    def _release(self, scope):
+        with self._lock:
+            waiter = self._pending.pop(scope, None)
+        if waiter is not None:
+            waiter.set()
+
+    def _remember(self, scope, stored):
+        with self._lock:
+            self._responses[scope] = stored
+            self._responses.move_to_end(scope)
+            while len(self._responses) > self.cache_size:
+                self._responses.popitem(last=False)
+        self.filter.add(f'{scope[0]}:{scope[1]}')
+
+    def _seen(self, scope):
+        return self.filter.seen(f'{scope[0]}:{scope[1]}')
+
+    def _recorder(self, scope, digest, session):
+        # A batch that failed and was retried records again; the last call is the committed one
+        recorded = {}
+
+        def record(body):
+            recorded['text'] = dumps(body)
+            session.add(SessionKey(user_id=scope[0], key=scope[1], session_id=body['id'], request_hash=digest,
+                                   response=recorded['text'], created_at=datetime.utcnow()))
+
+        return record, recorded
+
+    def _statement(self, scope):
+        return select(SessionKey.request_hash, SessionKey.response).where(
+            SessionKey.user_id == scope[0], SessionKey.key == scope[1])
+
+    def _stored(self, row):
+        return tuple(row) if row is not None else None
+
+    def _replay(self, stored, digest):
+        if stored[0] != digest:
+            return {'msg': 'Idempotency-Key was already used with a different request'}, 422, {}
+        return json.loads(stored[1]), 201, dict(REPLAYED)
+
+    def _in_progress(self):
+        return {'msg': 'A request with this Idempotency-Key is in progress'}, 409, {'Retry-After': '1'}
+
+    def prune(self):
+        """Deletes the keys older than the TTL; returns how many."""
+        cutoff = datetime.utcnow() - timedelta(seconds=self.ttl)
+        deleted = db.session.execute(delete(SessionKey).where(SessionKey.created_at < cutoff)).rowcount
+        db.session.commit()
+        return deleted
+
+    def clear(self):
+        with self._lock:
+            self._responses.clear()
+
+    def _ensure_started(self):
+        # Started lazily and per pid so a preloaded app forks cleanly into its workers
+        if self.app is None or self.prune_interval <= 0 or self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='session-key-pruner', daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def _run(self):
+        while not self._stop.wait(self.prune_interval):
+            with self.app.app_context():
+                try:
+                    self.prune()
+                except Exception:
+                    db.session.rollback()
+                    self.app.logger.exception('pruning idempotency keys failed')
+                finally:
+                    db.session.remove()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join()
+
+
+session_keys = SessionKeys()
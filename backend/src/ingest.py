@@ -0,0 +1,253 @@
+"""
+Batched session ingestion: many GameSession rows and their GameStats deltas in one transaction.
+"""
+import json
+from datetime import datetime
+from itertools import islice
+from sqlalchemy import insert, select, func
+from sqlalchemy.dialects import postgresql, sqlite
+from models import db, User, GameStats, GameSession
+from leaderboard import sync_users
+from cache import stats_changed
+from simulator import session_validator
+from rollups import fold_rollups, upsert_rollups
+from sketches import high_scores, score_sketches
+
+UPSERT_DIALECTS = ('sqlite', 'postgresql')
+
+SESSION_FIELDS = {
+    'score': 0,
+    'level_reached': 1,
+    'zombies_defeated': 0,
+    'duration_seconds': 0,
+}
+
+
+def parse_session(item):
+    """Returns (row, None) for a valid submission or (None, message) otherwise."""
+    if not isinstance(item, dict):
+        return None, 'Expected an object'
+    if item.get('user_id') is None:
+        return None, 'Missing user_id'
+    row = {'user_id': item['user_id']}
+    row.update((field, item.get(field, default)) for field, default in SESSION_FIELDS.items())
+    for field, value in row.items():
+        if not isinstance(value, int) or isinstance(value, bool) or value < 0:
+            return None, f'Invalid {field}'
+    return row, None
+
+
+def validate_session(item):
+    """(message, status) when SESSION_VALIDATION rejects a single submission, else None."""
+    if not session_validator.enabled:
+        return None
+    row, error = parse_session(item)
+    if error:
+        return error, 400
+    error = session_validator.check([row])[0]
+    return (error, 422) if error else None
+
+
+def updated_fields(session, data):
+    """The session as it would read after applying a PUT body, for validate_session."""
+    item = {field: getattr(session, field) for field in SESSION_FIELDS}
+    item.update((field, data[field]) for field in SESSION_FIELDS if field in data)
+    item['user_id'] = session.user_id
+    return item
+
+
+def fold_stats(rows):
+    """Folds session rows into one GameStats delta per user, matching create_session."""
+    deltas = {}
+    for row in rows:
+        delta = deltas.get(row['user_id'])
+        if delta is None:
+            delta = deltas[row['user_id']] = {
+                'user_id': row['user_id'],
+                'total_games': 0,
+                'total_score': 0,
+                'high_score': 0,
+                'levels_completed': 0,
+                'zombies_defeated': 0,
+            }
+        delta['total_games'] += 1
+        delta['total_score'] += row['score']
+        delta['high_score'] = max(delta['high_score'], row['score'])
+        delta['levels_completed'] = max(delta['levels_completed'], row['level_reached'])
+        delta['zombies_defeated'] += row['zombies_defeated']
+    return deltas
+
+
+def stats_upsert(dialect):
+    """INSERT .. ON CONFLICT statement that adds one delta row to a player's GameStats."""
+    table = GameStats.__table__
+    stmt = (sqlite if dialect == 'sqlite' else postgresql).insert(table)
+    greatest = func.max if dialect == 'sqlite' else func.greatest
+    return stmt.on_conflict_do_update(
+        index_elements=[table.c.user_id],
+        set_={
+            'total_games': table.c.total_games + stmt.excluded.total_games,
+            'total_score': table.c.total_score + stmt.excluded.total_score,
+            'high_score': greatest(table.c.high_score, stmt.excluded.high_score),
+            'levels_completed': greatest(table.c.levels_completed, stmt.excluded.levels_completed),
+            'zombies_defeated': table.c.zombies_defeated + stmt.excluded.zombies_defeated,
+            'updated_at': stmt.excluded.updated_at,
+        },
+    )
+
+
+def stats_params(deltas):
+    now = datetime.utcnow()
+    return [dict(delta, created_at=now, updated_at=now) for delta in deltas.values()]
+
+
+def session_insert():
+    return insert(GameSession).returning(GameSession.id, sort_by_parameter_order=True)
+
+
+def high_score_changes(old, deltas):
+    """(old, new) high score of each player in `deltas`, given their {user_id: high_score} before the upsert."""
+    return [(old.get(user_id), max(old.get(user_id, delta['high_score']), delta['high_score']))
+            for user_id, delta in deltas.items()]
+
+
+def upsert_stats(deltas, session=None):
+    """Applies per-user deltas with one INSERT .. ON CONFLICT per user, in `session` (db.session by default)."""
+    if not deltas:
+        return
+    session = db.session if session is None else session
+    params = stats_params(deltas)
+    dialect = session.get_bind().dialect.name
+    if dialect not in UPSERT_DIALECTS:
+        return _merge_stats(session, params, params[0]['updated_at'])
+    old = dict(session.execute(high_scores(list(deltas))).all())
+    session.execute(stats_upsert(dialect), params)
+    score_sketches.stage(session, score_sketches.players(high_score_changes(old, deltas)))
+
+
+def _merge_stats(session, params, now):
+    user_ids = [p['user_id'] for p in params]
+    existing = {
+        s.user_id: s
+        for s in session.scalars(select(GameStats).where(GameStats.user_id.in_(user_ids)).with_for_update())
+    }
+    for p in params:
+        stats = existing.get(p['user_id'])
+        if stats is None:
+            session.add(GameStats(**p))
+            continue
+        stats.total_games += p['total_games']
+        stats.total_score += p['total_score']
+        stats.high_score = max(stats.high_score, p['high_score'])
+        stats.levels_completed = max(stats.levels_completed, p['levels_completed'])
+        stats.zombies_defeated += p['zombies_defeated']
+        stats.updated_at = now
+
+
+def parse_batch(items, start=0):
+    """Returns one result per item plus (result position, row) for the items that parsed."""
+    results = []
+    rows = []
+    for index, item in enumerate(items, start):
+        row, error = parse_session(item)
+        if error:
+            results.append({'index': index, 'status': 400, 'msg': error})
+        else:
+            results.append({'index': index, 'status': 201})
+            rows.append((len(results) - 1, row))
+    if session_validator.enabled and rows:
+        return results, reject_implausible(results, rows)
+    return results, rows
+
+
+def reject_implausible(results, rows):
+    plausible = []
+    for (pos, row), error in zip(rows, session_validator.check([row for _, row in rows])):
+        if error:
+            results[pos].update(status=422, msg=error)
+        else:
+            plausible.append((pos, row))
+    return plausible
+
+
+def known_users(rows):
+    user_ids = {row['user_id'] for _, row in rows}
+    return select(User.id).where(User.id.in_(user_ids)) if user_ids else None
+
+
+def drop_unknown(results, rows, known):
+    valid = []
+    for pos, row in rows:
+        if row['user_id'] in known:
+            valid.append((pos, row))
+        else:
+            results[pos].update(status=404, msg='User not found')
+    return valid
+
+
+def session_params(valid):
+    now = datetime.utcnow()
+    return [dict(row, completed_at=now) for _, row in valid]
+
+
+def ingest_sessions(items, start=0, session=None):
+    """
+    Inserts every valid item and folds it into GameStats in a single transaction.
+    Returns one result dict per item, in input order, numbered from `start`.
+    """
+    session = db.session if session is None else session
+    results, rows = parse_batch(items, start)
+    stmt = known_users(rows)
+    known = set(session.scalars(stmt)) if stmt is not None else set()
+    valid = drop_unknown(results, rows, known)
+    if valid:
+        for (pos, _), params in zip(valid, write_sessions(valid, session=session)):
+            results[pos]['id'] = params['id']
+    return results
+
+
+def write_sessions(valid, on_insert=None, session=None):
+    """
+    Inserts the (position, row) pairs of `valid` and folds them into GameStats and the rollups in one
+    transaction. Returns the inserted rows, with their ids, which are also passed to `on_insert`
+    before the commit.
+    """
+    session = db.session if session is None else session
+    try:
+        params = session_params(valid)
+        ids = session.scalars(session_insert(), params).all()
+        for row, session_id in zip(params, ids):
+            row['id'] = session_id
+        upsert_stats(fold_stats(row for _, row in valid), session)
+        upsert_rollups(fold_rollups(params), session)
+        if on_insert is not None:
+            on_insert(params)
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    user_ids = [row['user_id'] for _, row in valid]
+    sync_users(user_ids, session)
+    stats_changed(user_ids)
+    return params
+
+
+def iter_ndjson(stream):
+    """Yields one decoded object per non-blank line; undecodable lines yield None."""
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            yield None
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
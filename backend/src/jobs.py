@@ -0,0 +1,173 @@
+"""
+Chunked background jobs started from the admin panel.
+
+A job is a generator that works through its rows a chunk at a time, committing after each chunk
+and yielding the running count of rows handled. Jobs run on one worker thread per process, never
+inside the request that started them. Their status is kept in a SQLite file shared by all
+workers on the host (in /dev/shm when available), so every worker's admin page lists every job.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from sqlalchemy import select, func, delete
+from models import db, GameSession, GameStats
+from maintenance import check_range, check_users, fix
+from rollups import SOURCE_COLUMNS, fold_rollups, upsert_rollups
+from leaderboard import sync_users
+from cache import shared_file, stats_changed
+from writebehind import write_behind
+
+
+def recompute_stats(chunk, user_ids=None):
+    """Rewrites GameStats from game_session for `user_ids`, or for every player."""
+    write_behind.flush()
+    if user_ids is not None:
+        batches = (user_ids[i:i + chunk] for i in range(0, len(user_ids), chunk))
+        checks = (check_users(batch) for batch in batches)
+    else:
+        last = db.session.scalar(select(func.max(GameStats.user_id))) or 0
+        checks = (check_range(lo, lo + chunk) for lo in range(0, last + 1, chunk))
+    done = 0
+    for checked, mismatches in checks:
+        fix(mismatches)
+        changed = [m['user_id'] for m in mismatches]
+        sync_users(changed)
+        stats_changed(changed)
+        done += checked
+        yield done
+
+
+def delete_sessions(chunk, days):
+    """
+    Deletes sessions completed more than `days` days ago, oldest first. Each chunk takes its rows
+    out of the rollups and recomputes the stats of the players it touched in the same transaction.
+    """
+    write_behind.flush()
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    names = [c.key for c in SOURCE_COLUMNS]
+    done = 0
+    while True:
+        stmt = (select(GameSession.id, GameSession.user_id, *SOURCE_COLUMNS)
+                .where(GameSession.completed_at < cutoff).order_by(GameSession.id).limit(chunk))
+        rows = db.session.execute(stmt).all()
+        if not rows:
+            return
+        upsert_rollups(fold_rollups((dict(zip(names, row[2:])) for row in rows), sign=-1))
+        db.session.execute(delete(GameSession).where(GameSession.id.in_([row[0] for row in rows])))
+        users = sorted({row[1] for row in rows})
+        _, mismatches = check_users(users)
+        fix(mismatches)
+        sync_users(users)
+        stats_changed(users)
+        done += len(rows)
+        yield done
+
+
+JOBS = {'recompute_stats': recompute_stats, 'delete_sessions': delete_sessions}
+
+
+class JobStore:
+    """Status rows of submitted jobs."""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._connect().executescript('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                params TEXT NOT NULL,
+                status TEXT NOT NULL,
+                done INTEGER NOT NULL DEFAULT 0,
+                message TEXT,
+                pid INTEGER NOT NULL,
+                created REAL NOT NULL,
+                updated REAL NOT NULL
+            );
+        ''')
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        # A connection opened before fork() (e.g. under gunicorn --preload) must not be reused
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, isolation_level=None, timeout=5)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def create(self, kind, params):
+        now = time.time()
+        cursor = self._connect().execute(
+            "INSERT INTO jobs (kind, params, status, pid, created, updated) VALUES (?, ?, 'queued', ?, ?, ?)",
+            (kind, json.dumps(params), os.getpid(), now, now))
+        return cursor.lastrowid
+
+    def update(self, job_id, **fields):
+        fields['updated'] = time.time()
+        assignments = ', '.join(f'{name} = ?' for name in fields)
+        self._connect().execute(f'UPDATE jobs SET {assignments} WHERE id = ?', (*fields.values(), job_id))
+
+    def get(self, job_id):
+        row = self._connect().execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return dict(row) if row else None
+
+    def recent(self, limit=20):
+        return [dict(row) for row in self._connect().execute('SELECT * FROM jobs ORDER BY id DESC LIMIT ?', (limit,))]
+
+
+class Jobs:
+    """Runs JOBS on a per-process background thread and records their progress."""
+
+    def __init__(self):
+        self.app = None
+        self.store = None
+        self.chunk = 1000
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.app = app
+        self.chunk = app.config.get('ADMIN_JOB_CHUNK', 1000)
+        self.store = JobStore(shared_file(app.config, 'ADMIN_JOBS_PATH', 'bvz_jobs.db'))
+
+    def submit(self, kind, **params):
+        if kind not in JOBS:
+            raise ValueError(f'Unknown job {kind!r}')
+        job_id = self.store.create(kind, params)
+        return job_id, self._pool().submit(self._run, job_id, kind, params)
+
+    def _pool(self):
+        # One thread per process: an executor inherited over fork() has no live thread
+        if self._executor is None or self._pid != os.getpid():
+            with self._lock:
+                if self._executor is None or self._pid != os.getpid():
+                    self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='admin-jobs')
+                    self._pid = os.getpid()
+        return self._executor
+
+    def _run(self, job_id, kind, params):
+        self.store.update(job_id, status='running', pid=os.getpid())
+        with self.app.app_context():
+            try:
+                for done in JOBS[kind](self.chunk, **params):
+                    self.store.update(job_id, done=done)
+            except Exception as error:
+                db.session.rollback()
+                self.store.update(job_id, status='failed', message=str(error))
+                return
+            finally:
+                db.session.remove()
+        self.store.update(job_id, status='done')
+
+    def recent(self, limit=20):
+        return self.store.recent(limit)
+
+
+jobs = Jobs()
@@ -0,0 +1,344 @@
+"""
+In-process leaderboard that is kept in sync with GameStats by the session endpoints.
+
+Standings live in a bucketed sorted list keyed by (-high_score, user_id), so top-N pages,
+offset pagination and rank lookups never touch the database once the board is loaded.
+The per-player rows themselves are __slots__ records kept in a pluggable local store.
+
+Each process has its own board. Every standings change bumps cache.leaderboard_version, which
+all workers on the host share along with a log of the players each bump changed: a board follows
+the bumps of the writes it applied itself, and on its next read refreshes just the players that
+other workers changed since. It is only rebuilt in full when first loaded, or when it fell more
+than LEADERBOARD_LOG_SLOTS changes behind. Its reads go to the writer, never to a replica that may
+not have the writes a version stands for yet.
+"""
+import bisect
+import threading
+from itertools import accumulate
+from sqlalchemy import select
+from cache import leaderboard_version
+from models import db, Profile, GameStats
+from replicas import read_from_primary
+from serializers import record
+
+BOARD_FIELDS = ('display_name', 'high_score', 'total_games', 'levels_completed')
+BoardRow = record('BoardRow', BOARD_FIELDS, __name__)
+# Leaderboard.changes when only a full rebuild will do
+ALL = object()
+# Players read per statement when catching up, within every backend's bound parameter limit
+REFRESH_CHUNK = 500
+
+
+class SortedKeyList:
+    """Sorted list split into buckets of roughly `load` keys with O(log n) lookups."""
+
+    def __init__(self, load=1000):
+        self._load = load
+        self._lists = []
+        self._maxes = []
+        self._offsets = None
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        for lst in self._lists:
+            yield from lst
+
+    def clear(self):
+        self._lists = []
+        self._maxes = []
+        self._offsets = None
+        self._len = 0
+
+    def update(self, keys):
+        keys = sorted(list(self) + list(keys))
+        self._lists = [keys[i:i + self._load] for i in range(0, len(keys), self._load)]
+        self._maxes = [lst[-1] for lst in self._lists]
+        self._offsets = None
+        self._len = len(keys)
+
+    def add(self, key):
+        if not self._maxes:
+            self._lists.append([key])
+            self._maxes.append(key)
+        else:
+            pos = bisect.bisect_left(self._maxes, key)
+            if pos == len(self._maxes):
+                pos -= 1
+                self._lists[pos].append(key)
+                self._maxes[pos] = key
+            else:
+                bisect.insort(self._lists[pos], key)
+            self._split(pos)
+        self._len += 1
+        self._offsets = None
+
+    def remove(self, key):
+        pos = bisect.bisect_left(self._maxes, key)
+        if pos == len(self._maxes):
+            raise ValueError(f'{key!r} not in list')
+        lst = self._lists[pos]
+        idx = bisect.bisect_left(lst, key)
+        if idx == len(lst) or lst[idx] != key:
+            raise ValueError(f'{key!r} not in list')
+        del lst[idx]
+        if lst:
+            self._maxes[pos] = lst[-1]
+        else:
+            del self._lists[pos]
+            del self._maxes[pos]
+        self._len -= 1
+        self._offsets = None
+
+    def index(self, key):
+        pos = bisect.bisect_left(self._maxes, key)
+        if pos < len(self._maxes):
+            lst = self._lists[pos]
+            idx = bisect.bisect_left(lst, key)
+            if idx < len(lst) and lst[idx] == key:
+                return self._bucket_offsets()[pos] + idx
+        raise ValueError(f'{key!r} not in list')
+
+    def islice(self, start, stop):
+        start = max(start, 0)
+        stop = min(stop, self._len)
+        if start >= stop:
+            return
+        offsets = self._bucket_offsets()
+        pos = bisect.bisect_right(offsets, start) - 1
+        idx = start - offsets[pos]
+        remaining = stop - start
+        while remaining > 0 and pos < len(self._lists):
+            chunk = self._lists[pos][idx:idx + remaining]
+            yield from chunk
+            remaining -= len(chunk)
+            pos += 1
+            idx = 0
+
+    def _split(self, pos):
+        lst = self._lists[pos]
+        if len(lst) > 2 * self._load:
+            half = lst[self._load:]
+            del lst[self._load:]
+            self._lists.insert(pos + 1, half)
+            self._maxes[pos] = lst[-1]
+            self._maxes.insert(pos + 1, half[-1])
+
+    def _bucket_offsets(self):
+        if self._offsets is None:
+            self._offsets = [0] + list(accumulate(len(lst) for lst in self._lists))
+        return self._offsets
+
+
+class MemoryStore:
+    """Keeps leaderboard rows in a plain dict; the default store."""
+
+    def __init__(self):
+        self._rows = {}
+
+    def get(self, user_id):
+        return self._rows.get(user_id)
+
+    def put(self, user_id, row):
+        self._rows[user_id] = row
+
+    def delete(self, user_id):
+        self._rows.pop(user_id, None)
+
+    def clear(self):
+        self._rows.clear()
+
+    def items(self):
+        return self._rows.items()
+
+
+class Leaderboard:
+    fields = BOARD_FIELDS
+
+    def __init__(self, store=None):
+        self.store = store if store is not None else MemoryStore()
+        self.loaded = False
+        # The leaderboard_version the standings reflect
+        self.version = None
+        self._keys = SortedKeyList()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def reset(self):
+        with self._lock:
+            self.store.clear()
+            self._keys.clear()
+            self.loaded = False
+            self.version = None
+
+    def changes(self, version):
+        """
+        What to read to reflect `version` of the shared standings: None when the board already
+        does, ALL for a full rebuild, else the ids of the players to refresh.
+        """
+        if self.loaded and self.version == version:
+            return None
+        if not self.loaded:
+            return ALL
+        changed = leaderboard_version.changed(self.version, version)
+        return ALL if changed is None else changed
+
+    def catch_up(self, version, user_ids, rows):
+        """Applies `rows` read for the `user_ids` that `changes(version)` returned."""
+        with self._lock:
+            if user_ids is ALL:
+                self.rebuild(rows, version)
+            else:
+                self.refresh(user_ids, rows)
+                self.version = version
+
+    def advance(self, before, after):
+        """Follows a bump made after this board applied the write, unless another process wrote first."""
+        with self._lock:
+            if self.loaded and self.version == before:
+                self.version = after
+
+    def rebuild(self, rows, version=None):
+        """
+        Replaces the standings with `rows` of (user_id, display_name, high_score, total_games,
+        levels_completed), read after leaderboard_version was `version`.
+        """
+        with self._lock:
+            self.store.clear()
+            self._keys.clear()
+            keys = []
+            for user_id, *values in rows:
+                row = BoardRow(*values)
+                self.store.put(user_id, row)
+                keys.append((-row.high_score, user_id))
+            self._keys.update(keys)
+            self.loaded = True
+            self.version = version
+
+    def upsert(self, user_id, **values):
+        with self._lock:
+            old = self.store.get(user_id)
+            row = old.replace(**values) if old is not None else BoardRow(**values)
+            if old is not None:
+                self._keys.remove((-old.high_score, user_id))
+            self.store.put(user_id, row)
+            self._keys.add((-row.high_score, user_id))
+
+    def refresh(self, user_ids, rows):
+        """Upserts `rows` (shaped as for rebuild) and drops any of `user_ids` they do not cover."""
+        with self._lock:
+            missing = set(user_ids)
+            for user_id, *values in rows:
+                missing.discard(user_id)
+                self.upsert(user_id, **dict(zip(self.fields, values)))
+            for user_id in missing:
+                self.remove(user_id)
+
+    def remove(self, user_id):
+        with self._lock:
+            old = self.store.get(user_id)
+            if old is not None:
+                self._keys.remove((-old.high_score, user_id))
+                self.store.delete(user_id)
+
+    def get(self, user_id):
+        return self.store.get(user_id)
+
+    def rank(self, user_id):
+        """1-based rank of `user_id`, or None when the player is not on the board."""
+        with self._lock:
+            row = self.store.get(user_id)
+            if row is None:
+                return None
+            return self._keys.index((-row.high_score, user_id)) + 1
+
+    def page(self, offset=0, limit=20):
+        with self._lock:
+            keys = list(self._keys.islice(offset, offset + limit))
+            return [self._entry(offset + i + 1, user_id) for i, (_, user_id) in enumerate(keys)]
+
+    def around(self, user_id, radius=5):
+        with self._lock:
+            rank = self.rank(user_id)
+            if rank is None:
+                return None, []
+            start = max(rank - 1 - radius, 0)
+            return rank, self.page(start, rank - start + radius)
+
+    def _entry(self, rank, user_id):
+        entry = self.store.get(user_id).as_dict()
+        entry['rank'] = rank
+        entry['user_id'] = user_id
+        return entry
+
+
+board = Leaderboard()
+leaderboard_version.on_bump.append(board.advance)
+
+
+def board_rows(user_ids=None):
+    """Statement for rows in the shape Leaderboard.rebuild expects, optionally for some players."""
+    stmt = (
+        select(GameStats.user_id, Profile.display_name, GameStats.high_score,
+               GameStats.total_games, GameStats.levels_completed)
+        .join(Profile, Profile.id == GameStats.user_id)
+    )
+    if user_ids is not None:
+        stmt = stmt.where(GameStats.user_id.in_(user_ids))
+    return stmt
+
+
+def refresh_chunks(user_ids):
+    ids = sorted(user_ids)
+    return [ids[start:start + REFRESH_CHUNK] for start in range(0, len(ids), REFRESH_CHUNK)]
+
+
+def ensure_loaded():
+    """Loads the board from GameStats the first time it is used in this process, then keeps up with other workers."""
+    version = leaderboard_version.value()
+    if board.changes(version) is None:
+        return board
+    # A replica may not have the writes behind `version` yet, and the board would be stamped with it regardless
+    with board._lock, read_from_primary():
+        version = leaderboard_version.value()
+        user_ids = board.changes(version)
+        if user_ids is ALL:
+            board.catch_up(version, ALL, db.session.execute(board_rows().execution_options(yield_per=10000)))
+        elif user_ids is not None:
+            rows = [row for chunk in refresh_chunks(user_ids) for row in db.session.execute(board_rows(chunk))]
+            board.catch_up(version, user_ids, rows)
+    return board
+
+
+def sync_stats(stats, display_name=None, session=None):
+    """Pushes a freshly committed GameStats row into the board."""
+    if not board.loaded:
+        return
+    if display_name is None:
+        row = board.get(stats.user_id)
+        if row is not None:
+            display_name = row.display_name
+        else:
+            with read_from_primary():
+                profile = (db.session if session is None else session).get(Profile, stats.user_id)
+            if profile is None:
+                return
+            display_name = profile.display_name
+    board.upsert(stats.user_id, display_name=display_name, high_score=stats.high_score,
+                 total_games=stats.total_games, levels_completed=stats.levels_completed)
+
+
+def sync_user(user_id):
+    sync_users([user_id])
+
+
+def sync_users(user_ids, session=None):
+    if not board.loaded:
+        return
+    user_ids = set(user_ids)
+    with read_from_primary():
+        board.refresh(user_ids, (db.session if session is None else session).execute(board_rows(user_ids)))
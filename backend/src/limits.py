@@ -0,0 +1,314 @@
+"""
+Per-route rate limiting and admission control, applied before a request reaches its view.
+
+RATE_LIMITS holds token buckets as `endpoint=requests/seconds[/burst]` separated by ';', e.g.
+`login_user=10/60;create_session=300/60/600;*=1200/60`, where `*` is one bucket shared by the
+endpoints without a rule of their own. A request takes a token from its endpoint's bucket for its
+caller: the JWT identity when it carries a valid token, else the client address. The buckets live
+in a memory-mapped file shared by every worker process on the host (in /dev/shm when available),
+so a caller gets the same allowance whichever worker answers. An empty bucket answers 429.
+
+Behind a reverse proxy every request arrives from the proxy's address, so PROXY_FIX_HOPS counts the
+proxies whose X-Forwarded-For is trusted: app.py applies werkzeug's ProxyFix and asgi.py reads the
+header with `forwarded_address`, so anonymous callers still get a bucket each.
+
+ADMISSION_LIMITS caps the requests in flight in each worker process, as `endpoint=concurrency` in
+the same form. A request waits up to ADMISSION_QUEUE_MS for a slot and is shed with a 503
+otherwise, before it checks out a database connection. The leaderboard's event stream holds its
+request for as long as the client listens, so it is never admission controlled.
+"""
+import asyncio
+import hashlib
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+import jwt
+from flask import g, jsonify, request
+from cache import shared_file
+
+try:
+    import fcntl
+except ImportError:  # not on Windows; buckets are then per process
+    fcntl = None
+
+DEFAULT = '*'
+MAGIC = b'BVZRATE1'
+HEADER = struct.Struct('<8sQ')
+# Slots of (key fingerprint, tokens, last update on the monotonic clock), locked WAYS at a time
+SLOT = struct.Struct('<Qdd')
+WAYS = 4
+GROUP = struct.Struct('<' + 'Qdd' * WAYS)
+MAX_CACHED = 10000
+# Long-lived responses that would hold a slot until their client goes away
+UNLIMITED = frozenset({'leaderboard_stream'})
+
+
+def parse_rules(text, parse):
+    """{endpoint: parse(value)} from `endpoint=value;...`."""
+    rules = {}
+    for item in (text or '').split(';'):
+        if not item.strip():
+            continue
+        name, sep, value = item.partition('=')
+        try:
+            if not sep or not name.strip():
+                raise ValueError
+            rules[name.strip()] = parse(value.strip())
+        except ValueError:
+            raise ValueError(f'Invalid limit {item.strip()!r}') from None
+    return rules
+
+
+def token_bucket(value):
+    """(tokens per second, burst) from `requests/seconds[/burst]`."""
+    parts = [float(part) for part in value.split('/')]
+    if len(parts) not in (2, 3) or min(parts) <= 0:
+        raise ValueError(value)
+    return parts[0] / parts[1], parts[2] if len(parts) == 3 else parts[0]
+
+
+def concurrency(value):
+    value = int(value)
+    if value <= 0:
+        raise ValueError(value)
+    return value
+
+
+class BucketTable:
+    """
+    Token buckets in a memory-mapped file, hashed into groups of WAYS slots that are each guarded
+    by a POSIX lock on their byte range. A key that finds its group full evicts the bucket updated
+    longest ago, which has usually refilled anyway. `slots` only applies to a new file.
+    """
+
+    def __init__(self, path, slots=65536):
+        self.path = path
+        self.groups = max(slots // WAYS, 1)
+        self._fd = None
+        self._map = None
+        self._pid = None
+        self._keys = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _lockf(fd, exclusive, length=0, start=0):
+        if fcntl is not None:
+            fcntl.lockf(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_UN, length, start)
+
+    def _open(self):
+        if fcntl is None:
+            # No POSIX locks to share the file safely: each process keeps buckets of its own
+            self._map = mmap.mmap(-1, HEADER.size + self.groups * GROUP.size)
+            HEADER.pack_into(self._map, 0, MAGIC, self.groups)
+            self._keys = {}
+            self._pid = os.getpid()
+            return
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        self._lockf(fd, True)
+        try:
+            magic, groups = HEADER.unpack(os.pread(fd, HEADER.size, 0).ljust(HEADER.size, b'\0'))
+            if magic != MAGIC or os.fstat(fd).st_size != HEADER.size + groups * GROUP.size:
+                groups = self.groups
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, HEADER.size + groups * GROUP.size)
+                os.pwrite(fd, HEADER.pack(MAGIC, groups), 0)
+        finally:
+            self._lockf(fd, False)
+        self.groups = groups
+        self._map = mmap.mmap(fd, HEADER.size + groups * GROUP.size)
+        self._fd = fd
+        self._keys = {}
+        self._pid = os.getpid()
+
+    def take(self, key, rate, burst, now=None):
+        """Takes a token from `key`'s bucket. Returns 0, or the seconds until one is available."""
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._open()
+        entry = self._keys.get(key)
+        if entry is None:
+            digest = int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'little')
+            if len(self._keys) >= MAX_CACHED:
+                self._keys.clear()
+            entry = self._keys[key] = (HEADER.size + digest % self.groups * GROUP.size, digest | 1)
+        offset, fingerprint = entry
+        if now is None:
+            now = time.monotonic()
+        # POSIX locks are held per process, so the threads of one process also take _lock
+        with self._lock:
+            self._lockf(self._fd, True, GROUP.size, offset)
+            try:
+                values = GROUP.unpack_from(self._map, offset)
+                fingerprints = values[0::3]
+                if fingerprint in fingerprints:
+                    way = fingerprints.index(fingerprint)
+                    tokens = min(burst, values[3 * way + 1] + max(now - values[3 * way + 2], 0) * rate)
+                else:
+                    way = fingerprints.index(0) if 0 in fingerprints else min(
+                        range(WAYS), key=lambda w: values[3 * w + 2])
+                    tokens = burst
+                wait = 0 if tokens >= 1 else (1 - tokens) / rate
+                SLOT.pack_into(self._map, offset + way * SLOT.size, fingerprint, tokens if wait else tokens - 1, now)
+            finally:
+                self._lockf(self._fd, False, GROUP.size, offset)
+        return wait
+
+    def clear(self):
+        if self._pid == os.getpid():
+            with self._lock:
+                self._lockf(self._fd, True)
+                try:
+                    self._map[HEADER.size:] = bytes(len(self._map) - HEADER.size)
+                finally:
+                    self._lockf(self._fd, False)
+
+
+class RateLimiter:
+    def __init__(self, app=None):
+        self.rules = {}
+        self.table = None
+        self.secret = None
+        self._identities = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.configure(app.config)
+        app.before_request(self._before_request)
+
+    def configure(self, config):
+        self.rules = parse_rules(config.get('RATE_LIMITS'), token_bucket)
+        self.secret = config.get('JWT_SECRET_KEY')
+        self._identities = {}
+        self.table = BucketTable(shared_file(config, 'RATE_LIMIT_PATH', 'bvz_rate_limits'),
+                                 config.get('RATE_LIMIT_SLOTS', 65536)) if self.rules else None
+
+    def identity(self, token):
+        """The subject of a valid access token, verified once per process and token."""
+        cached = self._identities.get(token)
+        if cached is not None:
+            return cached[0] if cached[1] > time.time() else None
+        try:
+            claims = jwt.decode(token, self.secret, algorithms=['HS256'])
+        except jwt.InvalidTokenError:
+            return None
+        if len(self._identities) >= MAX_CACHED:
+            self._identities.clear()
+        self._identities[token] = (claims.get('sub'), claims.get('exp', math.inf))
+        return claims.get('sub')
+
+    def caller(self, authorization, address):
+        if authorization and authorization.startswith('Bearer '):
+            identity = self.identity(authorization[len('Bearer '):])
+            if identity is not None:
+                return f'user:{identity}'
+        return f'ip:{address}'
+
+    def check(self, endpoint, caller, now=None):
+        """0 when `caller` may call `endpoint`, else the seconds it should wait."""
+        if not self.rules:
+            return 0
+        name = endpoint if endpoint in self.rules else DEFAULT
+        rule = self.rules.get(name)
+        if rule is None:
+            return 0
+        return self.table.take(f'{name}|{caller}', *rule, now=now)
+
+    def _before_request(self):
+        if not self.rules:
+            return None
+        wait = self.check(request.endpoint, self.caller(request.headers.get('Authorization'), request.remote_addr))
+        if wait:
+            return jsonify({'msg': 'Too many requests'}), 429, {'Retry-After': str(math.ceil(wait))}
+        return None
+
+
+def forwarded_address(forwarded_for, address, hops):
+    """The client address as ProxyFix(x_for=hops) reads it: `hops` entries from the end of X-Forwarded-For."""
+    if hops and forwarded_for:
+        values = [value.strip() for value in forwarded_for.split(',')]
+        if len(values) >= hops:
+            return values[-hops]
+    return address
+
+
+class AdmissionControl:
+    def __init__(self, app=None):
+        self.limits = {}
+        self.timeout = 0.05
+        self._slots = {}
+        self._async_slots = {}
+        self._pid = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.configure(app.config)
+        app.before_request(self._before_request)
+        app.teardown_request(self._teardown_request)
+
+    def configure(self, config):
+        self.limits = parse_rules(config.get('ADMISSION_LIMITS'), concurrency)
+        self.timeout = config.get('ADMISSION_QUEUE_MS', 50) / 1000
+        self._pid = None
+
+    def rule(self, endpoint):
+        """The rule `endpoint` is admitted under, or None when it is not limited."""
+        if endpoint in UNLIMITED:
+            return None
+        if endpoint in self.limits:
+            return endpoint
+        return DEFAULT if DEFAULT in self.limits else None
+
+    def _semaphores(self):
+        # Requests in flight in a parent at fork() never leave the child's slots
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._slots = {name: threading.BoundedSemaphore(n) for name, n in self.limits.items()}
+                    self._async_slots = {}
+                    self._pid = os.getpid()
+        return self._slots
+
+    def enter(self, name):
+        return self._semaphores()[name].acquire(timeout=self.timeout)
+
+    def leave(self, name):
+        self._semaphores()[name].release()
+
+    async def aenter(self, name):
+        self._semaphores()
+        slots = self._async_slots.get(name)
+        if slots is None:
+            slots = self._async_slots[name] = asyncio.Semaphore(self.limits[name])
+        try:
+            await asyncio.wait_for(slots.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    def aleave(self, name):
+        self._async_slots[name].release()
+
+    def _before_request(self):
+        name = self.rule(request.endpoint) if self.limits else None
+        if name is None:
+            return None
+        if not self.enter(name):
+            return jsonify({'msg': 'Server busy, retry shortly'}), 503, {'Retry-After': '1'}
+        g._admitted = name
+        return None
+
+    def _teardown_request(self, error):
+        name = g.pop('_admitted', None)
+        if name is not None:
+            self.leave(name)
+
+
+rate_limiter = RateLimiter()
+admission = AdmissionControl()
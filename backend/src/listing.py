@@ -0,0 +1,147 @@
+"""
+Keyset-paginated, column-projected reads over game_session for GET /sessions.
+
+Rows are fetched as plain column tuples (no ORM objects) in id order, one page at a time,
+so memory use does not depend on the size of the table, and turned into dicts by a compiled
+encoder. GET /sessions/export streams the archived sessions (archive.py) ahead of these.
+"""
+import csv
+import io
+from datetime import datetime
+from sqlalchemy import select
+from utils import APIException
+from models import db, GameSession
+from serializers import encoder, dumps
+from archive import OPS
+
+SESSION_COLUMNS = {column.key: column for column in GameSession.__table__.columns}
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+EXPORT_FORMATS = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+
+
+def _int_arg(args, name, minimum=0):
+    value = args.get(name)
+    if value is None or value == '':
+        return None
+    try:
+        value = int(value)
+    except ValueError:
+        raise APIException(f'Invalid {name}', 400)
+    if value < minimum:
+        raise APIException(f'Invalid {name}', 400)
+    return value
+
+
+def _datetime_arg(args, name):
+    value = args.get(name)
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        raise APIException(f'Invalid {name}', 400)
+
+
+class SessionListing:
+    """Parsed GET /sessions arguments plus the keyset queries they translate to."""
+
+    def __init__(self, args):
+        fields = args.get('fields')
+        self.fields = [f.strip() for f in fields.split(',') if f.strip()] if fields else list(SESSION_COLUMNS)
+        unknown = [f for f in self.fields if f not in SESSION_COLUMNS]
+        if unknown:
+            raise APIException(f"Unknown fields: {', '.join(unknown)}", 400)
+        self.descending = args.get('order', 'asc') == 'desc'
+        self.cursor = _int_arg(args, 'cursor')
+        self.limit = min(_int_arg(args, 'limit', minimum=1) or DEFAULT_LIMIT, MAX_LIMIT)
+        # (column, op, value) predicates, shared with archive scans
+        self.where = []
+        user_id = _int_arg(args, 'user_id')
+        if user_id is not None:
+            self.where.append(('user_id', '==', user_id))
+        min_score = _int_arg(args, 'min_score')
+        if min_score is not None:
+            self.where.append(('score', '>=', min_score))
+        max_score = _int_arg(args, 'max_score')
+        if max_score is not None:
+            self.where.append(('score', '<=', max_score))
+        since = _datetime_arg(args, 'from')
+        if since is not None:
+            self.where.append(('completed_at', '>=', since))
+        until = _datetime_arg(args, 'to')
+        if until is not None:
+            self.where.append(('completed_at', '<', until))
+        self.filters = [OPS[op](SESSION_COLUMNS[column], value) for column, op, value in self.where]
+        # Rows always start with id (see statement); it is only emitted when requested
+        self.columns = ['id'] + [f for f in self.fields if f != 'id']
+        self.encode = encoder(self.fields, [self.columns.index(f) for f in self.fields])
+
+    def statement(self, after, limit):
+        # id always comes first so the next cursor can be read from the last row
+        stmt = select(*(SESSION_COLUMNS[f] for f in self.columns)).where(*self.filters)
+        if after is not None:
+            stmt = stmt.where(GameSession.id < after if self.descending else GameSession.id > after)
+        order = GameSession.id.desc() if self.descending else GameSession.id.asc()
+        return stmt.order_by(order).limit(limit)
+
+    def page_statement(self):
+        # One row past the page tells whether another page exists
+        return self.statement(self.cursor, self.limit + 1)
+
+    def paginate(self, rows):
+        next_cursor = rows[self.limit - 1][0] if len(rows) > self.limit else None
+        return [self.encode(row) for row in rows[:self.limit]], next_cursor
+
+    def page(self):
+        """Returns (rows, next_cursor) for a single page."""
+        return self.paginate(db.session.execute(self.page_statement()).all())
+
+    def scan(self):
+        """Yields every matching row by walking keyset pages of `limit` rows."""
+        after = self.cursor
+        while True:
+            rows = db.session.execute(self.statement(after, self.limit)).all()
+            for row in rows:
+                yield self.encode(row)
+            if len(rows) < self.limit:
+                return
+            after = rows[-1][0]
+
+    def export(self, archive=None):
+        """Yields the matching archived rows, then `scan`'s."""
+        if archive is not None:
+            for row in archive.rows(self.columns, self.where):
+                yield self.encode(row)
+        yield from self.scan()
+
+
+def csv_line(values):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerow([v.isoformat() if isinstance(v, datetime) else v for v in values])
+    return buffer.getvalue()
+
+
+def stream_csv(fields, items):
+    yield csv_line(fields)
+    for item in items:
+        yield csv_line(item.values())
+
+
+def export_body(fmt, fields, items):
+    """Streamed body of GET /sessions/export in `fmt`, one of EXPORT_FORMATS."""
+    return stream_csv(fields, items) if fmt == 'csv' else stream_ndjson(items)
+
+
+def stream_json_array(items):
+    yield '['
+    first = True
+    for item in items:
+        yield dumps(item) if first else ',' + dumps(item)
+        first = False
+    yield ']'
+
+
+def stream_ndjson(items):
+    for item in items:
+        yield dumps(item) + '\n'
@@ -0,0 +1,150 @@
+"""
+Keeps GameStats exact when a stored session is edited or deleted.
+
+Sums move by the difference between the old and new row. The maxima (high_score and
+levels_completed) only need the database when the value being removed was the maximum; then the
+player's top two values are read from the (user_id, column DESC) indexes, which is enough to know
+the maximum with one occurrence of the old value taken out.
+
+Sessions moved to the archive still count in GameStats; their per-player share in archived_stats
+is added to the checks and joins the top-two values as one more candidate for the maxima.
+"""
+from datetime import datetime
+from sqlalchemy import select, func
+from models import db, GameStats, GameSession, ArchivedStats
+from sketches import score_sketches
+
+SUMS = (('total_score', 'score'), ('zombies_defeated', 'zombies_defeated'))
+MAXIMA = (('high_score', GameSession.score), ('levels_completed', GameSession.level_reached))
+
+STATS_COLUMNS = ('total_games', 'total_score', 'high_score', 'levels_completed', 'zombies_defeated')
+
+
+def top_two(user_id, column):
+    return select(column).where(GameSession.user_id == user_id).order_by(column.desc()).limit(2)
+
+
+def archived_maximum(user_id, field):
+    """The player's archived sessions' `field` maximum, a third candidate next to `top_two`."""
+    return select(getattr(ArchivedStats, field)).where(ArchivedStats.user_id == user_id)
+
+
+def combine(hot, archived):
+    """The stats of two disjoint sets of sessions taken together."""
+    maxima = {field for field, _ in MAXIMA}
+    return {c: max(hot[c], archived[c]) if c in maxima else hot[c] + archived[c] for c in STATS_COLUMNS}
+
+
+def lookups(stats, old, new):
+    """The maxima whose old value is being removed, as {stats field: session column}."""
+    needed = {}
+    for field, column in MAXIMA:
+        current = getattr(stats, field) or 0
+        removed = old[column.key] if old else None
+        added = new[column.key] if new else None
+        if removed is not None and removed >= current and (added is None or added < removed):
+            needed[field] = column
+    return needed
+
+
+def apply_change(stats, old, new, tops):
+    """
+    Moves `stats` from a state that includes the `old` session row to one that includes `new`
+    (either may be None). `tops` holds the top-two values read for each field from `lookups`,
+    taken while the old row was still stored.
+    """
+    sign = (1 if new else 0) - (1 if old else 0)
+    stats.total_games += sign
+    for field, key in SUMS:
+        delta = (new[key] if new else 0) - (old[key] if old else 0)
+        setattr(stats, field, getattr(stats, field) + delta)
+    for field, column in MAXIMA:
+        added = new[column.key] if new else None
+        if field in tops:
+            remaining = list(tops[field])
+            if old[column.key] in remaining:
+                remaining.remove(old[column.key])
+            candidates = remaining + ([added] if added is not None else [])
+            setattr(stats, field, max(candidates, default=0))
+        elif added is not None:
+            setattr(stats, field, max(getattr(stats, field) or 0, added))
+    stats.updated_at = datetime.utcnow()
+
+
+def adjust_stats(user_id, old, new, session=None):
+    """
+    Applies a session edit (old and new rows) or delete (new is None) to the player's GameStats.
+    Must run before the change is flushed. Returns the updated stats, or None without a stats row.
+    """
+    session = db.session if session is None else session
+    with session.no_autoflush:
+        stmt = select(GameStats).where(GameStats.user_id == user_id).with_for_update()
+        stats = session.scalars(stmt).first()
+        if stats is None:
+            return None
+        tops = {field: session.scalars(top_two(user_id, column)).all()
+                + session.scalars(archived_maximum(user_id, field)).all()
+                for field, column in lookups(stats, old, new).items()}
+    apply_change(stats, old, new, tops)
+    return stats
+
+
+def expected_stats(*where):
+    """GameStats as recomputed from game_session for the players matching `where`, archive left out."""
+    return (
+        select(
+            GameSession.user_id,
+            func.count(GameSession.id),
+            func.coalesce(func.sum(GameSession.score), 0),
+            func.coalesce(func.max(GameSession.score), 0),
+            func.coalesce(func.max(GameSession.level_reached), 0),
+            func.coalesce(func.sum(GameSession.zombies_defeated), 0),
+        )
+        .where(*where)
+        .group_by(GameSession.user_id)
+    )
+
+
+def _stats(model, where):
+    return select(model.user_id, *(getattr(model, c) for c in STATS_COLUMNS)).where(*where)
+
+
+def _compare(session_where, stats_where, archived_where):
+    expected = {row[0]: dict(zip(STATS_COLUMNS, row[1:])) for row in db.session.execute(expected_stats(*session_where))}
+    empty = dict.fromkeys(STATS_COLUMNS, 0)
+    for row in db.session.execute(_stats(ArchivedStats, archived_where)):
+        expected[row[0]] = combine(expected.get(row[0], empty), dict(zip(STATS_COLUMNS, row[1:])))
+    stmt = _stats(GameStats, stats_where)
+    mismatches = []
+    checked = 0
+    for row in db.session.execute(stmt):
+        checked += 1
+        actual = dict(zip(STATS_COLUMNS, row[1:]))
+        want = expected.get(row[0], empty)
+        if actual != want:
+            mismatches.append({'user_id': row[0], 'actual': actual, 'expected': want})
+    return checked, mismatches
+
+
+def check_range(lo, hi):
+    """Returns (checked, mismatches) for the GameStats rows of user ids in [lo, hi)."""
+    return _compare((GameSession.user_id >= lo, GameSession.user_id < hi),
+                    (GameStats.user_id >= lo, GameStats.user_id < hi),
+                    (ArchivedStats.user_id >= lo, ArchivedStats.user_id < hi))
+
+
+def check_users(user_ids):
+    """Returns (checked, mismatches) for the GameStats rows of `user_ids`."""
+    user_ids = list(user_ids)
+    return _compare((GameSession.user_id.in_(user_ids),), (GameStats.user_id.in_(user_ids),),
+                    (ArchivedStats.user_id.in_(user_ids),))
+
+
+def fix(mismatches):
+    now = datetime.utcnow()
+    for mismatch in mismatches:
+        db.session.query(GameStats).filter_by(user_id=mismatch['user_id']).update(
+            dict(mismatch['expected'], updated_at=now))
+    score_sketches.stage(db.session, score_sketches.players(
+        (m['actual']['high_score'], m['expected']['high_score']) for m in mismatches))
+    db.session.commit()
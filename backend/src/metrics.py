@@ -0,0 +1,431 @@
+"""
+Request, SQL and connection-pool instrumentation, published on GET /metrics in Prometheus text format.
+
+Every process accumulates its own series in memory and periodically writes a snapshot of them to
+a SQLite file shared by all workers on the host (in /dev/shm when available). A scrape answered by
+any worker therefore sums the series of every worker. Counters and histograms of exited workers
+are folded into one set of rows so totals never go backwards while the table stays bounded; gauges
+are only reported for processes that are still alive.
+
+Slow statements are sampled to GET /metrics/slow. A request carrying `X-Profile: <PROFILE_TOKEN>`
+is run under a stack-sampling profiler whose collapsed stacks are served by
+GET /metrics/profiles/<id>, the id being returned in the X-Profile-Id response header. Both hold
+SQL and code paths, so they answer 404 without that header.
+"""
+import atexit
+import os
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+from flask import Response, g, has_request_context, jsonify, request, request_finished, request_started
+from sqlalchemy import event
+from cache import shared_file
+
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'))
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100, float('inf'))
+WAIT_BUCKETS = (0.0001, 0.001, 0.01, 0.05, 0.1, 0.5, 1, 5, float('inf'))
+
+FAMILIES = {
+    'http_request_duration_seconds': ('histogram', 'Time spent handling a request, by endpoint.'),
+    'db_queries_per_request': ('histogram', 'SQL statements executed per request, by endpoint.'),
+    'db_query_seconds_per_request': ('histogram', 'Time spent in SQL statements per request, by endpoint.'),
+    'db_queries_total': ('counter', 'SQL statements executed, by endpoint.'),
+    'db_query_seconds_total': ('counter', 'Time spent in SQL statements, by endpoint.'),
+    'db_slow_queries_total': ('counter', 'SQL statements slower than SLOW_QUERY_MS, by endpoint.'),
+    'db_pool_checkout_wait_seconds': ('histogram', 'Time spent waiting for a pooled connection.'),
+    'db_pool_checkouts_total': ('counter', 'Connections handed out by the pool.'),
+    'db_pool_overflow_checkouts_total': ('counter', 'Checkouts served by an overflow connection.'),
+    'db_pool_checked_out': ('gauge', 'Connections currently checked out.'),
+    'db_pool_overflow': ('gauge', 'Overflow connections currently open.'),
+    'db_pool_size': ('gauge', 'Configured pool size.'),
+}
+
+MAX_SLOW_SAMPLES = 200
+MAX_PROFILES = 20
+BACKGROUND = '<background>'
+# proc of the counters and histograms folded in from exited processes
+EXITED = '<exited>'
+
+
+def render_labels(labels):
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return ','.join(f'{key}="{escape(value)}"' for key, value in labels)
+
+
+def format_value(value):
+    return repr(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class MetricsStore:
+    """Snapshots of every process's series plus the slow-query and profile samples."""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._connect().executescript('''
+            CREATE TABLE IF NOT EXISTS samples (
+                proc TEXT NOT NULL,
+                pid INTEGER NOT NULL,
+                kind TEXT NOT NULL,
+                family TEXT NOT NULL,
+                name TEXT NOT NULL,
+                labels TEXT NOT NULL,
+                le REAL,
+                value REAL NOT NULL,
+                PRIMARY KEY (proc, name, labels, le)
+            );
+            CREATE TABLE IF NOT EXISTS slow_queries (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                at REAL NOT NULL,
+                pid INTEGER NOT NULL,
+                endpoint TEXT NOT NULL,
+                seconds REAL NOT NULL,
+                statement TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS profiles (
+                id TEXT PRIMARY KEY,
+                at REAL NOT NULL,
+                endpoint TEXT NOT NULL,
+                samples INTEGER NOT NULL,
+                folded TEXT NOT NULL
+            );
+        ''')
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        # A connection opened before fork() (e.g. under gunicorn --preload) must not be reused
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, isolation_level=None, timeout=5)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=OFF')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def publish(self, proc, pid, rows):
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute('DELETE FROM samples WHERE proc = ?', (proc,))
+            conn.executemany('INSERT INTO samples VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                             [(proc, pid) + row for row in rows])
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def retire(self, pids):
+        """Drops the gauges of the exited `pids` and folds their other series into the EXITED rows."""
+        conn = self._connect()
+        marks = ','.join('?' * len(pids))
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            rows = conn.execute(f'''
+                SELECT kind, family, name, labels, le, sum(value) FROM samples
+                WHERE kind != 'gauge' AND (proc = ? OR pid IN ({marks}))
+                GROUP BY kind, family, name, labels, le
+            ''', [EXITED, *pids]).fetchall()
+            conn.execute(f'DELETE FROM samples WHERE proc = ? OR pid IN ({marks})', [EXITED, *pids])
+            conn.executemany('INSERT INTO samples VALUES (?, 0, ?, ?, ?, ?, ?, ?)', [(EXITED,) + row for row in rows])
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def aggregate(self):
+        conn = self._connect()
+        dead = [pid for (pid,) in conn.execute('SELECT DISTINCT pid FROM samples WHERE proc != ?', (EXITED,))
+                if not pid_alive(pid)]
+        if dead:
+            self.retire(dead)
+        return conn.execute('''
+            SELECT family, name, labels, le, sum(value) FROM samples
+            GROUP BY family, name, labels, le
+            ORDER BY family, labels, name, le
+        ''').fetchall()
+
+    def add_slow_query(self, endpoint, seconds, statement):
+        conn = self._connect()
+        conn.execute('INSERT INTO slow_queries (at, pid, endpoint, seconds, statement) VALUES (?, ?, ?, ?, ?)',
+                     (time.time(), os.getpid(), endpoint, seconds, statement))
+        conn.execute('DELETE FROM slow_queries WHERE id <= (SELECT max(id) FROM slow_queries) - ?',
+                     (MAX_SLOW_SAMPLES,))
+
+    def slow_queries(self, limit):
+        rows = self._connect().execute(
+            'SELECT at, pid, endpoint, seconds, statement FROM slow_queries ORDER BY id DESC LIMIT ?', (limit,))
+        return [dict(zip(('at', 'pid', 'endpoint', 'seconds', 'statement'), row)) for row in rows]
+
+    def add_profile(self, profile_id, endpoint, samples, folded):
+        conn = self._connect()
+        conn.execute('INSERT INTO profiles VALUES (?, ?, ?, ?, ?)', (profile_id, time.time(), endpoint, samples, folded))
+        conn.execute('DELETE FROM profiles WHERE id NOT IN (SELECT id FROM profiles ORDER BY at DESC LIMIT ?)',
+                     (MAX_PROFILES,))
+
+    def profile(self, profile_id):
+        row = self._connect().execute('SELECT folded FROM profiles WHERE id = ?', (profile_id,)).fetchone()
+        return row[0] if row else None
+
+    def clear(self):
+        self._connect().executescript('DELETE FROM samples; DELETE FROM slow_queries; DELETE FROM profiles;')
+
+
+class Sampler:
+    """Samples one thread's stack every `interval` seconds into collapsed-stack counts."""
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profile-sampler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}')
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def folded(self):
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+
+class Metrics:
+    def __init__(self, app=None, db=None):
+        self.app = None
+        self.enabled = False
+        self.store = None
+        self.interval = 5
+        self.slow_query_seconds = 0.25
+        self.profile_token = None
+        self.profile_interval = 0.005
+        self._values = defaultdict(float)
+        self._lock = threading.Lock()
+        self._engines = {}
+        self._pid = None
+        self._proc = None
+        self._thread = None
+        self._stop = threading.Event()
+        if app is not None:
+            self.init_app(app, db)
+
+    def init_app(self, app, db):
+        config = app.config
+        self.app = app
+        self.enabled = config.get('METRICS_ENABLED', True)
+        if not self.enabled:
+            return
+        self.store = MetricsStore(shared_file(config, 'METRICS_PATH', 'bvz_metrics.db'))
+        self.interval = config.get('METRICS_FLUSH_INTERVAL', 5)
+        self.slow_query_seconds = config.get('SLOW_QUERY_MS', 250) / 1000
+        self.profile_token = config.get('PROFILE_TOKEN') or None
+        self.profile_interval = config.get('PROFILE_INTERVAL_MS', 5) / 1000
+        request_started.connect(self._request_started, app, weak=False)
+        request_finished.connect(self._request_finished, app, weak=False)
+        with app.app_context():
+            for bind, engine in db.engines.items():
+                self.instrument(engine, bind or 'default')
+        app.add_url_rule('/metrics', 'metrics', self.exposition)
+        app.add_url_rule('/metrics/slow', 'slow_queries', self.slow_queries)
+        app.add_url_rule('/metrics/profiles/<profile_id>', 'profile', self.profile)
+        atexit.register(self.publish)
+
+    def instrument(self, engine, bind):
+        self._engines[bind] = engine
+        event.listen(engine, 'before_cursor_execute', self._before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', self._after_cursor_execute)
+        pool = engine.pool
+        labels = (('bind', bind),)
+
+        def on_checkout(dbapi_connection, connection_record, connection_proxy):
+            self.inc('db_pool_checkouts_total', labels)
+            overflow = getattr(pool, 'overflow', None)
+            if overflow is not None and overflow() > 0:
+                self.inc('db_pool_overflow_checkouts_total', labels)
+
+        event.listen(pool, 'checkout', on_checkout)
+        # The pool has no event for the start of a checkout, so the wait is timed around the
+        # method that blocks on the queue
+        do_get = pool._do_get
+
+        def timed_do_get():
+            started = time.perf_counter()
+            try:
+                return do_get()
+            finally:
+                self.observe('db_pool_checkout_wait_seconds', labels, time.perf_counter() - started, WAIT_BUCKETS)
+
+        pool._do_get = timed_do_get
+
+    # Recording
+
+    def _local(self):
+        # Series inherited over fork() belong to the parent
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._values.clear()
+                    self._pid = os.getpid()
+                    self._proc = f'{self._pid}-{uuid.uuid4().hex[:8]}'
+                    self._stop.clear()
+                    self._thread = threading.Thread(target=self._run, name='metrics-publisher', daemon=True)
+                    self._thread.start()
+        return self._values
+
+    def inc(self, family, labels, amount=1):
+        values = self._local()
+        with self._lock:
+            values[(family, family, labels, None)] += amount
+
+    def observe(self, family, labels, value, buckets):
+        values = self._local()
+        with self._lock:
+            for le in buckets:
+                values[(family, f'{family}_bucket', labels, le)] += 1 if value <= le else 0
+            values[(family, f'{family}_sum', labels, None)] += value
+            values[(family, f'{family}_count', labels, None)] += 1
+
+    def _gauges(self):
+        rows = []
+        for bind, engine in self._engines.items():
+            labels = render_labels((('bind', bind),))
+            for family, method in (('db_pool_checked_out', 'checkedout'), ('db_pool_overflow', 'overflow'),
+                                   ('db_pool_size', 'size')):
+                read = getattr(engine.pool, method, None)
+                if read is not None:
+                    rows.append(('gauge', family, family, labels, None, max(read(), 0)))
+        return rows
+
+    def publish(self):
+        if not self.enabled:
+            return
+        values = self._local()
+        with self._lock:
+            snapshot = list(values.items())
+        rows = [(FAMILIES[family][0], family, name, render_labels(labels), le, value)
+                for (family, name, labels, le), value in snapshot]
+        self.store.publish(self._proc, self._pid, rows + self._gauges())
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.publish()
+            except Exception:
+                self.app.logger.exception('publishing metrics failed')
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+        if self.store is not None:
+            self.store.clear()
+
+    # Hooks
+
+    def _endpoint(self):
+        return (request.endpoint or '<unmatched>') if has_request_context() else BACKGROUND
+
+    def _request_started(self, sender, **extra):
+        g._metrics = {'started': time.perf_counter(), 'queries': 0, 'query_seconds': 0.0, 'sampler': None}
+        if self.profile_token and request.headers.get('X-Profile') == self.profile_token:
+            g._metrics['sampler'] = Sampler(threading.get_ident(), self.profile_interval).start()
+
+    def _request_finished(self, sender, response, **extra):
+        state = g.pop('_metrics', None)
+        if state is None:
+            return
+        endpoint = self._endpoint()
+        labels = (('endpoint', endpoint), ('method', request.method), ('status', response.status_code))
+        self.observe('http_request_duration_seconds', labels, time.perf_counter() - state['started'],
+                     REQUEST_BUCKETS)
+        self.observe('db_queries_per_request', (('endpoint', endpoint),), state['queries'], QUERY_COUNT_BUCKETS)
+        self.observe('db_query_seconds_per_request', (('endpoint', endpoint),), state['query_seconds'],
+                     REQUEST_BUCKETS)
+        sampler = state['sampler']
+        if sampler is not None:
+            sampler.stop()
+            profile_id = uuid.uuid4().hex
+            self.store.add_profile(profile_id, endpoint, sum(sampler.stacks.values()), sampler.folded())
+            response.headers['X-Profile-Id'] = profile_id
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('metrics_started', []).append(time.perf_counter())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['metrics_started'].pop()
+        endpoint = self._endpoint()
+        if endpoint != BACKGROUND:
+            state = g.get('_metrics')
+            if state is not None:
+                state['queries'] += 1
+                state['query_seconds'] += elapsed
+        labels = (('endpoint', endpoint),)
+        self.inc('db_queries_total', labels)
+        self.inc('db_query_seconds_total', labels, elapsed)
+        if elapsed >= self.slow_query_seconds:
+            self.inc('db_slow_queries_total', labels)
+            self.store.add_slow_query(endpoint, elapsed, statement[:4000])
+
+    # Views
+
+    def exposition(self):
+        self.publish()
+        lines = []
+        family = None
+        for fam, name, labels, le, value in self.store.aggregate():
+            if fam != family:
+                family = fam
+                kind, help_text = FAMILIES[fam]
+                lines.append(f'# HELP {fam} {help_text}')
+                lines.append(f'# TYPE {fam} {kind}')
+            if le is not None:
+                le_label = 'le="+Inf"' if le == float('inf') else f'le="{format_value(le)}"'
+                labels = f'{labels},{le_label}' if labels else le_label
+            lines.append(f'{name}{{{labels}}} {format_value(value)}' if labels else f'{name} {format_value(value)}')
+        return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+    def _authorized(self):
+        return bool(self.profile_token) and request.headers.get('X-Profile') == self.profile_token
+
+    def slow_queries(self):
+        if not self._authorized():
+            return jsonify({'msg': 'Not found'}), 404
+        return jsonify(self.store.slow_queries(request.args.get('limit', 50, type=int)))
+
+    def profile(self, profile_id):
+        if not self._authorized():
+            return jsonify({'msg': 'Not found'}), 404
+        folded = self.store.profile(profile_id)
+        if folded is None:
+            return jsonify({'msg': 'Not found'}), 404
+        return Response(folded, mimetype='text/plain')
+
+
+metrics = Metrics()
@@ -1,9 +1,11 @@
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import String, Boolean, Integer, ForeignKey, DateTime
-from sqlalchemy.orm import Mapped, mapped_column, relationship
+from sqlalchemy import String, Text, Boolean, Integer, BigInteger, ForeignKey, DateTime, Index
+from sqlalchemy.orm import Mapped, mapped_column, relationship, backref
 from datetime import datetime
+from replicas import RoutingSession
 
-db = SQLAlchemy()
+# GET requests read from the replicas configured in DATABASE_REPLICA_URLS, see replicas.py
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 
 class User(db.Model):
     id: Mapped[int] = mapped_column(primary_key=True)
@@ -26,7 +28,7 @@ class Profile(db.Model):
     avatar_url: Mapped[str | None] = mapped_column(String(200), nullable=True)
     created_at: Mapped[datetime] = mapped_column(DateTime(), default=datetime.utcnow)
     updated_at: Mapped[datetime] = mapped_column(DateTime(), default=datetime.utcnow)
-    user = relationship('User', backref='profile', uselist=False)
+    user = relationship('User', backref=backref('profile', uselist=False))
 
     def serialize(self):
         return {
@@ -48,7 +50,7 @@ class GameStats(db.Model):
     zombies_defeated: Mapped[int] = mapped_column(Integer(), default=0)
     created_at: Mapped[datetime] = mapped_column(DateTime(), default=datetime.utcnow)
     updated_at: Mapped[datetime] = mapped_column(DateTime(), default=datetime.utcnow)
-    user = relationship('User', backref='stats', uselist=False)
+    user = relationship('User', backref=backref('stats', uselist=False))
 
     def serialize(self):
         return {
@@ -83,3 +85,88 @@ class GameSession(db.Model):
             "duration_seconds": self.duration_seconds,
             "completed_at": self.completed_at.isoformat(),
         }
+
+
+class ArchivedStats(db.Model):
+    """Each player's share of the sessions moved to the archive, which GameStats still counts."""
+    __tablename__ = 'archived_stats'
+    user_id: Mapped[int] = mapped_column(ForeignKey('user.id'), primary_key=True)
+    total_games: Mapped[int] = mapped_column(Integer(), default=0)
+    high_score: Mapped[int] = mapped_column(Integer(), default=0)
+    total_score: Mapped[int] = mapped_column(Integer(), default=0)
+    levels_completed: Mapped[int] = mapped_column(Integer(), default=0)
+    zombies_defeated: Mapped[int] = mapped_column(Integer(), default=0)
+    updated_at: Mapped[datetime] = mapped_column(DateTime(), default=datetime.utcnow)
+
+
+class BulkLoad(db.Model):
+    """Progress of a `flask data import`, committed with each chunk so a rerun resumes after it."""
+    __tablename__ = 'bulk_load'
+    name: Mapped[str] = mapped_column(String(500), primary_key=True)
+    bytes_read: Mapped[int] = mapped_column(BigInteger(), default=0)
+    lines_read: Mapped[int] = mapped_column(BigInteger(), default=0)
+    loaded: Mapped[int] = mapped_column(BigInteger(), default=0)
+    rejected: Mapped[int] = mapped_column(BigInteger(), default=0)
+    # Players with sessions above it get their stats rebuilt when the load finishes
+    first_session_id: Mapped[int] = mapped_column(BigInteger(), default=0)
+    finished_at: Mapped[datetime | None] = mapped_column(DateTime(), nullable=True)
+    updated_at: Mapped[datetime] = mapped_column(DateTime(), default=datetime.utcnow)
+
+
+class SessionKey(db.Model):
+    """The Idempotency-Key of a POST /sessions and the response it got, replayed to retries."""
+    __tablename__ = 'session_key'
+    user_id: Mapped[int] = mapped_column(ForeignKey('user.id'), primary_key=True)
+    key: Mapped[str] = mapped_column(String(255), primary_key=True)
+    # No foreign key: the session may be deleted or archived while retries are still replayed
+    session_id: Mapped[int] = mapped_column(Integer())
+    request_hash: Mapped[str] = mapped_column(String(64))
+    response: Mapped[str] = mapped_column(Text())
+    created_at: Mapped[datetime] = mapped_column(DateTime(), default=datetime.utcnow, index=True)
+
+
+class RollupCounters:
+    """Additive totals over the sessions of one rollup bucket."""
+    games: Mapped[int] = mapped_column(BigInteger(), default=0)
+    total_score: Mapped[int] = mapped_column(BigInteger(), default=0)
+    zombies_defeated: Mapped[int] = mapped_column(BigInteger(), default=0)
+    total_duration: Mapped[int] = mapped_column(BigInteger(), default=0)
+
+
+class HourlyRollup(RollupCounters, db.Model):
+    __tablename__ = 'rollup_hourly'
+    bucket: Mapped[datetime] = mapped_column(DateTime(), primary_key=True)
+
+
+class DailyRollup(RollupCounters, db.Model):
+    __tablename__ = 'rollup_daily'
+    bucket: Mapped[datetime] = mapped_column(DateTime(), primary_key=True)
+
+
+class LevelRollup(RollupCounters, db.Model):
+    __tablename__ = 'rollup_level'
+    bucket: Mapped[datetime] = mapped_column(DateTime(), primary_key=True)
+    level: Mapped[int] = mapped_column(Integer(), primary_key=True)
+
+
+class StatsJournalMark(db.Model):
+    """The last row of a write-behind journal (writebehind.py) folded into GameStats and the rollups."""
+    __tablename__ = 'stats_journal_mark'
+    journal: Mapped[str] = mapped_column(String(36), primary_key=True)
+    applied_id: Mapped[int] = mapped_column(BigInteger(), default=0)
+    updated_at: Mapped[datetime] = mapped_column(DateTime(), default=datetime.utcnow)
+
+
+class ScoreSketch(db.Model):
+    """One bucket of a level's score sketch (sketches.py): the sessions whose score falls in it."""
+    __tablename__ = 'score_sketch'
+    level: Mapped[int] = mapped_column(Integer(), primary_key=True)
+    bucket: Mapped[int] = mapped_column(Integer(), primary_key=True)
+    count: Mapped[int] = mapped_column(BigInteger(), default=0)
+
+
+Index('ix_game_session_user_id_completed_at', GameSession.user_id, GameSession.completed_at)
+Index('ix_game_session_user_id_score', GameSession.user_id, GameSession.score.desc())
+Index('ix_game_session_user_id_level_reached', GameSession.user_id, GameSession.level_reached.desc())
+Index('ix_game_session_completed_at', GameSession.completed_at)
+Index('ix_game_stats_high_score', GameStats.high_score.desc(), GameStats.user_id)
@@ -0,0 +1,90 @@
+"""
+Statements and row serializers shared by the WSGI and ASGI entry points.
+
+Reads select plain columns and are turned into response dicts by compiled encoders, so no ORM
+objects are built for them.
+"""
+from sqlalchemy import select
+from models import User, Profile, GameStats, GameSession
+from serializers import MODEL_FIELDS, model_columns, model_encoder
+
+# Where each model's columns start in a player_statement row
+PLAYER_OFFSETS = {}
+_offset = 0
+for _model in (User, Profile, GameStats, GameSession):
+    PLAYER_OFFSETS[_model] = _offset
+    _offset += len(MODEL_FIELDS[_model])
+
+encode_user = model_encoder(User)
+encode_session = model_encoder(GameSession)
+encode_stats = model_encoder(GameStats)
+
+
+def profile_statement(user_id):
+    return (
+        select(*model_columns(User), Profile.display_name)
+        .outerjoin(Profile, Profile.id == User.id)
+        .where(User.id == user_id)
+    )
+
+
+def serialize_profile(row):
+    data = encode_user(row)
+    display_name = row[-1]
+    if display_name is not None:
+        data['display_name'] = display_name
+    return data
+
+
+def session_statement(session_id):
+    return select(*model_columns(GameSession)).where(GameSession.id == session_id)
+
+
+def stats_statement(user_id):
+    return select(*model_columns(GameStats)).where(GameStats.user_id == user_id)
+
+
+def high_score_statement(user_id):
+    return select(GameStats.high_score).where(GameStats.user_id == user_id)
+
+
+def player_statement(user_id, limit):
+    # User, profile, stats and the latest sessions come back from one statement;
+    # the user's columns repeat on each session row.
+    recent = (
+        select(*model_columns(GameSession))
+        .where(GameSession.user_id == user_id)
+        .order_by(GameSession.completed_at.desc(), GameSession.id.desc())
+        .limit(limit)
+        .subquery()
+    )
+    return (
+        select(*model_columns(User), *model_columns(Profile), *model_columns(GameStats),
+               *(recent.c[field] for field in MODEL_FIELDS[GameSession]))
+        .outerjoin(Profile, Profile.id == User.id)
+        .outerjoin(GameStats, GameStats.user_id == User.id)
+        .outerjoin(recent, recent.c.user_id == User.id)
+        .where(User.id == user_id)
+        .order_by(recent.c.completed_at.desc(), recent.c.id.desc())
+    )
+
+
+def _part(model):
+    # Every serialized model starts with a non-null key column, so None there means no row
+    offset = PLAYER_OFFSETS[model]
+    encode = model_encoder(model, offset)
+    return lambda row: encode(row) if row[offset] is not None else None
+
+
+_player_profile = _part(Profile)
+_player_stats = _part(GameStats)
+_player_session = _part(GameSession)
+
+
+def serialize_player(rows):
+    first = rows[0]
+    data = encode_user(first)
+    data['profile'] = _player_profile(first)
+    data['stats'] = _player_stats(first)
+    data['recent_sessions'] = [s for s in map(_player_session, rows) if s is not None]
+    return data
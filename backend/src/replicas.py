@@ -0,0 +1,181 @@
+"""
+Read replicas: DATABASE_REPLICA_URLS adds one SQLAlchemy bind per replica (replica_0, replica_1, ...).
+
+While a GET or HEAD request is served, the SELECTs of `db.session` go to a healthy replica, the
+same one for the whole request and the next one in turn for the next request; writes, SELECT ...
+FOR UPDATE, anything outside a request and every statement after the request's first flush stay
+on the writer. A thread per process probes the replicas every
+REPLICA_CHECK_INTERVAL seconds, and those that fail or trail the writer by more than
+REPLICA_MAX_LAG seconds are skipped until they recover; with none left, reads fall back to the writer.
+
+Reads that must see the latest writes use `read_from_primary()`, the `@primary` view decorator, or
+(from clients) an `X-Read-Primary: 1` request header.
+"""
+import itertools
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from flask import g, has_app_context, has_request_context, request
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event, text
+
+READ_METHODS = ('GET', 'HEAD')
+
+LAG_QUERIES = {
+    'postgresql': """
+        SELECT CASE
+            WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+            ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+        END
+    """,
+}
+
+
+def replication_lag(conn):
+    """Seconds the database behind `conn` trails its primary; 0 where the dialect cannot tell."""
+    query = LAG_QUERIES.get(conn.dialect.name, 'SELECT 0')
+    return float(conn.execute(text(query)).scalar() or 0)
+
+
+class ReplicaRouter:
+    def __init__(self, app=None, db=None):
+        self.app = None
+        self.db = None
+        self.keys = []
+        self.max_lag = 5.0
+        self.interval = 5.0
+        self.status = {}
+        self._healthy = []
+        self._turn = itertools.count()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._stop = threading.Event()
+        if app is not None:
+            self.init_app(app, db)
+
+    def init_app(self, app, db):
+        self.app = app
+        self.db = db
+        self.keys = sorted(key for key in app.config.get('SQLALCHEMY_BINDS') or {} if key.startswith('replica_'))
+        self.max_lag = app.config.get('REPLICA_MAX_LAG', 5.0)
+        self.interval = app.config.get('REPLICA_CHECK_INTERVAL', 5.0)
+        self.status = {}
+        self._healthy = []
+        self._pid = None
+        app.after_request(self._tag_response)
+
+    def routes_reads(self):
+        return (bool(self.keys) and has_request_context() and request.method in READ_METHODS
+                and not g.get('read_primary') and request.headers.get('X-Read-Primary') != '1')
+
+    def pick(self):
+        """
+        Bind key of the request's replica, or None to read from the writer. A request keeps the
+        replica of its first read, so its queries see one snapshot of replication progress.
+        """
+        self._ensure_started()
+        healthy = self._healthy
+        key = g.get('read_replica')
+        if key is not None and key in healthy:
+            return key
+        if not healthy:
+            return None
+        key = healthy[next(self._turn) % len(healthy)]
+        g.read_replica = key
+        return key
+
+    def check(self):
+        """Probes every replica and keeps those that answer within REPLICA_MAX_LAG seconds of lag."""
+        healthy = []
+        with self.app.app_context():
+            for key in self.keys:
+                status = {'healthy': False, 'lag': None, 'error': None, 'checked_at': time.time()}
+                try:
+                    with self.db.engines[key].connect() as conn:
+                        status['lag'] = replication_lag(conn)
+                    status['healthy'] = status['lag'] <= self.max_lag
+                except Exception as error:
+                    status['error'] = str(error).splitlines()[0]
+                if status['healthy']:
+                    healthy.append(key)
+                self.status[key] = status
+        self._healthy = healthy
+        return healthy
+
+    def _ensure_started(self):
+        # Checked once before the first replica read, then by a thread started per pid after fork
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self.check()
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='replica-check', daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.check()
+            except Exception:
+                self.app.logger.exception('replica check failed')
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join()
+
+    def _tag_response(self, response):
+        key = g.get('read_replica')
+        if key is not None:
+            response.headers['X-Read-Replica'] = key
+        return response
+
+
+replicas = ReplicaRouter()
+
+
+class RoutingSession(Session):
+    """Flask-SQLAlchemy session that sends the SELECTs of read-only requests to a replica."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if (bind is None and not self._flushing and getattr(clause, 'is_select', False)
+                and getattr(clause, '_for_update_arg', None) is None and replicas.routes_reads()):
+            key = replicas.pick()
+            if key is not None:
+                return self._db.engines[key]
+        return super().get_bind(mapper, clause=clause, bind=bind, **kwargs)
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _read_own_writes(session, context):
+    if has_request_context():
+        g.read_primary = True
+
+
+@contextmanager
+def read_from_primary():
+    """Sends the reads made inside the block to the writer."""
+    if not has_app_context():
+        yield
+        return
+    previous = g.get('read_primary', False)
+    g.read_primary = True
+    try:
+        yield
+    finally:
+        g.read_primary = previous
+
+
+def primary(view):
+    """View decorator: the whole request reads from the writer."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        with read_from_primary():
+            return view(*args, **kwargs)
+    return wrapper
@@ -0,0 +1,227 @@
+"""
+Hourly, daily and per-level-per-day rollups of game_session for GET /stats/global.
+
+Every session write folds its row into the three tables as a signed delta (+1 on insert, -1 on
+delete, both on update), so the totals stay exact without rescanning game_session. Only additive
+counters are kept; averages are derived from them at read time.
+"""
+from datetime import datetime, timedelta
+from sqlalchemy import select, func, delete
+from sqlalchemy.dialects import postgresql, sqlite
+from models import db, GameSession, GameStats, HourlyRollup, DailyRollup, LevelRollup, ScoreSketch
+from sketches import score_sketches
+from utils import APIException
+
+ROLLUPS = (HourlyRollup, DailyRollup, LevelRollup)
+COUNTERS = ('games', 'total_score', 'zombies_defeated', 'total_duration')
+UPSERT_DIALECTS = ('sqlite', 'postgresql')
+
+BUCKETS = {'hour': HourlyRollup, 'day': DailyRollup, 'level': LevelRollup}
+# Widest range each bucket answers when `from` is left out
+DEFAULT_SPAN = {'hour': timedelta(days=2), 'day': timedelta(days=90), 'level': timedelta(days=90)}
+MAX_ROWS = 10000
+
+SOURCE_COLUMNS = (
+    GameSession.completed_at,
+    GameSession.level_reached,
+    GameSession.score,
+    GameSession.zombies_defeated,
+    GameSession.duration_seconds,
+)
+
+
+def rollup_keys(completed_at, level):
+    hour = completed_at.replace(minute=0, second=0, microsecond=0)
+    day = hour.replace(hour=0)
+    return ((HourlyRollup, (hour,)), (DailyRollup, (day,)), (LevelRollup, (day, level)))
+
+
+def fold_rollups(rows, sign=1, deltas=None):
+    """
+    Folds session rows (dicts with completed_at, level_reached, score, zombies_defeated and
+    duration_seconds) into {model: {key: counters}}, and their scores into {(level, bucket): count}
+    under ScoreSketch. Pass `deltas` to accumulate several folds.
+    """
+    deltas = deltas if deltas is not None else {model: {} for model in ROLLUPS + (ScoreSketch,)}
+    sketch = deltas[ScoreSketch]
+    now = datetime.utcnow()
+    for row in rows:
+        values = [sign] + [sign * (row.get(name) or 0) for name in ('score', 'zombies_defeated', 'duration_seconds')]
+        level = row.get('level_reached') or 0
+        for model, key in rollup_keys(row.get('completed_at') or now, level):
+            counters = deltas[model].get(key)
+            if counters is None:
+                counters = deltas[model][key] = [0, 0, 0, 0]
+            for i, value in enumerate(values):
+                counters[i] += value
+        key = (level, score_sketches.bucket(row.get('score') or 0))
+        sketch[key] = sketch.get(key, 0) + sign
+    return deltas
+
+
+def session_row(session):
+    return {
+        'completed_at': session.completed_at,
+        'level_reached': session.level_reached,
+        'score': session.score,
+        'zombies_defeated': session.zombies_defeated,
+        'duration_seconds': session.duration_seconds,
+    }
+
+
+def rollup_params(model, deltas):
+    keys = [c.key for c in model.__table__.primary_key.columns]
+    return [dict(zip(keys, key), **dict(zip(COUNTERS, counters)))
+            for key, counters in deltas.items() if any(counters)]
+
+
+def rollup_upsert(model, dialect):
+    table = model.__table__
+    stmt = (sqlite if dialect == 'sqlite' else postgresql).insert(table)
+    return stmt.on_conflict_do_update(
+        index_elements=list(table.primary_key.columns),
+        set_={name: table.c[name] + stmt.excluded[name] for name in COUNTERS},
+    )
+
+
+def upsert_rollups(deltas, session=None):
+    """
+    Adds folded deltas to the rollup tables inside the current transaction of `session`
+    (db.session by default), and to the score sketches once it commits.
+    """
+    session = db.session if session is None else session
+    score_sketches.stage(session, deltas.get(ScoreSketch))
+    dialect = session.get_bind().dialect.name
+    for model in ROLLUPS:
+        params = rollup_params(model, deltas[model])
+        if not params:
+            continue
+        if dialect in UPSERT_DIALECTS:
+            session.execute(rollup_upsert(model, dialect), params)
+        else:
+            _merge_rollups(session, model, params)
+
+
+def _merge_rollups(session, model, params):
+    keys = [c.key for c in model.__table__.primary_key.columns]
+    for p in params:
+        row = session.get(model, tuple(p[k] for k in keys), with_for_update=True)
+        if row is None:
+            session.add(model(**p))
+            continue
+        for name in COUNTERS:
+            setattr(row, name, getattr(row, name) + p[name])
+
+
+def backfill(chunk=10000, log=None, archive=None):
+    """
+    Rebuilds every rollup and score sketch from game_session in id-ordered chunks, one transaction
+    per chunk, then from `archive`'s segments (archive.Archive) one segment at a time, and the
+    players' high score sketch from game_stats.
+    Sessions created while it runs are counted by the write paths; edits and deletes of rows
+    not yet scanned are not, so run it while the game is quiet.
+    """
+    for model in ROLLUPS + (ScoreSketch,):
+        db.session.execute(delete(model))
+    db.session.commit()
+    score_sketches.reset()
+    upto = db.session.scalar(select(func.max(GameSession.id))) or 0
+    names = [c.key for c in SOURCE_COLUMNS]
+    after = 0
+    total = 0
+    while after < upto:
+        stmt = (select(GameSession.id, *SOURCE_COLUMNS)
+                .where(GameSession.id > after, GameSession.id <= upto)
+                .order_by(GameSession.id).limit(chunk))
+        rows = db.session.execute(stmt).all()
+        if not rows:
+            break
+        upsert_rollups(fold_rollups(dict(zip(names, row[1:])) for row in rows))
+        db.session.commit()
+        total += len(rows)
+        after = rows[-1][0]
+        if log:
+            log(total)
+    for batch in archive.batches(names) if archive is not None else ():
+        upsert_rollups(fold_rollups(dict(zip(names, row)) for row in batch))
+        db.session.commit()
+        total += len(batch)
+        if log:
+            log(total)
+    after = 0
+    while True:
+        stmt = (select(GameStats.user_id, GameStats.high_score).where(GameStats.user_id > after)
+                .order_by(GameStats.user_id).limit(chunk))
+        rows = db.session.execute(stmt).all()
+        if not rows:
+            break
+        score_sketches.stage(db.session, score_sketches.players((None, score) for _, score in rows))
+        db.session.commit()
+        after = rows[-1][0]
+    return total
+
+
+def _datetime_arg(args, name):
+    value = args.get(name)
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        raise APIException(f'Invalid {name}', 400)
+
+
+class GlobalStats:
+    """Parsed GET /stats/global arguments and the rollup query they translate to."""
+
+    def __init__(self, args):
+        self.bucket = args.get('bucket', 'day')
+        if self.bucket not in BUCKETS:
+            raise APIException(f"Invalid bucket, expected one of: {', '.join(BUCKETS)}", 400)
+        self.until = _datetime_arg(args, 'to') or datetime.utcnow()
+        self.since = _datetime_arg(args, 'from') or self.until - DEFAULT_SPAN[self.bucket]
+        if self.since >= self.until:
+            raise APIException('from must be before to', 400)
+        step = timedelta(hours=1) if self.bucket == 'hour' else timedelta(days=1)
+        if (self.until - self.since) / step > MAX_ROWS:
+            raise APIException(f'Range too large for bucket={self.bucket}', 400)
+
+    def statement(self):
+        model = BUCKETS[self.bucket]
+        # The bucket holding `from` is included whole
+        since = self.since.replace(minute=0, second=0, microsecond=0)
+        if self.bucket != 'hour':
+            since = since.replace(hour=0)
+        in_range = (model.bucket >= since, model.bucket < self.until)
+        if self.bucket == 'level':
+            sums = [func.sum(getattr(model, name)).label(name) for name in COUNTERS]
+            return select(model.level, *sums).where(*in_range).group_by(model.level).order_by(model.level)
+        counters = [getattr(model, name) for name in COUNTERS]
+        return select(model.bucket, *counters).where(*in_range).order_by(model.bucket)
+
+    def serialize(self, rows):
+        items = []
+        totals = dict.fromkeys(COUNTERS, 0)
+        for key, *counters in rows:
+            item = {'level' if self.bucket == 'level' else 'bucket':
+                    key if self.bucket == 'level' else key.isoformat()}
+            item.update(zip(COUNTERS, (int(c or 0) for c in counters)))
+            if not item['games']:
+                continue
+            for name in COUNTERS:
+                totals[name] += item[name]
+            items.append(with_averages(item))
+        return {
+            'bucket': self.bucket,
+            'from': self.since.isoformat(),
+            'to': self.until.isoformat(),
+            'totals': with_averages(totals),
+            'rows': items,
+        }
+
+
+def with_averages(item):
+    games = item['games']
+    item['avg_score'] = round(item['total_score'] / games, 2) if games else None
+    item['avg_duration'] = round(item['total_duration'] / games, 2) if games else None
+    return item
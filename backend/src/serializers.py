@@ -0,0 +1,132 @@
+"""
+Response serialization straight from column tuples, without hydrating ORM objects.
+
+`encoder` compiles, once per field layout, a function that turns a result row into the dict a
+model's serialize() builds, and `record` makes small __slots__ classes for rows kept in memory.
+Datetimes are left untouched by both and rendered by the JSON layer: orjson when it is
+installed, the standard library with an isoformat() default otherwise.
+"""
+import json
+from datetime import date, datetime
+from flask.json.provider import DefaultJSONProvider
+from models import User, Profile, GameStats, GameSession
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# The columns each model's serialize() exposes, in order
+MODEL_FIELDS = {
+    User: ('id', 'email'),
+    Profile: ('id', 'display_name', 'avatar_url', 'created_at', 'updated_at'),
+    GameStats: ('user_id', 'total_games', 'high_score', 'total_score', 'levels_completed',
+                'zombies_defeated', 'created_at', 'updated_at'),
+    GameSession: ('id', 'user_id', 'score', 'level_reached', 'zombies_defeated', 'duration_seconds',
+                  'completed_at'),
+}
+
+_encoders = {}
+
+
+def _compile(name, source):
+    namespace = {}
+    exec(source, namespace)
+    return namespace[name]
+
+
+def encoder(fields, positions=None):
+    """
+    Returns a function building {field: row[position]} from a row tuple; positions default to
+    0, 1, ... The function is generated once per layout and cached.
+    """
+    fields = tuple(fields)
+    positions = tuple(positions) if positions is not None else tuple(range(len(fields)))
+    key = (fields, positions)
+    encode = _encoders.get(key)
+    if encode is None:
+        items = ', '.join(f'{field!r}: row[{i}]' for field, i in zip(fields, positions))
+        encode = _encoders[key] = _compile('encode', f'def encode(row):\n    return {{{items}}}\n')
+    return encode
+
+
+def model_columns(model):
+    return [getattr(model, field) for field in MODEL_FIELDS[model]]
+
+
+def model_encoder(model, offset=0):
+    """Encoder for `model_columns(model)` found at `offset` in a row."""
+    fields = MODEL_FIELDS[model]
+    return encoder(fields, range(offset, offset + len(fields)))
+
+
+def record(name, fields, module=None):
+    """
+    A __slots__ class holding `fields`, for rows kept in memory in large numbers: an instance
+    takes a fraction of the space of the equivalent dict. Pass `module` (the caller's
+    __name__) and bind the class to `name` there so instances can be pickled.
+    """
+    fields = tuple(fields)
+    assigns = ''.join(f'    self.{f} = {f}\n' for f in fields) or '    pass\n'
+    items = ', '.join(f'{f!r}: self.{f}' for f in fields)
+    values = ''.join(f'self.{f}, ' for f in fields)
+
+    def replace(self, **changes):
+        return type(self)(**dict(self.as_dict(), **changes))
+
+    def __repr__(self):
+        return f"{name}({', '.join(f'{f}={getattr(self, f)!r}' for f in fields)})"
+
+    return type(name, (), {
+        '__slots__': fields,
+        '__module__': module or __name__,
+        '_fields': fields,
+        '__init__': _compile('__init__', f"def __init__(self, {', '.join(fields)}):\n{assigns}"),
+        'as_dict': _compile('as_dict', f'def as_dict(self):\n    return {{{items}}}\n'),
+        'astuple': _compile('astuple', f'def astuple(self):\n    return ({values})\n'),
+        '__eq__': lambda self, other: type(other) is type(self) and self.astuple() == other.astuple(),
+        '__hash__': None,
+        '__reduce__': lambda self: (type(self), self.astuple()),
+        '__repr__': __repr__,
+        'replace': replace,
+    })
+
+
+def _default(obj):
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    return DefaultJSONProvider.default(obj)
+
+
+def _stdlib_dumps(obj, sort_keys):
+    return json.dumps(obj, default=_default, sort_keys=sort_keys, separators=(',', ':')).encode()
+
+
+def dumps_bytes(obj, sort_keys=False):
+    if orjson is None:
+        return _stdlib_dumps(obj, sort_keys)
+    option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_SORT_KEYS if sort_keys else 0)
+    try:
+        return orjson.dumps(obj, default=_default, option=option)
+    except TypeError:
+        # Integers wider than 64 bits and other values orjson refuses
+        return _stdlib_dumps(obj, sort_keys)
+
+
+def dumps(obj, sort_keys=False):
+    return dumps_bytes(obj, sort_keys).decode()
+
+
+class JSONProvider(DefaultJSONProvider):
+    """app.json provider that goes through `dumps_bytes`, rendering datetimes as isoformat()."""
+
+    default = staticmethod(_default)
+
+    def dumps(self, obj, **kwargs):
+        if kwargs:
+            return super().dumps(obj, **kwargs)
+        return dumps(obj, self.sort_keys)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(dumps_bytes(obj, self.sort_keys) + b'\n', mimetype=self.mimetype)
@@ -0,0 +1,102 @@
+"""
+The session writes behind POST, PUT and DELETE /sessions, shared by app.py and asgi.py.
+
+Each takes the SQLAlchemy Session to work in as its first argument (db.session under Flask, the
+sync session of `AsyncSession.run_sync` under FastAPI) and returns (response body, status), so
+neither entry point carries its own copy of the stats, rollup and leaderboard bookkeeping.
+"""
+from datetime import datetime
+from sqlalchemy import select
+from models import GameStats, GameSession
+from ingest import validate_session, updated_fields
+from leaderboard import sync_stats
+from writebehind import write_behind
+from maintenance import adjust_stats
+from rollups import fold_rollups, upsert_rollups, session_row
+from cache import stats_changed
+
+
+def create_session(session, data, record=None):
+    """Records one game; `record` is called with a 201's body before the commit."""
+    rejected = validate_session(data)
+    if rejected:
+        return {'msg': rejected[0]}, rejected[1]
+    game = GameSession(
+        user_id=data['user_id'],
+        score=data.get('score', 0),
+        level_reached=data.get('level_reached', 1),
+        zombies_defeated=data.get('zombies_defeated', 0),
+        duration_seconds=data.get('duration_seconds', 0),
+        completed_at=datetime.utcnow()
+    )
+    session.add(game)
+    if write_behind.enabled:
+        session.flush()
+        if record is not None:
+            record(game.serialize())
+        # Journaled before the commit, so a crash after it cannot lose the delta
+        entry_id = write_behind.enqueue(game)
+        try:
+            session.commit()
+        except Exception:
+            write_behind.discard(entry_id)
+            raise
+        return game.serialize(), 201
+    upsert_rollups(fold_rollups([session_row(game)]), session)
+    stats = session.scalars(select(GameStats).where(GameStats.user_id == data['user_id'])).first()
+    if stats:
+        stats.total_games += 1
+        stats.total_score += game.score
+        stats.high_score = max(stats.high_score, game.score)
+        stats.levels_completed = max(stats.levels_completed, game.level_reached)
+        stats.zombies_defeated += game.zombies_defeated
+        stats.updated_at = datetime.utcnow()
+    if record is not None:
+        session.flush()
+        record(game.serialize())
+    session.commit()
+    if stats:
+        sync_stats(stats, session=session)
+    stats_changed([game.user_id])
+    return game.serialize(), 201
+
+
+def update_session(session, session_id, data):
+    # Queued deltas must land first, or they would be folded on top of the adjusted maxima
+    write_behind.flush()
+    game = session.get(GameSession, session_id)
+    if not game:
+        return {'msg': 'Not found'}, 404
+    rejected = validate_session(updated_fields(game, data))
+    if rejected:
+        return {'msg': rejected[0]}, rejected[1]
+    old = session_row(game)
+    game.score = data.get('score', game.score)
+    game.level_reached = data.get('level_reached', game.level_reached)
+    game.zombies_defeated = data.get('zombies_defeated', game.zombies_defeated)
+    game.duration_seconds = data.get('duration_seconds', game.duration_seconds)
+    new = session_row(game)
+    stats = adjust_stats(game.user_id, old, new, session)
+    upsert_rollups(fold_rollups([new], deltas=fold_rollups([old], sign=-1)), session)
+    session.commit()
+    if stats:
+        sync_stats(stats, session=session)
+    stats_changed([game.user_id])
+    return game.serialize(), 200
+
+
+def delete_session(session, session_id):
+    write_behind.flush()
+    game = session.get(GameSession, session_id)
+    if not game:
+        return {'msg': 'Not found'}, 404
+    user_id = game.user_id
+    old = session_row(game)
+    stats = adjust_stats(user_id, old, None, session)
+    upsert_rollups(fold_rollups([old], sign=-1), session)
+    session.delete(game)
+    session.commit()
+    if stats:
+        sync_stats(stats, session=session)
+    stats_changed([user_id])
+    return {'detail': 'Session deleted'}, 200
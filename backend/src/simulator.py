@@ -0,0 +1,172 @@
+"""
+Headless replay of the game rules, used to reject sessions that could not have been played.
+
+The rules come from src/game/scenes/Game.js and its parameters from src/game/config/levels.js.
+Every level is stepped in lock-step on (levels, columns) arrays, one turret volley at a time,
+playing the best case for the player: a zombie is always waiting in every empty column and bullets
+land the moment they are fired. The cumulative kills after n volleys are therefore an upper bound
+for any real session that lasted n volleys, and checking a batch is one array lookup.
+"""
+import json
+import os
+import re
+import numpy as np
+
+LEVELS_PATH = os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '..', '..', 'src', 'game', 'config', 'levels.js'))
+
+# Constants of the Phaser scene (main.js and Game.js)
+WORLD_HEIGHT = 576
+VOLLEY_INTERVAL = 2.0
+MAX_ZOMBIES = 10
+ZOMBIE_SPAWN_Y = WORLD_HEIGHT - 20
+TURRET_REACH = 100 + 25 + 20
+SERVER_REACH = 40 + 27 + 20
+MAX_DURATION = 6 * 3600
+# Keeps absurd submissions inside int64
+CLAMP = 2 ** 40
+
+OK, TOO_LONG, BAD_LEVEL, TOO_MANY_KILLS, SCORE_TOO_HIGH = range(5)
+MESSAGES = {
+    TOO_LONG: 'duration_seconds is longer than a game can last',
+    BAD_LEVEL: 'level_reached does not exist',
+    TOO_MANY_KILLS: 'zombies_defeated is not reachable in duration_seconds',
+    SCORE_TOO_HIGH: 'score is not reachable in duration_seconds',
+}
+
+
+def load_levels(path=LEVELS_PATH):
+    """Reads the `levels` array out of levels.js."""
+    with open(path, encoding='utf-8') as f:
+        source = re.sub(r'//[^\n]*', '', f.read())
+    body = source[source.index('['):source.rindex(']') + 1]
+    body = re.sub(r'([A-Za-z_]\w*)\s*:', r'"\1":', body)
+    body = re.sub(r',\s*([\]}])', r'\1', body)
+    return json.loads(body)
+
+
+class Simulator:
+    def __init__(self, levels):
+        self.levels = levels
+        self.curves = self._run(1)
+
+    def _column_mask(self, cols):
+        width = max(level['gridCols'] for level in self.levels)
+        mask = np.zeros((len(self.levels), width), dtype=bool)
+        for i, level in enumerate(self.levels):
+            mask[i, [c - 1 for c in cols(level) if 0 < c <= level['gridCols']]] = True
+        return mask
+
+    def _param(self, name):
+        return np.array([[abs(level[name])] for level in self.levels], dtype=np.float64)
+
+    def _run(self, volleys):
+        """Cumulative kills per level after 0..volleys volleys, shape (levels, volleys + 1)."""
+        grid = self._column_mask(lambda level: range(1, level['gridCols'] + 1))
+        # Turrets are placed on the server columns, as in Game.create()
+        armed = self._column_mask(lambda level: level['serverCols'])
+        turret_hp = np.where(armed, self._param('turretHealth'), 0)
+        server_hp = np.where(armed, self._param('serverHealth'), 0)
+        zombie_health = self._param('zombieHealth')
+        zombie_damage = self._param('zombieDamage')
+        bullet_damage = self._param('bulletDamage')
+        step = self._param('zombieVelocityY') * VOLLEY_INTERVAL
+
+        zombie_hp = np.zeros(grid.shape)
+        zombie_y = np.zeros(grid.shape)
+        kills = np.zeros(len(self.levels), dtype=np.int64)
+        curves = np.zeros((len(self.levels), volleys + 1), dtype=np.int64)
+        for n in range(1, volleys + 1):
+            playing = (server_hp > 0).any(axis=1)
+            empty = grid & (zombie_hp <= 0)
+            room = MAX_ZOMBIES - (zombie_hp > 0).sum(axis=1, keepdims=True)
+            spawn = empty & (np.cumsum(empty, axis=1) <= room)
+            zombie_hp = np.where(spawn, zombie_health, zombie_hp)
+            zombie_y = np.where(spawn, ZOMBIE_SPAWN_Y, zombie_y)
+
+            walking = zombie_hp > 0
+            zombie_y = np.where(walking, zombie_y - step, zombie_y)
+            turret_up = turret_hp > 0
+            hit_turret = walking & turret_up & (zombie_y <= TURRET_REACH)
+            hit_server = walking & ~turret_up & (server_hp > 0) & (zombie_y <= SERVER_REACH)
+            turret_hp = turret_hp - np.where(hit_turret, zombie_damage, 0)
+            server_hp = server_hp - np.where(hit_server, zombie_damage, 0)
+            zombie_hp = np.where(hit_turret | hit_server, 0, zombie_hp)
+
+            firing = (turret_hp > 0) & (zombie_hp > 0)
+            zombie_hp = zombie_hp - np.where(firing, bullet_damage, 0)
+            killed = firing & (zombie_hp <= 0)
+            kills += np.where(playing, killed.sum(axis=1), 0)
+            curves[:, n] = kills
+        return curves
+
+    def max_kills(self, levels, durations):
+        """Upper bound on zombies_defeated for each (level_reached, duration_seconds) pair."""
+        volleys = (np.asarray(durations) // VOLLEY_INTERVAL).astype(np.int64)
+        needed = int(volleys.max()) if volleys.size else 0
+        if needed >= self.curves.shape[1]:
+            self.curves = self._run(max(needed, 2 * self.curves.shape[1]))
+        index = np.clip(np.asarray(levels) - 1, 0, len(self.levels) - 1)
+        return self.curves[index, volleys]
+
+    def check(self, score, level, kills, duration, points_per_zombie):
+        """Returns one code per session: OK or the first rule it breaks."""
+        score, level, kills, duration = (np.asarray(a, dtype=np.int64) for a in (score, level, kills, duration))
+        codes = np.full(score.shape, OK, dtype=np.int8)
+        too_long = duration > MAX_DURATION
+        bound = self.max_kills(level, np.minimum(duration, MAX_DURATION))
+        for code, broken in (
+            (SCORE_TOO_HIGH, score > bound * points_per_zombie),
+            (TOO_MANY_KILLS, kills > bound),
+            (BAD_LEVEL, level > len(self.levels)),
+            (TOO_LONG, too_long),
+        ):
+            codes[broken] = code
+        return codes
+
+
+class SessionValidator:
+    """Plausibility check applied to submitted sessions when SESSION_VALIDATION is 'reject'."""
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self.points_per_zombie = 100
+        self.levels_path = LEVELS_PATH
+        self._simulator = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.configure(app.config)
+
+    def configure(self, config):
+        self.enabled = config.get('SESSION_VALIDATION') == 'reject'
+        self.points_per_zombie = config.get('SESSION_POINTS_PER_ZOMBIE', 100)
+        path = config.get('GAME_LEVELS_PATH') or LEVELS_PATH
+        if path != self.levels_path:
+            self._simulator = None
+        self.levels_path = path
+
+    @property
+    def simulator(self):
+        if self._simulator is None:
+            self._simulator = Simulator(load_levels(self.levels_path))
+        return self._simulator
+
+    def codes(self, rows):
+        """Vectorized check of (score, level_reached, zombies_defeated, duration_seconds) tuples."""
+        if not rows:
+            return np.zeros(0, dtype=np.int8)
+        score, level, kills, duration = np.array(rows, dtype=np.int64).T
+        return self.simulator.check(score, level, kills, duration, self.points_per_zombie)
+
+    def check(self, rows):
+        """Returns an error message or None for each session dict."""
+        codes = self.codes([
+            tuple(min(r[f], CLAMP) for f in ('score', 'level_reached', 'zombies_defeated', 'duration_seconds'))
+            for r in rows
+        ])
+        return [MESSAGES.get(int(code)) for code in codes]
+
+
+session_validator = SessionValidator()
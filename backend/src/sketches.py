@@ -0,0 +1,405 @@
+"""
+Score distributions for GET /stats/distribution and GET /stats/<user_id>/percentile, answered
+from memory in a time that does not grow with the number of sessions.
+
+Each level has a log-bucketed sketch of its session scores: bucket 0 counts the scores <= 0, and
+the others ranges of scores that grow by about (1 + α) / (1 - α) each, with α being
+SKETCH_RELATIVE_ERROR. Each bucket reports a score within α of every score in it, so a quantile
+read from a sketch is within α of the true one, relative. Buckets are plain counters: sketches
+merge by adding them, the global one is the sum of the levels', and a deleted session counts -1.
+Session writes fold their scores in with the rollups (rollups.fold_rollups); the deltas are
+applied once their transaction commits.
+
+One more sketch, under level PLAYERS, holds every player's GameStats.high_score and answers the
+percentile endpoint. A write that moves a high score moves the player between its buckets: ORM
+changes to GameStats are staged by a before_flush listener, and the bulk statements that bypass
+the ORM stage theirs with `players`.
+
+Every process adds the deltas it applied to score_sketch each SKETCH_FLUSH_INTERVAL seconds and
+reloads the sum of every process's from there, so it sees its own writes at once and the other
+workers' within about two intervals. After changing α, rebuild the sketches with
+`flask backfill-rollups`.
+"""
+import asyncio
+import atexit
+import bisect
+import logging
+import os
+import threading
+from collections import defaultdict
+import numpy as np
+from sqlalchemy import event, inspect, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+from models import db, GameStats, ScoreSketch
+
+UPSERT_DIALECTS = ('sqlite', 'postgresql')
+DEFAULT_QUANTILES = (0.5, 0.75, 0.9, 0.95, 0.99)
+MAX_QUANTILES = 20
+MAX_SCORE = 2 ** 63 - 1
+# Session.info key of the deltas a transaction has folded but not yet committed
+STAGED = 'score_sketch'
+# Level key of the players' high score sketch, kept apart from the sessions' global sketch
+PLAYERS = -1
+
+log = logging.getLogger(__name__)
+
+
+def parse_quantiles(text):
+    """The quantiles of a `q=0.5,0.9` argument, each in [0, 1]."""
+    if not text:
+        return DEFAULT_QUANTILES
+    qs = [float(q) for q in text.split(',')]
+    if len(qs) > MAX_QUANTILES or not all(0 <= q <= 1 for q in qs):
+        raise ValueError(text)
+    return qs
+
+
+def sketch_upsert(dialect):
+    table = ScoreSketch.__table__
+    stmt = (sqlite if dialect == 'sqlite' else postgresql).insert(table)
+    return stmt.on_conflict_do_update(index_elements=[table.c.level, table.c.bucket],
+                                      set_={'count': table.c.count + stmt.excluded.count})
+
+
+def sketch_rows():
+    return select(ScoreSketch.level, ScoreSketch.bucket, ScoreSketch.count).where(ScoreSketch.count != 0)
+
+
+class ScoreSketches:
+    def __init__(self, app=None):
+        self.app = None
+        self.alpha = 0.01
+        self.interval = 10.0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._owner = None
+        self._loaded = False
+        self.configure({})
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.configure(app.config)
+        atexit.register(self.stop)
+
+    def configure(self, config):
+        self.alpha = config.get('SKETCH_RELATIVE_ERROR', 0.01)
+        self.interval = config.get('SKETCH_FLUSH_INTERVAL', 10.0)
+        # Inclusive upper bound and reported score of each bucket. Integer bounds keep the bucket
+        # of a score the same whether it is found with bisect or, for bulk loads, with numpy
+        uppers, values = [0], [0]
+        lower = 1
+        while lower <= MAX_SCORE:
+            value = lower + int(lower * self.alpha)
+            upper = min(value + int(value * self.alpha / (1 - self.alpha)), MAX_SCORE)
+            uppers.append(upper)
+            values.append(min(value, upper))
+            lower = upper + 1
+        self._uppers = uppers
+        self._bounds = np.array(uppers, dtype=np.int64)
+        self._values = np.array(values, dtype=np.int64)
+        self.reset()
+
+    @property
+    def size(self):
+        return len(self._uppers)
+
+    def bucket(self, score):
+        return min(bisect.bisect_left(self._uppers, score), self.size - 1)
+
+    def buckets(self, scores):
+        """`bucket` for an array of scores."""
+        return np.minimum(np.searchsorted(self._bounds, scores, side='left'), self.size - 1)
+
+    def reset(self):
+        with self._lock:
+            self._counts = {}
+            self._total = np.zeros(self.size, dtype=np.int64)
+            self._pending = defaultdict(int)
+            self._loaded = False
+
+    # Writing
+
+    def players(self, changes):
+        """{(PLAYERS, bucket): count} for (old, new) high scores of players, None where there is no stats row."""
+        deltas = defaultdict(int)
+        for old, new in changes:
+            if old is not None:
+                deltas[PLAYERS, self.bucket(old)] -= 1
+            if new is not None:
+                deltas[PLAYERS, self.bucket(new)] += 1
+        return {key: count for key, count in deltas.items() if count}
+
+    def stage(self, session, deltas):
+        """Holds {(level, bucket): count} folded in `session`'s transaction until it commits."""
+        if not deltas:
+            return
+        staged = session.info.setdefault(STAGED, defaultdict(int))
+        for key, count in deltas.items():
+            staged[key] += count
+
+    def apply(self, deltas):
+        self._ensure_started()
+        with self._lock:
+            self._own()
+            for (level, bucket), count in deltas.items():
+                if count:
+                    self._pending[level, bucket] += count
+                    self._level(level)[bucket] += count
+                    if level != PLAYERS:
+                        self._total[bucket] += count
+
+    def _own(self):
+        # Deltas inherited over fork() are the parent's to flush
+        if self._owner != os.getpid():
+            self._counts = {}
+            self._total = np.zeros(self.size, dtype=np.int64)
+            self._pending = defaultdict(int)
+            self._loaded = False
+            self._owner = os.getpid()
+
+    def _level(self, level):
+        counts = self._counts.get(level)
+        if counts is None:
+            counts = self._counts[level] = np.zeros(self.size, dtype=np.int64)
+        return counts
+
+    # Persisting
+
+    def _take(self):
+        with self._lock:
+            self._own()
+            pending, self._pending = self._pending, defaultdict(int)
+        return [{'level': level, 'bucket': bucket, 'count': count}
+                for (level, bucket), count in pending.items() if count]
+
+    def _restore(self, params):
+        with self._lock:
+            for p in params:
+                self._pending[p['level'], p['bucket']] += p['count']
+
+    def _load(self, rows):
+        counts = {}
+        for level, bucket, count in rows:
+            if level not in counts:
+                counts[level] = np.zeros(self.size, dtype=np.int64)
+            counts[level][min(bucket, self.size - 1)] += count
+        with self._lock:
+            self._own()
+            for (level, bucket), count in self._pending.items():
+                if level not in counts:
+                    counts[level] = np.zeros(self.size, dtype=np.int64)
+                counts[level][bucket] += count
+            self._counts = counts
+            self._total = sum((c for level, c in counts.items() if level != PLAYERS),
+                              np.zeros(self.size, dtype=np.int64))
+            self._loaded = True
+
+    def flush(self):
+        """Adds this process's deltas to score_sketch, then reloads the sum of every process's."""
+        with self._flush_lock:
+            params = self._take()
+            try:
+                if params:
+                    dialect = db.session.get_bind().dialect.name
+                    if dialect in UPSERT_DIALECTS:
+                        db.session.execute(sketch_upsert(dialect), params)
+                    else:
+                        self._merge(params)
+                    db.session.commit()
+                rows = db.session.execute(sketch_rows()).all()
+            except Exception:
+                db.session.rollback()
+                self._restore(params)
+                raise
+            self._load(rows)
+
+    def _merge(self, params):
+        for p in params:
+            row = db.session.get(ScoreSketch, (p['level'], p['bucket']), with_for_update=True)
+            if row is None:
+                db.session.add(ScoreSketch(**p))
+            else:
+                row.count += p['count']
+
+    async def aflush(self, session):
+        """`flush` for asgi.py, on the AsyncSession `session`."""
+        params = self._take()
+        try:
+            if params:
+                dialect = session.bind.dialect.name
+                if dialect in UPSERT_DIALECTS:
+                    await session.execute(sketch_upsert(dialect), params)
+                else:
+                    for p in params:
+                        row = await session.get(ScoreSketch, (p['level'], p['bucket']), with_for_update=True)
+                        if row is None:
+                            session.add(ScoreSketch(**p))
+                        else:
+                            row.count += p['count']
+                await session.commit()
+            rows = (await session.execute(sketch_rows())).all()
+        except Exception:
+            await session.rollback()
+            self._restore(params)
+            raise
+        self._load(rows)
+
+    def ensure_loaded(self):
+        """Loads the merged sketches the first time this process reads them."""
+        self._ensure_started()
+        if self._loaded and self._owner == os.getpid():
+            return
+        with self._flush_lock:
+            if not (self._loaded and self._owner == os.getpid()):
+                self._load(db.session.execute(sketch_rows()).all())
+
+    # Reading
+
+    def counts(self, level=None):
+        """A copy of the bucket counts of `level`, or of every level, or None when it has no sessions."""
+        with self._lock:
+            self._own()
+            counts = self._total if level is None else self._counts.get(level)
+            # Another worker's delete can land here before its insert did
+            return np.maximum(counts, 0) if counts is not None else None
+
+    def levels(self):
+        with self._lock:
+            return sorted(level for level, counts in self._counts.items()
+                          if level != PLAYERS and counts.max(initial=0) > 0)
+
+    def quantiles(self, qs, level=None):
+        """(sessions, the score at each quantile of `qs`)."""
+        counts = self.counts(level)
+        games = int(counts.sum()) if counts is not None else 0
+        if not games:
+            return 0, [None] * len(qs)
+        index = np.searchsorted(np.cumsum(counts), np.asarray(qs, dtype=float) * (games - 1), side='right')
+        return games, self._values[index].tolist()
+
+    def percentile(self, score, level=None):
+        """(sessions, the percentage of them that scored below `score`), ties counted as half below."""
+        counts = self.counts(level)
+        games = int(counts.sum()) if counts is not None else 0
+        if not games:
+            return 0, None
+        bucket = self.bucket(score)
+        below = int(counts[:bucket].sum())
+        return games, 100 * (below + counts[bucket] / 2) / games
+
+    def distribution(self, qs, level=None):
+        games, scores = self.quantiles(qs, level)
+        return {'level': level, 'games': games, 'relative_error': self.alpha,
+                'quantiles': [{'q': q, 'score': score} for q, score in zip(qs, scores)]}
+
+    def standing(self, high_score):
+        """Where `high_score` places among the players' high scores."""
+        players, percentile = self.percentile(high_score, PLAYERS)
+        return {'high_score': high_score, 'players': players, 'relative_error': self.alpha,
+                'percentile': round(percentile, 2) if players else None,
+                'top_percent': round(100 - percentile, 2) if players else None}
+
+    # Background flushing
+
+    def _ensure_started(self):
+        # Started lazily and per pid so a preloaded app forks cleanly into its workers
+        if self.app is None or self.interval <= 0 or self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='score-sketch-flush', daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._flush_logged()
+
+    def _flush_logged(self):
+        with self.app.app_context():
+            try:
+                self.flush()
+            except Exception:
+                self.app.logger.exception('flushing score sketches failed')
+            finally:
+                db.session.remove()
+
+    async def arun(self, sessionmaker, stop):
+        """
+        The flush thread as a task on the ASGI app's event loop: its first flush loads the
+        sketches, and it flushes once more when `stop` (an asyncio.Event) is set.
+        """
+        while True:
+            try:
+                async with sessionmaker() as session:
+                    await self.aflush(session)
+            except Exception:
+                log.exception('flushing score sketches failed')
+            if stop.is_set():
+                return
+            try:
+                await asyncio.wait_for(stop.wait(), self.interval if self.interval > 0 else None)
+            except asyncio.TimeoutError:
+                pass
+
+    def stop(self):
+        """Joins the flush thread after one last flush; the next write starts it again."""
+        if self._thread is None or self._pid != os.getpid():
+            return
+        self._stop.set()
+        self._thread.join()
+        with self._start_lock:
+            self._thread = None
+            self._pid = None
+        if self._pending:
+            self._flush_logged()
+
+
+score_sketches = ScoreSketches()
+
+
+@event.listens_for(Session, 'before_flush')
+def stage_high_scores(session, context, instances):
+    changes = []
+    for stats in session.new:
+        if isinstance(stats, GameStats):
+            changes.append((None, stats.high_score or 0))
+    for stats in session.dirty:
+        if isinstance(stats, GameStats):
+            history = inspect(stats).attrs.high_score.history
+            if history.deleted and history.added:
+                changes.append((history.deleted[0] or 0, history.added[0] or 0))
+    for stats in session.deleted:
+        if isinstance(stats, GameStats):
+            history = inspect(stats).attrs.high_score.history
+            changes.append(((history.deleted or history.unchanged or [0])[0] or 0, None))
+    if changes:
+        score_sketches.stage(session, score_sketches.players(changes))
+
+
+def high_scores(user_ids):
+    """(user_id, high_score) of the players in `user_ids` that have a stats row, locked until commit."""
+    return select(GameStats.user_id, GameStats.high_score).where(GameStats.user_id.in_(user_ids)).with_for_update()
+
+
+@event.listens_for(Session, 'after_commit')
+def apply_staged(session):
+    deltas = session.info.pop(STAGED, None)
+    if deltas:
+        score_sketches.apply(deltas)
+
+
+@event.listens_for(Session, 'after_transaction_end')
+def drop_staged(session, transaction):
+    # A rolled back transaction's deltas are never applied
+    if transaction.parent is None:
+        session.info.pop(STAGED, None)
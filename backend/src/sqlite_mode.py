@@ -0,0 +1,218 @@
+"""
+Production mode for SQLite deployments, enabled with SQLITE_PRODUCTION=1 on a file database.
+
+Every connection is switched to WAL journaling with a busy timeout, and gets the SQLITE_* pragmas
+(synchronous, cache_size, mmap_size, temp_store). POST /sessions no longer writes from the request
+thread: submissions are queued to one writer thread per process, which commits everything queued
+since its last commit in a single transaction, so concurrent games share one fsync. The writers
+of the worker processes on a host take turns on an flock next to the database file, instead of
+polling for SQLite's write lock until it times out with "database is locked".
+
+A submission whose request gives up waiting after SQLITE_WRITER_TIMEOUT seconds, and answers 503,
+is dropped if the writer has not started on it; one already being written is waited for, so a
+client is never told a game that was recorded failed.
+
+Only POST /sessions is group-committed. PUT and DELETE /sessions/<id>, /sessions/batch and
+registration still write from the request thread, relying on the busy timeout; they are rare next to
+game submissions, and a batch already shares one transaction.
+
+The writer stands in for write-behind (STATS_WRITE_BEHIND) on POST /sessions, since it already
+batches the stats upserts.
+"""
+import os
+import queue
+import threading
+from concurrent import futures
+from contextlib import contextmanager
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from ingest import parse_batch, known_users, drop_unknown, write_sessions
+from models import db
+
+try:
+    import fcntl
+except ImportError:  # not on Windows; the busy timeout alone serializes writers there
+    fcntl = None
+
+SYNCHRONOUS = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+TEMP_STORE = ('DEFAULT', 'FILE', 'MEMORY')
+
+
+def pragmas(config):
+    synchronous = config['SQLITE_SYNCHRONOUS'].upper()
+    temp_store = config['SQLITE_TEMP_STORE'].upper()
+    if synchronous not in SYNCHRONOUS or temp_store not in TEMP_STORE:
+        raise ValueError(f'Unknown SQLITE_SYNCHRONOUS or SQLITE_TEMP_STORE: {synchronous}, {temp_store}')
+    return [
+        ('journal_mode', 'WAL'),
+        ('busy_timeout', int(config['SQLITE_BUSY_TIMEOUT_MS'])),
+        ('synchronous', synchronous),
+        ('cache_size', -int(config['SQLITE_CACHE_SIZE_KB'])),
+        ('mmap_size', int(config['SQLITE_MMAP_SIZE'])),
+        ('temp_store', temp_store),
+    ]
+
+
+def tune_engine(engine, settings):
+    """Applies `settings`, (name, value) pragma pairs, to every connection `engine` opens."""
+    @event.listens_for(engine, 'connect')
+    def apply_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in settings:
+            cursor.execute(f'PRAGMA {name}={value}')
+        cursor.close()
+
+
+def session_body(row):
+    """The POST /sessions response for an inserted row, as GameSession.serialize() renders it."""
+    return {
+        'id': row['id'],
+        'user_id': row['user_id'],
+        'score': row['score'],
+        'level_reached': row['level_reached'],
+        'zombies_defeated': row['zombies_defeated'],
+        'duration_seconds': row['duration_seconds'],
+        'completed_at': row['completed_at'].isoformat(),
+    }
+
+
+class SQLiteMode:
+    def __init__(self, app=None):
+        self.app = None
+        self.enabled = False
+        self.batch_size = 500
+        self.timeout = 30.0
+        self.lock_path = None
+        self._queue = queue.SimpleQueue()
+        self._start_lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._lock_file = None
+        self._lock_pid = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        url = make_url(app.config['SQLALCHEMY_DATABASE_URI'])
+        self.enabled = (app.config.get('SQLITE_PRODUCTION', False) and url.get_backend_name() == 'sqlite'
+                        and url.database not in (None, '', ':memory:'))
+        if not self.enabled:
+            return
+        self.batch_size = app.config['SQLITE_WRITER_BATCH']
+        self.timeout = app.config['SQLITE_WRITER_TIMEOUT']
+        self.lock_path = f'{url.database}.write.lock'
+        self.tune(app)
+
+    def tune(self, app):
+        """Tunes the SQLite engines of `app`, which shares this app's config."""
+        settings = pragmas(app.config)
+        with app.app_context():
+            for engine in db.engines.values():
+                if engine.dialect.name == 'sqlite':
+                    tune_engine(engine, settings)
+
+    def submit(self, item, record=None):
+        """
+        Queues one POST /sessions body; the future resolves to its (response body, status).
+        `record`, if given, is called with the response in the transaction that inserts it.
+        """
+        future = futures.Future()
+        self._queue.put(((item, record), future))
+        self._ensure_started()
+        return future
+
+    def write(self, item, record=None):
+        """
+        (response body, status) for one POST /sessions body, once committed. Raises TimeoutError
+        after `timeout` seconds, withdrawing the submission unless the writer has started on it.
+        """
+        future = self.submit(item, record)
+        try:
+            return future.result(timeout=self.timeout)
+        except futures.TimeoutError:
+            if future.cancel():
+                raise TimeoutError from None
+        # Already being written: its outcome is the answer, not a 503
+        return future.result()
+
+    def _ensure_started(self):
+        # Started lazily and per pid so a preloaded app forks cleanly into its workers
+        if self._pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid() and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='sqlite-writer', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._commit(batch)
+
+    def _commit(self, batch):
+        with self.app.app_context(), self._host_lock():
+            # Submissions whose request stopped waiting are dropped; the rest can no longer be withdrawn
+            batch = [(entry, future) for entry, future in batch if future.set_running_or_notify_cancel()]
+            if not batch:
+                return
+            try:
+                outcomes = self._write([entry for entry, _ in batch])
+            except Exception as error:
+                if len(batch) == 1:
+                    outcomes = [error]
+                else:
+                    # One failing submission must not fail the rest of the batch
+                    outcomes = [self._write_one(entry) for entry, _ in batch]
+        for (_, future), outcome in zip(batch, outcomes):
+            if isinstance(outcome, Exception):
+                future.set_exception(outcome)
+            else:
+                future.set_result(outcome)
+
+    def _write_one(self, entry):
+        try:
+            return self._write([entry])[0]
+        except Exception as error:
+            return error
+
+    def _write(self, entries):
+        results, rows = parse_batch([item for item, _ in entries])
+        stmt = known_users(rows)
+        known = set(db.session.scalars(stmt)) if stmt is not None else set()
+        valid = drop_unknown(results, rows, known)
+
+        def record(params):
+            for (pos, _), row in zip(valid, params):
+                if entries[pos][1] is not None:
+                    entries[pos][1](session_body(row))
+
+        if valid:
+            for (pos, _), row in zip(valid, write_sessions(valid, record)):
+                results[pos] = session_body(row)
+        return [(result, 201) if 'id' in result else ({'msg': result['msg']}, result['status'])
+                for result in results]
+
+    @contextmanager
+    def _host_lock(self):
+        if fcntl is None:
+            yield
+            return
+        if self._lock_pid != os.getpid():
+            self._lock_file = open(self.lock_path, 'a')
+            self._lock_pid = os.getpid()
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+
+sqlite_mode = SQLiteMode()
@@ -0,0 +1,314 @@
+"""
+Opt-in write-behind mode for GameStats and the analytics rollups.
+
+With STATS_WRITE_BEHIND enabled, create_session still inserts the GameSession row but only
+appends the stats delta to a local SQLite journal. A background thread folds everything queued
+into one upsert per player every STATS_FLUSH_INTERVAL_MS milliseconds, so parallel games of the
+same player no longer queue up on that player's game_stats row lock.
+
+The delta is journaled before the session commits, and a row is only folded in once its session
+is visible; one whose session never commits is dropped after ORPHAN_SECONDS. The id of the last
+row folded in is stored in stats_journal_mark in the transaction that folds it, so rows a crash
+left in the journal after that commit are skipped instead of counted twice.
+"""
+import atexit
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime
+from sqlalchemy import select
+from ingest import fold_stats, upsert_stats
+from leaderboard import sync_users
+from cache import stats_changed
+from models import db, GameSession, StatsJournalMark
+from rollups import fold_rollups, upsert_rollups
+
+# A journal row whose session is still not committed after this long was left by a request
+# that failed or crashed between the two
+ORPHAN_SECONDS = 60
+
+
+class StatsJournal:
+    """Durable queue of pending stats deltas, shared by every worker process on the host."""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._connect().executescript('''
+            CREATE TABLE IF NOT EXISTS pending (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                session_id INTEGER,
+                score INTEGER NOT NULL,
+                level_reached INTEGER NOT NULL,
+                zombies_defeated INTEGER NOT NULL,
+                queued_at REAL NOT NULL,
+                duration_seconds INTEGER NOT NULL DEFAULT 0,
+                completed_at TEXT
+            );
+            CREATE INDEX IF NOT EXISTS ix_pending_user_id ON pending (user_id);
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+        ''')
+        self._upgrade()
+        # Names this journal's mark in the main database; a recreated file starts its ids over
+        conn = self._connect()
+        conn.execute("INSERT OR IGNORE INTO meta VALUES ('id', ?)", (str(uuid.uuid4()),))
+        self.id = conn.execute("SELECT value FROM meta WHERE key = 'id'").fetchone()[0]
+
+    def _upgrade(self):
+        # Journals written before the rollups lack the columns they need
+        conn = self._connect()
+        columns = {row['name'] for row in conn.execute('PRAGMA table_info(pending)')}
+        for name, decl in (('duration_seconds', 'INTEGER NOT NULL DEFAULT 0'), ('completed_at', 'TEXT')):
+            if name not in columns:
+                try:
+                    conn.execute(f'ALTER TABLE pending ADD COLUMN {name} {decl}')
+                except sqlite3.OperationalError:
+                    pass  # added by another worker meanwhile
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        # A connection opened before fork() (e.g. under gunicorn --preload) must not be reused
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, isolation_level=None, timeout=5)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def append(self, session):
+        """Queues the delta of a flushed `session`; returns the row's id."""
+        return self._connect().execute(
+            'INSERT INTO pending (user_id, session_id, score, level_reached, zombies_defeated, duration_seconds, '
+            'completed_at, queued_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (session.user_id, session.id, session.score, session.level_reached, session.zombies_defeated,
+             session.duration_seconds, session.completed_at.isoformat() if session.completed_at else None,
+             time.time()),
+        ).lastrowid
+
+    def remove(self, entry_id):
+        self._connect().execute('DELETE FROM pending WHERE id = ?', (entry_id,))
+
+    def pending_for(self, user_id, after):
+        rows = self._connect().execute(
+            'SELECT session_id, user_id, score, level_reached, zombies_defeated FROM pending '
+            'WHERE user_id = ? AND id > ?',
+            (user_id, after),
+        )
+        return [dict(row) for row in rows]
+
+    def queued(self, user_ids):
+        """Whether any of `user_ids` has a row in the journal."""
+        conn = self._connect()
+        user_ids = list(user_ids)
+        for start in range(0, len(user_ids), 500):
+            batch = user_ids[start:start + 500]
+            if conn.execute(f"SELECT 1 FROM pending WHERE user_id IN ({', '.join('?' * len(batch))}) LIMIT 1",
+                            batch).fetchone():
+                return True
+        return False
+
+    def backlog(self):
+        count, oldest = self._connect().execute('SELECT count(*), min(queued_at) FROM pending').fetchone()
+        return count, oldest
+
+    def drain(self, apply, limit):
+        """
+        Hands up to `limit` queued rows to `apply`, which returns the id of the last one it is done
+        with, and deletes the rows up to it. No journal transaction is held while `apply` writes to
+        the main database, whose write lock a request holds while it appends; two processes that
+        read the same rows are kept from applying them twice by the mark. Returns the number of
+        rows deleted.
+        """
+        conn = self._connect()
+        rows = conn.execute(
+            'SELECT id, session_id, user_id, score, level_reached, zombies_defeated, duration_seconds, '
+            'completed_at, queued_at FROM pending ORDER BY id LIMIT ?',
+            (limit,),
+        ).fetchall()
+        done = apply([decode(row) for row in rows]) if rows else 0
+        if done:
+            conn.execute('DELETE FROM pending WHERE id <= ?', (done,))
+        return sum(1 for row in rows if row['id'] <= done)
+
+def decode(row):
+    row = dict(row)
+    if row['completed_at']:
+        row['completed_at'] = datetime.fromisoformat(row['completed_at'])
+    return row
+
+
+class WriteBehind:
+    def __init__(self, app=None):
+        self.app = None
+        self.enabled = False
+        self.journal = None
+        self.interval = 0.2
+        self.batch_size = 5000
+        self.last_flush_at = None
+        self.last_flush_rows = 0
+        self._thread = None
+        self._pid = None
+        self._stop = threading.Event()
+        self._flush_lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.enabled = app.config.get('STATS_WRITE_BEHIND', False)
+        self.interval = app.config.get('STATS_FLUSH_INTERVAL_MS', 200) / 1000
+        if self.enabled:
+            self.journal = StatsJournal(app.config.get('STATS_JOURNAL_PATH', '/tmp/stats_journal.db'))
+            atexit.register(self.stop)
+
+    def enqueue(self, session):
+        """Journals a flushed, not yet committed `session`; pass the returned id to `discard` if its commit fails."""
+        entry_id = self.journal.append(session)
+        self._ensure_started()
+        return entry_id
+
+    def discard(self, entry_id):
+        try:
+            self.journal.remove(entry_id)
+        except Exception:
+            # Dropped as an orphan after ORPHAN_SECONDS instead
+            self.app.logger.exception('removing a write-behind journal row failed')
+
+    def _ensure_started(self):
+        # Started lazily and per pid so a preloaded app forks cleanly into its workers
+        if self._pid == os.getpid() and self._thread.is_alive():
+            return
+        self._pid = os.getpid()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='stats-write-behind', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.flush()
+            except Exception:
+                self.app.logger.exception('write-behind flush failed')
+
+    def flush(self):
+        """Applies everything currently queued; returns the number of journal rows cleared."""
+        if not self.enabled:
+            return 0
+        total = 0
+        with self._flush_lock, self.app.app_context():
+            while True:
+                count = self.journal.drain(self._apply, self.batch_size)
+                total += count
+                if count < self.batch_size:
+                    break
+        self.last_flush_at = time.time()
+        self.last_flush_rows = total
+        return total
+
+    def _apply(self, rows):
+        try:
+            mark = db.session.get(StatsJournalMark, self.journal.id, with_for_update=True)
+            if mark is None:
+                mark = StatsJournalMark(journal=self.journal.id, applied_id=0)
+                db.session.add(mark)
+            # Rows at or below the mark were folded in before a crash kept them from being deleted
+            done = max((row['id'] for row in rows if row['id'] <= mark.applied_id), default=0)
+            rows = [row for row in rows if row['id'] > mark.applied_id]
+            committed = self._committed(rows)
+            ready = []
+            cutoff = time.time() - ORPHAN_SECONDS
+            for row in rows:
+                if row['session_id'] is None or row['session_id'] in committed:
+                    ready.append(row)
+                elif row['queued_at'] > cutoff:
+                    # Its session may still be committing; later rows wait behind it
+                    break
+                done = row['id']
+            if ready:
+                upsert_stats(fold_stats(ready))
+                upsert_rollups(fold_rollups(ready))
+            if done > mark.applied_id:
+                mark.applied_id = done
+                mark.updated_at = datetime.utcnow()
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        user_ids = {row['user_id'] for row in ready}
+        sync_users(user_ids)
+        stats_changed(user_ids)
+        return done
+
+    def hold(self):
+        """
+        Applies everything queued, then locks the journal's mark in the current transaction, so no
+        process's flusher folds deltas in until it ends. For rewriting GameStats from game_session.
+        """
+        if not self.enabled:
+            return
+        self.flush()
+        db.session.get(StatsJournalMark, self.journal.id, with_for_update=True)
+
+    def ensure_unqueued(self, user_ids):
+        """
+        Raises ValueError when one of `user_ids` has a delta queued, which a GameStats rewrite made
+        since `hold` may already have counted from its session.
+        """
+        if self.enabled and self.journal.queued(user_ids):
+            raise ValueError('Sessions were posted for the players being rebuilt; rerun once the game is quiet')
+
+    def _committed(self, rows):
+        session_ids = [row['session_id'] for row in rows if row['session_id'] is not None]
+        if not session_ids:
+            return set()
+        return set(db.session.scalars(select(GameSession.id).where(GameSession.id.in_(session_ids))))
+
+    def applied_column(self):
+        """The journal's mark, to read in the same statement as the GameStats row `fold_pending` is given."""
+        return (select(StatsJournalMark.applied_id).where(StatsJournalMark.journal == self.journal.id)
+                .scalar_subquery())
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join()
+        self.flush()
+
+    def lag(self):
+        count, oldest = self.journal.backlog() if self.enabled else (0, None)
+        now = time.time()
+        return {
+            'enabled': self.enabled,
+            'pending': count,
+            'lag_ms': round((now - oldest) * 1000) if oldest else 0,
+            'last_flush_at': self.last_flush_at,
+            'last_flush_rows': self.last_flush_rows,
+        }
+
+    def fold_pending(self, data, applied):
+        """
+        Returns serialized stats with this player's queued deltas folded in: those of committed
+        sessions above `applied`, the journal's mark as read with the stats (see applied_column).
+        """
+        if not self.enabled:
+            return data
+        rows = self.journal.pending_for(data['user_id'], applied or 0)
+        committed = self._committed(rows)
+        rows = [row for row in rows if row['session_id'] is None or row['session_id'] in committed]
+        pending = fold_stats(rows).get(data['user_id'])
+        if pending is None:
+            return data
+        data = dict(data)
+        for key in ('total_games', 'total_score', 'zombies_defeated'):
+            data[key] += pending[key]
+        for key in ('high_score', 'levels_completed'):
+            data[key] = max(data[key], pending[key])
+        return data
+
+
+write_behind = WriteBehind()
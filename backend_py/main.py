@@ -0,0 +1,8 @@
+"""
+Importable location of the ASGI app (`uvicorn backend_py.main:app`); it is implemented in backend/src/asgi.py.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'backend', 'src'))
+from asgi import app, create_app  # noqa: E402,F401
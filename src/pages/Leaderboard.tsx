@@ -12,34 +12,99 @@ import {
 } from "@/components/ui/table";
 import Navigation from "@/components/Navigation";
 const API_BASE_URL = import.meta.env.VITE_API_BASE_URL || 'http://localhost:5000/api';
+// Pushed over server-sent events unless VITE_LEADERBOARD_STREAM=false; polling is the fallback
+const STREAM = import.meta.env.VITE_LEADERBOARD_STREAM !== 'false';
+const POLL_INTERVAL_MS = 30000;
+const MAX_POLL_INTERVAL_MS = 300000;
 
 interface LeaderboardRow {
+  user_id: number;
+  rank: number;
   display_name: string | null;
   high_score: number;
   total_games: number;
   levels_completed: number;
 }
 
+interface LeaderboardDiff {
+  upsert: LeaderboardRow[];
+  remove: number[];
+}
+
+const byRank = (a: LeaderboardRow, b: LeaderboardRow) => a.rank - b.rank;
+
 const Leaderboard: React.FC = () => {
   const [rows, setRows] = useState<LeaderboardRow[]>([]);
   const [loading, setLoading] = useState<boolean>(true);
 
   useEffect(() => {
-    async function fetchLeaderboard() {
-      setLoading(true);
+    let cancelled = false;
+    let timer: ReturnType<typeof setTimeout> | undefined;
+    let source: EventSource | undefined;
+    let delay = POLL_INTERVAL_MS;
+    let last = "";
+
+    // Waits twice as long after each unchanged or failed poll, up to MAX_POLL_INTERVAL_MS
+    async function poll() {
       try {
         const res = await fetch(`${API_BASE_URL}/leaderboard`);
         if (!res.ok) throw new Error('request failed');
-        const data = await res.json();
-        setRows(data);
+        const text = await res.text();
+        delay = text === last ? Math.min(delay * 2, MAX_POLL_INTERVAL_MS) : POLL_INTERVAL_MS;
+        last = text;
+        const data: LeaderboardRow[] = JSON.parse(text);
+        if (!cancelled) setRows(data.sort(byRank));
       } catch (err) {
         console.error(err);
+        delay = Math.min(delay * 2, MAX_POLL_INTERVAL_MS);
       }
-
+      if (cancelled) return;
       setLoading(false);
+      timer = setTimeout(poll, delay);
+    }
+
+    const stop = () => {
+      cancelled = true;
+      clearTimeout(timer);
+      source?.close();
+    };
+
+    if (!STREAM) {
+      poll();
+      return stop;
     }
 
-    fetchLeaderboard();
+    // The server pushes a snapshot of the top players, then a diff whenever the standings move.
+    // EventSource reconnects by itself and resumes from the last event it received.
+    let connected = false;
+    source = new EventSource(`${API_BASE_URL}/leaderboard/stream`);
+
+    source.addEventListener("snapshot", (event) => {
+      const data: LeaderboardRow[] = JSON.parse((event as MessageEvent).data);
+      connected = true;
+      setRows(data.sort(byRank));
+      setLoading(false);
+    });
+
+    source.addEventListener("diff", (event) => {
+      const diff: LeaderboardDiff = JSON.parse((event as MessageEvent).data);
+      const changed = new Set([...diff.remove, ...diff.upsert.map((r) => r.user_id)]);
+      setRows((current) =>
+        current.filter((r) => !changed.has(r.user_id)).concat(diff.upsert).sort(byRank)
+      );
+    });
+
+    source.onerror = (err) => {
+      console.error(err);
+      // EventSource retries a dropped stream; one refused (a busy worker answers 503) or never delivered falls back to polling
+      if (source?.readyState === EventSource.CLOSED || !connected) {
+        source?.close();
+        source = undefined;
+        poll();
+      }
+    };
+
+    return stop;
   }, []);
 
   return (
@@ -68,7 +133,7 @@ const Leaderboard: React.FC = () => {
                     </TableHeader>
                     <TableBody>
                       {rows.map((r, i) => (
-                        <TableRow key={r.display_name + i}>
+                        <TableRow key={r.user_id}>
                           <TableCell>
                             <strong>#{i + 1}</strong>{" "}
                             {i === 0
@@ -0,0 +1,28 @@
+import os
+import sys
+import tempfile
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'backend', 'src')))
+os.environ.setdefault('DATABASE_URL', f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'test.db')}")
+from app import app, db
+from cache import response_cache
+from leaderboard import board
+from sketches import score_sketches
+
+
+@pytest.fixture()
+def client():
+    """A test client of the Flask app on fresh tables, an empty board and an empty response cache."""
+    with app.app_context():
+        db.create_all()
+    board.reset()
+    response_cache.clear()
+    with app.test_client() as client:
+        yield client
+    board.reset()
+    response_cache.clear()
+    score_sketches.stop()
+    with app.app_context():
+        db.session.remove()
+        db.drop_all()
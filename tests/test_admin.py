@@ -0,0 +1,94 @@
+import re
+from datetime import datetime, timedelta
+from sqlalchemy import event, insert
+from sqlalchemy.engine import Engine
+
+from app import app, db
+from maintenance import check_range
+from models import GameSession, GameStats, DailyRollup
+from rollups import fold_rollups, upsert_rollups
+from jobs import jobs
+
+
+def seed(client, sessions=120):
+    uids = [client.post('/api/auth/register', json={'email': f'p{n}@example.com', 'name': f'P{n}', 'password': 'x'})
+            .get_json()['user']['id'] for n in range(3)]
+    client.post('/sessions/batch', json=[{'user_id': uids[n % 3], 'score': n} for n in range(sessions)])
+    return uids
+
+
+def listed_ids(html):
+    return [int(i) for i in re.findall(r'<td class="col-id">\s*(\d+)', html)]
+
+
+def test_session_list_pages_by_key_without_counting(client):
+    seed(client)
+    statements = []
+    listener = lambda conn, cursor, statement, *args: statements.append(statement.lower())  # noqa: E731
+    event.listen(Engine, 'before_cursor_execute', listener)
+    try:
+        html = client.get('/admin/gamesession/').get_data(as_text=True)
+        assert listed_ids(html) == list(range(120, 70, -1))
+        assert not any('count(' in s for s in statements)
+        assert 'About 120 rows' in html
+
+        older = re.search(r'href="([^"]*after=71[^"]*)"', html).group(1).replace('&amp;', '&')
+        statements.clear()
+        assert listed_ids(client.get(older).get_data(as_text=True)) == list(range(70, 20, -1))
+        assert any('game_session.id < ?' in s for s in statements)
+    finally:
+        event.remove(Engine, 'before_cursor_execute', listener)
+
+    # Score greater than 100, newest first
+    html = client.get('/admin/gamesession/', query_string={'flt0_2': 100}).get_data(as_text=True)
+    assert listed_ids(html) == list(range(120, 101, -1))
+
+    # Read-only: changes go through the session endpoints
+    assert client.get('/admin/gamesession/new/').status_code == 302
+    assert client.get('/admin/gamesession/edit/?id=5').status_code == 302
+    assert client.post('/admin/gamesession/delete/', data={'id': 5}).status_code == 302
+    with app.app_context():
+        assert db.session.get(GameSession, 5) is not None
+
+
+def test_delete_job_keeps_stats_and_rollups_exact(client):
+    uids = seed(client, 30)
+    old = datetime.utcnow() - timedelta(days=400)
+    with app.app_context():
+        rows = [{'user_id': uids[0], 'score': 10_000, 'level_reached': 9, 'zombies_defeated': 3,
+                 'duration_seconds': 60, 'completed_at': old} for _ in range(5)]
+        db.session.execute(insert(GameSession), rows)
+        upsert_rollups(fold_rollups(rows))
+        db.session.commit()
+    jobs.chunk = 2
+    try:
+        job_id, done = jobs.submit('delete_sessions', days=365)
+        done.result(timeout=30)
+    finally:
+        jobs.chunk = app.config['ADMIN_JOB_CHUNK']
+    assert jobs.store.get(job_id)['status'] == 'done'
+    assert jobs.store.get(job_id)['done'] == 5
+    with app.app_context():
+        assert check_range(0, 10 ** 9)[1] == []
+        assert db.session.query(GameSession).count() == 30
+        assert sum(r.games for r in db.session.query(DailyRollup)) == 30
+    assert client.get(f'/stats/{uids[0]}').get_json()['high_score'] < 10_000
+
+
+def test_recompute_action_and_jobs_page(client):
+    uids = seed(client, 9)
+    with app.app_context():
+        stats = db.session.query(GameStats).filter_by(user_id=uids[1]).one()
+        stats.high_score = 999
+        db.session.commit()
+        stats_id = stats.id
+    rv = client.post('/admin/gamestats/action/', data={'action': 'recompute', 'rowid': [str(stats_id)]})
+    assert rv.status_code == 302
+    job = jobs.recent(1)[0]
+    assert job['kind'] == 'recompute_stats'
+    jobs._pool().submit(lambda: None).result(timeout=30)
+    with app.app_context():
+        assert check_range(0, 10 ** 9)[1] == []
+    page = client.get('/admin/jobs/').get_data(as_text=True)
+    assert 'recompute_stats' in page and 'done' in page
+    assert client.post('/admin/jobs/delete-sessions', data={'days': '0'}).status_code == 302
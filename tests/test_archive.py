@@ -0,0 +1,99 @@
+import os
+import csv
+import json
+from datetime import datetime
+import pytest
+from sqlalchemy import update
+
+from app import app, db
+from archive import Archive, archiver, columnar, move_sessions, COLUMNS
+from cache import response_cache
+from maintenance import check_users
+from models import GameSession
+
+
+@pytest.fixture()
+def archive(tmp_path, monkeypatch):
+    archive = Archive(str(tmp_path))
+    monkeypatch.setattr(archiver, 'archive', archive)
+    return archive
+
+
+def seed(client):
+    """Two players; sessions 1-6 are backdated to January and February 2024."""
+    ids = []
+    for n in (1, 2):
+        rv = client.post('/api/auth/register',
+                         json={'email': f'p{n}@example.com', 'name': f'Player {n}', 'password': 'x'})
+        ids.append(rv.get_json()['user']['id'])
+    scores = [700, 10, 20, 30, 40, 50, 900, 100, 60, 70]
+    client.post('/sessions/batch', json=[{'user_id': ids[i % 2], 'score': s} for i, s in enumerate(scores)])
+    with app.app_context():
+        for lo, hi, month in ((1, 3, 1), (4, 6, 2)):
+            db.session.execute(update(GameSession).where(GameSession.id.between(lo, hi))
+                               .values(completed_at=datetime(2024, month, 15)))
+        db.session.commit()
+    return ids
+
+
+def test_old_sessions_move_to_the_archive_and_keep_counting(client, archive):
+    ids = seed(client)
+    before = [client.get(f'/stats/{uid}').get_json() for uid in ids]
+
+    with app.app_context():
+        assert list(move_sessions(archive, days=30, chunk=4)) == [4, 6]
+        assert db.session.query(GameSession).count() == 4
+        assert check_users(ids) == (2, [])
+    # Chunks split at month boundaries
+    assert [s['file'] for s in archive.segments()] == [
+        '2024-01/000000000001-000000000003.npz', '2024-02/000000000004-000000000004.npz',
+        '2024-02/000000000005-000000000006.npz']
+    response_cache.clear()
+    assert [client.get(f'/stats/{uid}').get_json()['high_score'] for uid in ids] == [
+        s['high_score'] for s in before] == [900, 100]
+
+    # Column pruning and predicate pushdown
+    feb = [('completed_at', '>=', datetime(2024, 2, 1)), ('user_id', '==', ids[0])]
+    assert len(archive.segments(feb[:1])) == 2
+    # Session 4 is player 2's only February row, so its segment is skipped unopened
+    assert [sorted(batch) for batch in archive.scan(['score'], feb)] == [['score']]
+    assert [row for row in archive.rows(['id', 'score'], feb)] == [(5, 40)]
+    with pytest.raises(ValueError):
+        next(archive.scan(['password']))
+
+    # The archived 700 stands in when player 1's hot maximum (900) is deleted
+    assert client.delete('/sessions/7').status_code == 200
+    assert client.get(f'/stats/{ids[0]}').get_json()['high_score'] == 700
+    with app.app_context():
+        assert check_users(ids) == (2, [])
+
+
+def test_export_streams_both_tiers(client, archive):
+    ids = seed(client)
+    with app.app_context():
+        list(move_sessions(archive, days=30, chunk=100))
+
+    rv = client.get(f'/sessions/export?format=csv&user_id={ids[1]}&fields=id,score,completed_at')
+    assert rv.status_code == 200 and rv.mimetype == 'text/csv'
+    rows = list(csv.reader(rv.get_data(as_text=True).splitlines()))
+    assert rows[0] == ['id', 'score', 'completed_at']
+    assert [(r[0], r[1]) for r in rows[1:]] == [('2', '10'), ('4', '30'), ('6', '50'), ('8', '100'), ('10', '70')]
+    assert rows[1][2] == '2024-01-15T00:00:00'
+
+    rv = client.get('/sessions/export?min_score=60&to=2025-01-01')
+    assert [json.loads(line)['score'] for line in rv.get_data(as_text=True).splitlines()] == [700]
+    assert client.get('/sessions/export?format=xml').status_code == 400
+
+    result = app.test_cli_runner().invoke(args=['export-sessions', '--min-score', '700'])
+    assert result.exit_code == 0, result.output
+    assert [json.loads(line)['id'] for line in result.output.splitlines()] == [1, 7]
+
+
+def test_recover_drops_segments_of_uncommitted_moves(client, archive):
+    seed(client)
+    with app.app_context():
+        rows = db.session.execute(db.select(*(GameSession.__table__.c[c] for c in COLUMNS))
+                                  .where(GameSession.id <= 3)).all()
+        archive.write(columnar(rows))
+        assert archive.recover() == 0
+        assert archive.segments() == [] and os.listdir(os.path.join(archive.path, '2024-01')) == []
@@ -0,0 +1,65 @@
+import json
+
+from app import app
+
+
+def register(client, n):
+    rv = client.post('/api/auth/register',
+                     json={'email': f'p{n}@example.com', 'name': f'Player {n}', 'password': 'x'})
+    return rv.get_json()['user']['id']
+
+
+def games(first, second):
+    return [
+        {'user_id': first, 'score': 10, 'level_reached': 2, 'zombies_defeated': 4},
+        {'user_id': second, 'score': 50, 'level_reached': 1, 'zombies_defeated': 9},
+        {'user_id': first, 'score': 30, 'level_reached': 1, 'zombies_defeated': 1},
+    ]
+
+
+def test_batch_matches_single_path(client):
+    first, second = register(client, 1), register(client, 2)
+    third, fourth = register(client, 3), register(client, 4)
+
+    for item in games(first, second):
+        assert client.post('/sessions', json=item).status_code == 201
+    rv = client.post('/sessions/batch', json={'sessions': games(third, fourth)})
+    assert rv.status_code == 201
+    data = rv.get_json()
+    assert data['created'] == 3
+    assert [r['index'] for r in data['results']] == [0, 1, 2]
+
+    for single, batched in ((first, third), (second, fourth)):
+        expected = client.get(f'/stats/{single}').get_json()
+        actual = client.get(f'/stats/{batched}').get_json()
+        for key in ('total_games', 'total_score', 'high_score', 'levels_completed', 'zombies_defeated'):
+            assert expected[key] == actual[key]
+
+    session = client.get(f"/sessions/{data['results'][1]['id']}").get_json()
+    assert session['user_id'] == fourth and session['score'] == 50
+
+
+def test_batch_reports_item_errors(client):
+    uid = register(client, 1)
+    rv = client.post('/sessions/batch', json=[
+        {'user_id': uid, 'score': 5},
+        {'score': 5},
+        {'user_id': uid, 'score': 'lots'},
+        {'user_id': 999, 'score': 5},
+    ])
+    assert rv.status_code == 207
+    assert [r['status'] for r in rv.get_json()['results']] == [201, 400, 400, 404]
+    assert client.get(f'/stats/{uid}').get_json()['total_games'] == 1
+
+
+def test_ndjson_stream(client):
+    app.config['SESSION_BATCH_CHUNK'] = 2
+    uid = register(client, 1)
+    body = '\n'.join(json.dumps({'user_id': uid, 'score': s}) for s in (1, 2, 3)) + '\nnot json\n'
+    rv = client.post('/sessions/batch', data=body, content_type='application/x-ndjson')
+    app.config['SESSION_BATCH_CHUNK'] = 1000
+    results = [json.loads(line) for line in rv.get_data(as_text=True).splitlines()]
+    assert [r['index'] for r in results] == [0, 1, 2, 3]
+    assert [r['status'] for r in results] == [201, 201, 201, 400]
+    stats = client.get(f'/stats/{uid}').get_json()
+    assert stats['total_games'] == 3 and stats['total_score'] == 6 and stats['high_score'] == 3
@@ -0,0 +1,142 @@
+import json
+import pytest
+from sqlalchemy import func, select
+
+from app import app, db
+from maintenance import check_users
+from models import GameSession, GameStats, BulkLoad, DailyRollup
+from writebehind import StatsJournal, write_behind
+import bulk
+
+
+def register(client, count):
+    return [client.post('/api/auth/register', json={'email': f'p{n}@example.com', 'name': f'P{n}', 'password': 'x'})
+            .get_json()['user']['id'] for n in range(count)]
+
+
+def invoke(*args):
+    return app.test_cli_runner().invoke(args=['data', *args])
+
+
+def test_import_loads_csv_and_reports_rejected_lines(client, tmp_path):
+    a, b = register(client, 2)
+    client.post('/sessions', json={'user_id': a, 'score': 5000})
+    path = tmp_path / 'sessions.csv'
+    path.write_text(
+        'user_id,score,level_reached,zombies_defeated,duration_seconds,completed_at\n'
+        f'{a},100,2,1,60,2026-01-01T10:00:00\n'
+        f'{b},250,1,2,30,2026-01-01T11:30:00\n'
+        '\n'
+        f'{a},-5,1,0,0,2026-01-02T00:00:00\n'
+        f'999,10,1,0,0,2026-01-02T00:00:00\n'
+        f'{b},300,3,4,90,\n'
+        f'{b},x,1,0,0,2026-01-02T00:00:00\n'
+        f'{b},1,1\n'
+        f'{a},7000,4,5,120,2026-01-03T08:00:00+02:00\n')
+
+    result = invoke('import', str(path), '--workers', '0', '--chunk', '3')
+    assert result.exit_code == 0, result.stderr
+    assert [json.loads(line) for line in result.stdout.splitlines()] == [
+        {'line': 5, 'msg': 'Invalid score'}, {'line': 6, 'msg': 'User not found'},
+        {'line': 8, 'msg': 'Invalid score'}, {'line': 9, 'msg': 'Expected 6 columns'}]
+    assert '10 lines read, 4 sessions loaded, 4 rejected' in result.stderr
+    assert 'Rebuilt the stats of 2 players' in result.stderr
+
+    with app.app_context():
+        assert db.session.query(GameSession).count() == 5
+        late = db.session.scalars(select(GameSession.completed_at).where(GameSession.score == 7000)).one()
+        assert late.isoformat() == '2026-01-03T06:00:00'
+        assert check_users([a, b]) == (2, [])
+        assert db.session.scalar(select(func.sum(DailyRollup.games))) == 5
+        assert db.session.get(BulkLoad, str(path)).finished_at is not None
+    assert client.get(f'/stats/{a}').get_json()['high_score'] == 7000
+    assert client.get('/leaderboard').get_json()[0]['high_score'] == 7000
+
+    result = invoke('import', str(path))
+    assert result.exit_code != 0 and 'restart to load it again' in result.stderr
+
+
+def test_import_resumes_after_a_failed_chunk(client, tmp_path, monkeypatch):
+    (a,) = register(client, 1)
+    path = tmp_path / 'sessions.ndjson'
+    path.write_text(''.join(json.dumps({'user_id': a, 'score': n, 'completed_at': '2026-02-01T00:00:00'}) + '\n'
+                            for n in range(10)))
+    store, calls = bulk.store, []
+
+    def failing(arrays):
+        calls.append(1)
+        if len(calls) == 2:
+            raise RuntimeError('disk full')
+        store(arrays)
+
+    monkeypatch.setattr(bulk, 'store', failing)
+    with app.app_context(), pytest.raises(RuntimeError):
+        list(bulk.import_sessions(str(path), 'ndjson', app.config, chunk=4, workers=0))
+    with app.app_context():
+        assert db.session.query(GameSession).count() == 4
+        assert db.session.get(BulkLoad, str(path)).lines_read == 4
+
+    monkeypatch.setattr(bulk, 'store', store)
+    result = invoke('import', str(path), '--workers', '0', '--chunk', '4', '--defer-indexes')
+    assert result.exit_code == 0, result.stderr
+    with app.app_context():
+        assert sorted(db.session.scalars(select(GameSession.score))) == list(range(10))
+        assert check_users([a]) == (1, [])
+        assert {index['name'] for index in db.inspect(db.engine).get_indexes('game_session')} == {
+            index.name for index in GameSession.__table__.indexes}
+
+    result = invoke('import', str(path), '--workers', '2', '--chunk', '3', '--restart')
+    assert result.exit_code == 0, result.stderr
+    with app.app_context():
+        assert db.session.query(GameSession).count() == 20
+        assert db.session.get(GameStats, a).total_games == 20
+
+
+def test_rebuild_stops_when_sessions_are_queued_meanwhile(client, tmp_path, monkeypatch):
+    monkeypatch.setattr(write_behind, 'enabled', True)
+    monkeypatch.setattr(write_behind, 'journal', StatsJournal(str(tmp_path / 'journal.db')))
+    monkeypatch.setattr(write_behind, 'interval', 3600)
+    (a,) = register(client, 1)
+    # Queued before the import, so folded in before the rebuild
+    client.post('/sessions', json={'user_id': a, 'score': 10})
+    path = tmp_path / 'sessions.ndjson'
+    path.write_text(''.join(json.dumps({'user_id': a, 'score': n}) + '\n' for n in (30, 40)))
+    hold = write_behind.hold
+
+    def posting():
+        hold()
+        client.post('/sessions', json={'user_id': a, 'score': 20})
+
+    try:
+        monkeypatch.setattr(write_behind, 'hold', posting)
+        result = invoke('import', str(path), '--workers', '0')
+        assert result.exit_code != 0 and 'rerun once the game is quiet' in result.stderr
+        monkeypatch.setattr(write_behind, 'hold', hold)
+        result = invoke('import', str(path), '--workers', '0')
+        assert result.exit_code == 0, result.stderr
+        write_behind.flush()
+        with app.app_context():
+            assert check_users([a]) == (1, [])
+        assert client.get(f'/stats/{a}').get_json()['total_games'] == 4
+    finally:
+        write_behind.stop()
+
+
+def test_seed_adds_plausible_sessions(client):
+    previous, app.config['SESSION_VALIDATION'] = app.config['SESSION_VALIDATION'], 'reject'
+    try:
+        result = invoke('seed', '--players', '20', '--sessions', '500', '--chunk', '200', '--password', 'pw')
+        assert result.exit_code == 0, result.stderr
+        assert 'Seeded 500 sessions for 20 players' in result.stdout
+        with app.app_context():
+            ids = bulk.seed_players(20, 'pw').tolist()
+            assert db.session.query(GameSession).count() == 500
+            assert check_users(ids) == (20, [])
+            rows = db.session.execute(select(GameSession.user_id, GameSession.score, GameSession.level_reached,
+                                             GameSession.zombies_defeated, GameSession.duration_seconds)).all()
+            checker = bulk.validator(bulk.validation_settings(app.config))
+            assert checker.check([row._asdict() for row in rows]) == [None] * 500
+    finally:
+        app.config['SESSION_VALIDATION'] = previous
+    rv = client.post('/api/auth/login', json={'email': 'player3@seed.example', 'password': 'pw'})
+    assert rv.status_code == 200
@@ -0,0 +1,111 @@
+import os
+import sqlite3
+import tempfile
+import pytest
+
+from app import app, db
+from cache import (ChangeLog, LRUBackend, ResponseCache, SharedBackend, leaderboard_version, response_cache,
+                   shared_dir, shared_file)
+from leaderboard import board
+from models import GameStats
+
+
+@pytest.fixture(params=['lru', 'shared'])
+def client(client, request, tmp_path):
+    original = response_cache.backend
+    if request.param == 'shared':
+        response_cache.backend = SharedBackend(str(tmp_path / 'cache.db'))
+    else:
+        response_cache.backend = LRUBackend()
+    yield client
+    response_cache.backend = original
+
+
+def test_stats_cache_and_invalidation(client):
+    rv = client.post('/api/auth/register', json={'email': 'p@example.com', 'name': 'P', 'password': 'x'})
+    uid = rv.get_json()['user']['id']
+
+    first = client.get(f'/stats/{uid}')
+    assert first.headers['X-Cache'] == 'MISS'
+    second = client.get(f'/stats/{uid}')
+    assert second.headers['X-Cache'] == 'HIT'
+    assert second.get_json() == first.get_json()
+
+    etag = first.headers['ETag']
+    rv = client.get(f'/stats/{uid}', headers={'If-None-Match': etag})
+    assert rv.status_code == 304 and rv.get_data() == b''
+
+    client.post('/sessions', json={'user_id': uid, 'score': 12})
+    rv = client.get(f'/stats/{uid}', headers={'If-None-Match': etag})
+    assert rv.status_code == 200
+    assert rv.headers['X-Cache'] == 'MISS'
+    assert rv.get_json()['high_score'] == 12
+
+
+def test_leaderboard_invalidated_by_profile_update(client):
+    rv = client.post('/api/auth/register', json={'email': 'p@example.com', 'name': 'Old', 'password': 'x'})
+    data = rv.get_json()
+    uid = data['user']['id']
+    assert client.get('/leaderboard').get_json()[0]['display_name'] == 'Old'
+    assert client.get('/leaderboard').headers['X-Cache'] == 'HIT'
+
+    with app.app_context():
+        from models import Profile
+        profile = db.session.get(Profile, uid)
+        profile.display_name = 'New'
+        db.session.commit()
+    # Direct database edits are not seen until a write endpoint invalidates the tag
+    assert client.get('/leaderboard').get_json()[0]['display_name'] == 'Old'
+    client.post('/sessions', json={'user_id': uid, 'score': 1})
+    assert client.get('/leaderboard').headers['X-Cache'] == 'MISS'
+
+
+def test_leaderboard_behind_other_workers_is_not_cached(client, monkeypatch):
+    rv = client.post('/api/auth/register', json={'email': 'p@example.com', 'name': 'P', 'password': 'x'})
+    uid = rv.get_json()['user']['id']
+    client.post('/sessions', json={'user_id': uid, 'score': 5})
+    assert client.get('/leaderboard').get_json()[0]['high_score'] == 5
+
+    # Another worker's write, seen by the cache before this worker's board catches up
+    with app.app_context():
+        db.session.get(GameStats, uid).high_score = 9
+        db.session.commit()
+    ChangeLog(leaderboard_version.path).bump([uid])
+    response_cache.invalidate('leaderboard')
+    monkeypatch.setattr(board, 'changes', lambda version: None)
+    rv = client.get('/leaderboard')
+    assert 'X-Cache' not in rv.headers and rv.get_json()[0]['high_score'] == 5
+    monkeypatch.undo()
+    rv = client.get('/leaderboard')
+    assert rv.headers['X-Cache'] == 'MISS' and rv.get_json()[0]['high_score'] == 9
+    assert client.get('/leaderboard').headers['X-Cache'] == 'HIT'
+
+
+def test_several_workers_default_to_the_shared_backend(tmp_path):
+    cache = ResponseCache()
+    cache.configure({'CACHE_PATH': str(tmp_path / 'cache.db'), 'WEB_WORKERS': 4})
+    assert isinstance(cache.backend, SharedBackend)
+    cache.configure({'WEB_WORKERS': 1})
+    assert isinstance(cache.backend, LRUBackend)
+    cache.configure({'CACHE_BACKEND': 'lru', 'WEB_WORKERS': 4})
+    assert isinstance(cache.backend, LRUBackend)
+
+
+def test_shared_files_are_private_per_database(tmp_path, monkeypatch):
+    monkeypatch.setattr(tempfile, 'gettempdir', lambda: str(tmp_path))
+    monkeypatch.setattr(os.path, 'isdir', lambda path: path != '/dev/shm' and os.path.exists(path))
+    first = shared_dir({'SQLALCHEMY_DATABASE_URI': 'sqlite:///a.db'})
+    assert os.stat(first).st_mode & 0o777 == 0o700
+    assert shared_dir({'SQLALCHEMY_DATABASE_URI': 'sqlite:///a.db'}) == first
+    assert shared_dir({'SQLALCHEMY_DATABASE_URI': 'sqlite:///b.db'}) != first
+    assert shared_file({'CACHE_PATH': 'x'}, 'CACHE_PATH', 'cache.db') == 'x'
+    # One another user could have planted or could read is refused
+    os.chmod(first, 0o777)
+    with pytest.raises(RuntimeError):
+        shared_dir({'SQLALCHEMY_DATABASE_URI': 'sqlite:///a.db'})
+
+    backend = SharedBackend(str(tmp_path / 'cache.db'))
+    backend.set('k', ((1, 2), '"etag"', b'{}', 'application/json'), 30)
+    assert backend.get('k') == ((1, 2), '"etag"', b'{}', 'application/json')
+    with sqlite3.connect(str(tmp_path / 'cache.db')) as conn:
+        assert conn.execute('SELECT versions, body FROM responses').fetchone() == ('1,2', b'{}')
@@ -0,0 +1,134 @@
+import json
+import pytest
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from app import app, db
+from cache import ChangeLog, leaderboard_version, response_cache
+from feed import Feed, leaderboard_feed
+from models import GameStats
+
+
+@pytest.fixture()
+def client(client):
+    leaderboard_feed.init_app(app)
+    leaderboard_feed.keepalive = 0.1
+    return client
+
+
+def register(client, n):
+    rv = client.post('/api/auth/register',
+                     json={'email': f'p{n}@example.com', 'name': f'Player {n}', 'password': 'x'})
+    return rv.get_json()['user']['id']
+
+
+def parse(chunk):
+    """(event, id, data) of every frame in `chunk`, skipping keepalive comments."""
+    events = []
+    for block in chunk.decode().split('\n\n'):
+        fields = dict(line.split(': ', 1) for line in block.splitlines() if not line.startswith(':'))
+        if fields:
+            events.append((fields['event'], fields['id'], json.loads(fields['data'])))
+    return events
+
+
+def apply(standings, events):
+    for kind, _, data in events:
+        if kind == 'snapshot':
+            standings = {entry['user_id']: entry for entry in data}
+        else:
+            standings = {k: v for k, v in standings.items() if k not in data['remove']}
+            standings.update((entry['user_id'], entry) for entry in data['upsert'])
+    return standings
+
+
+def test_stream_pushes_standing_changes(client):
+    uids = [register(client, n) for n in range(3)]
+    rv = client.get('/leaderboard/stream', buffered=False)
+    assert rv.mimetype == 'text/event-stream'
+    frames = iter(rv.response)
+    [(kind, _, entries)] = parse(next(frames))
+    assert kind == 'snapshot' and {e['user_id'] for e in entries} == set(uids)
+
+    standings = apply({}, [(kind, None, entries)])
+    client.post('/sessions', json={'user_id': uids[2], 'score': 500})
+    client.post('/sessions', json={'user_id': uids[1], 'score': 300})
+    for _ in range(100):
+        standings = apply(standings, parse(next(frames)))
+        if standings[uids[1]]['high_score'] == 300:
+            break
+    assert sorted(standings.values(), key=lambda e: e['rank']) == client.get('/leaderboard').get_json()
+    rv.close()
+    assert leaderboard_feed.subscribers == 0
+
+
+def test_streams_past_the_limit_are_refused(client):
+    leaderboard_feed.max_streams = 1
+    rv = client.get('/leaderboard/stream', buffered=False)
+    next(iter(rv.response))
+    refused = client.get('/leaderboard/stream')
+    assert refused.status_code == 503 and refused.headers['Retry-After'] == '60'
+    rv.close()
+    rv = client.get('/leaderboard/stream', buffered=False)
+    assert rv.status_code == 200
+    rv.close()
+
+
+def test_subscribers_share_frames_without_queries(client):
+    uids = [register(client, n) for n in range(3)]
+    streams = [leaderboard_feed.subscribe() for _ in range(50)]
+    snapshots = {next(stream) for stream in streams}
+    assert len(snapshots) == 1
+
+    client.post('/sessions', json={'user_id': uids[0], 'score': 900})
+    statements = []
+    listener = lambda conn, cursor, statement, *args: statements.append(statement)  # noqa: E731
+    leaderboard_feed.poll()
+    event.listen(Engine, 'before_cursor_execute', listener)
+    try:
+        diffs = [parse(next(stream)) for stream in streams]
+    finally:
+        event.remove(Engine, 'before_cursor_execute', listener)
+        for stream in streams:
+            stream.close()
+    assert statements == []
+    assert all(d == diffs[0] for d in diffs)
+    assert diffs[0][-1][2]['upsert'][0]['user_id'] == uids[0]
+
+
+def test_feed_sees_other_workers_changes_without_a_cache(client, monkeypatch):
+    uid = register(client, 0)
+    monkeypatch.setattr(response_cache, 'backend', None)
+    stream = leaderboard_feed.subscribe()
+    next(stream)
+    assert not leaderboard_feed.poll()
+
+    # Written by another worker: this process only sees the shared counter move
+    with app.app_context():
+        stats = db.session.get(GameStats, uid)
+        stats.high_score = 70
+        db.session.commit()
+    assert not leaderboard_feed.poll()
+    ChangeLog(leaderboard_version.path).bump([uid])
+    assert leaderboard_feed.poll()
+    [(kind, _, diff)] = parse(next(stream))
+    assert kind == 'diff' and diff['upsert'][0]['high_score'] == 70
+    stream.close()
+
+
+def test_feed_coalesces_and_resumes():
+    feed = Feed(size=3, history=2)
+    row = lambda uid, score, rank: {'user_id': uid, 'high_score': score, 'rank': rank}  # noqa: E731
+    feed.publish([row(1, 10, 1), row(2, 5, 2)])
+    assert not feed.publish([row(1, 10, 1), row(2, 5, 2)])
+    assert feed.publish([row(2, 50, 1), row(1, 10, 2), row(3, 1, 3)])
+    assert feed.publish([row(2, 50, 1), row(3, 40, 2), row(1, 10, 3)])
+
+    seq, frames = feed.since(feed.parse_id(feed.event_id(2)))
+    assert seq == 3 and [e for e, _, _ in parse(b''.join(frames))] == ['diff']
+    [(_, _, diff)] = parse(frames[0])
+    assert diff == {'upsert': [row(3, 40, 2), row(1, 10, 3)], 'remove': []}
+    # Too far behind, or an id from another process: a snapshot
+    assert parse(feed.since(0)[1][0])[0][0] == 'snapshot'
+    assert feed.parse_id('other-2') is None
+    assert feed.since(3) == (3, [])
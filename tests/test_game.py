@@ -1,12 +1,28 @@
+import pytest
 from fastapi.testclient import TestClient
-from backend_py.main import app
+from sqlalchemy import create_engine
+from backend_py.main import create_app
+from config import load_config
+from leaderboard import board
+from models import db
 
-client = TestClient(app)
 
-def test_game_session_crud():
+@pytest.fixture()
+def client(tmp_path):
+    url = f"sqlite:///{tmp_path / 'test.db'}"
+    engine = create_engine(url)
+    db.metadata.create_all(engine)
+    engine.dispose()
+    board.reset()
+    with TestClient(create_app(dict(load_config(), SQLALCHEMY_DATABASE_URI=url, HASH_WORKERS=0))) as client:
+        yield client
+    board.reset()
+
+
+def test_game_session_crud(client):
     # create
     create_resp = client.post("/sessions", json={"user_id": 1, "score": 10})
-    assert create_resp.status_code == 200
+    assert create_resp.status_code == 201
     session_id = create_resp.json()["id"]
 
     # list
@@ -32,3 +48,31 @@ def test_game_session_crud():
     # confirm deletion
     not_found_resp = client.get(f"/sessions/{session_id}")
     assert not_found_resp.status_code == 404
+    assert client.delete(f"/sessions/{session_id}").status_code == 404
+    assert client.post("/sessions", json={"score": 10}).status_code == 400
+
+
+def test_auth_players_and_leaderboard(client):
+    rv = client.post("/api/auth/register", json={"email": "p@example.com", "name": "Pat", "password": "pw"})
+    assert rv.status_code == 201
+    uid = rv.json()["user"]["id"]
+    token = client.post("/api/auth/login", json={"email": "p@example.com", "password": "pw"}).json()["token"]
+
+    rv = client.post("/sessions/batch", json=[{"user_id": uid, "score": s} for s in (5, 25, 15)])
+    assert rv.status_code == 201
+
+    me = client.get("/api/auth/me", headers={"Authorization": f"Bearer {token}"})
+    assert me.json()["display_name"] == "Pat"
+    assert client.get("/api/auth/me").status_code == 401
+
+    player = client.get(f"/api/players/{uid}", params={"sessions": 2}).json()
+    assert player["stats"]["total_games"] == 3
+    assert [s["score"] for s in player["recent_sessions"]] == [15, 25]
+
+    assert client.get("/leaderboard").json()[0]["high_score"] == 25
+    assert client.get(f"/leaderboard/{uid}").json()["rank"] == 1
+
+    rv = client.get("/sessions", params={"limit": 2, "user_id": uid})
+    assert len(rv.json()) == 2 and rv.headers["X-Next-Cursor"]
+    lines = client.get("/sessions", params={"stream": "ndjson", "limit": 2}).text.splitlines()
+    assert len(lines) == 3
@@ -0,0 +1,65 @@
+import os
+import pytest
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS, generate_password_hash
+
+from app import app
+from hashing import PasswordHasher, default_workers, hasher, normalize_method
+from models import User
+
+
+@pytest.fixture()
+def client(client):
+    hasher.init_app(app)
+    method = hasher.method
+    yield client
+    hasher.method = method
+
+
+def stored_hash():
+    with app.app_context():
+        return User.query.filter_by(email='p@example.com').one().password
+
+
+def test_login_rehashes_outdated_hashes(client):
+    hasher.method = 'pbkdf2:sha256:1000'
+    client.post('/api/auth/register', json={'email': 'p@example.com', 'name': 'P', 'password': 'secret'})
+    assert stored_hash().startswith('pbkdf2:sha256:1000$')
+
+    hasher.method = 'pbkdf2:sha256:2000'
+    assert client.post('/api/auth/login', json={'email': 'p@example.com', 'password': 'wrong'}).status_code == 401
+    assert stored_hash().startswith('pbkdf2:sha256:1000$')
+    assert client.post('/api/auth/login', json={'email': 'p@example.com', 'password': 'secret'}).status_code == 200
+    assert stored_hash().startswith('pbkdf2:sha256:2000$')
+    assert client.post('/api/auth/login', json={'email': 'p@example.com', 'password': 'secret'}).status_code == 200
+
+
+def test_saturated_pool_returns_503(client):
+    client.post('/api/auth/register', json={'email': 'p@example.com', 'name': 'P', 'password': 'secret'})
+    held = []
+    while hasher._slots.acquire(blocking=False):
+        held.append(True)
+    try:
+        rv = client.post('/api/auth/login', json={'email': 'p@example.com', 'password': 'secret'})
+    finally:
+        for _ in held:
+            hasher._slots.release()
+    assert rv.status_code == 503
+    assert rv.headers['Retry-After'] == '1'
+
+
+def test_slow_hashes_return_503(client, monkeypatch):
+    client.post('/api/auth/register', json={'email': 'p@example.com', 'name': 'P', 'password': 'secret'})
+    monkeypatch.setattr(hasher, 'timeout', 0)
+    rv = client.post('/api/auth/login', json={'email': 'p@example.com', 'password': 'secret'})
+    assert rv.status_code == 503 and rv.headers['Retry-After'] == '1'
+
+
+def test_methods_are_compared_with_their_defaults():
+    assert normalize_method('scrypt') == 'scrypt:32768:8:1'
+    assert normalize_method('pbkdf2') == normalize_method('pbkdf2:sha256') == f'pbkdf2:sha256:{DEFAULT_PBKDF2_ITERATIONS}'
+    assert normalize_method('pbkdf2:sha256:1000') == 'pbkdf2:sha256:1000'
+    checker = PasswordHasher()
+    checker.configure({'HASH_METHOD': 'pbkdf2', 'HASH_WORKERS': 0})
+    assert not checker.needs_rehash(generate_password_hash('x', 'pbkdf2'))
+    assert checker.needs_rehash(generate_password_hash('x', 'pbkdf2:sha256:1000'))
+    assert default_workers(os.cpu_count() * 2) == 1
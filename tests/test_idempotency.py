@@ -0,0 +1,132 @@
+import os
+import sys
+import json
+import threading
+import subprocess
+from datetime import datetime, timedelta
+import pytest
+
+SRC = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'backend', 'src'))
+from app import app, db
+from models import GameSession, GameStats, SessionKey
+from idempotency import KeyFilter, session_keys
+
+
+@pytest.fixture()
+def client(client, tmp_path):
+    session_keys.configure(dict(app.config, IDEMPOTENCY_FILTER_PATH=str(tmp_path / 'keys'),
+                                IDEMPOTENCY_FILTER_BITS=1 << 12))
+    yield client
+    session_keys.configure(app.config)
+
+
+def register(client, count):
+    return [client.post('/api/auth/register', json={'email': f'p{n}@example.com', 'name': f'P{n}', 'password': 'x'})
+            .get_json()['user']['id'] for n in range(count)]
+
+
+def test_retries_with_a_key_replay_the_first_response(client):
+    uid, other = register(client, 2)
+    game = {'user_id': uid, 'score': 40, 'level_reached': 2}
+    first = client.post('/sessions', json=game, headers={'Idempotency-Key': 'a'})
+    assert first.status_code == 201 and 'Idempotent-Replayed' not in first.headers
+    again = client.post('/sessions', json=game, headers={'Idempotency-Key': 'a'})
+    assert again.status_code == 201 and again.headers['Idempotent-Replayed'] == 'true'
+    assert again.get_json() == first.get_json()
+    # From the table once the process has forgotten it
+    session_keys.clear()
+    assert client.post('/sessions', json=game, headers={'Idempotency-Key': 'a'}).get_json() == first.get_json()
+
+    rv = client.post('/sessions', json=dict(game, score=41), headers={'Idempotency-Key': 'a'})
+    assert rv.status_code == 422
+    # Keys are per user, and requests without one are never deduplicated
+    assert client.post('/sessions', json=dict(game, user_id=other), headers={'Idempotency-Key': 'a'}).status_code == 201
+    assert client.post('/sessions', json=game).status_code == 201
+    assert client.post('/sessions', json=game, headers={'Idempotency-Key': 'x' * 256}).status_code == 400
+    assert client.post('/sessions', json=game, headers={'Idempotency-Key': 'b'}).status_code == 201
+
+    with app.app_context():
+        assert db.session.query(GameSession).filter_by(user_id=uid).count() == 3
+        assert db.session.get(GameStats, uid).total_games == 3
+        assert db.session.query(SessionKey).count() == 3
+        stale = db.session.get(SessionKey, (uid, 'a'))
+        stale.created_at = datetime.utcnow() - timedelta(seconds=session_keys.ttl + 1)
+        db.session.commit()
+        assert session_keys.prune() == 1
+        assert db.session.query(SessionKey).count() == 2
+
+
+def test_concurrent_requests_with_one_key_create_one_session(client):
+    uid, = register(client, 1)
+    statuses = []
+
+    def post():
+        c = app.test_client()
+        rv = c.post('/sessions', json={'user_id': uid, 'score': 7}, headers={'Idempotency-Key': 'same'})
+        statuses.append((rv.status_code, rv.get_json()['id']))
+
+    threads = [threading.Thread(target=post) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(set(statuses)) == 1 and statuses[0][0] == 201
+    with app.app_context():
+        assert db.session.query(GameSession).count() == 1
+
+
+def test_key_filter_forgets_keys_after_two_epochs(tmp_path, monkeypatch):
+    keys = KeyFilter(str(tmp_path / 'keys'), 1 << 12, ttl=10)
+    keys.add('1:a', now=100)
+    assert keys.seen('1:a', now=105) and not keys.seen('1:b', now=105)
+    # A second handle on the file, as in another worker, sees the key
+    assert KeyFilter(str(tmp_path / 'keys'), 1 << 20, ttl=10).seen('1:a', now=105)
+    keys.add('1:b', now=110)
+    assert keys.seen('1:a', now=115) and keys.seen('1:b', now=115)
+    assert not keys.seen('1:a', now=120) and keys.seen('1:b', now=120)
+    # Without POSIX locks, as on Windows, each process keeps a filter of its own
+    monkeypatch.setattr('idempotency.fcntl', None)
+    local = KeyFilter(str(tmp_path / 'local'), 1 << 12, ttl=10)
+    local.add('1:a', now=100)
+    assert local.seen('1:a', now=105) and not local.seen('1:b', now=105)
+    assert not (tmp_path / 'local').exists()
+
+
+PROBE = '''
+import json, multiprocessing
+from app import app, db
+from models import GameSession
+with app.app_context():
+    db.create_all()
+    db.engine.dispose()
+client = app.test_client()
+uid = client.post('/api/auth/register', json={'email': 'p@example.com', 'name': 'P', 'password': 'x'}).get_json()['user']['id']
+
+def process(out):
+    c = app.test_client()
+    out.put([c.post('/sessions', json={'user_id': uid, 'score': 3}, headers={'Idempotency-Key': 'k'}).get_json()['id']
+             for _ in range(3)])
+
+with app.app_context():
+    db.engine.dispose()
+ctx = multiprocessing.get_context('fork')
+out = ctx.Queue()
+procs = [ctx.Process(target=process, args=(out,)) for _ in range(2)]
+for p in procs:
+    p.start()
+ids = [i for _ in procs for i in out.get(timeout=120)]
+for p in procs:
+    p.join()
+with app.app_context():
+    print(json.dumps({'ids': sorted(set(ids)), 'games': db.session.query(GameSession).count()}))
+'''
+
+
+def test_keys_are_shared_by_sqlite_worker_processes(tmp_path):
+    env = dict(os.environ, DATABASE_URL=f"sqlite:///{tmp_path / 'edge.db'}", SQLITE_PRODUCTION='1',
+               CACHE_BACKEND='none', METRICS_ENABLED='0', IDEMPOTENCY_FILTER_PATH=str(tmp_path / 'keys'))
+    env.pop('FLASK_RUN_FROM_CLI', None)
+    out = subprocess.run([sys.executable, '-c', PROBE], cwd=SRC, env=env, capture_output=True, text=True, timeout=300)
+    assert out.returncode == 0, out.stderr
+    result = json.loads(out.stdout)
+    assert len(result['ids']) == 1 and result['games'] == 1
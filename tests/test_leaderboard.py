@@ -0,0 +1,128 @@
+import random
+import pytest
+
+from app import app, db
+from cache import ChangeLog, leaderboard_version, response_cache
+from leaderboard import SortedKeyList, Leaderboard, board, ensure_loaded
+from models import GameStats
+
+
+def register(client, n):
+    rv = client.post('/api/auth/register',
+                     json={'email': f'p{n}@example.com', 'name': f'Player {n}', 'password': 'x'})
+    return rv.get_json()['user']['id']
+
+
+def test_sorted_key_list_matches_sorted():
+    keys = SortedKeyList(load=4)
+    expected = []
+    for _ in range(500):
+        key = (random.randint(-50, 0), random.randint(0, 10 ** 6))
+        if key in expected:
+            continue
+        keys.add(key)
+        expected.append(key)
+    expected.sort()
+    assert list(keys) == expected
+    for key in random.sample(expected, 100):
+        assert keys.index(key) == expected.index(key)
+    assert list(keys.islice(37, 81)) == expected[37:81]
+    for key in random.sample(expected, 200):
+        keys.remove(key)
+        expected.remove(key)
+    assert list(keys) == expected
+    assert len(keys) == len(expected)
+
+
+def test_rank_and_neighbours():
+    lb = Leaderboard()
+    lb.rebuild((uid, f'p{uid}', uid * 10, 1, 1) for uid in range(1, 101))
+    assert lb.rank(100) == 1
+    assert lb.rank(1) == 100
+    rank, entries = lb.around(50, radius=2)
+    assert rank == 51
+    assert [e['user_id'] for e in entries] == [52, 51, 50, 49, 48]
+    lb.upsert(1, high_score=5000)
+    assert lb.rank(1) == 1
+    assert lb.page(0, 2)[1]['user_id'] == 100
+
+
+def test_leaderboard_follows_sessions(client):
+    first = register(client, 1)
+    second = register(client, 2)
+    assert client.get('/leaderboard').get_json()[0]['high_score'] == 0
+
+    client.post('/sessions', json={'user_id': first, 'score': 10})
+    rv = client.post('/sessions', json={'user_id': second, 'score': 30})
+    session_id = rv.get_json()['id']
+
+    rows = client.get('/leaderboard').get_json()
+    assert [r['display_name'] for r in rows] == ['Player 2', 'Player 1']
+    assert rows[0]['rank'] == 1 and rows[0]['high_score'] == 30
+
+    rows = client.get('/leaderboard', query_string={'offset': 1}).get_json()
+    assert [r['display_name'] for r in rows] == ['Player 1']
+
+    rv = client.get(f'/leaderboard/{first}', query_string={'radius': 1})
+    data = rv.get_json()
+    assert data['rank'] == 2 and data['total'] == 2
+    assert [e['user_id'] for e in data['entries']] == [second, first]
+
+    client.delete(f'/sessions/{session_id}')
+    assert client.get(f'/leaderboard/{first}').status_code == 200
+    assert client.get('/leaderboard/999').status_code == 404
+
+
+def test_leaderboard_rebuilds_from_stats(client):
+    uid = register(client, 1)
+    client.post('/sessions', json={'user_id': uid, 'score': 42})
+    board.reset()
+    response_cache.clear()
+    rows = client.get('/leaderboard').get_json()
+    assert rows[0]['high_score'] == 42
+
+
+def test_board_rebuilds_after_another_workers_write(client, monkeypatch):
+    uids = [register(client, n) for n in range(2)]
+    client.post('/sessions', json={'user_id': uids[0], 'score': 10})
+    assert client.get(f'/leaderboard/{uids[0]}').get_json()['rank'] == 1
+
+    # The board follows the bumps of its own writes without a rebuild
+    rebuild = board.rebuild
+    monkeypatch.setattr(board, 'rebuild', lambda *args: pytest.fail('rebuilt'))
+    client.post('/sessions', json={'user_id': uids[1], 'score': 5})
+    assert client.get(f'/leaderboard/{uids[1]}').get_json()['rank'] == 2
+    monkeypatch.setattr(board, 'rebuild', rebuild)
+
+    # Written by another worker, which only shares the change log: just that player is read back
+    with app.app_context():
+        db.session.get(GameStats, uids[1]).high_score = 50
+        db.session.commit()
+    ChangeLog(leaderboard_version.path).bump([uids[1]])
+    monkeypatch.setattr(board, 'rebuild', lambda *args: pytest.fail('rebuilt'))
+    with app.app_context():
+        assert ensure_loaded().rank(uids[1]) == 1
+    monkeypatch.setattr(board, 'rebuild', rebuild)
+
+    # A bump naming no one, or one the ring has since overwritten, needs a rebuild
+    with app.app_context():
+        db.session.get(GameStats, uids[0]).high_score = 60
+        db.session.commit()
+    ChangeLog(leaderboard_version.path).bump()
+    with app.app_context():
+        assert ensure_loaded().rank(uids[0]) == 1
+
+
+def test_change_log_names_changed_players(tmp_path):
+    log = ChangeLog(str(tmp_path / 'log'), slots=4)
+    assert log.bump([3, 1, 3]) == 2
+    other = ChangeLog(str(tmp_path / 'log'), slots=1024)
+    assert other.changed(0, other.value()) == {1, 3} and other.slots == 4
+    assert log.changed(2, 2) == set() and log.changed(None, 2) is None
+    log.bump([7])
+    assert log.changed(1, 3) == {3, 7}
+    # Wrapped past what the reader last saw
+    log.bump([8, 9])
+    assert log.changed(0, 5) is None and log.changed(0, 4) is None and log.changed(1, 5) == {3, 7, 8, 9}
+    log.bump()
+    assert log.changed(5, 6) is None
@@ -0,0 +1,117 @@
+import multiprocessing
+import pytest
+
+from app import app
+from werkzeug.middleware.proxy_fix import ProxyFix
+from limits import BucketTable, admission, forwarded_address, parse_rules, rate_limiter, token_bucket
+
+
+@pytest.fixture()
+def client(client):
+    yield client
+    rate_limiter.configure(app.config)
+    admission.configure(app.config)
+
+
+def take_many(path, count, out):
+    table = BucketTable(path, slots=64)
+    out.put(sum(1 for _ in range(count) if table.take('login_user|ip:10.0.0.1', 1e-6, 5) == 0))
+
+
+def test_buckets_refill_and_are_shared_between_processes(tmp_path, monkeypatch):
+    table = BucketTable(str(tmp_path / 'buckets'), slots=64)
+    assert [table.take('k', 1, 3, now=100) for _ in range(4)] == [0, 0, 0, 1]
+    assert table.take('k', 1, 3, now=100.5) == 0.5
+    assert table.take('k', 1, 3, now=101) == 0
+    assert table.take('other', 1, 3, now=101) == 0
+    # Keys keep getting buckets once every group is full
+    for n in range(64):
+        table.take(f'key{n}', 1, 1, now=102)
+    assert table.take('k', 1, 3, now=103) == 0
+
+    ctx = multiprocessing.get_context('fork')
+    out = ctx.Queue()
+    procs = [ctx.Process(target=take_many, args=(str(tmp_path / 'shared'), 20, out)) for _ in range(3)]
+    for p in procs:
+        p.start()
+    assert sum(out.get(timeout=30) for _ in procs) == 5
+    for p in procs:
+        p.join()
+
+    # Without POSIX locks, as on Windows, each process keeps buckets of its own
+    monkeypatch.setattr('limits.fcntl', None)
+    local = BucketTable(str(tmp_path / 'local'), slots=64)
+    assert [local.take('k', 1, 2, now=100) for _ in range(3)] == [0, 0, 1]
+    local.clear()
+    assert local.take('k', 1, 2, now=100) == 0
+    assert not (tmp_path / 'local').exists()
+
+    assert parse_rules(' login_user=10/60 ; *=5/1/20', token_bucket) == {'login_user': (10 / 60, 10), '*': (5, 20)}
+    for text in ('login_user', 'login_user=10', 'login_user=0/60', '=1/1'):
+        with pytest.raises(ValueError):
+            parse_rules(text, token_bucket)
+
+
+def test_rate_limits_per_endpoint_and_caller(client, tmp_path):
+    rate_limiter.configure(dict(app.config, RATE_LIMITS='login_user=2/60;get_profile=1/3600',
+                                RATE_LIMIT_PATH=str(tmp_path / 'buckets')))
+    tokens = [client.post('/api/auth/register', json={'email': f'p{n}@example.com', 'name': f'P{n}', 'password': 'x'})
+              .get_json()['token'] for n in range(2)]
+
+    statuses = [client.post('/api/auth/login', json={'email': 'p0@example.com', 'password': p}).status_code
+                for p in ('wrong', 'x', 'x')]
+    assert statuses == [401, 200, 429]
+    rv = client.post('/api/auth/login', json={'email': 'p0@example.com', 'password': 'x'})
+    assert rv.status_code == 429 and rv.get_json() == {'msg': 'Too many requests'}
+    assert 1 <= int(rv.headers['Retry-After']) <= 30
+    # Another address has its own bucket
+    rv = client.post('/api/auth/login', json={'email': 'p0@example.com', 'password': 'x'},
+                     environ_base={'REMOTE_ADDR': '10.1.2.3'})
+    assert rv.status_code == 200
+
+    # Callers with a valid token are limited by identity, whatever their address
+    headers = [{'Authorization': f'Bearer {token}'} for token in tokens]
+    assert client.get('/api/auth/me', headers=headers[0]).status_code == 200
+    assert client.get('/api/auth/me', headers=headers[0], environ_base={'REMOTE_ADDR': '10.9.9.9'}).status_code == 429
+    assert client.get('/api/auth/me', headers=headers[1]).status_code == 200
+    assert client.get('/api/auth/me', headers={'Authorization': 'Bearer forged'}).status_code == 422
+    assert client.get('/api/auth/me', headers={'Authorization': 'Bearer forged'}).status_code == 429
+    # Endpoints without a rule, with no `*`, are not limited
+    assert {client.get('/leaderboard').status_code for _ in range(5)} == {200}
+
+
+def test_forwarded_clients_get_buckets_of_their_own(client, tmp_path, monkeypatch):
+    # What create_app wraps the app in with PROXY_FIX_HOPS=1, as on Render
+    monkeypatch.setattr(app, 'wsgi_app', ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1))
+    rate_limiter.configure(dict(app.config, RATE_LIMITS='handle_hello=2/3600',
+                                RATE_LIMIT_PATH=str(tmp_path / 'buckets')))
+    proxy = {'REMOTE_ADDR': '10.0.0.1'}
+
+    def hello(forwarded_for):
+        return client.get('/user', headers={'X-Forwarded-For': forwarded_for}, environ_base=proxy).status_code
+
+    assert [hello('203.0.113.7') for _ in range(3)] == [200, 200, 429]
+    assert [hello('198.51.100.2') for _ in range(3)] == [200, 200, 429]
+    # Entries the client adds itself are ignored; only the one the proxy appended counts
+    assert hello('192.0.2.1, 203.0.113.7') == 429
+
+    assert forwarded_address('192.0.2.1, 203.0.113.7', '10.0.0.1', 1) == '203.0.113.7'
+    assert forwarded_address('203.0.113.7', '10.0.0.1', 2) == '10.0.0.1'
+    assert forwarded_address('203.0.113.7', '10.0.0.1', 0) == '10.0.0.1'
+
+
+def test_admission_sheds_requests_over_the_concurrency_limit(client):
+    admission.configure(dict(app.config, ADMISSION_LIMITS='stats=1;*=2', ADMISSION_QUEUE_MS=10))
+    assert admission.rule('stats') == 'stats' and admission.rule('leaderboard') == '*'
+    # The event stream would hold a slot for as long as its client listens
+    assert admission.rule('leaderboard_stream') is None
+    assert [client.get('/stats/1').status_code for _ in range(3)] == [404] * 3
+
+    assert admission.enter('stats')
+    try:
+        rv = client.get('/stats/1')
+        assert rv.status_code == 503 and rv.headers['Retry-After'] == '1'
+        assert client.get('/leaderboard').status_code == 200
+    finally:
+        admission.leave('stats')
+    assert client.get('/stats/1').status_code == 404
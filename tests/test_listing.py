@@ -0,0 +1,50 @@
+import json
+
+
+def seed(client):
+    ids = []
+    for n in (1, 2):
+        rv = client.post('/api/auth/register',
+                         json={'email': f'p{n}@example.com', 'name': f'Player {n}', 'password': 'x'})
+        ids.append(rv.get_json()['user']['id'])
+    sessions = [{'user_id': ids[i % 2], 'score': i * 10} for i in range(10)]
+    client.post('/sessions/batch', json=sessions)
+    return ids
+
+
+def test_keyset_pages_cover_everything(client):
+    seed(client)
+    seen = []
+    cursor = None
+    while True:
+        query = {'limit': 3}
+        if cursor:
+            query['cursor'] = cursor
+        rv = client.get('/sessions', query_string=query)
+        seen += [s['id'] for s in rv.get_json()]
+        cursor = rv.headers.get('X-Next-Cursor')
+        if not cursor:
+            break
+    assert seen == sorted(seen) and len(seen) == 10
+
+
+def test_filters_and_projection(client):
+    first, _ = seed(client)
+    rv = client.get('/sessions', query_string={
+        'user_id': first, 'min_score': 20, 'max_score': 60, 'fields': 'score,user_id',
+    })
+    rows = rv.get_json()
+    assert rows == [{'score': 20, 'user_id': first}, {'score': 40, 'user_id': first},
+                    {'score': 60, 'user_id': first}]
+    assert client.get('/sessions', query_string={'fields': 'password'}).status_code == 400
+    assert client.get('/sessions', query_string={'from': '2999-01-01'}).get_json() == []
+
+
+def test_streaming_modes(client):
+    seed(client)
+    rv = client.get('/sessions', query_string={'stream': 'json', 'limit': 4, 'order': 'desc'})
+    ids = [s['id'] for s in json.loads(rv.get_data(as_text=True))]
+    assert len(ids) == 10 and ids == sorted(ids, reverse=True)
+    rv = client.get('/sessions', query_string={'stream': 'ndjson', 'limit': 3, 'fields': 'id'})
+    lines = [json.loads(line) for line in rv.get_data(as_text=True).splitlines()]
+    assert len(lines) == 10 and set(lines[0]) == {'id'}
@@ -0,0 +1,79 @@
+import json
+import random
+
+from app import app, db
+from maintenance import check_range
+from models import GameStats
+
+
+def register(client, n):
+    rv = client.post('/api/auth/register',
+                     json={'email': f'p{n}@example.com', 'name': f'Player {n}', 'password': 'x'})
+    return rv.get_json()['user']['id']
+
+
+def mismatches():
+    with app.app_context():
+        return check_range(0, 10 ** 9)[1]
+
+
+def test_stats_follow_updates_and_deletes(client):
+    uid = register(client, 1)
+    rng = random.Random(7)
+    ids = []
+    for _ in range(40):
+        rv = client.post('/sessions', json={'user_id': uid, 'score': rng.choice([10, 20, 30, 30]),
+                                            'level_reached': rng.randint(1, 3), 'zombies_defeated': 1})
+        ids.append(rv.get_json()['id'])
+    for _ in range(60):
+        session_id = rng.choice(ids)
+        if rng.random() < 0.4:
+            client.delete(f'/sessions/{session_id}')
+            ids.remove(session_id)
+        else:
+            client.put(f'/sessions/{session_id}', json={'score': rng.randint(0, 40),
+                                                        'level_reached': rng.randint(1, 3)})
+        assert mismatches() == []
+    assert client.get(f'/leaderboard/{uid}').get_json()['entries'][0]['high_score'] == \
+        client.get(f'/stats/{uid}').get_json()['high_score']
+
+
+def test_session_without_user_id_is_rejected(client):
+    rv = client.post('/sessions', json={'score': 10})
+    assert rv.status_code == 400
+    assert rv.get_json() == {'msg': 'Missing user_id'}
+
+
+def test_ties_keep_the_maximum(client):
+    uid = register(client, 1)
+    first = client.post('/sessions', json={'user_id': uid, 'score': 50, 'level_reached': 3}).get_json()['id']
+    second = client.post('/sessions', json={'user_id': uid, 'score': 50, 'level_reached': 3}).get_json()['id']
+    client.delete(f'/sessions/{first}')
+    stats = client.get(f'/stats/{uid}').get_json()
+    assert stats['high_score'] == 50 and stats['levels_completed'] == 3
+    client.put(f'/sessions/{second}', json={'score': 5, 'level_reached': 1})
+    stats = client.get(f'/stats/{uid}').get_json()
+    assert stats['high_score'] == 5 and stats['levels_completed'] == 1
+    client.delete(f'/sessions/{second}')
+    stats = client.get(f'/stats/{uid}').get_json()
+    assert (stats['total_games'], stats['high_score'], stats['total_score']) == (0, 0, 0)
+
+
+def test_check_stats_command(client):
+    uids = [register(client, n) for n in range(1, 6)]
+    for uid in uids:
+        client.post('/sessions', json={'user_id': uid, 'score': uid * 10, 'zombies_defeated': 2})
+    with app.app_context():
+        GameStats.query.filter_by(user_id=uids[2]).update({'high_score': 999, 'total_games': 7})
+        db.session.commit()
+
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=['check-stats', '--chunk', '2', '--workers', '3'])
+    assert result.exit_code == 1
+    reported = [json.loads(line) for line in result.stdout.splitlines()]
+    assert [r['user_id'] for r in reported] == [uids[2]]
+    assert reported[0]['expected']['high_score'] == uids[2] * 10
+
+    assert runner.invoke(args=['check-stats', '--fix']).exit_code == 0
+    assert runner.invoke(args=['check-stats']).exit_code == 0
+    assert mismatches() == []
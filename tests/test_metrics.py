@@ -0,0 +1,83 @@
+import os
+import re
+import pytest
+
+from app import app
+from metrics import metrics
+
+
+@pytest.fixture()
+def client(client):
+    metrics.reset()
+    yield client
+    metrics.profile_token = None
+    metrics.slow_query_seconds = 0.25
+
+
+def sample(text, name, **labels):
+    for line in text.splitlines():
+        match = re.match(r'(\w+)(?:\{(.*)\})? (\S+)$', line)
+        if not match or match.group(1) != name:
+            continue
+        found = dict(re.findall(r'(\w+)="([^"]*)"', match.group(2) or ''))
+        if all(found.get(k) == str(v) for k, v in labels.items()):
+            return float(match.group(3))
+    return None
+
+
+def test_requests_and_queries_are_counted(client):
+    client.post('/api/auth/register', json={'email': 'p@example.com', 'name': 'P', 'password': 'x'})
+    for _ in range(3):
+        client.get('/stats/1', query_string={'fresh': 1})
+    client.get('/sessions/999')
+
+    text = client.get('/metrics').get_data(as_text=True)
+    assert '# TYPE http_request_duration_seconds histogram' in text
+    assert sample(text, 'http_request_duration_seconds_count', endpoint='stats', status=200) == 3
+    assert sample(text, 'http_request_duration_seconds_count', endpoint='get_session', status=404) == 1
+    assert sample(text, 'http_request_duration_seconds_bucket', endpoint='stats', le='+Inf') == 3
+    assert sample(text, 'db_queries_per_request_sum', endpoint='stats') == 3
+    assert sample(text, 'db_queries_total', endpoint='stats') == 3
+    assert sample(text, 'db_pool_checkouts_total', bind='default') >= 4
+
+
+def test_series_are_summed_across_processes(client):
+    client.get('/user')
+    pid = os.fork()
+    if pid == 0:
+        try:
+            with app.test_client() as child:
+                child.get('/user')
+                child.get('/user')
+            metrics.publish()
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+
+    text = client.get('/metrics').get_data(as_text=True)
+    assert sample(text, 'http_request_duration_seconds_count', endpoint='handle_hello') == 3
+    # Gauges of the exited worker are dropped and its counters folded into one set of rows
+    assert sample(text, 'db_pool_size', bind='default') == app.config.get('SQLALCHEMY_POOL_SIZE', 5)
+    assert {pid for (pid,) in metrics.store._connect().execute('SELECT DISTINCT pid FROM samples')} == {0, os.getpid()}
+    client.get('/user')
+    text = client.get('/metrics').get_data(as_text=True)
+    assert sample(text, 'http_request_duration_seconds_count', endpoint='handle_hello') == 4
+
+
+def test_slow_queries_and_profiles(client):
+    metrics.slow_query_seconds = 0
+    metrics.profile_token = 'secret'
+    metrics.profile_interval = 0.0005
+    client.post('/api/auth/register', json={'email': 'p@example.com', 'name': 'P', 'password': 'x'})
+
+    rv = client.post('/sessions/batch', json=[{'user_id': 1, 'score': n} for n in range(2000)],
+                     headers={'X-Profile': 'secret'})
+    profile_id = rv.headers['X-Profile-Id']
+    assert client.get(f'/metrics/profiles/{profile_id}').status_code == 404
+    folded = client.get(f'/metrics/profiles/{profile_id}', headers={'X-Profile': 'secret'}).get_data(as_text=True)
+    assert 'create_sessions_batch' in folded
+    assert 'X-Profile-Id' not in client.get('/user', headers={'X-Profile': 'wrong'}).headers
+
+    assert client.get('/metrics/slow').status_code == 404
+    slow = client.get('/metrics/slow', headers={'X-Profile': 'secret'}).get_json()
+    assert any(s['endpoint'] == 'create_sessions_batch' and 'INSERT INTO game_session' in s['statement'] for s in slow)
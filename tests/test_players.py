@@ -0,0 +1,57 @@
+from sqlalchemy import event
+
+from app import app, db
+from cache import response_cache
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, *args):
+        self.count += 1
+
+    def __enter__(self):
+        with app.app_context():
+            self.engine = db.engine
+        event.listen(self.engine, 'before_cursor_execute', self)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(self.engine, 'before_cursor_execute', self)
+
+
+def register(client):
+    rv = client.post('/api/auth/register', json={'email': 'p@example.com', 'name': 'Pat', 'password': 'x'})
+    return rv.get_json()
+
+
+def test_player_in_one_query(client):
+    uid = register(client)['user']['id']
+    client.post('/sessions/batch', json=[{'user_id': uid, 'score': s} for s in range(8)])
+    response_cache.clear()
+
+    with QueryCounter() as queries:
+        rv = client.get(f'/api/players/{uid}', query_string={'sessions': 3})
+    assert queries.count == 1
+    data = rv.get_json()
+    assert data['email'] == 'p@example.com'
+    assert data['profile']['display_name'] == 'Pat'
+    assert data['stats']['total_games'] == 8
+    assert [s['score'] for s in data['recent_sessions']] == [7, 6, 5]
+
+
+def test_player_without_sessions(client):
+    uid = register(client)['user']['id']
+    data = client.get(f'/api/players/{uid}').get_json()
+    assert data['recent_sessions'] == [] and data['stats']['total_games'] == 0
+    assert client.get('/api/players/999').status_code == 404
+
+
+def test_me_in_one_query(client):
+    token = register(client)['token']
+    with QueryCounter() as queries:
+        rv = client.get('/api/auth/me', headers={'Authorization': f'Bearer {token}'})
+    assert rv.status_code == 200
+    assert rv.get_json()['display_name'] == 'Pat'
+    assert queries.count == 1
@@ -0,0 +1,72 @@
+import re
+from sqlalchemy import event
+
+from app import app, db
+from leaderboard import ensure_loaded
+
+
+def capture(client, requests):
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if executemany:
+            parameters = parameters[0]
+        statements.append((statement, parameters))
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        for method, url, kwargs in requests:
+            getattr(client, method)(url, **kwargs)
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
+    return statements
+
+
+def full_scans(statement, parameters):
+    with app.app_context():
+        connection = db.engine.raw_connection()
+        try:
+            plan = [row[-1] for row in connection.cursor().execute(f'EXPLAIN QUERY PLAN {statement}', parameters)]
+        finally:
+            connection.close()
+    # An unfiltered walk in primary-key order stops at LIMIT, so it is not a full scan
+    bounded = (re.search(r'\bLIMIT\b', statement) and not re.search(r'\bWHERE\b', statement)
+               and not any('TEMP B-TREE' in line for line in plan))
+    return [line for line in plan
+            if re.match(r'SCAN \w+$', line) and not bounded]
+
+
+def test_api_queries_use_indexes(client):
+    rv = client.post('/api/auth/register', json={'email': 'p@example.com', 'name': 'P', 'password': 'x'})
+    uid = rv.get_json()['user']['id']
+    client.post('/sessions/batch', json=[{'user_id': uid, 'score': s} for s in range(50)])
+    with app.app_context():
+        ensure_loaded()
+
+    statements = capture(client, [
+        ('post', '/api/auth/login', {'json': {'email': 'p@example.com', 'password': 'x'}}),
+        ('post', '/sessions', {'json': {'user_id': uid, 'score': 7}}),
+        ('post', '/sessions/batch', {'json': [{'user_id': uid, 'score': 3}]}),
+        ('get', '/sessions', {'query_string': {'limit': 10}}),
+        ('get', '/sessions', {'query_string': {'cursor': 10, 'limit': 10}}),
+        ('get', '/sessions', {'query_string': {'user_id': uid, 'limit': 10}}),
+        ('get', '/sessions', {'query_string': {'user_id': uid, 'min_score': 10, 'max_score': 20}}),
+        ('get', '/sessions', {'query_string': {'user_id': uid, 'from': '2000-01-01', 'to': '2999-01-01'}}),
+        ('get', '/sessions/1', {}),
+        ('put', '/sessions/1', {'json': {'score': 9}}),
+        ('delete', '/sessions/2', {}),
+        # The top-scoring session, so the maxima are recovered from the indexes
+        ('put', '/sessions/50', {'json': {'score': 0, 'level_reached': 1}}),
+        ('delete', '/sessions/49', {}),
+        ('get', '/stats/global', {}),
+        ('get', '/stats/global', {'query_string': {'bucket': 'level'}}),
+        ('get', f'/stats/{uid}', {}),
+        ('get', '/leaderboard', {}),
+        ('get', f'/leaderboard/{uid}', {}),
+        ('get', f'/api/players/{uid}', {}),
+    ])
+    assert statements
+    offenders = {s: scans for s, p in statements if (scans := full_scans(s, p))}
+    assert not offenders, offenders
@@ -0,0 +1,78 @@
+import os
+import sys
+import json
+import subprocess
+
+SRC = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'backend', 'src'))
+
+# Replicas are plain copies of the writer's SQLite file, renamed so each read shows where it went
+PROBE = '''
+import json, shutil, sqlite3, sys
+from app import app, db
+from models import Profile
+from replicas import replicas, LAG_QUERIES
+writer, copies = sys.argv[1], sys.argv[2:]
+
+@app.get('/names')
+def names():
+    return [db.session.scalar(db.select(Profile.display_name)) for _ in range(4)]
+with app.app_context():
+    db.create_all(bind_key=None)
+client = app.test_client()
+uid = client.post('/api/auth/register', json={'email': 'a@example.com', 'name': 'writer', 'password': 'x'}).get_json()['user']['id']
+for n, path in enumerate(copies):
+    shutil.copy(writer, path)
+    with sqlite3.connect(path) as conn:
+        conn.execute('UPDATE profile SET display_name = ?', (f'replica_{n}',))
+
+def read(path='/api/players/%d' % uid, **headers):
+    rv = client.get(path, headers=headers)
+    return rv.get_json()['profile']['display_name'], rv.headers.get('X-Read-Replica')
+
+result = {'healthy': replicas.check(), 'errors': sorted(k for k, s in replicas.status.items() if s['error'])}
+result['reads'] = [read() for _ in range(3)]
+result['request_reads'] = [client.get('/names').get_json() for _ in range(2)]
+result['primary_header'] = read(**{'X-Read-Primary': '1'})
+client.post('/sessions', json={'user_id': uid, 'score': 70})
+result['fresh_stats'] = client.get('/stats/%d?fresh=1' % uid).get_json()['high_score']
+result['replica_stats'] = client.get('/stats/%d' % uid).get_json()['high_score']
+top = client.get('/leaderboard').get_json()[0]
+result['board'] = [top['display_name'], top['high_score']]
+with app.app_context():
+    result['pools'] = {key or 'writer': engine.pool.size() for key, engine in db.engines.items() if key != 'replica_2'}
+LAG_QUERIES['sqlite'] = 'SELECT 60'
+result['lagging'] = replicas.check()
+result['lagging_read'] = read()
+print(json.dumps(result))
+'''
+
+
+def test_reads_go_to_healthy_replicas(tmp_path):
+    writer = str(tmp_path / 'writer.db')
+    copies = [str(tmp_path / f'replica_{n}.db') for n in range(2)]
+    urls = [f'sqlite:///{path}' for path in copies] + [f'sqlite:///{tmp_path}/missing/replica_2.db']
+    env = dict(os.environ, DATABASE_URL=f'sqlite:///{writer}', DATABASE_REPLICA_URLS=','.join(urls),
+               CACHE_BACKEND='none', REPLICA_CHECK_INTERVAL='3600', REPLICA_MAX_LAG='5',
+               DATABASE_POOL_SIZE='7', DATABASE_REPLICA_POOL_SIZE='2', DATABASE_REPLICA_1_POOL_SIZE='3')
+    env.pop('FLASK_RUN_FROM_CLI', None)
+    out = subprocess.run([sys.executable, '-c', PROBE, writer, *copies], cwd=SRC, env=env,
+                         capture_output=True, text=True)
+    assert out.returncode == 0, out.stderr
+    result = json.loads(out.stdout)
+
+    assert result['healthy'] == ['replica_0', 'replica_1']
+    assert result['errors'] == ['replica_2']
+    assert sorted({name for name, _ in result['reads']}) == ['replica_0', 'replica_1']
+    assert all(name == key for name, key in result['reads'])
+    # Every read of a request goes to its replica; the next request takes the next one
+    assert [len(set(names)) for names in result['request_reads']] == [1, 1]
+    assert result['request_reads'][0][0] != result['request_reads'][1][0]
+    assert result['primary_header'] == ['writer', None]
+    # Writes land on the writer and ?fresh=1 reads them back from it; the copies never see them
+    assert result['fresh_stats'] == 70
+    assert result['replica_stats'] == 0
+    # The board is stamped with the current version, so it is read from the writer
+    assert result['board'] == ['writer', 70]
+    assert result['pools'] == {'writer': 7, 'replica_0': 2, 'replica_1': 3}
+    assert result['lagging'] == []
+    assert result['lagging_read'] == ['writer', None]
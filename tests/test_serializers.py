@@ -0,0 +1,55 @@
+import json
+import pickle
+import pytest
+
+from app import app, db
+from leaderboard import BoardRow
+from models import User, Profile, GameStats, GameSession
+import serializers
+from serializers import model_columns, model_encoder, dumps
+
+
+def test_encoders_match_serialize(client):
+    rv = client.post('/api/auth/register', json={'email': 'p@example.com', 'name': 'P', 'password': 'x'})
+    user_id = rv.get_json()['user']['id']
+    client.post('/sessions/batch', json=[{'user_id': user_id, 'score': n} for n in range(3)])
+    with app.app_context():
+        for model in (User, Profile, GameStats, GameSession):
+            encode = model_encoder(model)
+            rows = db.session.execute(db.select(*model_columns(model))).all()
+            objects = db.session.scalars(db.select(model)).all()
+            assert len(rows) == len(objects) > 0
+            for row, obj in zip(rows, objects):
+                assert json.loads(dumps(encode(row))) == obj.serialize()
+
+
+def test_routes_serve_the_same_shape(client):
+    rv = client.post('/api/auth/register', json={'email': 'p@example.com', 'name': 'P', 'password': 'x'})
+    user_id = rv.get_json()['user']['id']
+    session = client.post('/sessions', json={'user_id': user_id, 'score': 40}).get_json()
+    assert client.get(f"/sessions/{session['id']}").get_json() == session
+    assert client.get('/sessions').get_json() == [session]
+    assert client.get('/sessions', query_string={'fields': 'score,completed_at'}).get_json() == \
+        [{'score': 40, 'completed_at': session['completed_at']}]
+    player = client.get(f'/api/players/{user_id}').get_json()
+    assert player['recent_sessions'] == [session]
+    assert player['stats']['high_score'] == 40
+    assert client.get(f'/stats/{user_id}').get_json() == player['stats']
+
+
+def test_stdlib_fallback_matches_orjson(monkeypatch):
+    from datetime import datetime
+    value = {'b': 1, 'a': [datetime(2024, 5, 1, 12, 30, 0, 250), None, 'é'], 'big': 2 ** 70}
+    fast = json.loads(dumps(value, sort_keys=True))
+    monkeypatch.setattr(serializers, 'orjson', None)
+    assert json.loads(dumps(value, sort_keys=True)) == fast
+    assert fast['a'][0] == '2024-05-01T12:30:00.000250'
+
+
+def test_board_rows_are_records():
+    row = BoardRow('P', 10, 2, 3)
+    assert pickle.loads(pickle.dumps(row)) == row
+    assert row.replace(high_score=11).as_dict() == {
+        'display_name': 'P', 'high_score': 11, 'total_games': 2, 'levels_completed': 3}
+    with pytest.raises(AttributeError):
+        row.extra = 1
@@ -0,0 +1,81 @@
+import json
+import pytest
+
+from app import app, db
+from models import GameSession
+from simulator import Simulator, load_levels, session_validator, OK, TOO_LONG, BAD_LEVEL, TOO_MANY_KILLS, SCORE_TOO_HIGH
+
+
+@pytest.fixture()
+def client(client):
+    session_validator.configure(dict(app.config, SESSION_VALIDATION='reject'))
+    yield client
+    session_validator.configure(app.config)
+
+
+def register(client, n):
+    rv = client.post('/api/auth/register',
+                     json={'email': f'p{n}@example.com', 'name': f'Player {n}', 'password': 'x'})
+    return rv.get_json()['user']['id']
+
+
+def test_levels_are_read_from_game_config():
+    levels = load_levels()
+    assert levels[0]['zombieHealth'] == 30
+    assert levels[0]['serverCols'] == [1, 2, 3, 4, 5, 6, 7, 8]
+
+
+def test_kill_bound_follows_turret_fire_rate():
+    level = load_levels()[0]
+    sim = Simulator([level])
+    # Each armed column finishes one zombie every zombieHealth / bulletDamage volleys
+    volleys_per_kill = level['zombieHealth'] // level['bulletDamage']
+    kills = sim.max_kills([1, 1, 1, 1], [0, 2 * volleys_per_kill - 1, 2 * volleys_per_kill, 600])
+    assert list(kills) == [0, 0, len(level['serverCols']), 600 // (2 * volleys_per_kill) * len(level['serverCols'])]
+    bounds = sim.max_kills([1] * 300, range(300))
+    assert all(a <= b for a, b in zip(bounds, bounds[1:]))
+
+
+def test_check_codes():
+    sim = Simulator(load_levels())
+    codes = sim.check(
+        score=[100, 10 ** 6, 0, 0, 0],
+        level=[1, 1, 1, 9, 1],
+        kills=[1, 1, 500, 0, 0],
+        duration=[60, 60, 60, 60, 10 ** 6],
+        points_per_zombie=100,
+    )
+    assert list(codes) == [OK, SCORE_TOO_HIGH, TOO_MANY_KILLS, BAD_LEVEL, TOO_LONG]
+
+
+def test_ingestion_rejects_implausible_sessions(client):
+    uid = register(client, 1)
+    honest = {'user_id': uid, 'score': 400, 'level_reached': 1, 'zombies_defeated': 4, 'duration_seconds': 60}
+    cheat = dict(honest, score=10 ** 7)
+
+    assert client.post('/sessions', json=honest).status_code == 201
+    rv = client.post('/sessions', json=cheat)
+    assert rv.status_code == 422
+
+    rv = client.post('/sessions/batch', json=[honest, cheat, dict(honest, zombies_defeated=10 ** 4)])
+    assert rv.status_code == 207
+    assert [r['status'] for r in rv.get_json()['results']] == [201, 422, 422]
+
+    session_id = client.get('/sessions').get_json()[0]['id']
+    assert client.put(f'/sessions/{session_id}', json={'duration_seconds': 1}).status_code == 422
+    assert client.get(f'/stats/{uid}', query_string={'fresh': 1}).get_json()['high_score'] == 400
+
+
+def test_audit_command_reports_stored_cheats(client):
+    uid = register(client, 1)
+    with app.app_context():
+        db.session.add_all([
+            GameSession(user_id=uid, score=300, level_reached=1, zombies_defeated=3, duration_seconds=60),
+            GameSession(user_id=uid, score=10 ** 6, level_reached=1, zombies_defeated=3, duration_seconds=60),
+        ])
+        db.session.commit()
+    result = app.test_cli_runner().invoke(args=['audit-sessions', '--chunk', '1'])
+    assert result.exit_code == 0
+    lines = [json.loads(line) for line in result.stdout.splitlines()]
+    assert [line['msg'] for line in lines] == ['score is not reachable in duration_seconds']
+    assert '1 of 2' in result.stderr
@@ -0,0 +1,107 @@
+import multiprocessing
+from collections import Counter
+import numpy as np
+import pytest
+
+from app import app, db
+from rollups import backfill
+from sketches import PLAYERS, ScoreSketches, score_sketches
+
+
+@pytest.fixture()
+def client(client):
+    score_sketches.reset()
+    yield client
+    score_sketches.stop()
+    score_sketches.reset()
+
+
+def register(client, count):
+    return [client.post('/api/auth/register', json={'email': f'p{n}@example.com', 'name': f'P{n}', 'password': 'x'})
+            .get_json()['user']['id'] for n in range(count)]
+
+
+def test_quantiles_are_within_the_relative_error():
+    sketch = ScoreSketches()
+    scores = np.random.default_rng(7).lognormal(8, 2, 20000).astype(np.int64)
+    buckets = sketch.buckets(scores)
+    assert buckets.tolist() == [sketch.bucket(score) for score in scores.tolist()]
+    sketch.apply({(1, bucket): count for bucket, count in zip(*np.unique(buckets, return_counts=True))})
+
+    qs = [0, 0.01, 0.25, 0.5, 0.9, 0.99, 1]
+    games, estimates = sketch.quantiles(qs, level=1)
+    assert games == len(scores)
+    for q, estimate in zip(qs, estimates):
+        exact = np.quantile(scores, q, method='lower')
+        assert abs(estimate - exact) <= 0.01 * exact + 1
+    _, percentile = sketch.percentile(int(np.quantile(scores, 0.9)))
+    assert 89 <= percentile <= 91
+    # Small scores get buckets of their own
+    assert sketch.bucket(-5) == sketch.bucket(0) == 0
+    assert len({sketch.bucket(score) for score in range(1, 51)}) == 50
+    assert sketch.quantiles([0.5], level=2) == (0, [None])
+
+
+def test_session_writes_keep_the_distribution(client):
+    uids = register(client, 4)
+    ids = [client.post('/sessions', json={'user_id': uids[n % 4], 'score': n * 10, 'level_reached': 1 + n % 2})
+           .get_json()['id'] for n in range(1, 101)]
+    rv = client.get('/stats/distribution?q=0,0.5,1')
+    assert rv.get_json()['games'] == 100
+    assert [q['score'] for q in rv.get_json()['quantiles']] == pytest.approx([10, 500, 1000], rel=0.01)
+    assert client.get('/stats/distribution?level=2').get_json()['games'] == 50
+    assert client.get('/stats/distribution?q=1.5').status_code == 400
+
+    # Ranked among the players' high scores (970, 980, 990), not among the games
+    rv = client.get(f'/stats/{uids[0]}/percentile').get_json()
+    assert rv['high_score'] == 1000 and rv['players'] == 4 and rv['percentile'] == 87.5
+    assert client.get('/stats/999/percentile').status_code == 404
+
+    # Players 0 and 3 lose their best games: 960 against 970, 980 and 950
+    client.put(f'/sessions/{ids[-1]}', json={'score': 5})
+    client.delete(f'/sessions/{ids[-2]}')
+    rv = client.get('/stats/distribution?q=0,1').get_json()
+    assert rv['games'] == 99 and [q['score'] for q in rv['quantiles']] == pytest.approx([5, 980], rel=0.01)
+    # 960 and 970 are less than 2α apart and may share a bucket, which counts as half below
+    assert client.get(f'/stats/{uids[0]}/percentile').get_json()['percentile'] in (37.5, 50)
+    # A batch write raises player 3 above everyone
+    client.post('/sessions/batch', json=[{'user_id': uids[3], 'score': 2000}])
+    assert client.get(f'/stats/{uids[3]}/percentile').get_json()['percentile'] == 87.5
+    assert client.get(f'/stats/{uids[0]}/percentile').get_json()['players'] == 4
+
+    # Persisted, then read back as another process would
+    with app.app_context():
+        score_sketches.flush()
+        expected = score_sketches.counts().tolist(), score_sketches.counts(PLAYERS).tolist()
+        score_sketches.reset()
+        score_sketches.ensure_loaded()
+        assert (score_sketches.counts().tolist(), score_sketches.counts(PLAYERS).tolist()) == expected
+        backfill()
+        score_sketches.flush()
+        assert (score_sketches.counts().tolist(), score_sketches.counts(PLAYERS).tolist()) == expected
+
+
+def write_scores(scores, out):
+    with app.app_context():
+        db.engine.dispose()
+        score_sketches.apply(Counter((1, score_sketches.bucket(score)) for score in scores))
+        score_sketches.flush()
+        db.session.remove()
+    out.put(True)
+
+
+def test_worker_sketches_merge(client):
+    with app.app_context():
+        db.engine.dispose()
+    ctx = multiprocessing.get_context('fork')
+    out = ctx.Queue()
+    procs = [ctx.Process(target=write_scores, args=(range(n, 1000, 4), out)) for n in range(4)]
+    for p in procs:
+        p.start()
+    assert all(out.get(timeout=60) for _ in procs)
+    for p in procs:
+        p.join()
+    with app.app_context():
+        score_sketches.ensure_loaded()
+    games, (median,) = score_sketches.quantiles([0.5])
+    assert games == 1000 and median == pytest.approx(500, rel=0.01)
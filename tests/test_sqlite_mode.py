@@ -0,0 +1,103 @@
+import os
+import sys
+import json
+import fcntl
+import subprocess
+import pytest
+
+SRC = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'backend', 'src'))
+from app import app, db
+from models import GameSession
+from sqlite_mode import SQLiteMode
+
+PROBE = '''
+import json, multiprocessing, threading
+from sqlalchemy import event, text
+from app import app, db
+from models import GameSession, GameStats
+with app.app_context():
+    db.create_all()
+    pragmas = {name: db.session.execute(text(f'PRAGMA {name}')).scalar()
+               for name in ('journal_mode', 'synchronous', 'busy_timeout', 'temp_store', 'cache_size')}
+    db.session.remove()
+    db.engine.dispose()
+client = app.test_client()
+uids = [client.post('/api/auth/register', json={'email': f'p{n}@example.com', 'name': f'P{n}', 'password': 'x'})
+        .get_json()['user']['id'] for n in range(4)]
+first = client.post('/sessions', json={'user_id': uids[0], 'score': 5})
+errors = [client.post('/sessions', json={'user_id': 999, 'score': 1}).status_code,
+          client.post('/sessions', json={'user_id': uids[0], 'score': -1}).status_code]
+
+def play(worker, statuses):
+    c = app.test_client()
+    for n in range(25):
+        statuses.append(c.post('/sessions', json={'user_id': uids[worker % 4], 'score': n}).status_code)
+
+def process(worker, out):
+    commits = []
+    with app.app_context():
+        event.listen(db.engine, 'commit', lambda conn: commits.append(1))
+    statuses = []
+    threads = [threading.Thread(target=play, args=(worker * 8 + t, statuses)) for t in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    out.put((statuses, len(commits)))
+
+with app.app_context():
+    db.engine.dispose()
+ctx = multiprocessing.get_context('fork')
+out = ctx.Queue()
+procs = [ctx.Process(target=process, args=(w, out)) for w in range(2)]
+for p in procs:
+    p.start()
+done = [out.get(timeout=120) for _ in procs]
+for p in procs:
+    p.join()
+with app.app_context():
+    games = db.session.query(GameSession).count()
+    total = sum(s.total_games for s in db.session.query(GameStats))
+print(json.dumps({'pragmas': pragmas, 'first': [first.status_code, sorted(first.get_json())], 'errors': errors,
+                  'statuses': sorted({s for statuses, _ in done for s in statuses}),
+                  'commits': sum(c for _, c in done), 'games': games, 'total': total}))
+'''
+
+
+def test_production_mode_batches_concurrent_writes(tmp_path):
+    env = dict(os.environ, DATABASE_URL=f"sqlite:///{tmp_path / 'edge.db'}", SQLITE_PRODUCTION='1',
+               CACHE_BACKEND='none', METRICS_ENABLED='0')
+    env.pop('FLASK_RUN_FROM_CLI', None)
+    out = subprocess.run([sys.executable, '-c', PROBE], cwd=SRC, env=env, capture_output=True, text=True, timeout=300)
+    assert out.returncode == 0, out.stderr
+    result = json.loads(out.stdout)
+
+    assert result['pragmas'] == {'journal_mode': 'wal', 'synchronous': 1, 'busy_timeout': 5000,
+                                 'temp_store': 2, 'cache_size': -65536}
+    assert result['first'] == [201, ['completed_at', 'duration_seconds', 'id', 'level_reached', 'score',
+                                     'user_id', 'zombies_defeated']]
+    assert result['errors'] == [404, 400]
+    assert result['statuses'] == [201]
+    assert result['games'] == result['total'] == 401
+    # 2 processes x 8 threads x 25 games, fewer commits than games
+    assert result['commits'] < 400
+
+
+def test_timed_out_submissions_are_withdrawn(client, tmp_path):
+    uid = client.post('/api/auth/register', json={'email': 'p@example.com', 'name': 'P', 'password': 'x'}
+                      ).get_json()['user']['id']
+    mode = SQLiteMode()
+    mode.app = app
+    mode.timeout = 0.2
+    mode.lock_path = str(tmp_path / 'write.lock')
+    # Another worker holds the write turn past the request's timeout
+    with open(mode.lock_path, 'a') as other:
+        fcntl.flock(other, fcntl.LOCK_EX)
+        with pytest.raises(TimeoutError):
+            mode.write({'user_id': uid, 'score': 7})
+        fcntl.flock(other, fcntl.LOCK_UN)
+    body, status = mode.write({'user_id': uid, 'score': 8})
+    assert status == 201 and body['score'] == 8
+    with app.app_context():
+        # The 503'd game was never written
+        assert [s.score for s in db.session.query(GameSession)] == [8]
@@ -0,0 +1,59 @@
+import os
+import sys
+import json
+import subprocess
+import tempfile
+
+SRC = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'backend', 'src'))
+sys.path.insert(0, SRC)
+os.environ.setdefault('DATABASE_URL', f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'test.db')}")
+from cache import SharedBackend
+
+PROBE = '''
+import json, sys
+from app import app, db
+with app.app_context():
+    db.create_all()
+loaded = lambda: sorted(m for m in ('flask_admin', 'flask_migrate', 'flask_swagger') if m in sys.modules)
+before = loaded()
+client = app.test_client()
+statuses = {path: client.get(path).status_code for path in ('/user', '/admin/', '/admin/user/', '/swagger.json')}
+spec = client.get('/swagger.json').get_json()
+print(json.dumps({'before': before, 'after': loaded(), 'statuses': statuses, 'spec': sorted(spec)}))
+'''
+
+
+def probe(**env):
+    env = dict(os.environ, **env)
+    env.pop('FLASK_RUN_FROM_CLI', None)
+    out = subprocess.run([sys.executable, '-c', PROBE], cwd=SRC, env=env, check=True, capture_output=True, text=True)
+    return json.loads(out.stdout)
+
+
+def test_optional_subsystems_load_on_first_use():
+    result = probe(EAGER_SUBSYSTEMS='')
+    assert result['before'] == []
+    assert result['after'] == ['flask_admin', 'flask_swagger']
+    assert result['statuses'] == {'/user': 200, '/admin/': 200, '/admin/user/': 200, '/swagger.json': 200}
+    assert 'paths' in result['spec']
+
+
+def test_eager_subsystems_load_with_the_app():
+    result = probe(EAGER_SUBSYSTEMS='admin,migrate,swagger')
+    assert result['before'] == ['flask_admin', 'flask_migrate', 'flask_swagger']
+    assert result['statuses']['/admin/'] == 200
+
+
+def test_shared_backend_reconnects_after_fork(tmp_path):
+    backend = SharedBackend(str(tmp_path / 'cache.db'))
+    parent = backend._connect()
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.write(write, b'1' if backend._connect() is not parent else b'0')
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+    assert os.read(read, 1) == b'1'
+    assert backend._connect() is parent
@@ -0,0 +1,110 @@
+import threading
+import time
+import pytest
+
+from app import app, db
+from models import GameSession
+from writebehind import ORPHAN_SECONDS, StatsJournal, write_behind
+
+
+@pytest.fixture()
+def client(client, tmp_path):
+    write_behind.enabled = True
+    write_behind.journal = StatsJournal(str(tmp_path / 'journal.db'))
+    write_behind.interval = 3600
+    yield client
+    write_behind.stop()
+    write_behind.enabled = False
+
+
+def test_deltas_are_applied_on_flush(client):
+    rv = client.post('/api/auth/register', json={'email': 'p@example.com', 'name': 'P', 'password': 'x'})
+    uid = rv.get_json()['user']['id']
+    for score, level in ((10, 2), (40, 1), (5, 3)):
+        rv = client.post('/sessions', json={'user_id': uid, 'score': score, 'level_reached': level,
+                                            'zombies_defeated': 2})
+        assert rv.status_code == 201
+
+    assert client.get(f'/stats/{uid}').get_json()['total_games'] == 0
+    fresh = client.get(f'/stats/{uid}', query_string={'fresh': 1}).get_json()
+    assert fresh['total_games'] == 3 and fresh['high_score'] == 40
+    assert client.get('/stats/lag').get_json()['pending'] == 3
+
+    assert write_behind.flush() == 3
+    stats = client.get(f'/stats/{uid}').get_json()
+    assert stats['total_games'] == 3
+    assert stats['total_score'] == 55
+    assert stats['high_score'] == 40
+    assert stats['levels_completed'] == 3
+    assert stats['zombies_defeated'] == 6
+    assert client.get('/stats/lag').get_json()['pending'] == 0
+    assert client.get(f'/stats/{uid}', query_string={'fresh': 1}).get_json()['total_games'] == 3
+    assert client.get('/stats/global').get_json()['totals']['total_score'] == 55
+
+
+def test_rows_left_by_a_crash_are_counted_once(client):
+    rv = client.post('/api/auth/register', json={'email': 'p@example.com', 'name': 'P', 'password': 'x'})
+    uid = rv.get_json()['user']['id']
+    client.post('/sessions', json={'user_id': uid, 'score': 10})
+    client.post('/sessions', json={'user_id': uid, 'score': 20})
+
+    # Folded in, then the process died before the rows left the journal
+    drain = write_behind.journal.drain
+    write_behind.journal.drain = lambda apply, limit: drain(lambda rows: apply(rows) and 0, limit)
+    assert write_behind.flush() == 0
+    write_behind.journal.drain = drain
+    assert client.get('/stats/lag').get_json()['pending'] == 2
+    assert client.get(f'/stats/{uid}', query_string={'fresh': 1}).get_json()['total_games'] == 2
+    assert write_behind.flush() == 2
+    assert client.get(f'/stats/{uid}').get_json()['total_score'] == 30
+
+    # A delta journaled for a session that never committed is dropped once it is old enough
+    with app.app_context():
+        session = GameSession(user_id=uid, score=99)
+        db.session.add(session)
+        db.session.flush()
+        write_behind.journal.append(session)
+        db.session.rollback()
+    assert client.get(f'/stats/{uid}', query_string={'fresh': 1}).get_json()['total_games'] == 2
+    assert write_behind.flush() == 0
+    write_behind.journal._connect().execute('UPDATE pending SET queued_at = queued_at - ?', (ORPHAN_SECONDS + 1,))
+    assert write_behind.flush() == 1
+    assert client.get(f'/stats/{uid}').get_json()['total_games'] == 2
+
+
+def test_sessions_are_submitted_while_a_flush_applies(client, monkeypatch):
+    rv = client.post('/api/auth/register', json={'email': 'p@example.com', 'name': 'P', 'password': 'x'})
+    uid = rv.get_json()['user']['id']
+    apply = write_behind._apply
+
+    def slow(rows):
+        # Long enough for requests to flush their sessions meanwhile
+        time.sleep(0.02)
+        return apply(rows)
+
+    monkeypatch.setattr(write_behind, '_apply', slow)
+    stop = threading.Event()
+    errors = []
+
+    def flusher():
+        while not stop.is_set():
+            try:
+                write_behind.flush()
+            except Exception as error:
+                errors.append(error)
+
+    thread = threading.Thread(target=flusher)
+    thread.start()
+    try:
+        began = time.monotonic()
+        statuses = [client.post('/sessions', json={'user_id': uid, 'score': n}).status_code for n in range(30)]
+        elapsed = time.monotonic() - began
+    finally:
+        stop.set()
+        thread.join()
+    assert statuses == [201] * 30 and not errors
+    # Neither side waited out a busy timeout on the other
+    assert elapsed < 5
+    write_behind.flush()
+    stats = client.get(f'/stats/{uid}').get_json()
+    assert stats['total_games'] == 30 and stats['total_score'] == sum(range(30))